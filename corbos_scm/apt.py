@@ -0,0 +1,160 @@
+# Copyright (c) 2021 Marcus Schäfer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""
+Shell command snippets and configuration for the apt tooling
+inside of the container
+"""
+import os
+import re
+import shlex
+from tempfile import TemporaryDirectory
+from typing import (
+    Dict, List, Optional
+)
+
+from corbos_scm.exceptions import CSCMPackageNameError
+
+# package names and versions as allowed by the Debian policy
+# manual, sections 5.6.1 and 5.6.12
+PACKAGE_NAME = re.compile(r'[a-z0-9][a-z0-9.+-]+')
+PACKAGE_VERSION = re.compile(r'[0-9A-Za-z][0-9A-Za-z.+~:-]*')
+
+
+def get_update_command() -> List[str]:
+    """
+    Command to update the package indexes
+
+    :return: command and arguments
+
+    :rtype: list
+    """
+    return ['apt', 'update']
+
+
+def get_source_command(
+    package: str, version: Optional[str] = None,
+    bandwidth_limit: Optional[int] = None
+) -> List[str]:
+    """
+    Command to download the source files of the given package
+    into the current working directory. The sources are not
+    unpacked, apt verifies the downloaded files against the
+    checksums of the package index
+
+    :param str package: source or binary package name
+    :param str version: exact version, None for the candidate
+    :param int bandwidth_limit: download rate limit in kB/s or None
+
+    :return: command and arguments
+
+    :rtype: list
+    """
+    limit_options = []
+    if bandwidth_limit:
+        for scheme in ('http', 'https'):
+            limit_options += [
+                '-o', f'Acquire::{scheme}::Dl-Limit={bandwidth_limit}'
+            ]
+    check_package(package, version)
+    return quote(
+        ['apt'] + limit_options + [
+            'source', '--download-only',
+            f'{package}={version}' if version else package
+        ]
+    )
+
+
+def get_showsrc_command(package: str) -> List[str]:
+    """
+    Command to print the source records of the given package
+
+    :param str package: source or binary package name
+
+    :return: command and arguments
+
+    :rtype: list
+    """
+    check_package(package)
+    return quote(['apt-cache', 'showsrc', package])
+
+
+def check_package(package: str, version: Optional[str] = None) -> None:
+    """
+    Check package name and version before they are passed to
+    the shell of the container
+
+    :param str package: source or binary package name
+    :param str version: exact version or None
+
+    :raises CSCMPackageNameError: if name or version is not valid
+    """
+    if not PACKAGE_NAME.fullmatch(package):
+        raise CSCMPackageNameError(f'Invalid package name: {package!r}')
+    if version and not PACKAGE_VERSION.fullmatch(version):
+        raise CSCMPackageNameError(f'Invalid package version: {version!r}')
+
+
+def quote(command: List[str]) -> List[str]:
+    """
+    Quote command arguments for the shell of the container,
+    commands are run via bash -c
+
+    :param list command: command and arguments
+
+    :return: shell quoted command and arguments
+
+    :rtype: list
+    """
+    return [shlex.quote(argument) for argument in command]
+
+
+class AptProxyConfig:
+    """
+    apt configuration directing the http traffic of a container
+    through the caching proxy
+
+    The configuration file is shared with the container as an
+    additional apt.conf.d snippet, see get_volumes. Repositories
+    accessed via https are not proxied
+    """
+    config_path = '/etc/apt/apt.conf.d/99corbos_scm_proxy'
+
+    def __init__(self, uri: str) -> None:
+        """
+        Write apt configuration for the given proxy
+
+        :param str uri: proxy URI as reachable from the container
+        """
+        self.uri = uri
+        self.config_dir = TemporaryDirectory()
+        self.config_file = os.sep.join([self.config_dir.name, 'proxy.conf'])
+        with open(self.config_file, 'w') as config:
+            config.write(f'Acquire::http::Proxy "{uri}";\n')
+
+    def get_volumes(self) -> Dict[str, str]:
+        """
+        Configuration file to share with the container
+
+        :return: host file to container path mapping
+
+        :rtype: dict
+        """
+        return {self.config_file: self.config_path}
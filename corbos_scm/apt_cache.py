@@ -0,0 +1,129 @@
+# Copyright (c) 2021 Marcus Schäfer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+import os
+import time
+import hashlib
+from typing import (
+    Dict, List
+)
+
+from corbos_scm.lock import FileLock
+
+
+class AptCache:
+    """
+    Host side apt index cache shared between service calls
+
+    The package index lists and the apt cache of the container
+    are mounted from the cache directory. An update of the index
+    is only required if the last update is older than the ttl.
+    If an update is required it runs against the existing lists
+    such that apt only fetches what has changed. Each container
+    image has its own index as the configured apt sources differ
+    between images. Updates take an exclusive lock, readers of
+    the index take a shared lock
+    """
+    lists_path = '/var/lib/apt/lists'
+    archives_path = '/var/cache/apt'
+    stamp_name = 'corbos_scm.stamp'
+
+    def __init__(
+        self, cache_dir: str, container: str, ttl: int = 3600
+    ) -> None:
+        """
+        Setup apt cache directories
+
+        :param str cache_dir: base cache directory
+        :param str container: name of the container image using the cache
+        :param int ttl: time in seconds the index is considered fresh
+        """
+        self.ttl = ttl
+        self.root = os.sep.join(
+            [
+                cache_dir, 'apt',
+                hashlib.sha256(container.encode()).hexdigest()
+            ]
+        )
+        self.lists_dir = os.sep.join([self.root, 'lists'])
+        self.archives_dir = os.sep.join([self.root, 'cache'])
+        self.lock_file = os.sep.join([self.root, 'apt.lock'])
+        os.makedirs(self.lists_dir, exist_ok=True)
+        os.makedirs(self.archives_dir, exist_ok=True)
+
+    def get_volumes(self) -> Dict[str, str]:
+        """
+        Cache directories to share with the container
+
+        :return: host directory to mount point mapping
+
+        :rtype: dict
+        """
+        return {
+            self.lists_dir: self.lists_path,
+            self.archives_dir: self.archives_path
+        }
+
+    def get_update_command(self) -> List[str]:
+        """
+        Command to update the index and record the update time
+
+        :return: command and arguments
+
+        :rtype: list
+        """
+        return [
+            'apt', 'update', '&&',
+            'touch', os.sep.join([self.lists_path, self.stamp_name])
+        ]
+
+    def is_fresh(self) -> bool:
+        """
+        Check if the last index update is within the ttl
+
+        :return: True if no update is required
+
+        :rtype: bool
+        """
+        stamp_file = os.sep.join([self.lists_dir, self.stamp_name])
+        try:
+            return time.time() - os.path.getmtime(stamp_file) < self.ttl
+        except OSError:
+            return False
+
+    def update_lock(self) -> FileLock:
+        """
+        Lock to hold while checking for and running an index update
+
+        :return: exclusive FileLock
+
+        :rtype: FileLock
+        """
+        return FileLock(self.lock_file)
+
+    def read_lock(self) -> FileLock:
+        """
+        Lock to hold while the index is used
+
+        :return: shared FileLock
+
+        :rtype: FileLock
+        """
+        return FileLock(self.lock_file, exclusive=False)
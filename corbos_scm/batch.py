@@ -0,0 +1,667 @@
+# Copyright (c) 2021 Marcus Schäfer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""
+Usage:
+    corbos_scm_batch --registry=<uri> --container=<name> --outdir=<dir>
+        (--package=<name>... | --package-list=<file>)
+        [--cache-dir=<directory>]
+        [--image-ttl=<seconds>]
+        [--apt-ttl=<seconds>]
+        [--timeout=<seconds>]
+        [--metrics=<file>]
+        [--workers=<number>]
+        [--host-limit=<number>]
+        [--bandwidth-limit=<kbytes>]
+        [--summary=<file>]
+        [--apt-proxy=<uri>]
+        [--apt-proxy-hosts=<list>]
+    corbos_scm_batch --mirror=<uri> --distribution=<name> --outdir=<dir>
+        (--package=<name>... | --package-list=<file>)
+        [--components=<list>]
+        [--keyring=<file>]
+        [--cache-dir=<directory>]
+        [--apt-ttl=<seconds>]
+        [--timeout=<seconds>]
+        [--metrics=<file>]
+        [--workers=<number>]
+        [--host-limit=<number>]
+        [--bandwidth-limit=<kbytes>]
+        [--summary=<file>]
+    corbos_scm_batch -h | --help
+    corbos_scm_batch --version
+
+Options:
+    --package=<name>
+        Name of package to fetch, can be specified multiple times.
+        The sources are stored below <dir>/<name>
+
+    --package-list=<file>
+        File with one package per line. An optional second column
+        specifies the output directory for this package. Relative
+        paths are relative to <dir>. Lines starting with '#' are
+        ignored
+
+    --registry=<uri>
+        Container registry URI. A comma separated list of
+        registries is spread over the workers
+
+    --container=<name>
+        Container name to pull. The container is expected to
+        contain the Debian/Ubuntu development tools
+
+    --mirror=<uri>
+        Debian/Ubuntu package mirror URI to fetch the sources from
+        without a container. A comma separated list of mirrors is
+        spread over the workers
+
+    --distribution=<name>
+        Distribution name on the mirror, e.g hirsute
+
+    --components=<list>
+        Comma separated list of mirror components to search
+        for the packages [default: main]
+
+    --keyring=<file>
+        Keyring to verify the signature of the mirror InRelease
+        file with gpgv. If not set the signature is not checked
+
+    --outdir=<dir>
+        Base output directory
+
+    --cache-dir=<directory>
+        Directory to store cache data shared between service
+        calls on the same host. If not set no caching takes place
+
+    --image-ttl=<seconds>
+        Time in seconds a pulled container image is considered
+        fresh without asking the registry [default: 3600]
+
+    --apt-ttl=<seconds>
+        Time in seconds the package index cached below --cache-dir
+        is used without running apt update, or without checking
+        the --mirror for an updated Sources index [default: 3600]
+
+    --timeout=<seconds>
+        Maximum time in seconds all commands run by the service
+        may take in sum. A command still running at that time is
+        terminated together with its child processes and the
+        service fails. If not set there is no limit
+
+    --metrics=<file>
+        Prometheus textfile collector file to merge the metrics of
+        this run into, e.g. pulls performed and skipped, command
+        and phase durations, downloaded bytes and failures by
+        error type. Concurrent runs update the file safely
+
+    --workers=<number>
+        Number of packages fetched concurrently, each by its own
+        corbos_scm process. Packages known to be small are fetched
+        first. With one worker and a container all packages are
+        fetched in one container session [default: 1]
+
+    --host-limit=<number>
+        Maximum number of concurrent fetches from the same
+        registry or mirror. If not set only --workers applies
+
+    --bandwidth-limit=<kbytes>
+        Maximum download rate in kB/s of all workers together.
+        The limit is split evenly between the workers
+
+    --summary=<file>
+        Write status, duration and size of each package as JSON
+        to file. The same summary is printed as a table
+
+    --apt-proxy=<uri>
+        URI of a corbos_scm_proxy as reachable from the containers.
+        The apt http traffic of the containers is sent through
+        this caching proxy. With --cache-dir the proxy is started
+        on this host if nothing listens on the port of the URI yet
+
+    --apt-proxy-hosts=<list>
+        Comma separated list of the archive hosts the started
+        proxy passes requests to, subdomains included. This has
+        to cover the http repositories of the containers. If not
+        set the default of corbos_scm_proxy applies
+"""
+import os
+import sys
+import json
+import time
+import logging
+from pathlib import Path
+from contextlib import ExitStack
+from typing import (
+    NamedTuple, List, Dict, Optional
+)
+import docopt
+
+from corbos_scm.version import __version__
+from corbos_scm.command import (
+    Command, command_type
+)
+from corbos_scm.container import (
+    pull, ContainerSession
+)
+from corbos_scm.apt import (
+    get_update_command, get_source_command, AptProxyConfig
+)
+from corbos_scm.apt_cache import AptCache
+from corbos_scm.service import get_apt_proxy
+from corbos_scm.staging import StagingDir
+from corbos_scm.state import OutdirState
+from corbos_scm.mirror import Mirror
+from corbos_scm.sources import find_source
+from corbos_scm.sources_index import SourcesIndex
+from corbos_scm.scheduler import (
+    Scheduler, job_type
+)
+from corbos_scm.retry import get_candidates
+from corbos_scm.report import get_directory_size
+from corbos_scm.metrics import Metrics
+from corbos_scm.exceptions import (
+    exception_handler,
+    CSCMError,
+    CSCMBatchError,
+    CSCMPackageNameError
+)
+
+log = logging.getLogger('corbos_scm')
+
+fetch_result_type = NamedTuple(
+    'fetch_result_type', [
+        ('package', str),
+        ('outdir', str),
+        ('success', bool),
+        ('message', str),
+        ('duration', float),
+        ('size', Optional[int])
+    ]
+)
+
+
+@exception_handler
+def main() -> None:
+    args = docopt.docopt(__doc__, version=__version__)
+
+    if args['--timeout']:
+        Command.set_total_timeout(int(args['--timeout']))
+
+    Metrics.setup(args['--metrics'])
+
+    if args['--package-list']:
+        packages = read_package_list(args['--package-list'], args['--outdir'])
+    else:
+        packages = {
+            package: os.sep.join([args['--outdir'], package])
+            for package in args['--package']
+        }
+
+    bandwidth_limit = None
+    if args['--bandwidth-limit']:
+        bandwidth_limit = int(args['--bandwidth-limit'])
+
+    started = time.monotonic()
+    if args['--mirror'] or int(args['--workers']) > 1:
+        results = schedule(args, packages, bandwidth_limit)
+    else:
+        pull(
+            f'{get_candidates(args["--registry"])[0]}/{args["--container"]}',
+            args['--cache-dir'], int(args['--image-ttl'])
+        )
+
+        apt_cache = None
+        if args['--cache-dir']:
+            apt_cache = AptCache(
+                args['--cache-dir'], args['--container'],
+                int(args['--apt-ttl'])
+            )
+
+        results = fetch(
+            args['--container'], packages, apt_cache, bandwidth_limit,
+            get_apt_proxy(args)
+        )
+    duration = time.monotonic() - started
+
+    failed = [result.package for result in results if not result.success]
+    for result in results:
+        Metrics.inc(
+            'corbos_scm_packages_total',
+            {'result': 'success' if result.success else 'failure'}
+        )
+    print(format_summary(results, duration))
+    if args['--summary']:
+        write_summary(args['--summary'], results, duration)
+    if failed:
+        raise CSCMBatchError(
+            f'{len(failed)} of {len(results)} packages failed: {failed}'
+        )
+
+
+def read_package_list(filename: str, outdir: str) -> Dict[str, str]:
+    """
+    Read package list file
+
+    :param str filename: package list file
+    :param str outdir: base output directory
+
+    :return: package name to output directory mapping
+
+    :rtype: dict
+    """
+    packages = {}
+    with open(filename) as package_list:
+        for line in package_list:
+            columns = line.split()
+            if not columns or columns[0].startswith('#'):
+                continue
+            package_outdir = columns[1] if len(columns) > 1 else columns[0]
+            packages[columns[0]] = os.path.join(outdir, package_outdir)
+    return packages
+
+
+def schedule(
+    args: Dict, packages: Dict[str, str],
+    bandwidth_limit: Optional[int] = None
+) -> List[fetch_result_type]:
+    """
+    Fetch sources of all given packages concurrently
+
+    Every package is fetched by its own corbos_scm process, such
+    that caching, retries and failover work as for a single
+    package. Processes are started by the Scheduler, at most
+    --workers at a time and at most --host-limit per registry
+    or mirror
+
+    :param dict args: docopt arguments of main()
+    :param dict packages: package name to output directory mapping
+    :param int bandwidth_limit: limit of all workers in kB/s or None
+
+    :return: list of fetch_result_type in the order of packages
+
+    :rtype: list
+    """
+    workers = int(args['--workers'])
+    hosts = get_candidates(args['--mirror'] or args['--registry'])
+    sizes = get_sizes(args, packages)
+    jobs = [
+        job_type(
+            package=package,
+            outdir=package_outdir,
+            hosts=hosts,
+            size=sizes.get(package)
+        ) for package, package_outdir in packages.items()
+    ]
+    worker_limit = None
+    if bandwidth_limit and jobs:
+        worker_limit = max(bandwidth_limit // min(workers, len(jobs)), 1)
+    scheduler = Scheduler(
+        workers, int(args['--host-limit']) if args['--host-limit'] else None
+    )
+    return scheduler.run(
+        jobs, lambda job, host: fetch_job(
+            get_fetch_command(args, job, host, worker_limit), job
+        )
+    )
+
+
+def get_sizes(
+    args: Dict, packages: Dict[str, str]
+) -> Dict[str, int]:
+    """
+    Expected download size of the given packages
+
+    With a mirror the size is taken from its Sources index,
+    which is looked up from the SourcesIndex below --cache-dir
+    if set, otherwise from the sources fetched by a previous run
+
+    :param dict args: docopt arguments of main()
+    :param dict packages: package name to output directory mapping
+
+    :return: package name to size mapping, unknown sizes are missing
+
+    :rtype: dict
+    """
+    sources = []
+    mirror = None
+    if args['--mirror']:
+        sources_index = None
+        if args['--cache-dir']:
+            sources_index = SourcesIndex(
+                args['--cache-dir'], int(args['--apt-ttl'])
+            )
+        mirror = Mirror(
+            get_candidates(args['--mirror'])[0], args['--distribution'],
+            args['--components'].split(','), args['--keyring'],
+            sources_index=sources_index
+        )
+        try:
+            if sources_index:
+                mirror.update_index()
+            else:
+                sources = mirror.get_sources()
+        except CSCMError as issue:
+            log.warning(f'Package sizes unknown: {issue}')
+            mirror = None
+    sizes = {}
+    for package, package_outdir in packages.items():
+        if mirror and mirror.sources_index:
+            source = mirror.find(package)
+        else:
+            source = find_source(sources, package)
+        if source:
+            sizes[package] = sum(
+                source_file.size for source_file in source.files
+            )
+        elif os.path.isdir(package_outdir):
+            sizes[package] = get_directory_size(package_outdir)
+    return sizes
+
+
+def get_fetch_command(
+    args: Dict, job: job_type, host: str,
+    bandwidth_limit: Optional[int] = None
+) -> List[str]:
+    """
+    corbos_scm call fetching the package of the given job
+
+    :param dict args: docopt arguments of main()
+    :param job_type job: fetch job
+    :param str host: registry or mirror to use first
+    :param int bandwidth_limit: limit of this call in kB/s or None
+
+    :return: command and arguments
+
+    :rtype: list
+    """
+    # the other hosts stay available for failover
+    hosts = ','.join([host] + [name for name in job.hosts if name != host])
+    # the corbos_scm script is installed as OBS service and not
+    # on PATH, the module is run by the interpreter of the batch
+    command = [
+        sys.executable, '-m', 'corbos_scm.corbos_scm',
+        '--package', job.package, '--outdir', job.outdir
+    ]
+    if args['--mirror']:
+        command += [
+            '--mirror', hosts,
+            '--distribution', args['--distribution'],
+            '--components', args['--components'],
+            '--apt-ttl', args['--apt-ttl']
+        ]
+        if args['--keyring']:
+            command += ['--keyring', args['--keyring']]
+    else:
+        command += [
+            '--registry', hosts,
+            '--container', args['--container'],
+            '--image-ttl', args['--image-ttl'],
+            '--apt-ttl', args['--apt-ttl']
+        ]
+        if args['--apt-proxy']:
+            command += ['--apt-proxy', args['--apt-proxy']]
+        if args['--apt-proxy-hosts']:
+            command += ['--apt-proxy-hosts', args['--apt-proxy-hosts']]
+    for option in ('--cache-dir', '--metrics'):
+        if args[option]:
+            command += [option, args[option]]
+    if bandwidth_limit:
+        command += ['--bandwidth-limit', format(bandwidth_limit)]
+    return command
+
+
+def fetch_job(command: List[str], job: job_type) -> fetch_result_type:
+    """
+    Run the fetch process of a job
+
+    :param list command: fetch command and arguments
+    :param job_type job: fetch job
+
+    :return: fetch_result_type
+
+    :rtype: fetch_result_type
+    """
+    started = time.monotonic()
+    try:
+        result = Command.run(command, raise_on_error=False)
+        message = get_error_message(result)
+    except CSCMError as issue:
+        message = f'{type(issue).__name__}: {issue}'
+    success = not message
+    return fetch_result_type(
+        package=job.package,
+        outdir=job.outdir,
+        success=success,
+        message=message,
+        duration=round(time.monotonic() - started, 3),
+        size=get_directory_size(job.outdir) if success else None
+    )
+
+
+def get_error_message(result: command_type) -> str:
+    """
+    Error message of a failed fetch command
+
+    :param command_type result: result of the fetch command
+
+    :return: the last line of stderr, empty if the command succeeded
+
+    :rtype: str
+    """
+    if result.returncode == 0:
+        return ''
+    # the last stderr line usually carries the error
+    return (result.error.strip().splitlines() or [
+        f'exit code {result.returncode}'
+    ])[-1]
+
+
+def format_summary(
+    results: List[fetch_result_type], duration: float
+) -> str:
+    """
+    Summary table of a batch run
+
+    :param list results: list of fetch_result_type
+    :param float duration: wall time of all fetches in seconds
+
+    :return: table text
+
+    :rtype: str
+    """
+    rows = [['PACKAGE', 'STATUS', 'SECONDS', 'SIZE', 'RESULT']]
+    for result in results:
+        rows.append(
+            [
+                result.package,
+                'OK' if result.success else 'FAILED',
+                f'{result.duration:.1f}',
+                format_size(result.size),
+                result.outdir if result.success else result.message
+            ]
+        )
+    widths = [max(len(row[column]) for row in rows) for column in range(4)]
+    lines = []
+    for row in rows:
+        cells = [row[column].ljust(widths[column]) for column in range(4)]
+        lines.append('  '.join(cells + [row[4]]))
+    fetched = len([result for result in results if result.success])
+    lines.append(
+        f'{fetched} of {len(results)} packages fetched in {duration:.1f}s'
+    )
+    return os.linesep.join(lines)
+
+
+def format_size(size: Optional[int]) -> str:
+    """
+    Human readable size
+
+    :param int size: size in bytes or None
+
+    :return: size text, - for an unknown size
+
+    :rtype: str
+    """
+    if size is None:
+        return '-'
+    if size < 1024:
+        return f'{size}B'
+    value = float(size)
+    for unit in ('K', 'M', 'G'):
+        value /= 1024
+        if value < 1024 or unit == 'G':
+            break
+    return f'{value:.1f}{unit}'
+
+
+def write_summary(
+    filename: str, results: List[fetch_result_type], duration: float
+) -> None:
+    """
+    Write the summary of a batch run as JSON
+
+    :param str filename: summary file
+    :param list results: list of fetch_result_type
+    :param float duration: wall time of all fetches in seconds
+    """
+    new_filename = f'{filename}.new'
+    try:
+        with open(new_filename, 'w') as summary:
+            json.dump(
+                {
+                    'duration': round(duration, 3),
+                    'packages': [dict(result._asdict()) for result in results]
+                }, summary, indent=2
+            )
+        os.replace(new_filename, filename)
+    except OSError as issue:
+        raise CSCMBatchError(f'Failed to write summary {filename}: {issue}')
+
+
+def fetch(
+    container: str, packages: Dict[str, str],
+    apt_cache: Optional[AptCache] = None,
+    bandwidth_limit: Optional[int] = None,
+    apt_proxy: Optional[AptProxyConfig] = None
+) -> List[fetch_result_type]:
+    """
+    Fetch sources of all given packages in one container session
+
+    The package indexes are updated once, after that the sources
+    of each package are fetched into a staging directory and
+    published into their output directory once complete. A
+    failing package does not stop the session
+
+    :param str container: container name
+    :param dict packages: package name to output directory mapping
+    :param AptCache apt_cache: optional shared apt index cache
+    :param int bandwidth_limit: download rate limit in kB/s or None
+    :param AptProxyConfig apt_proxy: optional caching proxy
+
+    :return: list of fetch_result_type
+
+    :rtype: list
+    """
+    with ExitStack() as stack:
+        staging = {}
+        volumes = {}
+        for index, package_outdir in enumerate(packages.values()):
+            Path(package_outdir).mkdir(parents=True, exist_ok=True)
+            staging[package_outdir] = stack.enter_context(
+                StagingDir(package_outdir)
+            )
+            volumes[staging[package_outdir].path] = f'/mnt/{index}'
+
+        if apt_cache:
+            volumes.update(apt_cache.get_volumes())
+        if apt_proxy:
+            volumes.update(apt_proxy.get_volumes())
+
+        with ContainerSession(container, volumes) as session:
+            if apt_cache:
+                with apt_cache.update_lock():
+                    if not apt_cache.is_fresh():
+                        session.execute(apt_cache.get_update_command())
+                with apt_cache.read_lock():
+                    return fetch_packages(
+                        session, packages, staging, volumes, bandwidth_limit
+                    )
+            session.execute(get_update_command())
+            return fetch_packages(
+                session, packages, staging, volumes, bandwidth_limit
+            )
+
+
+def fetch_packages(
+    session: ContainerSession, packages: Dict[str, str],
+    staging: Dict[str, StagingDir], volumes: Dict[str, str],
+    bandwidth_limit: Optional[int] = None
+) -> List[fetch_result_type]:
+    """
+    Fetch sources of all given packages in a running session
+
+    :param ContainerSession session: active container session
+    :param dict packages: package name to output directory mapping
+    :param dict staging: output directory to StagingDir mapping
+    :param dict volumes: host directory to mount point mapping
+    :param int bandwidth_limit: download rate limit in kB/s or None
+
+    :return: list of fetch_result_type
+
+    :rtype: list
+    """
+    results = []
+    for package, package_outdir in packages.items():
+        log.info(f'Fetching {package}')
+        package_staging = staging[package_outdir]
+        fetch_source = ['cd', volumes[package_staging.path], '&&']
+        try:
+            fetch_source += get_source_command(
+                package, bandwidth_limit=bandwidth_limit
+            )
+        except CSCMPackageNameError as issue:
+            results.append(
+                fetch_result_type(
+                    package=package, outdir=package_outdir, success=False,
+                    message=str(issue), duration=0, size=None
+                )
+            )
+            continue
+        started = time.monotonic()
+        result = session.execute(fetch_source, raise_on_error=False)
+        success = result.returncode == 0
+        if success:
+            # replace the sources of the previous batch run
+            state = OutdirState(package_outdir)
+            state.begin_publish(package_staging.get_names())
+            state.write(
+                package, package_staging.publish(state.get_files())
+            )
+        results.append(
+            fetch_result_type(
+                package=package,
+                outdir=package_outdir,
+                success=success,
+                message=get_error_message(result),
+                duration=round(time.monotonic() - started, 3),
+                size=get_directory_size(package_outdir) if success else None
+            )
+        )
+    return results
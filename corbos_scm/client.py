@@ -0,0 +1,154 @@
+# Copyright (c) 2021 Marcus Schäfer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+import os
+import json
+import socket
+import logging
+from typing import (
+    Dict, Optional
+)
+
+from corbos_scm.exceptions import CSCMDaemonError
+
+log = logging.getLogger('corbos_scm')
+
+# the daemon answers once the whole fetch is done
+DAEMON_TIMEOUT = 1800
+
+
+class DaemonClient:
+    """
+    Client for the corbos_scm_daemon Unix socket
+
+    A request is one JSON line describing the package to fetch
+    or to resolve, the daemon answers with one JSON line containing the result.
+    A daemon which does not answer within the timeout is treated
+    like no daemon at all, such that the caller fetches directly
+    """
+    def __init__(
+        self, socket_path: str, timeout: float = DAEMON_TIMEOUT
+    ) -> None:
+        """
+        Setup client
+
+        :param str socket_path: daemon socket path
+        :param float timeout: socket timeout in seconds
+        """
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def is_available(self) -> bool:
+        """
+        Check if a daemon socket exists
+
+        :return: True if the socket file exists
+
+        :rtype: bool
+        """
+        return os.path.exists(self.socket_path)
+
+    def fetch(
+        self, image: str, package: str, outdir: str,
+        version: Optional[str] = None
+    ) -> bool:
+        """
+        Let the daemon fetch the package sources into outdir
+
+        :param str image: registry/container image reference
+        :param str package: source or binary package name
+        :param str outdir: output directory
+        :param str version: exact version, None for the candidate
+
+        :return:
+            True if the daemon fetched the sources, False if the
+            daemon could not be used and the caller has to fetch
+            the sources itself
+
+        :rtype: bool
+
+        :raises CSCMDaemonError: if the daemon failed to fetch
+        """
+        response = self._request(
+            {
+                'image': image,
+                'package': package,
+                'version': version,
+                'outdir': os.path.abspath(outdir)
+            }
+        )
+        if response is None:
+            return False
+        if not response.get('success'):
+            raise CSCMDaemonError(
+                f'Daemon failed to fetch {package}: {response.get("message")}'
+            )
+        return True
+
+    def resolve(self, image: str, package: str) -> Optional[str]:
+        """
+        Let the daemon look up the source records of a package
+
+        :param str image: registry/container image reference
+        :param str package: source or binary package name
+
+        :return:
+            apt-cache showsrc output, None if the daemon could not
+            be used and the caller has to resolve the package itself
+
+        :rtype: str
+
+        :raises CSCMDaemonError: if the daemon failed to resolve
+        """
+        response = self._request(
+            {'image': image, 'package': package, 'resolve': True}
+        )
+        if response is None:
+            return None
+        if not response.get('success'):
+            raise CSCMDaemonError(
+                f'Daemon failed to resolve {package}: '
+                f'{response.get("message")}'
+            )
+        return response.get('output', '')
+
+    def _request(self, request: Dict) -> Optional[Dict]:
+        if not self.is_available():
+            return None
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+                client.settimeout(self.timeout)
+                client.connect(self.socket_path)
+                client.sendall(json.dumps(request).encode() + b'\n')
+                with client.makefile('rb') as reply:
+                    response = json.loads(reply.readline().decode())
+        except socket.timeout:
+            log.warning(
+                f'Daemon at {self.socket_path} did not answer '
+                f'within {self.timeout}s'
+            )
+            return None
+        except (OSError, ValueError) as issue:
+            log.warning(f'Daemon at {self.socket_path} not usable: {issue}')
+            return None
+        if response.get('unsupported'):
+            log.warning(f'Daemon does not serve {request["image"]}')
+            return None
+        return response
@@ -0,0 +1,288 @@
+# Copyright (c) 2021 Marcus Schäfer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+import os
+import re
+import json
+import time
+import fcntl
+import shutil
+import socket
+import hashlib
+import logging
+from typing import (
+    IO, Dict, List, Optional
+)
+
+from corbos_scm.command import Command
+from corbos_scm.metrics import Metrics
+from corbos_scm.filesystem import link_or_copy
+from corbos_scm.exceptions import CSCMLockError
+
+log = logging.getLogger('corbos_scm')
+
+
+class RequestCoalescer:
+    """
+    Coalescing of concurrent fetch requests for the same package
+
+    The first process requesting a package takes the request lock
+    and fetches. Processes requesting the same package meanwhile
+    wait for the lock and then receive a copy of the result instead
+    of fetching again. If the first process fails, no result is
+    published and the next waiting process fetches itself.
+
+    Waiting processes hold a shared lock on the waiters file. A
+    result is only published if there are waiters and the last
+    waiter to receive it removes it again.
+
+    Partial downloads of a failed fetch can be kept in the partial
+    directory of the request, where the next fetch of the same
+    package resumes them.
+
+    The lock holder records its host, pid and start time in the
+    lock file. A lock held by a process which no longer exists on
+    this host is considered stale and broken. A living holder
+    keeps the lock no matter how long its fetch takes
+    """
+    poll_interval = 0.5
+    result_marker = '.complete'
+
+    def __init__(
+        self, cache_dir: str, key: str,
+        exclude: Optional[List[str]] = None
+    ) -> None:
+        """
+        Setup coalescer
+
+        :param str cache_dir: base cache directory
+        :param str key: request key, e.g. origin, package and version
+        :param list exclude: file names not shared with other requests
+        """
+        root = os.sep.join([cache_dir, 'requests'])
+        name = '{0}-{1}'.format(
+            re.sub(r'[^A-Za-z0-9.+~-]+', '_', key)[:64],
+            hashlib.sha256(key.encode()).hexdigest()[:16]
+        )
+        self.key = key
+        self.lock_file = os.sep.join([root, f'{name}.lock'])
+        self.result_dir = os.sep.join([root, f'{name}.result'])
+        self.waiters_file = os.sep.join([root, f'{name}.waiters'])
+        self.partial_dir = os.sep.join([root, f'{name}.partial'])
+        self.exclude = exclude or []
+        self.started = time.time()
+        self.lock: Optional[IO] = None
+        self.waiter: Optional[IO] = None
+        self.waited = False
+        os.makedirs(root, exist_ok=True)
+
+    def __enter__(self) -> 'RequestCoalescer':
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.release()
+
+    def acquire(self) -> None:
+        """
+        Block until the request lock is taken, breaking stale locks
+
+        :raises CSCMLockError: if the total timeout is exceeded
+        """
+        waiting = False
+        while True:
+            lock = open(self.lock_file, 'a+')
+            try:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                holder = self._read_holder(lock)
+                inode = os.fstat(lock.fileno()).st_ino
+                lock.close()
+                if self._is_stale(holder):
+                    log.warning(f'Breaking stale request lock {holder}')
+                    Metrics.inc('corbos_scm_stale_locks_total')
+                    self._unlink_lock(inode)
+                    continue
+                if not waiting:
+                    log.info(f'Waiting for concurrent fetch of {self.key}')
+                    self._join_waiters()
+                    waiting = True
+                if Command.deadline is not None and (
+                    time.monotonic() >= Command.deadline
+                ):
+                    raise CSCMLockError(
+                        f'Timed out waiting for concurrent fetch of {self.key}'
+                    )
+                time.sleep(self.poll_interval)
+                continue
+            if not self._is_current(lock):
+                # lock file was broken as stale after it was opened
+                lock.close()
+                continue
+            lock.seek(0)
+            lock.truncate()
+            json.dump(
+                {
+                    'host': socket.gethostname(),
+                    'pid': os.getpid(),
+                    'started': time.time()
+                }, lock
+            )
+            lock.flush()
+            self.lock = lock
+            self._leave_waiters()
+            return
+
+    def release(self) -> None:
+        """
+        Release the request lock if taken
+
+        The last waiting request removes the published result
+        """
+        self._leave_waiters()
+        if self.lock:
+            self.lock.seek(0)
+            self.lock.truncate()
+            fcntl.flock(self.lock.fileno(), fcntl.LOCK_UN)
+            self.lock.close()
+            self.lock = None
+            if self.waited and not self.has_waiters():
+                shutil.rmtree(self.result_dir, ignore_errors=True)
+            self.waited = False
+
+    def has_waiters(self) -> bool:
+        """
+        Check if other requests wait for the request lock
+
+        :return: True if a request waits
+
+        :rtype: bool
+        """
+        with open(self.waiters_file, 'a') as waiters:
+            try:
+                fcntl.flock(waiters.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+            return False
+
+    def receive(self, outdir: str) -> bool:
+        """
+        Provide the result of a concurrent request in outdir
+
+        Only a result published after this request started is
+        used, an older result could be outdated
+
+        :param str outdir: output directory
+
+        :return: True if a result was received
+
+        :rtype: bool
+        """
+        marker = os.sep.join([self.result_dir, self.result_marker])
+        try:
+            with open(marker) as result:
+                finished = json.load(result)['finished']
+        except (OSError, ValueError, KeyError):
+            return False
+        if finished < self.started:
+            return False
+        for name in os.listdir(self.result_dir):
+            if name != self.result_marker:
+                link_or_copy(
+                    os.sep.join([self.result_dir, name]),
+                    os.sep.join([outdir, name])
+                )
+        log.info(f'Received result of concurrent fetch of {self.key}')
+        Metrics.inc('corbos_scm_coalesced_total')
+        return True
+
+    def publish(self, outdir: str) -> None:
+        """
+        Publish the files in outdir for waiting requests
+
+        Without waiting requests nothing is published and a
+        previous result is removed
+
+        :param str outdir: output directory
+        """
+        if not self.has_waiters():
+            shutil.rmtree(self.result_dir, ignore_errors=True)
+            return
+        new_result_dir = f'{self.result_dir}.new'
+        shutil.rmtree(new_result_dir, ignore_errors=True)
+        os.makedirs(new_result_dir)
+        for name in os.listdir(outdir):
+            path = os.sep.join([outdir, name])
+            if name not in self.exclude and os.path.isfile(path):
+                link_or_copy(path, os.sep.join([new_result_dir, name]))
+        marker = os.sep.join([new_result_dir, self.result_marker])
+        with open(marker, 'w') as result:
+            json.dump({'finished': time.time()}, result)
+        shutil.rmtree(self.result_dir, ignore_errors=True)
+        os.replace(new_result_dir, self.result_dir)
+
+    def _join_waiters(self) -> None:
+        if not self.waiter:
+            self.waiter = open(self.waiters_file, 'a')
+            fcntl.flock(self.waiter.fileno(), fcntl.LOCK_SH)
+            self.waited = True
+
+    def _leave_waiters(self) -> None:
+        if self.waiter:
+            self.waiter.close()
+            self.waiter = None
+
+    def _read_holder(self, lock: IO) -> Dict:
+        try:
+            lock.seek(0)
+            return json.loads(lock.read())
+        except ValueError:
+            # holder did not write its data yet
+            return {}
+
+    def _is_stale(self, holder: Dict) -> bool:
+        # the lock of a crashed holder is released by the kernel,
+        # only a holder pid reused on this host can keep it
+        if not holder or holder.get('host') != socket.gethostname():
+            return False
+        try:
+            os.kill(holder['pid'], 0)
+        except ProcessLookupError:
+            return True
+        except (PermissionError, KeyError, TypeError):
+            pass
+        return False
+
+    def _is_current(self, lock: IO) -> bool:
+        try:
+            return os.stat(self.lock_file).st_ino == os.fstat(
+                lock.fileno()
+            ).st_ino
+        except FileNotFoundError:
+            return False
+
+    def _unlink_lock(self, inode: int) -> None:
+        # only unlink the lock file found stale, not a new one
+        # created by a process which broke it meanwhile
+        try:
+            if os.stat(self.lock_file).st_ino == inode:
+                os.unlink(self.lock_file)
+        except FileNotFoundError:
+            pass
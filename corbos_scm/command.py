@@ -19,63 +19,439 @@
 # SOFTWARE.
 #
 import os
+import time
+import signal
+import selectors
 import subprocess
+from tempfile import TemporaryFile
 from typing import (
-    NamedTuple, List, Dict
+    List, Dict, Optional, Iterator, IO, Tuple, Union
 )
-from corbos_scm.exceptions import CSCMCommandError
-
-command_type = NamedTuple(
-    'command_type', [
-        ('output', str),
-        ('error', str),
-        ('returncode', int)
-    ]
+from corbos_scm.report import record_command
+from corbos_scm.exceptions import (
+    CSCMCommandError,
+    CSCMCommandTimeoutError
 )
 
+# bytes read from a child process pipe at once
+CHUNK_SIZE = 65536
+
+
+class OutputBuffer:
+    """
+    Bounded memory capture of an output stream of a command
+
+    As long as the stream is smaller than limit it is kept in
+    memory. Beyond that the full stream is spilled to an
+    anonymous temporary file and only its last limit bytes are
+    kept in memory, for error messages
+    """
+    def __init__(self, limit: int) -> None:
+        """
+        Setup output buffer
+
+        :param int limit: bytes kept in memory
+        """
+        self.limit = limit
+        self.tail = bytearray()
+        self.spill: Optional[IO[bytes]] = None
+        self.size = 0
+
+    def write(self, data: bytes) -> None:
+        """
+        Add data to the captured stream
+
+        :param bytes data: data read from the stream
+        """
+        self.size += len(data)
+        if self.spill:
+            self.spill.write(data)
+        self.tail += data
+        if len(self.tail) > self.limit:
+            if not self.spill:
+                self.spill = TemporaryFile()
+                self.spill.write(self.tail)
+            del self.tail[:len(self.tail) - self.limit]
+
+    def get_tail(self) -> str:
+        """
+        Last bytes of the stream as kept in memory
+
+        :return: decoded data, prefixed with [...] if truncated
+
+        :rtype: str
+        """
+        text = self.tail.decode('utf-8', errors='replace')
+        return f'[...]{text}' if self.spill else text
+
+    def read(self) -> str:
+        """
+        Full captured stream, read back from the spill file if the
+        stream exceeded the memory limit
+
+        :return: decoded data
+
+        :rtype: str
+        """
+        if not self.spill:
+            return self.tail.decode('utf-8', errors='replace')
+        self.spill.seek(0)
+        return self.spill.read().decode('utf-8', errors='replace')
+
+    def close(self) -> None:
+        """
+        Release the spill file of a stream which is not read
+        """
+        if self.spill:
+            self.spill.close()
+
+
+class command_type:
+    """
+    Result of a command
+
+    output and error are read from their OutputBuffer only when
+    accessed, a command result does not hold large outputs in
+    memory unless they are used
+    """
+    __slots__ = ('_output', '_error', 'returncode')
+
+    def __init__(
+        self, output: Union[str, OutputBuffer] = '',
+        error: Union[str, OutputBuffer] = '', returncode: int = 0
+    ) -> None:
+        """
+        Setup command result
+
+        :param output: stdout as str or OutputBuffer
+        :param error: stderr as str or OutputBuffer
+        :param int returncode: exit code
+        """
+        self._output = output
+        self._error = error
+        self.returncode = returncode
+
+    @property
+    def output(self) -> str:
+        return _get_text(self._output)
+
+    @property
+    def error(self) -> str:
+        return _get_text(self._error)
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, command_type):
+            return NotImplemented
+        return (self.output, self.error, self.returncode) == (
+            other.output, other.error, other.returncode
+        )
+
+    def __repr__(self) -> str:
+        return (
+            f'command_type(output={self.output!r}, error={self.error!r}, '
+            f'returncode={self.returncode!r})'
+        )
+
 
 class Command:
     """
     Simple command invocation interface
+
+    All commands run in their own process group, which is
+    terminated as a whole if a command exceeds its timeout.
+    Besides the per command timeout a deadline for all commands
+    can be set via set_total_timeout
     """
+    # seconds between SIGTERM and SIGKILL on timeout
+    kill_grace_time = 5
+    # bytes of stdout and stderr each kept in memory per command
+    output_limit = 256 * 1024
+    deadline: Optional[float] = None
+
+    @staticmethod
+    def set_total_timeout(timeout: Optional[int]) -> None:
+        """
+        Set the maximum time all following commands may take in sum
+
+        :param int timeout: seconds from now, None for no limit
+        """
+        Command.deadline = None
+        if timeout is not None:
+            Command.deadline = time.monotonic() + timeout
+
     @staticmethod
     def run(
-        command: List, custom_env: Dict[str, str] = None,
-        raise_on_error: bool = True
+        command: List, custom_env: Optional[Dict[str, str]] = None,
+        raise_on_error: bool = True, timeout: Optional[float] = None
     ) -> command_type:
         """
         Execute a program and block the caller.
 
+        stdout and stderr are captured in an OutputBuffer each,
+        the memory used does not grow with the output of the
+        program. Error messages contain the end of both streams
+
+        :param list command: command and arguments
+        :param list custom_env: custom os.environ
+        :param bool raise_on_error:
+            if true, raise exception if command did not succeed
+            ecode != 0
+        :param float timeout: timeout in seconds, None for no limit
+
+        :return:
+            A command_type
+
+        :rtype: command_type
+        """
+        started = time.monotonic()
+        process = Command._start(command, custom_env)
+        return Command._collect(
+            process, command, started, raise_on_error, timeout
+        )
+
+    @staticmethod
+    async def run_async(
+        command: List, custom_env: Optional[Dict[str, str]] = None,
+        raise_on_error: bool = True, timeout: Optional[float] = None
+    ) -> command_type:
+        """
+        Execute a program without blocking the event loop.
+
+        The output is captured like in run() by a thread of the
+        default executor of the running event loop. If the
+        awaiting task is cancelled the program is terminated
+
         :param list command: command and arguments
         :param list custom_env: custom os.environ
         :param bool raise_on_error:
             if true, raise exception if command did not succeed
             ecode != 0
+        :param float timeout: timeout in seconds, None for no limit
 
         :return:
             A command_type
 
-        :rtype: NamedTuple
+        :rtype: command_type
+        """
+        # only the callers of run_async pay for importing asyncio
+        import asyncio
+        loop = asyncio.get_event_loop()
+        started = time.monotonic()
+        process = Command._start(command, custom_env)
+        try:
+            return await loop.run_in_executor(
+                None, Command._collect, process, command, started,
+                raise_on_error, timeout
+            )
+        except asyncio.CancelledError:
+            # the capturing thread ends with the program, the
+            # grace time of SIGTERM is not waited for in the loop
+            loop.run_in_executor(None, Command._terminate, process)
+            raise
+
+    @staticmethod
+    def stream(
+        command: List, custom_env: Optional[Dict[str, str]] = None,
+        timeout: Optional[float] = None
+    ) -> Iterator[str]:
+        """
+        Execute a program and iterate over the lines of its stdout
+        as they are written.
+
+        stderr is captured in an OutputBuffer. If the iteration is
+        stopped before the end of the output the program is
+        terminated
+
+        :param list command: command and arguments
+        :param list custom_env: custom os.environ
+        :param float timeout: timeout in seconds, None for no limit
+
+        :raises CSCMCommandError: after the last line if the
+            command did not succeed ecode != 0
+
+        :return: lines without line end
+
+        :rtype: iterator
         """
+        started = time.monotonic()
+        process = Command._start(command, custom_env)
+        error = OutputBuffer(Command.output_limit)
+        stderr_fd = process.stderr.fileno()  # type: ignore
+        end_time = Command._get_end_time(timeout)
+        reader = Command._read(process, command, started, end_time)
+        pending = bytearray()
+        try:
+            for fd, data in reader:
+                if fd == stderr_fd:
+                    error.write(data)
+                    continue
+                pending += data
+                *lines, rest = pending.split(b'\n')
+                pending = rest
+                for line in lines:
+                    yield line.decode('utf-8', errors='replace')
+            if pending:
+                yield pending.decode('utf-8', errors='replace')
+            Command._wait(process, command, started, end_time)
+        except BaseException:
+            # GeneratorExit if the caller stops iterating
+            Command._abort(process, error)
+            raise
+        finally:
+            reader.close()
+            process.stdout.close()  # type: ignore
+            process.stderr.close()  # type: ignore
+        record_command(command, started, process.returncode)
+        if process.returncode != 0:
+            message = f'command: {command}, stderr: {error.get_tail()!r}'
+            error.close()
+            raise CSCMCommandError(
+                message, process.returncode, error.get_tail()
+            )
+        error.close()
+
+    @staticmethod
+    def _start(
+        command: List, custom_env: Optional[Dict[str, str]]
+    ) -> subprocess.Popen:
         environment = custom_env if custom_env else os.environ
         try:
-            process = subprocess.Popen(
+            return subprocess.Popen(
                 command,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE,
-                env=environment
+                env=environment,
+                start_new_session=True
             )
         except Exception as issue:
             raise CSCMCommandError(
                 f'{issue!r}'
             )
-        output, error = process.communicate()
+
+    @staticmethod
+    def _collect(
+        process: subprocess.Popen, command: List, started: float,
+        raise_on_error: bool, timeout: Optional[float]
+    ) -> command_type:
+        output = OutputBuffer(Command.output_limit)
+        error = OutputBuffer(Command.output_limit)
+        stderr_fd = process.stderr.fileno()  # type: ignore
+        # one deadline for reading the output and the exit, a
+        # child may close its output and keep running
+        end_time = Command._get_end_time(timeout)
+        reader = Command._read(process, command, started, end_time)
+        try:
+            for fd, data in reader:
+                (error if fd == stderr_fd else output).write(data)
+            Command._wait(process, command, started, end_time)
+        except BaseException:
+            # e.g. KeyboardInterrupt, SystemExit on SIGTERM or a
+            # failed read, the child runs in its own session and
+            # is not left behind
+            Command._abort(process, output, error)
+            raise
+        finally:
+            reader.close()
+            process.stdout.close()  # type: ignore
+            process.stderr.close()  # type: ignore
+        record_command(command, started, process.returncode)
         if process.returncode != 0 and raise_on_error:
+            message = (
+                f'command: {command}, stderr: {error.get_tail()!r}, '
+                f'stdout: {output.get_tail()!r}'
+            )
+            output.close()
+            error.close()
             raise CSCMCommandError(
-                f'command: {command}, stderr: {error!r}, stdout: {output!r}'
+                message, process.returncode,
+                error.get_tail(), output.get_tail()
             )
         return command_type(
-            output=format(output),
-            error=format(error),
-            returncode=process.returncode
+            output=output, error=error, returncode=process.returncode
         )
+
+    @staticmethod
+    def _read(
+        process: subprocess.Popen, command: List, started: float,
+        end_time: Optional[float]
+    ) -> Iterator[Tuple[int, bytes]]:
+        # yields chunks of stdout and stderr by file descriptor as
+        # they are written, an empty chunk marks the end of a stream
+        with selectors.DefaultSelector() as selector:
+            for stream in [process.stdout, process.stderr]:
+                selector.register(
+                    stream.fileno(), selectors.EVENT_READ  # type: ignore
+                )
+            while selector.get_map():
+                wait_time = None
+                if end_time is not None:
+                    wait_time = end_time - time.monotonic()
+                    if wait_time <= 0:
+                        Command._terminate(process)
+                        record_command(command, started, None)
+                        raise CSCMCommandTimeoutError(
+                            f'command: {command}, timed out'
+                        )
+                for key, event in selector.select(wait_time):
+                    data = os.read(key.fd, CHUNK_SIZE)
+                    if not data:
+                        selector.unregister(key.fd)
+                    yield key.fd, data
+
+    @staticmethod
+    def _wait(
+        process: subprocess.Popen, command: List, started: float,
+        end_time: Optional[float]
+    ) -> None:
+        try:
+            process.wait(
+                timeout=None if end_time is None
+                else max(end_time - time.monotonic(), 0)
+            )
+        except subprocess.TimeoutExpired:
+            Command._terminate(process)
+            record_command(command, started, None)
+            raise CSCMCommandTimeoutError(
+                f'command: {command}, timed out'
+            )
+
+    @staticmethod
+    def _get_end_time(timeout: Optional[float]) -> Optional[float]:
+        command_timeout = Command._get_timeout(timeout)
+        if command_timeout is None:
+            return None
+        return time.monotonic() + command_timeout
+
+    @staticmethod
+    def _get_timeout(timeout: Optional[float]) -> Optional[float]:
+        limits = [] if timeout is None else [timeout]
+        if Command.deadline is not None:
+            limits.append(Command.deadline - time.monotonic())
+        return max(min(limits), 0) if limits else None
+
+    @staticmethod
+    def _abort(process: subprocess.Popen, *buffers: OutputBuffer) -> None:
+        if process.returncode is None:
+            Command._terminate(process)
+        for buffer in buffers:
+            buffer.close()
+
+    @staticmethod
+    def _terminate(process: subprocess.Popen) -> None:
+        Command._signal(process.pid, signal.SIGTERM)
+        try:
+            process.wait(timeout=Command.kill_grace_time)
+        except subprocess.TimeoutExpired:
+            Command._signal(process.pid, signal.SIGKILL)
+            process.wait()
+
+    @staticmethod
+    def _signal(pid: int, signum: int) -> None:
+        try:
+            os.killpg(pid, signum)
+        except ProcessLookupError:
+            pass
+
+
+def _get_text(data: Union[str, OutputBuffer]) -> str:
+    return data if isinstance(data, str) else data.read()
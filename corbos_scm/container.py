@@ -0,0 +1,200 @@
+# Copyright (c) 2021 Marcus Schäfer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+import os
+import logging
+from tempfile import TemporaryDirectory
+from typing import (
+    Dict, List, Optional
+)
+
+from corbos_scm.command import (
+    Command, command_type
+)
+from corbos_scm.image_cache import ImageCache
+from corbos_scm.metrics import Metrics
+
+log = logging.getLogger('corbos_scm')
+
+
+def pull(
+    image: str, cache_dir: Optional[str] = None, ttl: int = 3600
+) -> None:
+    """
+    Pull container image, through the image cache if a cache
+    directory is given
+
+    :param str image: registry/container image reference
+    :param str cache_dir: cache directory or None
+    :param int ttl: image cache ttl in seconds
+    """
+    pulled = True
+    if cache_dir:
+        pulled = ImageCache(cache_dir, ttl).pull(image)
+    else:
+        Command.run(['podman', 'pull', image])
+    Metrics.inc(
+        'corbos_scm_image_pulls_total',
+        {'result': 'pulled' if pulled else 'skipped'}
+    )
+
+
+def run(
+    container: str, volumes: Dict[str, str], command: List[str],
+    tty: bool = True
+) -> command_type:
+    """
+    Run shell command in a new container which is removed
+    after the command has finished
+
+    :param str container: container name
+    :param dict volumes: host directory to mount point mapping
+    :param list command: shell command and arguments
+    :param bool tty:
+        allocate a terminal, stdout and stderr are merged then.
+        Disable if the output is parsed
+
+    :return: A command_type
+
+    :rtype: command_type
+    """
+    safe_volumes = SafeVolumes()
+    for host_path, container_path in volumes.items():
+        safe_volumes.add(host_path, container_path)
+    return Command.run(
+        ['podman', 'run'] + safe_volumes.get_options() + (
+            ['-ti'] if tty else []
+        ) + ['--rm', container, 'bash', '-c', ' '.join(command)]
+    )
+
+
+class SafeVolumes:
+    """
+    Host directories prepared to be shared with podman
+
+    For sharing a directory via --volume some characters are not
+    allowed, e.g ":". In OBS the colon is used as project separator.
+    Because of that it happens very easily that the --outdir path
+    created by OBS at call time of the service contains colons and
+    prevents this directory name from being eligible to be shared
+    via --volume with podman. The recommended workaround from the
+    podman team is to create a temporary symlink which is what is
+    done here
+    """
+    def __init__(self) -> None:
+        self.volume_dir = TemporaryDirectory()
+        self.volumes: List[str] = []
+
+    def add(self, host_path: str, container_path: str) -> None:
+        """
+        Add volume for the given host directory
+
+        :param str host_path: directory on the host
+        :param str container_path: mount point in the container
+        """
+        volume_file = os.sep.join(
+            [self.volume_dir.name, f'volume{len(self.volumes) or ""}']
+        )
+        os.symlink(host_path, volume_file)
+        self.volumes.append(f'{volume_file}:{container_path}')
+
+    def get_options(self) -> List[str]:
+        """
+        podman options to share all added volumes
+
+        :return: list of --volume options
+
+        :rtype: list
+        """
+        options = []
+        for volume in self.volumes:
+            options += ['--volume', volume]
+        return options
+
+
+class ContainerSession:
+    """
+    Long living container to run several commands in
+
+    The container is started detached and removed when the
+    session ends. Use as context manager or call start and stop
+    """
+    def __init__(self, container: str, volumes: Dict[str, str]) -> None:
+        """
+        Setup session
+
+        :param str container: container name
+        :param dict volumes: host directory to mount point mapping
+        """
+        self.container = container
+        self.safe_volumes = SafeVolumes()
+        for host_path, container_path in volumes.items():
+            self.safe_volumes.add(host_path, container_path)
+        self.container_id = ''
+
+    def __enter__(self) -> 'ContainerSession':
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.stop()
+
+    def start(self) -> None:
+        """
+        Start the session container
+        """
+        self.container_id = Command.run(
+            [
+                'podman', 'run', '--detach', '--rm'
+            ] + self.safe_volumes.get_options() + [
+                self.container, 'sleep', 'infinity'
+            ]
+        ).output.strip()
+
+    def stop(self) -> None:
+        """
+        Remove the session container
+        """
+        if self.container_id:
+            Command.run(
+                ['podman', 'rm', '--force', self.container_id],
+                raise_on_error=False
+            )
+            self.container_id = ''
+
+    def execute(
+        self, command: List[str], raise_on_error: bool = True
+    ) -> command_type:
+        """
+        Run shell command in the session container
+
+        :param list command: shell command and arguments
+        :param bool raise_on_error: see Command.run
+
+        :return: A command_type
+
+        :rtype: command_type
+        """
+        return Command.run(
+            [
+                'podman', 'exec', self.container_id,
+                'bash', '-c', ' '.join(command)
+            ], raise_on_error=raise_on_error
+        )
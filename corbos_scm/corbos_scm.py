@@ -21,6 +21,37 @@
 """
 Usage:
     corbos_scm --package=<name> --registry=<uri> --container=<name> --outdir=<obs_out>
+        [--package-version=<version>]
+        [--cache-dir=<directory>]
+        [--image-ttl=<seconds>]
+        [--apt-ttl=<seconds>]
+        [--timeout=<seconds>]
+        [--source-cache-size=<megabytes>]
+        [--daemon-socket=<path>]
+        [--report=<file>]
+        [--metrics=<file>]
+        [--retries=<number>]
+        [--retry-budget=<seconds>]
+        [--bandwidth-limit=<kbytes>]
+        [--apt-proxy=<uri>]
+        [--apt-proxy-hosts=<list>]
+    corbos_scm --package=<name> --mirror=<uri> --distribution=<name> --outdir=<obs_out>
+        [--package-version=<version>]
+        [--snapshot=<timestamp>]
+        [--components=<list>]
+        [--keyring=<file>]
+        [--download-workers=<number>]
+        [--cache-dir=<directory>]
+        [--apt-ttl=<seconds>]
+        [--source-cache-size=<megabytes>]
+        [--report=<file>]
+        [--metrics=<file>]
+        [--retries=<number>]
+        [--retry-budget=<seconds>]
+        [--bandwidth-limit=<kbytes>]
+        [--prefetch-manifest=<file>]
+        [--prefetch-dir=<directory>]
+        [--architecture=<name>]
     corbos_scm -h | --help
     corbos_scm --version
 
@@ -28,25 +59,159 @@ Options:
     --package=<name>
         Name of package to fetch
 
+    --package-version=<version>
+        Exact version of the source package to fetch. If not set
+        the latest version is fetched
+
     --registry=<uri>
-        Container registry URI
+        Container registry URI. A comma separated list of
+        registries is tried in the given order if pulling from
+        a registry keeps failing with a temporary error
 
     --container=<name>
         Container name to pull. The container is expected to
         contain the Debian/Ubuntu development tools
 
+    --mirror=<uri>
+        Debian/Ubuntu package mirror URI. If set, the sources are
+        fetched directly from the mirror without a container. A
+        comma separated list of mirrors is tried in the given
+        order if a mirror keeps failing with a temporary error
+
+    --distribution=<name>
+        Distribution name on the mirror, e.g hirsute
+
+    --snapshot=<timestamp>
+        Fetch from the state of a snapshot archive at the given
+        time, e.g. 20210801T000000Z. The timestamp is appended to
+        the mirror URI, which must point to the snapshot archive,
+        e.g. https://snapshot.debian.org/archive/debian
+
+    --components=<list>
+        Comma separated list of mirror components to search
+        for the package [default: main]
+
+    --keyring=<file>
+        Keyring to verify the signature of the mirror InRelease
+        file with gpgv. If not set the signature is not checked
+
+    --download-workers=<number>
+        Number of files downloaded concurrently from the mirror.
+        Interrupted downloads are resumed [default: 4]
+
+    --prefetch-manifest=<file>
+        Resolve the Build-Depends, Build-Depends-Arch and
+        Build-Depends-Indep of the fetched package against the
+        Packages indexes of the --mirror components and write the
+        binary dependency closure as a JSON manifest of package
+        URLs, sizes and checksums to file. Relations which can
+        not be satisfied are listed in the manifest. The parsed
+        Packages indexes are kept below --cache-dir and reused as
+        long as they do not change on the mirror
+
+    --prefetch-dir=<directory>
+        Download the packages of the build dependency closure
+        into directory, e.g. a local package cache of the build
+        host. Packages already present are not downloaded again
+
+    --architecture=<name>
+        Architecture to resolve the build dependencies for
+        [default: amd64]
+
     --outdir=<obs_out>
         Output directory to store data produced by the service.
         At the time the service is called through the OBS API
         this option is set.
+
+    --cache-dir=<directory>
+        Directory to store cache data shared between service
+        calls on the same host. If not set no caching takes place
+
+    --image-ttl=<seconds>
+        Time in seconds a pulled container image is considered
+        fresh without asking the registry. After that time the
+        image is only pulled again if its registry digest has
+        changed. Requires --cache-dir [default: 3600]
+
+    --apt-ttl=<seconds>
+        Time in seconds the package index cached below --cache-dir
+        is used without running apt update, or without checking
+        the --mirror for an updated Sources index. After that time
+        the cached index is updated incrementally, from the pdiff
+        patches of the mirror if it has them [default: 3600]
+        Lookups of a pinned --package-version or --snapshot are
+        cached below --cache-dir too and do not need the index
+        again
+
+    --timeout=<seconds>
+        Maximum time in seconds all commands run by the service
+        may take in sum. A command still running at that time is
+        terminated together with its child processes and the
+        service fails. If not set there is no limit
+
+    --source-cache-size=<megabytes>
+        Maximum size of the source package file store in the
+        cache directory. Source files of a package version fetched
+        before are taken from that store instead of downloading
+        them again. If the store grows beyond this size the least
+        recently used packages are removed [default: 10240]
+
+    --daemon-socket=<path>
+        Unix socket of a corbos_scm_daemon serving the same
+        registry and container. If the daemon is running the
+        request is passed to it and served from its pool of warm
+        containers. Otherwise, or if the daemon does not answer
+        within half of --timeout, or 30 minutes without it, the
+        sources are fetched directly
+        [default: /run/corbos_scm/daemon.sock]
+
+    --report=<file>
+        Write a JSON report of the run to file. It contains the
+        wall time of each phase and command, their exit codes and
+        the number of bytes written to the output directory. If
+        the file name ends with .jsonl the report is appended as
+        one line, such that the reports of many runs can be
+        collected in one file
+
+    --metrics=<file>
+        Prometheus textfile collector file to merge the metrics of
+        this run into, e.g. pulls performed and skipped, command
+        and phase durations, downloaded bytes and failures by
+        error type. Concurrent runs update the file safely
+
+    --retries=<number>
+        Number of retries of a phase failing with a temporary
+        error, e.g. a network or mirror issue, per registry or
+        mirror. The delay between retries grows exponentially
+        [default: 3]
+
+    --retry-budget=<seconds>
+        Maximum time in seconds a phase may take including its
+        retries and failover to other registries or mirrors
+        [default: 300]
+
+    --bandwidth-limit=<kbytes>
+        Maximum rate in kB/s at which the source files are
+        downloaded. With the container the limit is passed to apt
+        and the request is not passed to a daemon. If not set
+        there is no limit
+
+    --apt-proxy=<uri>
+        URI of a corbos_scm_proxy as reachable from the container,
+        e.g. http://host.containers.internal:3142. The apt http
+        traffic of the container is sent through this caching
+        proxy. With --cache-dir the proxy is started on this host
+        if nothing listens on the port of the URI yet
+
+    --apt-proxy-hosts=<list>
+        Comma separated list of the archive hosts the started
+        proxy passes requests to, subdomains included. This has
+        to cover the http repositories of the container. If not
+        set the default of corbos_scm_proxy applies
 """
-import os
-from pathlib import Path
-from tempfile import TemporaryDirectory
 import docopt
 
 from corbos_scm.version import __version__
-from corbos_scm.command import Command
 from corbos_scm.exceptions import (
     exception_handler
 )
@@ -56,45 +221,11 @@ from corbos_scm.exceptions import (
 def main() -> None:
     args = docopt.docopt(__doc__, version=__version__)
 
-    if not os.path.exists(args['--outdir']):
-        Path(args['--outdir']).mkdir(parents=True, exist_ok=True)
-
-    Command.run(
-        [
-            'podman', 'pull',
-            f'{args["--registry"]}/{args["--container"]}'
-        ]
-    )
-
-    pull_debian_source = [
-        'cd', '/mnt', '&&', 'apt', 'update', '&&',
-        'apt', 'source', args['--package'], '&&',
-        'find', '-maxdepth', '1', '-type', 'd', '-not', '-path', '.', '|',
-        'xargs', 'rm', '-rf'
-    ]
-
-    # Create a safe symlink with regards to the volume
-    # name limitations of podman. For sharing a directory
-    # some characters are not allowed, e.g ":". In OBS
-    # the colon is used as project separator. Because of
-    # that it happens very easily that the --outdir path
-    # created by OBS at call time of the service contains
-    # colons and prevents this directory name from being
-    # eligible to be shared via --volume with podman.
-    # The recommended workaround from the podman team is
-    # to create a temporary symlink which is what is
-    # done next
-    save_volume_dir = TemporaryDirectory()
-    save_volume_file = os.sep.join(
-        [save_volume_dir.name, 'volume']
-    )
-
-    os.symlink(args["--outdir"], save_volume_file)
-
-    Command.run(
-        [
-            'podman', 'run', '--volume', f'{save_volume_file}:/mnt',
-            '-ti', '--rm', args["--container"], 'bash', '-c',
-            ' '.join(pull_debian_source)
-        ]
-    )
+    # the fetch machinery is imported only once the arguments are
+    # accepted, --help, --version and usage errors stay cheap
+    from corbos_scm.service import serve
+    serve(args)
+
+
+if __name__ == '__main__':
+    main()
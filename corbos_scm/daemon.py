@@ -0,0 +1,411 @@
+# Copyright (c) 2021 Marcus Schäfer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""
+Usage:
+    corbos_scm_daemon --registry=<uri> --container=<name>
+        [--socket=<path>]
+        [--pool-size=<number>]
+        [--work-dir=<directory>]
+        [--cache-dir=<directory>]
+        [--image-ttl=<seconds>]
+        [--apt-ttl=<seconds>]
+        [--apt-proxy=<uri>]
+        [--apt-proxy-hosts=<list>]
+        [--metrics=<file>]
+    corbos_scm_daemon -h | --help
+    corbos_scm_daemon --version
+
+Options:
+    --registry=<uri>
+        Container registry URI
+
+    --container=<name>
+        Container name to pull. The container is expected to
+        contain the Debian/Ubuntu development tools
+
+    --socket=<path>
+        Unix socket to accept fetch requests from corbos_scm
+        [default: /run/corbos_scm/daemon.sock]
+
+    --pool-size=<number>
+        Number of containers kept running to serve requests
+        concurrently [default: 2]
+
+    --work-dir=<directory>
+        Directory shared with the pool containers. Sources are
+        fetched below it and then moved to the requested output
+        directory [default: /var/tmp/corbos_scm]
+
+    --cache-dir=<directory>
+        Directory to store cache data shared between service
+        calls on the same host. If not set no caching takes place
+
+    --image-ttl=<seconds>
+        Time in seconds a pulled container image is considered
+        fresh without asking the registry [default: 3600]
+
+    --apt-ttl=<seconds>
+        Time in seconds the package index of a pool container
+        is used without running apt update [default: 3600]
+
+    --apt-proxy=<uri>
+        URI of a corbos_scm_proxy as reachable from the pool
+        containers. The apt http traffic of the containers is
+        sent through this caching proxy. With --cache-dir the
+        proxy is started on this host if nothing listens on the
+        port of the URI yet
+
+    --apt-proxy-hosts=<list>
+        Comma separated list of the archive hosts the started
+        proxy passes requests to, subdomains included. This has
+        to cover the http repositories of the containers. If not
+        set the default of corbos_scm_proxy applies
+
+    --metrics=<file>
+        Prometheus textfile collector file to merge the metrics
+        of each served request into
+"""
+import os
+import json
+import time
+import queue
+import shutil
+import signal
+import logging
+import threading
+import socketserver
+from pathlib import Path
+from tempfile import mkdtemp
+from typing import (
+    Callable, Dict, Optional
+)
+import docopt
+
+from corbos_scm.version import __version__
+from corbos_scm.command import command_type
+from corbos_scm.container import (
+    pull, ContainerSession
+)
+from corbos_scm.apt import (
+    get_update_command, get_source_command, get_showsrc_command,
+    check_package, AptProxyConfig
+)
+from corbos_scm.apt_cache import AptCache
+from corbos_scm.service import get_apt_proxy
+from corbos_scm.batch import (
+    fetch_result_type, get_error_message
+)
+from corbos_scm.report import get_directory_size
+from corbos_scm.filesystem import link_or_copy
+from corbos_scm.metrics import Metrics
+from corbos_scm.exceptions import exception_handler
+
+log = logging.getLogger('corbos_scm')
+
+# exit code of podman exec if the container is gone
+CONTAINER_GONE = 125
+
+
+@exception_handler
+def main() -> None:
+    args = docopt.docopt(__doc__, version=__version__)
+
+    Metrics.setup(args['--metrics'])
+
+    image = f'{args["--registry"]}/{args["--container"]}'
+    pull(image, args['--cache-dir'], int(args['--image-ttl']))
+
+    apt_cache = None
+    if args['--cache-dir']:
+        apt_cache = AptCache(
+            args['--cache-dir'], args['--container'], int(args['--apt-ttl'])
+        )
+
+    pool = ContainerPool(
+        args['--container'], int(args['--pool-size']), args['--work-dir'],
+        apt_cache, int(args['--apt-ttl']), get_apt_proxy(args)
+    )
+    server = DaemonServer(args['--socket'], image, pool)
+    signal.signal(
+        signal.SIGTERM,
+        lambda signum, frame: threading.Thread(target=server.shutdown).start()
+    )
+    try:
+        pool.start()
+        log.info(f'Serving {image} on {args["--socket"]}')
+        server.serve_forever()
+    finally:
+        server.close()
+        pool.stop()
+
+
+class ContainerPool:
+    """
+    Pool of running containers to fetch sources in
+
+    Starting a container and bringing its package index up to
+    date takes much longer than fetching the sources of a single
+    package. The pool keeps containers running such that a fetch
+    request only pays for the apt source call. Each container
+    shares the work directory, sources are fetched into a
+    private subdirectory of it and moved to the requested output
+    directory afterwards
+    """
+    def __init__(
+        self, container: str, size: int, work_dir: str,
+        apt_cache: Optional[AptCache] = None, apt_ttl: int = 3600,
+        apt_proxy: Optional[AptProxyConfig] = None
+    ) -> None:
+        """
+        Setup pool
+
+        :param str container: container name
+        :param int size: number of containers
+        :param str work_dir: directory shared with the containers
+        :param AptCache apt_cache: optional shared apt index cache
+        :param int apt_ttl:
+            package index ttl of a container if no apt_cache is used
+        :param AptProxyConfig apt_proxy: optional caching proxy
+        """
+        self.container = container
+        self.size = size
+        self.work_dir = work_dir
+        self.apt_cache = apt_cache
+        self.apt_ttl = apt_ttl
+        self.apt_proxy = apt_proxy
+        self.sessions: queue.Queue = queue.Queue()
+        self.updated: Dict[str, float] = {}
+
+    def start(self) -> None:
+        """
+        Start all pool containers
+        """
+        Path(self.work_dir).mkdir(parents=True, exist_ok=True)
+        for _ in range(self.size):
+            self.sessions.put(self._new_session())
+
+    def stop(self) -> None:
+        """
+        Remove all pool containers
+        """
+        while not self.sessions.empty():
+            self.sessions.get().stop()
+
+    def fetch(
+        self, package: str, outdir: str, version: Optional[str] = None
+    ) -> fetch_result_type:
+        """
+        Fetch package sources into outdir using a pool container
+
+        Blocks until a container is free. A container which has
+        gone away is replaced and the fetch is tried once more
+
+        :param str package: source or binary package name
+        :param str outdir: output directory
+        :param str version: exact version, None for the candidate
+
+        :return: A fetch_result_type
+
+        :rtype: NamedTuple
+
+        :raises CSCMPackageNameError: if package or version is not valid
+        """
+        # requests come from any client, reject them before they
+        # occupy a container
+        check_package(package, version)
+        started = time.monotonic()
+        result = self._execute(
+            lambda session: self._fetch(session, package, outdir, version)
+        )
+        success = result.returncode == 0
+        return fetch_result_type(
+            package=package,
+            outdir=outdir,
+            success=success,
+            message=get_error_message(result),
+            duration=round(time.monotonic() - started, 3),
+            size=get_directory_size(outdir) if success else None
+        )
+
+    def resolve(self, package: str) -> command_type:
+        """
+        Look up the source records of package using a pool container
+
+        Blocks until a container is free, see fetch
+
+        :param str package: source or binary package name
+
+        :return: A command_type with the apt-cache showsrc output
+
+        :rtype: command_type
+
+        :raises CSCMPackageNameError: if package is not valid
+        """
+        check_package(package)
+        return self._execute(
+            lambda session: self._resolve(session, package)
+        )
+
+    def _execute(
+        self, action: Callable[[ContainerSession], command_type]
+    ) -> command_type:
+        session = self.sessions.get()
+        try:
+            result = action(session)
+            if result.returncode == CONTAINER_GONE:
+                log.warning(f'Container {session.container_id} gone, replacing')
+                session.stop()
+                session = self._new_session()
+                result = action(session)
+        finally:
+            self.sessions.put(session)
+        return result
+
+    def _new_session(self) -> ContainerSession:
+        volumes = {self.work_dir: '/work'}
+        if self.apt_cache:
+            volumes.update(self.apt_cache.get_volumes())
+        if self.apt_proxy:
+            volumes.update(self.apt_proxy.get_volumes())
+        session = ContainerSession(self.container, volumes)
+        session.start()
+        return session
+
+    def _update(self, session: ContainerSession) -> None:
+        if self.apt_cache:
+            with self.apt_cache.update_lock():
+                if not self.apt_cache.is_fresh():
+                    session.execute(self.apt_cache.get_update_command())
+        elif time.time() - self.updated.get(
+            session.container_id, 0
+        ) > self.apt_ttl:
+            session.execute(get_update_command())
+            self.updated[session.container_id] = time.time()
+
+    def _resolve(
+        self, session: ContainerSession, package: str
+    ) -> command_type:
+        self._update(session)
+        showsrc = get_showsrc_command(package)
+        if self.apt_cache:
+            with self.apt_cache.read_lock():
+                return session.execute(showsrc, raise_on_error=False)
+        return session.execute(showsrc, raise_on_error=False)
+
+    def _fetch(
+        self, session: ContainerSession, package: str, outdir: str,
+        version: Optional[str]
+    ) -> command_type:
+        fetch_dir = mkdtemp(dir=self.work_dir)
+        try:
+            self._update(session)
+            fetch_source = [
+                'cd', f'/work/{os.path.basename(fetch_dir)}', '&&'
+            ] + get_source_command(package, version)
+            if self.apt_cache:
+                with self.apt_cache.read_lock():
+                    result = session.execute(fetch_source, raise_on_error=False)
+            else:
+                result = session.execute(fetch_source, raise_on_error=False)
+            if result.returncode == 0:
+                Path(outdir).mkdir(parents=True, exist_ok=True)
+                for name in os.listdir(fetch_dir):
+                    link_or_copy(
+                        os.sep.join([fetch_dir, name]),
+                        os.sep.join([outdir, name])
+                    )
+            return result
+        finally:
+            shutil.rmtree(fetch_dir, ignore_errors=True)
+
+
+class DaemonRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Handle one fetch or resolve request, see client.DaemonClient
+    """
+    server: 'DaemonServer'
+
+    def handle(self) -> None:
+        try:
+            request = json.loads(self.rfile.readline().decode())
+            if request.get('image') != self.server.image:
+                response = {
+                    'success': False, 'unsupported': True,
+                    'message': f'daemon serves {self.server.image}'
+                }
+            elif request.get('resolve'):
+                resolved = self.server.pool.resolve(request['package'])
+                response = {
+                    'success': resolved.returncode == 0,
+                    'message': get_error_message(resolved),
+                    'output': resolved.output
+                }
+            else:
+                result = self.server.pool.fetch(
+                    request['package'], request['outdir'],
+                    request.get('version')
+                )
+                response = {
+                    'success': result.success, 'message': result.message
+                }
+        except Exception as issue:
+            log.error(f'Request failed: {type(issue).__name__}: {issue}')
+            response = {'success': False, 'message': str(issue)}
+        Metrics.inc(
+            'corbos_scm_daemon_requests_total',
+            {'result': 'success' if response['success'] else 'failure'}
+        )
+        self.wfile.write(json.dumps(response).encode() + b'\n')
+        Metrics.flush()
+
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Threaded Unix socket server passing requests to the pool
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, image: str, pool: ContainerPool):
+        """
+        Setup server listening on socket_path
+
+        :param str socket_path: Unix socket path
+        :param str image: registry/container image served
+        :param ContainerPool pool: pool to fetch in
+        """
+        self.socket_path = socket_path
+        self.image = image
+        self.pool = pool
+        Path(os.path.dirname(socket_path) or '.').mkdir(
+            parents=True, exist_ok=True
+        )
+        if os.path.exists(socket_path):
+            # left behind by a daemon which did not shut down cleanly
+            os.unlink(socket_path)
+        super().__init__(socket_path, DaemonRequestHandler)
+
+    def close(self) -> None:
+        """
+        Close the server socket and remove the socket file
+        """
+        self.server_close()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
@@ -0,0 +1,404 @@
+# Copyright (c) 2021 Marcus Schäfer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+import os
+import time
+import hashlib
+import logging
+import threading
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import URLError
+from urllib.parse import (
+    urlsplit, urljoin
+)
+from urllib.request import urlopen
+from typing import (
+    NamedTuple, Dict, List, Tuple, Optional, IO
+)
+
+from corbos_scm.metrics import Metrics
+from corbos_scm.exceptions import (
+    CSCMDownloadError,
+    CSCMChecksumError
+)
+
+log = logging.getLogger('corbos_scm')
+
+download_job_type = NamedTuple(
+    'download_job_type', [
+        ('url', str),
+        ('filename', str),
+        ('size', Optional[int]),
+        ('sha256', Optional[str])
+    ]
+)
+
+CHUNK_SIZE = 1 << 20
+
+
+class StreamVerifier:
+    """
+    Size and sha256 verification of data while it is streamed
+
+    The checksum is calculated from the chunks as they are written,
+    such that no second read of the file is needed. Data exceeding
+    the expected size is rejected immediately
+    """
+    def __init__(
+        self, name: str, size: Optional[int] = None,
+        sha256: Optional[str] = None
+    ) -> None:
+        """
+        Setup verifier
+
+        :param str name: name of the data for error messages
+        :param int size: expected size or None
+        :param str sha256: expected hex digest or None
+        """
+        self.name = name
+        self.size = size
+        self.sha256 = sha256
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Restart verification from the first byte
+        """
+        self.checksum = hashlib.sha256()
+        self.received = 0
+
+    def update(self, chunk: bytes) -> None:
+        """
+        Add next chunk of data
+
+        :param bytes chunk: data
+        """
+        self.received += len(chunk)
+        if self.size is not None and self.received > self.size:
+            raise CSCMChecksumError(
+                f'{self.name}: more data than the expected {self.size} bytes'
+            )
+        self.checksum.update(chunk)
+
+    def update_from_file(self, filename: str) -> None:
+        """
+        Restart verification with the data of an existing file,
+        used to continue a download left by a previous run
+
+        :param str filename: file path
+        """
+        self.reset()
+        with open(filename, 'rb') as data:
+            for chunk in iter(lambda: data.read(CHUNK_SIZE), b''):
+                self.update(chunk)
+
+    def verify(self) -> None:
+        """
+        Verify the complete data
+
+        :raises CSCMChecksumError: if size or checksum do not match
+        """
+        if self.size is not None and self.received != self.size:
+            raise CSCMChecksumError(
+                f'{self.name}: size {self.received} != {self.size}'
+            )
+        if self.sha256 and self.checksum.hexdigest() != self.sha256:
+            raise CSCMChecksumError(
+                f'{self.name}: sha256 {self.checksum.hexdigest()} '
+                f'!= {self.sha256}'
+            )
+
+
+class Throttle:
+    """
+    Transfer rate limit shared by concurrent downloads
+
+    Every transferred chunk reserves the time it takes at the
+    given rate. A transfer ahead of its reserved time waits until
+    the rate is met again
+    """
+    def __init__(self, rate: int) -> None:
+        """
+        Setup throttle
+
+        :param int rate: maximum rate in bytes per second
+        """
+        self.rate = rate
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, size: int) -> None:
+        """
+        Account transferred data, waits if the rate is exceeded
+
+        :param int size: number of bytes transferred
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.next_time = max(self.next_time, now) + size / self.rate
+            delay = self.next_time - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+def fetch_url(url: str, timeout: int = 60) -> bytes:
+    """
+    Read the data of the given URL into memory
+
+    :param str url: http(s) or file URL
+    :param int timeout: socket timeout in seconds
+
+    :return: data
+
+    :rtype: bytes
+    """
+    try:
+        with urlopen(url, timeout=timeout) as response:
+            return response.read()
+    except (URLError, OSError) as issue:
+        raise CSCMDownloadError(f'Failed to fetch {url}: {issue}')
+
+
+def download(
+    url: str, filename: str, size: Optional[int] = None,
+    sha256: Optional[str] = None, timeout: int = 60
+) -> None:
+    """
+    Download the given URL into a file
+
+    :param str url: http(s) or file URL
+    :param str filename: target file path
+    :param int size: expected size, checked while downloading
+    :param str sha256: expected checksum, checked while downloading
+    :param int timeout: socket timeout in seconds
+    """
+    verifier = StreamVerifier(os.path.basename(filename), size, sha256)
+    try:
+        with urlopen(url, timeout=timeout) as response:
+            with open(filename, 'wb') as target:
+                _copy(response, target, verifier)
+        verifier.verify()
+    except (URLError, OSError) as issue:
+        raise CSCMDownloadError(f'Failed to download {url}: {issue}')
+    except CSCMChecksumError:
+        os.unlink(filename)
+        raise
+
+
+class Downloader:
+    """
+    Parallel HTTP downloader
+
+    Files are downloaded concurrently by a bounded pool of worker
+    threads. HTTP connections are kept alive and reused for further
+    requests to the same host. An interrupted transfer is resumed
+    from where it stopped using an HTTP Range request. Data is
+    written to a .part file which is renamed when complete, such
+    that a partial file left behind by an aborted run is resumed
+    too. If size and checksum are known, they are verified while
+    the data is streamed to disk. Other URL schemes are downloaded
+    via urllib. A rate limit applies to all HTTP downloads
+    together
+    """
+    max_redirects = 5
+
+    def __init__(
+        self, workers: int = 4, retries: int = 3, timeout: int = 60,
+        rate_limit: Optional[int] = None
+    ) -> None:
+        """
+        Setup downloader
+
+        :param int workers: maximum number of concurrent downloads
+        :param int retries: resume attempts per file
+        :param int timeout: socket timeout in seconds
+        :param int rate_limit: maximum rate in bytes per second or None
+        """
+        self.workers = workers
+        self.retries = retries
+        self.timeout = timeout
+        self.throttle = Throttle(rate_limit) if rate_limit else None
+        self.connections: Dict[
+            Tuple[str, str], List[http.client.HTTPConnection]
+        ] = {}
+        self.connections_lock = threading.Lock()
+
+    def __enter__(self) -> 'Downloader':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def download_all(self, jobs: List[download_job_type]) -> None:
+        """
+        Download all given URLs concurrently
+
+        :param list jobs: list of download_job_type
+
+        :raises CSCMDownloadError: for the first failed download
+        """
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = [
+                pool.submit(
+                    self.download, job.url, job.filename, job.size, job.sha256
+                ) for job in jobs
+            ]
+            for future in futures:
+                future.result()
+
+    def download(
+        self, url: str, filename: str, size: Optional[int] = None,
+        sha256: Optional[str] = None
+    ) -> None:
+        """
+        Download URL into file, resuming interrupted transfers
+
+        :param str url: http(s) or file URL
+        :param str filename: target file path
+        :param int size: expected size, checked while downloading
+        :param str sha256: expected checksum, checked while downloading
+
+        :raises CSCMChecksumError: if the data does not match
+        """
+        if urlsplit(url).scheme not in ('http', 'https'):
+            return download(url, filename, size, sha256, self.timeout)
+        partial_file = f'{filename}.part'
+        verifier = StreamVerifier(os.path.basename(filename), size, sha256)
+        issue: Exception = CSCMDownloadError('no attempt')
+        try:
+            for _ in range(self.retries + 1):
+                offset = 0
+                if os.path.exists(partial_file):
+                    offset = os.path.getsize(partial_file)
+                if offset != verifier.received:
+                    verifier.update_from_file(partial_file)
+                try:
+                    self._transfer(url, partial_file, offset, verifier)
+                    verifier.verify()
+                    os.replace(partial_file, filename)
+                    return None
+                except (OSError, http.client.HTTPException) as transfer_issue:
+                    issue = transfer_issue
+                    log.warning(
+                        f'Download of {url} interrupted: {issue!r}, resuming'
+                    )
+        except CSCMChecksumError:
+            # the data is wrong, resuming it would not help
+            if os.path.exists(partial_file):
+                os.unlink(partial_file)
+            raise
+        raise CSCMDownloadError(f'Failed to download {url}: {issue!r}')
+
+    def close(self) -> None:
+        """
+        Close all idle connections
+        """
+        with self.connections_lock:
+            for connections in self.connections.values():
+                for connection in connections:
+                    connection.close()
+            self.connections = {}
+
+    def _transfer(
+        self, url: str, partial_file: str, offset: int,
+        verifier: StreamVerifier
+    ) -> None:
+        for _ in range(self.max_redirects + 1):
+            location = self._get(url, partial_file, offset, verifier)
+            if not location:
+                return
+            url = urljoin(url, location)
+        raise CSCMDownloadError(f'Too many redirects for {url}')
+
+    def _get(
+        self, url: str, partial_file: str, offset: int,
+        verifier: StreamVerifier
+    ) -> Optional[str]:
+        location = urlsplit(url)
+        key = (location.scheme, location.netloc)
+        connection = self._acquire(key)
+        try:
+            connection.request(
+                'GET', location.path + (
+                    f'?{location.query}' if location.query else ''
+                ), headers={'Range': f'bytes={offset}-'} if offset else {}
+            )
+            response = connection.getresponse()
+            if response.status in (301, 302, 303, 307, 308):
+                response.read()
+                self._release(key, connection)
+                return response.getheader('Location', '')
+            if response.status == 416 and offset:
+                # nothing left to fetch, the partial file is complete
+                response.read()
+                self._release(key, connection)
+                return None
+            if response.status not in (200, 206):
+                response.read()
+                self._release(key, connection)
+                raise CSCMDownloadError(
+                    f'Failed to download {url}: HTTP {response.status}'
+                )
+            if response.status == 200:
+                # server ignored the range, data starts from scratch
+                verifier.reset()
+            expected = int(response.getheader('Content-Length', -1))
+            with open(
+                partial_file, 'ab' if response.status == 206 else 'wb'
+            ) as target:
+                received = _copy(response, target, verifier, self.throttle)
+            if expected >= 0 and received != expected:
+                raise http.client.IncompleteRead(b'', expected - received)
+        except (OSError, http.client.HTTPException, CSCMChecksumError):
+            connection.close()
+            raise
+        self._release(key, connection)
+        return None
+
+    def _acquire(self, key: Tuple[str, str]) -> http.client.HTTPConnection:
+        with self.connections_lock:
+            if self.connections.get(key):
+                return self.connections[key].pop()
+        scheme, netloc = key
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(netloc, timeout=self.timeout)
+
+    def _release(
+        self, key: Tuple[str, str], connection: http.client.HTTPConnection
+    ) -> None:
+        with self.connections_lock:
+            self.connections.setdefault(key, []).append(connection)
+
+
+def _copy(
+    source: IO, target: IO, verifier: StreamVerifier,
+    throttle: Optional[Throttle] = None
+) -> int:
+    received = 0
+    for chunk in iter(lambda: source.read(CHUNK_SIZE), b''):
+        verifier.update(chunk)
+        target.write(chunk)
+        received += len(chunk)
+        if throttle:
+            throttle.consume(len(chunk))
+    Metrics.inc('corbos_scm_downloaded_bytes_total', value=received)
+    return received
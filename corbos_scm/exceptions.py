@@ -19,9 +19,14 @@
 # SOFTWARE.
 #
 import sys
+import time
 import logging
 from functools import wraps
-from typing import Callable
+from typing import (
+    Callable, Optional
+)
+
+from corbos_scm.metrics import Metrics
 
 log = logging.getLogger('corbos_scm')
 
@@ -40,22 +45,30 @@ def exception_handler(func: Callable) -> Callable:
     """
     @wraps(func)
     def wrapper(*args, **kwargs):
+        started = time.monotonic()
         try:
-            return func(*args, **kwargs)
+            result = func(*args, **kwargs)
+            Metrics.record_run(time.monotonic() - started, None)
+            return result
         except CSCMError as issue:
             # known exception, log information and exit
+            Metrics.record_run(time.monotonic() - started, issue)
             log.error(f'{type(issue).__name__}: {issue}')
             sys.exit(1)
-        except KeyboardInterrupt:
+        except KeyboardInterrupt as issue:
+            Metrics.record_run(time.monotonic() - started, issue)
             log.error('Exit on keyboard interrupt')
             sys.exit(1)
         except SystemExit as issue:
             # user exception, program aborted by user
             sys.exit(issue)
-        except Exception:
+        except Exception as issue:
             # exception we did no expect, show python backtrace
+            Metrics.record_run(time.monotonic() - started, issue)
             log.error('Unexpected error:')
             raise
+        finally:
+            Metrics.flush()
     return wrapper
 
 
@@ -89,3 +102,139 @@ class CSCMCommandError(CSCMError):
     Exception raised if popen call failed and or command
     execution was not successful
     """
+    def __init__(
+        self, message, returncode: Optional[int] = None,
+        stderr: Optional[str] = None, stdout: Optional[str] = None
+    ) -> None:
+        """
+        Store exception message, command exit code and output
+
+        :param str message: Exception message text
+        :param int returncode: exit code, None if the command did not exit
+        :param str stderr: end of the command stderr, None if unknown
+        :param str stdout: end of the command stdout, None if unknown
+        """
+        super().__init__(message)
+        self.returncode = returncode
+        self.stderr = stderr
+        self.stdout = stdout
+
+
+class CSCMLockError(CSCMError):
+    """
+    Exception raised if a lock file could not be created
+    or locked
+    """
+
+
+class CSCMImageCacheError(CSCMError):
+    """
+    Exception raised if the image cache state file could not
+    be read or written
+    """
+
+
+class CSCMBatchError(CSCMError):
+    """
+    Exception raised if at least one package of a batch
+    could not be fetched
+    """
+
+
+class CSCMSourceCacheError(CSCMError):
+    """
+    Exception raised if the source cache could not be read
+    or written
+    """
+
+
+class CSCMDownloadError(CSCMError):
+    """
+    Exception raised if a file could not be downloaded
+    """
+
+
+class CSCMMirrorError(CSCMError):
+    """
+    Exception raised if the mirror index is invalid or does
+    not provide the requested package
+    """
+
+
+class CSCMChecksumError(CSCMError):
+    """
+    Exception raised if downloaded data does not match its
+    expected size or checksum
+    """
+
+
+class CSCMCommandTimeoutError(CSCMCommandError):
+    """
+    Exception raised if a command did not finish in time
+    """
+
+
+class CSCMDaemonError(CSCMError):
+    """
+    Exception raised if the daemon could not fetch the
+    requested package
+    """
+
+
+class CSCMReportError(CSCMError):
+    """
+    Exception raised if the run report could not be written
+    """
+
+
+class CSCMStateError(CSCMError):
+    """
+    Exception raised if the outdir state could not be written
+    """
+
+
+class CSCMMetadataCacheError(CSCMError):
+    """
+    Exception raised if the metadata cache could not be written
+    """
+
+
+class CSCMSourcesIndexError(CSCMError):
+    """
+    Exception raised if the Sources index database could not
+    be read or written
+    """
+
+
+class CSCMPdiffError(CSCMError):
+    """
+    Exception raised if a Sources index patch is invalid
+    """
+
+
+class CSCMProxyError(CSCMError):
+    """
+    Exception raised if the caching apt proxy could not be
+    started or reached
+    """
+
+
+class CSCMPrefetchError(CSCMError):
+    """
+    Exception raised if the build dependencies of a package
+    could not be resolved or prefetched
+    """
+
+
+class CSCMPackageNameError(CSCMError):
+    """
+    Exception raised if a package name or version is not valid
+    for a Debian package
+    """
+
+
+class CSCMSourceFormatError(CSCMError):
+    """
+    Exception raised if a source package record is not valid,
+    e.g lists a file name which is not a plain basename
+    """
@@ -0,0 +1,113 @@
+# Copyright (c) 2021 Marcus Schäfer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+import os
+import fcntl
+import shutil
+import hashlib
+
+# ioctl request number of FICLONE from linux/fs.h
+FICLONE = 0x40049409
+
+
+def link_or_copy(source: str, target: str) -> str:
+    """
+    Make the data of source available as target at the lowest cost
+
+    A hardlink is tried first, if source and target are on different
+    filesystems a reflink is tried and a plain copy is the last
+    resort. An existing target is replaced
+
+    :param str source: source file path
+    :param str target: target file path
+
+    :return: method used, one of link, reflink or copy
+
+    :rtype: str
+    """
+    if os.path.lexists(target):
+        os.unlink(target)
+    try:
+        os.link(source, target)
+        return 'link'
+    except OSError:
+        return reflink_or_copy(source, target)
+
+
+def reflink_or_copy(source: str, target: str) -> str:
+    """
+    Make the data of source available as an independent file target
+
+    Unlike a hardlink, target has its own inode, a change of the
+    mode or the data of one file does not affect the other. A
+    reflink is tried first and a plain copy is the last resort.
+    An existing target is replaced
+
+    :param str source: source file path
+    :param str target: target file path
+
+    :return: method used, one of reflink or copy
+
+    :rtype: str
+    """
+    if os.path.lexists(target):
+        os.unlink(target)
+    try:
+        reflink(source, target)
+        return 'reflink'
+    except OSError:
+        shutil.copyfile(source, target)
+        return 'copy'
+
+
+def reflink(source: str, target: str) -> None:
+    """
+    Create target as copy on write clone of source
+
+    :param str source: source file path
+    :param str target: target file path
+
+    :raises OSError: if the filesystem does not support reflinks
+    """
+    with open(source, 'rb') as source_file:
+        with open(target, 'wb') as target_file:
+            try:
+                fcntl.ioctl(target_file.fileno(), FICLONE, source_file.fileno())
+            except OSError:
+                target_file.close()
+                os.unlink(target)
+                raise
+
+
+def sha256sum(filename: str) -> str:
+    """
+    Calculate sha256 checksum of the given file
+
+    :param str filename: file path
+
+    :return: hex digest
+
+    :rtype: str
+    """
+    checksum = hashlib.sha256()
+    with open(filename, 'rb') as data:
+        for chunk in iter(lambda: data.read(1 << 20), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
@@ -0,0 +1,164 @@
+# Copyright (c) 2021 Marcus Schäfer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+import os
+import json
+import time
+import logging
+from typing import (
+    Dict, Optional
+)
+
+from corbos_scm.command import Command
+from corbos_scm.lock import FileLock
+from corbos_scm.exceptions import (
+    CSCMCommandError,
+    CSCMImageCacheError
+)
+
+log = logging.getLogger('corbos_scm')
+
+
+class ImageCache:
+    """
+    Image freshness cache
+
+    Records the digest of each pulled registry/container image
+    and the time of the last check. A pull is skipped if the
+    last check is not older than the configured ttl, or if the
+    remote manifest digest did not change since the last pull
+    """
+    # seconds to wait for the manifest lookup
+    remote_timeout = 30
+
+    def __init__(self, cache_dir: str, ttl: int = 3600) -> None:
+        """
+        Setup cache instance
+
+        :param str cache_dir: directory to store the cache state
+        :param int ttl: time in seconds a recorded digest is trusted
+        """
+        self.ttl = ttl
+        self.state_file = os.sep.join([cache_dir, 'images.json'])
+        self.lock_file = os.sep.join([cache_dir, 'images.lock'])
+
+    def pull(self, image: str) -> bool:
+        """
+        Pull the given image unless the cache considers it fresh
+
+        The cache lock is held for the whole operation such that
+        concurrent callers for the same image wait for the first
+        one and then find a fresh cache entry
+
+        :param str image: registry/container image reference
+
+        :return: True if the image was pulled, False if skipped
+
+        :rtype: bool
+        """
+        with FileLock(self.lock_file):
+            state = self._read_state()
+            entry = state.get(image)
+            remote_digest = None
+            if entry and self._image_exists(image):
+                if time.time() - entry['checked'] < self.ttl:
+                    log.info(f'Image {image} within ttl, skip pull')
+                    return False
+                remote_digest = self.get_remote_digest(image)
+                if remote_digest and remote_digest == entry['digest']:
+                    log.info(f'Image {image} digest unchanged, skip pull')
+                    entry['checked'] = time.time()
+                    self._write_state(state)
+                    return False
+            if not remote_digest:
+                remote_digest = self.get_remote_digest(image)
+            Command.run(['podman', 'pull', image])
+            state[image] = {
+                'digest': remote_digest or self.get_local_digest(image),
+                'checked': time.time()
+            }
+            self._write_state(state)
+            return True
+
+    def get_remote_digest(self, image: str) -> Optional[str]:
+        """
+        Lookup manifest digest in the registry without pulling
+        any image layers
+
+        :param str image: registry/container image reference
+
+        :return: digest or None if not available
+
+        :rtype: str
+        """
+        try:
+            result = Command.run(
+                [
+                    'skopeo', 'inspect', '--no-tags',
+                    '--format', '{{.Digest}}', f'docker://{image}'
+                ], raise_on_error=False, timeout=self.remote_timeout
+            )
+        except CSCMCommandError:
+            # skopeo not installed or registry not responding,
+            # no cheap manifest check possible
+            return None
+        return result.output.strip() if result.returncode == 0 else None
+
+    @staticmethod
+    def get_local_digest(image: str) -> str:
+        """
+        Lookup digest of the local image
+
+        :param str image: registry/container image reference
+
+        :return: digest
+
+        :rtype: str
+        """
+        return Command.run(
+            ['podman', 'image', 'inspect', '--format', '{{.Digest}}', image]
+        ).output.strip()
+
+    @staticmethod
+    def _image_exists(image: str) -> bool:
+        return Command.run(
+            ['podman', 'image', 'exists', image], raise_on_error=False
+        ).returncode == 0
+
+    def _read_state(self) -> Dict[str, Dict]:
+        if not os.path.exists(self.state_file):
+            return {}
+        try:
+            with open(self.state_file) as state:
+                return json.load(state)
+        except (OSError, ValueError) as issue:
+            log.warning(f'Ignoring unreadable image cache: {issue}')
+            return {}
+
+    def _write_state(self, state: Dict[str, Dict]) -> None:
+        new_state_file = f'{self.state_file}.new'
+        try:
+            with open(new_state_file, 'w') as new_state:
+                json.dump(state, new_state)
+            os.replace(new_state_file, self.state_file)
+        except OSError as issue:
+            raise CSCMImageCacheError(
+                f'Failed to write image cache {self.state_file}: {issue}'
+            )
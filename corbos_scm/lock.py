@@ -0,0 +1,80 @@
+# Copyright (c) 2021 Marcus Schäfer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+import os
+import fcntl
+from typing import IO, Optional
+
+from corbos_scm.exceptions import CSCMLockError
+
+
+class FileLock:
+    """
+    Advisory file lock based on flock(2)
+
+    The lock is shared between all processes on the same host
+    which use the same lock file path. It is released automatically
+    by the kernel if the holding process dies
+    """
+    def __init__(self, filename: str, exclusive: bool = True) -> None:
+        """
+        Setup lock instance
+
+        :param str filename: path to lock file, created if not present
+        :param bool exclusive: request exclusive or shared lock
+        """
+        self.filename = filename
+        self.exclusive = exclusive
+        self.lock_file: Optional[IO] = None
+
+    def __enter__(self) -> 'FileLock':
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.release()
+
+    def acquire(self) -> None:
+        """
+        Block until the lock could be taken
+        """
+        lock_dir = os.path.dirname(self.filename)
+        try:
+            if lock_dir:
+                os.makedirs(lock_dir, exist_ok=True)
+            self.lock_file = open(self.filename, 'a+')
+            fcntl.flock(
+                self.lock_file.fileno(),
+                fcntl.LOCK_EX if self.exclusive else fcntl.LOCK_SH
+            )
+        except OSError as issue:
+            self.release()
+            raise CSCMLockError(
+                f'Failed to lock {self.filename}: {issue}'
+            )
+
+    def release(self) -> None:
+        """
+        Release the lock if taken
+        """
+        if self.lock_file:
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+            self.lock_file.close()
+            self.lock_file = None
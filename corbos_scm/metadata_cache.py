@@ -0,0 +1,135 @@
+# Copyright (c) 2021 Marcus Schäfer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+import os
+import json
+import logging
+from typing import (
+    Dict, Optional
+)
+
+from corbos_scm.lock import FileLock
+from corbos_scm.metrics import Metrics
+from corbos_scm.sources import (
+    source_package_type, source_file_type
+)
+from corbos_scm.exceptions import CSCMMetadataCacheError
+
+log = logging.getLogger('corbos_scm')
+
+
+class MetadataCache:
+    """
+    Cache of resolved source package records
+
+    Only lookups with an immutable result may be cached, i.e. a
+    pinned package version or the state of a snapshot archive at
+    a given time. Such a lookup is resolved from the cache without
+    reading or updating any package index
+    """
+    def __init__(self, cache_dir: str) -> None:
+        """
+        Setup metadata cache
+
+        :param str cache_dir: base cache directory
+        """
+        self.root = os.sep.join([cache_dir, 'metadata'])
+        self.index_file = os.sep.join([self.root, 'resolved.json'])
+        self.lock_file = os.sep.join([self.root, 'metadata.lock'])
+        os.makedirs(self.root, exist_ok=True)
+
+    def get(self, key: str) -> Optional[source_package_type]:
+        """
+        Lookup resolved source package record
+
+        :param str key: lookup key, see get_key
+
+        :return: source_package_type or None
+
+        :rtype: source_package_type
+        """
+        with FileLock(self.lock_file, exclusive=False):
+            entry = self._read_index().get(key)
+        if not entry:
+            Metrics.inc('corbos_scm_metadata_cache_total', {'result': 'miss'})
+            return None
+        Metrics.inc('corbos_scm_metadata_cache_total', {'result': 'hit'})
+        log.info(f'Resolved {key} from metadata cache')
+        return source_package_type(
+            package=entry['package'],
+            version=entry['version'],
+            directory=entry['directory'],
+            files=[
+                source_file_type(*source_file) for source_file in entry['files']
+            ],
+            binaries=entry['binaries']
+        )
+
+    def put(self, key: str, source: source_package_type) -> None:
+        """
+        Store resolved source package record
+
+        :param str key: lookup key, see get_key
+        :param source_package_type source: source package record
+        """
+        with FileLock(self.lock_file):
+            index = self._read_index()
+            index[key] = source._asdict()
+            self._write_index(index)
+
+    @staticmethod
+    def get_key(
+        origin: str, package: str, version: Optional[str] = None
+    ) -> str:
+        """
+        Lookup key of a package in the given package origin
+
+        :param str origin:
+            package origin, e.g. mirror, distribution and
+            components or the container name
+        :param str package: source or binary package name
+        :param str version: pinned version or None for the latest
+
+        :return: key
+
+        :rtype: str
+        """
+        return f'{origin} {package}={version or "latest"}'
+
+    def _read_index(self) -> Dict[str, Dict]:
+        if not os.path.exists(self.index_file):
+            return {}
+        try:
+            with open(self.index_file) as index:
+                return json.load(index)
+        except (OSError, ValueError) as issue:
+            log.warning(f'Ignoring unreadable metadata cache: {issue}')
+            return {}
+
+    def _write_index(self, index: Dict[str, Dict]) -> None:
+        new_index_file = f'{self.index_file}.new'
+        try:
+            with open(new_index_file, 'w') as new_index:
+                json.dump(index, new_index)
+            os.replace(new_index_file, self.index_file)
+        except OSError as issue:
+            raise CSCMMetadataCacheError(
+                f'Failed to write metadata cache: {issue}'
+            )
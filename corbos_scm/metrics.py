@@ -0,0 +1,246 @@
+# Copyright (c) 2021 Marcus Schäfer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+import os
+import re
+import fcntl
+import logging
+import threading
+from typing import (
+    Dict, List, Tuple, Optional
+)
+
+log = logging.getLogger('corbos_scm')
+
+# histogram buckets in seconds
+BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+SAMPLE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{.*\})?\s+(\S+)$')
+
+
+class Metrics:
+    """
+    Counters and histograms in the Prometheus text format
+
+    Metrics are collected in memory during a run and merged into
+    a file for the node_exporter textfile collector when flushed.
+    Counter and histogram values of the file are added up with
+    the values of the run under an exclusive flock, such that
+    concurrent runs on the same host do not lose updates. The
+    file is replaced atomically, the collector never reads a
+    partially written file. Nothing is written unless a file
+    was set via setup
+
+    This module only uses the standard library because it is
+    used by exceptions.exception_handler
+    """
+    filename: Optional[str] = None
+    samples: Dict[str, float] = {}
+    types: Dict[str, str] = {}
+    samples_lock = threading.Lock()
+
+    @staticmethod
+    def setup(filename: Optional[str]) -> None:
+        """
+        Set the textfile collector file to merge metrics into
+
+        :param str filename: file path, should end with .prom
+        """
+        Metrics.filename = filename
+
+    @staticmethod
+    def inc(
+        name: str, labels: Optional[Dict[str, str]] = None,
+        value: float = 1
+    ) -> None:
+        """
+        Increase counter
+
+        :param str name: metric name, should end with _total
+        :param dict labels: label name to value mapping
+        :param float value: amount to add
+        """
+        with Metrics.samples_lock:
+            Metrics.types[name] = 'counter'
+            Metrics._add(_get_sample(name, labels), value)
+
+    @staticmethod
+    def observe(
+        name: str, value: float, labels: Optional[Dict[str, str]] = None
+    ) -> None:
+        """
+        Add observation to histogram
+
+        :param str name: metric name, e.g ending with _seconds
+        :param float value: observed value
+        :param dict labels: label name to value mapping
+        """
+        labels = labels or {}
+        with Metrics.samples_lock:
+            Metrics.types[name] = 'histogram'
+            for bucket in BUCKETS + (float('inf'),):
+                Metrics._add(
+                    _get_sample(
+                        f'{name}_bucket', dict(labels, le=_format(bucket))
+                    ), 1 if value <= bucket else 0
+                )
+            Metrics._add(_get_sample(f'{name}_sum', labels), value)
+            Metrics._add(_get_sample(f'{name}_count', labels), 1)
+
+    @staticmethod
+    def record_run(duration: float, issue: Optional[BaseException]) -> None:
+        """
+        Count finished run of a command line tool
+
+        :param float duration: run time in seconds
+        :param Exception issue: exception which ended the run or None
+        """
+        Metrics.inc(
+            'corbos_scm_runs_total',
+            {'result': 'failure' if issue else 'success'}
+        )
+        if issue:
+            Metrics.inc(
+                'corbos_scm_failures_total', {'error': type(issue).__name__}
+            )
+        Metrics.observe('corbos_scm_run_duration_seconds', duration)
+
+    @staticmethod
+    def flush() -> None:
+        """
+        Merge the collected metrics into the textfile and reset them
+
+        Failures are logged but do not fail the run
+        """
+        with Metrics.samples_lock:
+            samples = Metrics.samples
+            types = Metrics.types
+            Metrics.samples = {}
+            Metrics.types = {}
+        if not Metrics.filename or not samples:
+            return
+        try:
+            with open(f'{Metrics.filename}.lock', 'a+') as lock:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+                merged, merged_types = read_textfile(Metrics.filename)
+                for sample, value in samples.items():
+                    merged[sample] = merged.get(sample, 0) + value
+                merged_types.update(types)
+                new_textfile = f'{Metrics.filename}.new'
+                with open(new_textfile, 'w') as textfile:
+                    textfile.write(format_textfile(merged, merged_types))
+                os.replace(new_textfile, Metrics.filename)
+        except OSError as issue:
+            log.warning(f'Failed to write metrics {Metrics.filename}: {issue}')
+
+    @staticmethod
+    def _add(sample: str, value: float) -> None:
+        Metrics.samples[sample] = Metrics.samples.get(sample, 0) + value
+
+
+def read_textfile(filename: str) -> Tuple[Dict[str, float], Dict[str, str]]:
+    """
+    Read samples and metric types from a textfile
+
+    :param str filename: file path, a missing file has no samples
+
+    :return: sample to value mapping, metric name to type mapping
+
+    :rtype: tuple
+    """
+    samples: Dict[str, float] = {}
+    types: Dict[str, str] = {}
+    if not os.path.exists(filename):
+        return samples, types
+    with open(filename) as textfile:
+        for line in textfile:
+            line = line.strip()
+            if line.startswith('# TYPE '):
+                fields = line[7:].split()
+                if len(fields) == 2:
+                    types[fields[0]] = fields[1]
+                else:
+                    log.warning(f'Ignoring invalid metrics type: {line}')
+                continue
+            match = SAMPLE.match(line)
+            if match:
+                sample = match.group(1) + (match.group(2) or '')
+                try:
+                    samples[sample] = float(match.group(3))
+                except ValueError:
+                    log.warning(f'Ignoring invalid metrics sample: {line}')
+    return samples, types
+
+
+def format_textfile(samples: Dict[str, float], types: Dict[str, str]) -> str:
+    """
+    Format samples in the Prometheus text format
+
+    :param dict samples: sample to value mapping
+    :param dict types: metric name to type mapping
+
+    :return: textfile content
+
+    :rtype: str
+    """
+    families: Dict[str, List[str]] = {}
+    for sample in samples:
+        families.setdefault(_get_family(sample, types), []).append(sample)
+    lines = []
+    for family in sorted(families):
+        if family in types:
+            lines.append(f'# TYPE {family} {types[family]}')
+        for sample in sorted(families[family], key=_get_sort_key):
+            lines.append(f'{sample} {_format(samples[sample])}')
+    return '\n'.join(lines) + '\n'
+
+
+def _get_sample(name: str, labels: Optional[Dict[str, str]]) -> str:
+    if not labels:
+        return name
+    label_list = ','.join(
+        '{0}="{1}"'.format(
+            label, str(value).replace('\\', r'\\').replace('"', r'\"')
+        ) for label, value in sorted(labels.items())
+    )
+    return f'{name}{{{label_list}}}'
+
+
+def _get_family(sample: str, types: Dict[str, str]) -> str:
+    name = sample.split('{')[0]
+    for suffix in ('_bucket', '_sum', '_count'):
+        family = name[:-len(suffix)]
+        if name.endswith(suffix) and types.get(family) == 'histogram':
+            return family
+    return name
+
+
+def _get_sort_key(sample: str) -> Tuple[str, float]:
+    # order histogram buckets numerically by their upper bound
+    match = re.search(r'le="([^"]+)"', sample)
+    if match:
+        return re.sub(r',?le="[^"]+"', '', sample), float(match.group(1))
+    return sample, 0
+
+
+def _format(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(int(value)) if float(value).is_integer() else repr(value)
@@ -0,0 +1,451 @@
+# Copyright (c) 2021 Marcus Schäfer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+import os
+import gzip
+import lzma
+import zlib
+import hashlib
+import logging
+from tempfile import NamedTemporaryFile
+from typing import (
+    Dict, List, Optional, Tuple
+)
+
+from corbos_scm.command import Command
+from corbos_scm.metrics import Metrics
+from corbos_scm.pdiff import (
+    get_patches, apply_ed_script
+)
+from corbos_scm.download import (
+    fetch_url, Downloader, download_job_type
+)
+from corbos_scm.sources import (
+    parse_paragraphs, parse_sources, find_source, source_package_type
+)
+from corbos_scm.packages import (
+    parse_packages, binary_package_type
+)
+from corbos_scm.sources_index import SourcesIndex
+from corbos_scm.prefetch import PackagesCache
+from corbos_scm.exceptions import (
+    CSCMError,
+    CSCMMirrorError,
+    CSCMDownloadError
+)
+
+log = logging.getLogger('corbos_scm')
+
+
+class Mirror:
+    """
+    Debian package mirror accessed without apt
+
+    Reads the Sources indexes of the configured distribution and
+    components directly from the mirror and downloads the files
+    of a source package with checksum verification. With a
+    SourcesIndex the indexes are read once and later only
+    updated, through their pdiff patches if the mirror has them
+    """
+    # index variants in order of preference
+    index_names = ['Sources.xz', 'Sources.gz', 'Sources']
+    packages_index_names = ['Packages.xz', 'Packages.gz', 'Packages']
+
+    def __init__(
+        self, uri: str, distribution: str, components: List[str],
+        keyring: Optional[str] = None, download_workers: int = 4,
+        bandwidth_limit: Optional[int] = None,
+        sources_index: Optional[SourcesIndex] = None
+    ) -> None:
+        """
+        Setup mirror
+
+        :param str uri: mirror base URI, http(s) or file
+        :param str distribution: distribution name, e.g hirsute
+        :param list components: components, e.g main, universe
+        :param str keyring:
+            keyring to verify the InRelease signature with gpgv.
+            If not set the signature is not checked
+        :param int download_workers: number of concurrent downloads
+        :param int bandwidth_limit:
+            download rate limit of all files together in kB/s or None
+        :param SourcesIndex sources_index:
+            index to resolve packages from, None to read the
+            Sources indexes on every call
+        """
+        self.uri = uri.rstrip('/')
+        self.distribution = distribution
+        self.components = components
+        self.keyring = keyring
+        self.download_workers = download_workers
+        self.bandwidth_limit = bandwidth_limit
+        self.sources_index = sources_index
+        self.by_hash = False
+
+    def get_release(self) -> Dict[str, Tuple[int, str]]:
+        """
+        Read the SHA256 index list from the InRelease file
+
+        With a keyring only the data gpgv verified is read, text
+        outside of the signed part of the file is not trusted
+
+        :return: index path to (size, sha256) mapping
+
+        :rtype: dict
+        """
+        in_release = fetch_url(
+            f'{self.uri}/dists/{self.distribution}/InRelease'
+        )
+        if self.keyring:
+            release = self._verify_signature(in_release)
+        else:
+            release = in_release.decode('utf-8', errors='replace')
+        checksums = {}
+        for paragraph in parse_paragraphs(release):
+            if paragraph.get('Acquire-By-Hash') == 'yes':
+                self.by_hash = True
+            for line in paragraph.get('SHA256', '').splitlines():
+                checksum = line.split()
+                if len(checksum) == 3:
+                    checksums[checksum[2]] = (int(checksum[1]), checksum[0])
+        return checksums
+
+    def get_sources(self) -> List[source_package_type]:
+        """
+        Read the Sources indexes of all configured components
+
+        :return: list of source_package_type
+
+        :rtype: list
+        """
+        release = self.get_release()
+        sources = []
+        for component in self.components:
+            sources += parse_sources(
+                self._get_index(release, f'{component}/source')
+            )
+        return sources
+
+    def find(
+        self, package: str, version: Optional[str] = None
+    ) -> Optional[source_package_type]:
+        """
+        Find the latest source package of the given name, or the
+        one building a binary package of the given name
+
+        :param str package: source or binary package name
+        :param str version: exact version, None for the latest
+
+        :return: source_package_type or None
+
+        :rtype: source_package_type
+        """
+        if self.sources_index:
+            self.update_index()
+            return self.sources_index.lookup(
+                [self.get_origin(component) for component in self.components],
+                package, version
+            )
+        return find_source(self.get_sources(), package, version)
+
+    def resolve(
+        self, package: str, version: Optional[str] = None
+    ) -> source_package_type:
+        """
+        Find the latest source package of the given name, or the
+        one building a binary package of the given name
+
+        :param str package: source or binary package name
+        :param str version: exact version, None for the latest
+
+        :return: source_package_type
+
+        :rtype: source_package_type
+
+        :raises CSCMMirrorError: if the package is not found
+        """
+        source = self.find(package, version)
+        if not source:
+            raise CSCMMirrorError(
+                f'Package {package}{"=" + version if version else ""} '
+                f'not found in {self.distribution}'
+            )
+        return source
+
+    def get_origin(self, component: str) -> str:
+        """
+        Name of the Sources index of the given component
+
+        :param str component: component name
+
+        :return: origin name for the SourcesIndex
+
+        :rtype: str
+        """
+        return f'{self.uri} {self.distribution} {component}'
+
+    def update_index(self) -> None:
+        """
+        Update the SourcesIndex of all components which are not fresh
+
+        The uncompressed Sources checksum of the InRelease file
+        is compared with the indexed state. A changed index is
+        patched with its pdiffs if they are smaller than the
+        compressed index and read in full otherwise
+        """
+        if not self.sources_index:
+            return
+        sources_index = self.sources_index
+        with sources_index.update_lock():
+            stale = [
+                component for component in self.components
+                if not sources_index.is_fresh(self.get_origin(component))
+            ]
+            if not stale:
+                Metrics.inc(
+                    'corbos_scm_sources_index_total', {'result': 'fresh'}
+                )
+                return
+            release = self.get_release()
+            for component in stale:
+                self._update_component(sources_index, release, component)
+            sources_index.evict()
+
+    def get_packages(
+        self, architecture: str,
+        packages_cache: Optional[PackagesCache] = None
+    ) -> List[binary_package_type]:
+        """
+        Read the Packages indexes of all configured components for
+        the given architecture, including the arch all indexes if
+        the mirror has separate ones
+
+        :param str architecture: architecture, e.g amd64
+        :param PackagesCache packages_cache:
+            cache of parsed indexes, None to read the indexes on
+            every call
+
+        :return: list of binary_package_type
+
+        :rtype: list
+        """
+        release = self.get_release()
+        packages = []
+        for component in self.components:
+            for path in [
+                f'{component}/binary-{architecture}',
+                f'{component}/binary-all'
+            ]:
+                if path.endswith('-all') and not any(
+                    f'{path}/{index_name}' in release
+                    for index_name in self.packages_index_names
+                ):
+                    continue
+                current = release.get(f'{path}/Packages')
+                cached = None
+                if packages_cache and current:
+                    cached = packages_cache.get(current[1])
+                if cached is None:
+                    cached = parse_packages(
+                        self._get_index_data(
+                            release, path, self.packages_index_names
+                        ).decode('utf-8', errors='replace')
+                    )
+                    if packages_cache and current:
+                        packages_cache.put(current[1], cached)
+                packages += cached
+        return packages
+
+    def fetch(self, source: source_package_type, outdir: str) -> None:
+        """
+        Download and verify all files of the given source package
+
+        The files are downloaded concurrently and verified against
+        their size and sha256 checksum while they are written
+
+        :param source_package_type source: source package record
+        :param str outdir: target directory
+
+        :raises CSCMChecksumError: if a file does not match
+        """
+        log.info(
+            f'Downloading {source.package} {source.version}: '
+            f'{len(source.files)} files'
+        )
+        with Downloader(
+            self.download_workers, rate_limit=self.bandwidth_limit * 1024
+            if self.bandwidth_limit else None
+        ) as downloader:
+            downloader.download_all(
+                [
+                    download_job_type(
+                        url=f'{self.uri}/{source.directory}/{source_file.name}',
+                        filename=os.sep.join([outdir, source_file.name]),
+                        size=source_file.size,
+                        sha256=source_file.sha256
+                    ) for source_file in source.files
+                ]
+            )
+
+    def _update_component(
+        self, sources_index: SourcesIndex,
+        release: Dict[str, Tuple[int, str]], component: str
+    ) -> None:
+        origin = self.get_origin(component)
+        path = f'{component}/source'
+        state = sources_index.get_state(origin)
+        current = release.get(f'{path}/Sources')
+        data = None
+        result = 'unchanged'
+        if not state or not current or current[1] != state:
+            if state and current:
+                data = self._get_patched_index(
+                    sources_index, release, path, origin, state, current
+                )
+                result = 'pdiff'
+            if data is None:
+                data = self._get_index_data(release, path)
+                result = 'full'
+                if hashlib.sha256(data).hexdigest() == state:
+                    data = None
+                    result = 'unchanged'
+        if data is None:
+            sources_index.touch(origin)
+        else:
+            sources_index.update(origin, data)
+        Metrics.inc('corbos_scm_sources_index_total', {'result': result})
+
+    def _get_patched_index(
+        self, sources_index: SourcesIndex,
+        release: Dict[str, Tuple[int, str]], path: str, origin: str,
+        state: str, current: Tuple[int, str]
+    ) -> Optional[bytes]:
+        diff_index_path = f'{path}/Sources.diff/Index'
+        if diff_index_path not in release:
+            return None
+        try:
+            patches = get_patches(
+                self._fetch_verified(
+                    diff_index_path, *release[diff_index_path]
+                ).decode('utf-8', errors='replace'), state
+            )
+            index_sizes = [
+                release[f'{path}/{index_name}'][0]
+                for index_name in self.index_names
+                if f'{path}/{index_name}' in release
+            ]
+            if not patches or sum(
+                patch.download_size for patch in patches
+            ) >= min(index_sizes):
+                return None
+            data = sources_index.read_sources(origin)
+            for patch in patches:
+                patch_path = f'{path}/Sources.diff/{patch.name}.gz'
+                script = self._decompress(
+                    patch_path, self._fetch_verified(
+                        patch_path, patch.download_size,
+                        patch.download_sha256
+                    )
+                )
+                if len(script) != patch.size or hashlib.sha256(
+                    script
+                ).hexdigest() != patch.sha256:
+                    raise CSCMMirrorError(f'Checksum mismatch for {patch.name}')
+                data = apply_ed_script(data, script)
+            if len(data) != current[0] or hashlib.sha256(
+                data
+            ).hexdigest() != current[1]:
+                raise CSCMMirrorError(f'Patched {path}/Sources does not match')
+        except (CSCMError, OSError) as issue:
+            log.warning(f'Falling back to full index download: {issue}')
+            return None
+        log.info(f'Patched {path}/Sources with {len(patches)} pdiffs')
+        return data
+
+    def _get_index(self, release: Dict[str, Tuple[int, str]], path: str) -> str:
+        return self._get_index_data(release, path).decode(
+            'utf-8', errors='replace'
+        )
+
+    def _get_index_data(
+        self, release: Dict[str, Tuple[int, str]], path: str,
+        index_names: Optional[List[str]] = None
+    ) -> bytes:
+        for index_name in index_names or self.index_names:
+            index_path = f'{path}/{index_name}'
+            if index_path not in release:
+                continue
+            return self._decompress(
+                index_path, self._fetch_verified(
+                    index_path, *release[index_path]
+                )
+            )
+        raise CSCMMirrorError(
+            f'No index for {path} in {self.distribution}'
+        )
+
+    @staticmethod
+    def _decompress(path: str, data: bytes) -> bytes:
+        try:
+            if path.endswith('.xz'):
+                return lzma.decompress(data)
+            if path.endswith('.gz'):
+                return gzip.decompress(data)
+        except (lzma.LZMAError, EOFError, OSError, zlib.error) as issue:
+            # e.g. a mirror serving a truncated file while it syncs
+            raise CSCMMirrorError(f'Corrupt index {path}: {issue}')
+        return data
+
+    def _fetch_verified(self, path: str, size: int, sha256: str) -> bytes:
+        base = f'{self.uri}/dists/{self.distribution}'
+        urls = [f'{base}/{path}']
+        if self.by_hash:
+            # the by-hash name stays valid while the mirror is
+            # updated between reading InRelease and the index
+            urls.insert(
+                0, f'{base}/{os.path.dirname(path)}/by-hash/SHA256/{sha256}'
+            )
+        for url in urls:
+            try:
+                data = fetch_url(url)
+            except CSCMDownloadError:
+                if url == urls[-1]:
+                    raise
+                continue
+            if len(data) == size and hashlib.sha256(data).hexdigest() == sha256:
+                return data
+        raise CSCMMirrorError(f'Checksum mismatch for {path}')
+
+    def _verify_signature(self, in_release: bytes) -> str:
+        with NamedTemporaryFile() as signed:
+            signed.write(in_release)
+            signed.flush()
+            # gpgv writes the signed data without the armor
+            result = Command.run(
+                [
+                    'gpgv', '--keyring', self.keyring, '--output', '-',
+                    signed.name
+                ], raise_on_error=False
+            )
+        if result.returncode != 0:
+            raise CSCMMirrorError(
+                f'InRelease signature check failed: {result.error}'
+            )
+        return result.output
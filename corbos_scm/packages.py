@@ -0,0 +1,250 @@
+# Copyright (c) 2021 Marcus Schäfer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""
+Parser for Debian binary package control data as found in
+Packages indexes and for package relationship fields
+"""
+import re
+from typing import (
+    NamedTuple, List, Optional, Sequence, Tuple
+)
+
+from corbos_scm.sources import (
+    parse_paragraphs, compare_versions
+)
+
+binary_package_type = NamedTuple(
+    'binary_package_type', [
+        ('package', str),
+        ('version', str),
+        ('architecture', str),
+        ('filename', str),
+        ('size', int),
+        ('sha256', str),
+        ('depends', str),
+        ('provides', str)
+    ]
+)
+
+relation_type = NamedTuple(
+    'relation_type', [
+        ('name', str),
+        ('operator', Optional[str]),
+        ('version', Optional[str])
+    ]
+)
+
+RELATION = re.compile(
+    r'^(?P<name>[a-z0-9][a-z0-9.+-]*)(?::[a-z0-9-]+)?'
+    r'\s*(?:\(\s*(?P<operator><<|<=|>=|>>|=|<|>)\s*(?P<version>[^)\s]+)\s*\))?'
+    r'\s*(?:\[(?P<architectures>[^\]]*)\])?'
+    r'\s*(?P<profiles>(?:<[^>]*>\s*)*)$'
+)
+
+# build dependency fields of a .dsc file
+BUILD_DEPENDS_FIELDS = [
+    'Build-Depends', 'Build-Depends-Arch', 'Build-Depends-Indep'
+]
+
+
+def parse_packages(data: str) -> List[binary_package_type]:
+    """
+    Parse binary package records
+
+    :param str data: Packages index data
+
+    :return: list of binary_package_type
+
+    :rtype: list
+    """
+    packages = []
+    for paragraph in parse_paragraphs(data):
+        if not all(
+            field in paragraph for field in ['Package', 'Version', 'Filename']
+        ):
+            continue
+        packages.append(
+            binary_package_type(
+                package=paragraph['Package'],
+                version=paragraph['Version'],
+                architecture=paragraph.get('Architecture', ''),
+                filename=paragraph['Filename'],
+                size=int(paragraph.get('Size', 0)),
+                sha256=paragraph.get('SHA256', ''),
+                depends=', '.join(
+                    paragraph[field] for field in ['Pre-Depends', 'Depends']
+                    if paragraph.get(field)
+                ),
+                provides=paragraph.get('Provides', '')
+            )
+        )
+    return packages
+
+
+def parse_relations(
+    value: str, architecture: str, profiles: Sequence[str] = ()
+) -> List[List[relation_type]]:
+    """
+    Parse a package relationship field like Depends or
+    Build-Depends
+
+    Alternatives restricted to other architectures or build
+    profiles are left out, a relation without any remaining
+    alternative is dropped. Architecture qualifiers like :any
+    are ignored
+
+    :param str value: field value
+    :param str architecture: host architecture, e.g amd64
+    :param list profiles: active build profiles, e.g nocheck
+
+    :return: list of relations, each a list of alternatives
+
+    :rtype: list
+    """
+    relations = []
+    for relation in value.replace('\n', ' ').split(','):
+        alternatives = []
+        for alternative in relation.split('|'):
+            match = RELATION.match(alternative.strip())
+            if not match:
+                continue
+            if match.group('architectures') and not _matches_architectures(
+                match.group('architectures').split(), architecture
+            ):
+                continue
+            if match.group('profiles') and not _matches_profiles(
+                re.findall(r'<([^>]*)>', match.group('profiles')), profiles
+            ):
+                continue
+            alternatives.append(
+                relation_type(
+                    name=match.group('name'),
+                    operator=match.group('operator'),
+                    version=match.group('version')
+                )
+            )
+        if alternatives:
+            relations.append(alternatives)
+    return relations
+
+
+def get_build_depends(
+    dsc_data: str, architecture: str, profiles: Sequence[str] = ()
+) -> List[List[relation_type]]:
+    """
+    Build dependencies of a source package for the given
+    architecture, including those of the arch all packages
+
+    :param str dsc_data: .dsc file data
+    :param str architecture: host architecture, e.g amd64
+    :param list profiles: active build profiles
+
+    :return: list of relations, each a list of alternatives
+
+    :rtype: list
+    """
+    paragraphs = parse_paragraphs(dsc_data)
+    if not paragraphs:
+        return []
+    return parse_relations(
+        ', '.join(
+            paragraphs[0][field] for field in BUILD_DEPENDS_FIELDS
+            if paragraphs[0].get(field)
+        ), architecture, profiles
+    )
+
+
+def satisfies(version: str, relation: relation_type) -> bool:
+    """
+    Check if the given version satisfies the version constraint
+    of the relation
+
+    :param str version: package version
+    :param relation_type relation: relation to check
+
+    :return: True if satisfied or the relation is unversioned
+
+    :rtype: bool
+    """
+    if not relation.operator or not relation.version:
+        return True
+    result = compare_versions(version, relation.version)
+    return {
+        '<<': result < 0, '<': result <= 0, '<=': result <= 0,
+        '=': result == 0,
+        '>=': result >= 0, '>': result >= 0, '>>': result > 0
+    }[relation.operator]
+
+
+def format_relation(alternatives: List[relation_type]) -> str:
+    """
+    Relationship field notation of a relation
+
+    :param list alternatives: list of relation_type
+
+    :return: e.g libssl-dev (>= 1.1) | libgnutls28-dev
+
+    :rtype: str
+    """
+    return ' | '.join(
+        f'{relation.name} ({relation.operator} {relation.version})'
+        if relation.operator else relation.name
+        for relation in alternatives
+    )
+
+
+def _split_architecture(architecture: str) -> Tuple[str, str]:
+    if '-' in architecture:
+        os_name, cpu = architecture.split('-', 1)
+        return os_name, cpu
+    return 'linux', architecture
+
+
+def _matches_architecture(wildcard: str, architecture: str) -> bool:
+    if wildcard in ('any', architecture):
+        return True
+    os_name, cpu = _split_architecture(architecture)
+    wildcard_os, wildcard_cpu = _split_architecture(wildcard)
+    return wildcard_os in ('any', os_name) and wildcard_cpu in ('any', cpu)
+
+
+def _matches_architectures(restrictions: List[str], architecture: str) -> bool:
+    # either all entries are negated or none of them
+    if restrictions[0].startswith('!'):
+        return not any(
+            _matches_architecture(restriction[1:], architecture)
+            for restriction in restrictions
+        )
+    return any(
+        _matches_architecture(restriction, architecture)
+        for restriction in restrictions
+    )
+
+
+def _matches_profiles(formula: List[str], profiles: Sequence[str]) -> bool:
+    # a relation applies if all terms of one of its lists match
+    for terms in formula:
+        if all(
+            term[1:] not in profiles if term.startswith('!') else term in profiles
+            for term in terms.split()
+        ):
+            return True
+    return False
@@ -0,0 +1,185 @@
+# Copyright (c) 2021 Marcus Schäfer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""
+Support for the pdiff patches of Debian package indexes
+
+An archive publishing pdiffs provides an Index file next to the
+package index, e.g main/source/Sources.diff/Index. It lists the
+checksums of former index states and the ed scripts, as created
+by diff --ed, which turn a former state into the next one
+"""
+import re
+from typing import (
+    NamedTuple, List, Dict, Optional, Tuple
+)
+
+from corbos_scm.sources import parse_paragraphs
+from corbos_scm.exceptions import CSCMPdiffError
+
+pdiff_patch_type = NamedTuple(
+    'pdiff_patch_type', [
+        ('name', str),
+        ('size', int),
+        ('sha256', str),
+        ('download_size', int),
+        ('download_sha256', str)
+    ]
+)
+
+ed_command = re.compile(rb'^(\d+)(?:,(\d+))?([acd])$')
+
+
+def get_patches(index: str, state: str) -> Optional[List[pdiff_patch_type]]:
+    """
+    Patches which turn the index of the given state into the
+    current index
+
+    :param str index: data of the pdiff Index file
+    :param str state: sha256 of the uncompressed index to patch
+
+    :return:
+        list of pdiff_patch_type in the order they need to be
+        applied, None if the state is not in the history
+
+    :rtype: list
+    """
+    paragraphs = parse_paragraphs(index)
+    if not paragraphs:
+        return None
+    paragraph = paragraphs[0]
+    history = _get_checksums(paragraph, 'SHA256-History')
+    patches = {
+        name: (size, sha256) for sha256, size, name in
+        _get_checksums(paragraph, 'SHA256-Patches')
+    }
+    downloads = {
+        name[:-len('.gz')]: (size, sha256) for sha256, size, name in
+        _get_checksums(paragraph, 'SHA256-Download') if name.endswith('.gz')
+    }
+    names = [name for sha256, size, name in history]
+    for position, (sha256, size, name) in enumerate(history):
+        if sha256 == state:
+            break
+    else:
+        return None
+    if paragraph.get('X-Patch-Precedence') == 'merged':
+        # every patch turns its state into the current index
+        names = names[position:position + 1]
+    else:
+        names = names[position:]
+    result = []
+    for name in names:
+        if name not in patches or name not in downloads:
+            return None
+        result.append(
+            pdiff_patch_type(
+                name=name,
+                size=patches[name][0],
+                sha256=patches[name][1],
+                download_size=downloads[name][0],
+                download_sha256=downloads[name][1]
+            )
+        )
+    return result
+
+
+def apply_ed_script(data: bytes, script: bytes) -> bytes:
+    """
+    Apply an ed script as created by diff --ed
+
+    The commands of such a script address lines in descending
+    order, the result is assembled in one pass over the data
+
+    :param bytes data: text to patch
+    :param bytes script: ed script
+
+    :return: patched text
+
+    :rtype: bytes
+
+    :raises CSCMPdiffError: if the script can not be applied
+    """
+    lines = data.split(b'\n')
+    commands = script.split(b'\n')
+    # pieces of the result in reverse order
+    pieces: List[List[bytes]] = []
+    end = len(lines)
+    position = 0
+    while position < len(commands):
+        command = commands[position]
+        position += 1
+        if not command:
+            continue
+        if command == b's/.//':
+            # a text line consisting of a dot is written as two
+            # dots and fixed up after the text
+            if not pieces or not pieces[-1]:
+                raise CSCMPdiffError('Substitution without text')
+            pieces[-1][-1] = pieces[-1][-1][1:]
+            continue
+        if command == b'a':
+            # text continued after a substitution
+            if not pieces:
+                raise CSCMPdiffError('Append without address')
+            text = pieces.pop()
+        else:
+            match = ed_command.match(command)
+            if not match:
+                raise CSCMPdiffError(f'Unsupported ed command: {command!r}')
+            first = int(match.group(1))
+            last = int(match.group(2) or first)
+            action = match.group(3)
+            if action == b'a':
+                start, stop = first, first
+            else:
+                start, stop = first - 1, last
+            if stop > end or start > stop:
+                raise CSCMPdiffError(f'ed command out of order: {command!r}')
+            pieces.append(lines[stop:end])
+            end = start
+            if action == b'd':
+                continue
+            text = []
+        while True:
+            if position >= len(commands):
+                raise CSCMPdiffError('Unterminated ed text')
+            line = commands[position]
+            position += 1
+            if line == b'.':
+                break
+            text.append(line)
+        pieces.append(text)
+    pieces.append(lines[:end])
+    result: List[bytes] = []
+    for piece in reversed(pieces):
+        result += piece
+    return b'\n'.join(result)
+
+
+def _get_checksums(
+    paragraph: Dict[str, str], field: str
+) -> List[Tuple[str, int, str]]:
+    checksums = []
+    for line in paragraph.get(field, '').splitlines():
+        checksum = line.split()
+        if len(checksum) == 3:
+            checksums.append((checksum[0], int(checksum[1]), checksum[2]))
+    return checksums
@@ -0,0 +1,357 @@
+# Copyright (c) 2021 Marcus Schäfer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""
+Binary dependency closure of the build dependencies of a
+fetched source package, written as a prefetch manifest
+"""
+import os
+import json
+import time
+import logging
+from collections import deque
+from tempfile import NamedTemporaryFile
+from typing import (
+    Dict, List, Optional, Tuple
+)
+
+from corbos_scm.metrics import Metrics
+from corbos_scm.download import (
+    Downloader, download_job_type
+)
+from corbos_scm.sources import (
+    source_package_type, compare_versions
+)
+from corbos_scm.packages import (
+    binary_package_type, relation_type, parse_relations, satisfies,
+    format_relation
+)
+from corbos_scm.exceptions import CSCMPrefetchError
+
+log = logging.getLogger('corbos_scm')
+
+
+class PackagesCache:
+    """
+    Parsed Packages indexes of package mirrors
+
+    The binary package records of a Packages index are stored as
+    JSON named by the sha256 checksum of the uncompressed index as
+    listed in InRelease. An index which did not change is neither
+    downloaded nor parsed again. Files which were not used for
+    max_age seconds are removed
+    """
+    def __init__(self, cache_dir: str, max_age: int = 7 * 86400) -> None:
+        """
+        Setup packages cache
+
+        :param str cache_dir: base cache directory
+        :param int max_age: time in seconds an unused index is kept
+        """
+        self.max_age = max_age
+        self.root = os.sep.join([cache_dir, 'packages'])
+        os.makedirs(self.root, exist_ok=True)
+
+    def get(self, sha256: str) -> Optional[List[binary_package_type]]:
+        """
+        Records of the Packages index with the given checksum
+
+        :param str sha256: checksum of the uncompressed index
+
+        :return: list of binary_package_type or None if not cached
+
+        :rtype: list
+        """
+        index_file = self.get_index_file(sha256)
+        if not os.path.exists(index_file):
+            Metrics.inc('corbos_scm_packages_cache_total', {'result': 'miss'})
+            return None
+        try:
+            with open(index_file) as index:
+                packages = [
+                    binary_package_type(*record) for record in json.load(index)
+                ]
+            os.utime(index_file)
+        except (OSError, ValueError, TypeError) as issue:
+            log.warning(f'Ignoring unreadable packages cache: {issue}')
+            Metrics.inc('corbos_scm_packages_cache_total', {'result': 'miss'})
+            return None
+        Metrics.inc('corbos_scm_packages_cache_total', {'result': 'hit'})
+        return packages
+
+    def put(self, sha256: str, packages: List[binary_package_type]) -> None:
+        """
+        Store the records of a Packages index and remove indexes
+        which were not used for max_age seconds
+
+        :param str sha256: checksum of the uncompressed index
+        :param list packages: list of binary_package_type
+        """
+        index = None
+        try:
+            with NamedTemporaryFile(
+                'w', dir=self.root, prefix='.incoming.', delete=False
+            ) as index:
+                json.dump(packages, index)
+            os.replace(index.name, self.get_index_file(sha256))
+        except OSError as issue:
+            log.warning(f'Failed to write packages cache: {issue}')
+            if index and os.path.exists(index.name):
+                os.unlink(index.name)
+        expired = time.time() - self.max_age
+        for name in os.listdir(self.root):
+            if name.startswith('.incoming.'):
+                # written by a concurrent call
+                continue
+            index_file = os.sep.join([self.root, name])
+            try:
+                if os.path.getmtime(index_file) < expired:
+                    log.info(f'Removing unused packages index {name}')
+                    os.unlink(index_file)
+            except OSError as issue:
+                # e.g. removed by a concurrent call meanwhile
+                log.debug(f'Not expiring packages index {name}: {issue}')
+
+    def get_index_file(self, sha256: str) -> str:
+        """
+        Path of the stored index with the given checksum
+
+        :param str sha256: checksum of the uncompressed index
+
+        :return: file path
+
+        :rtype: str
+        """
+        return os.sep.join([self.root, f'{sha256}.json'])
+
+
+class BuildDepsResolver:
+    """
+    Resolve build dependencies against the binary packages of
+    the configured repositories
+
+    Every relation is satisfied by the highest version of a real
+    package, or else by a package providing it, the first
+    alternative which can be satisfied is taken. The Depends and
+    Pre-Depends of every selected package are followed until the
+    closure is complete. Conflicts and Recommends are not
+    considered, the closure is meant to prefetch packages, not
+    to replace the installation by the build system
+    """
+    def __init__(
+        self, packages: List[binary_package_type], architecture: str
+    ) -> None:
+        """
+        Setup resolver
+
+        :param list packages: list of binary_package_type
+        :param str architecture: host architecture, e.g amd64
+        """
+        self.architecture = architecture
+        self.packages: Dict[str, List[binary_package_type]] = {}
+        self.providers: Dict[
+            str, List[Tuple[Optional[str], binary_package_type]]
+        ] = {}
+        for package in packages:
+            self.packages.setdefault(package.package, []).append(package)
+            if package.provides:
+                for alternatives in parse_relations(
+                    package.provides, architecture
+                ):
+                    self.providers.setdefault(
+                        alternatives[0].name, []
+                    ).append((alternatives[0].version, package))
+
+    def resolve(
+        self, relations: List[List[relation_type]]
+    ) -> Tuple[List[binary_package_type], List[str]]:
+        """
+        Binary dependency closure of the given relations
+
+        :param list relations: list of relations, see parse_relations
+
+        :return:
+            selected packages sorted by name and the relations
+            which could not be satisfied
+
+        :rtype: tuple
+        """
+        selected: Dict[str, binary_package_type] = {}
+        provided: Dict[str, List[Optional[str]]] = {}
+        unresolved = []
+        pending = deque(relations)
+        while pending:
+            alternatives = pending.popleft()
+            if any(
+                self._is_selected(relation, selected, provided)
+                for relation in alternatives
+            ):
+                continue
+            for relation in alternatives:
+                package = self._find(relation, selected)
+                if package:
+                    selected[package.package] = package
+                    for provides in parse_relations(
+                        package.provides, self.architecture
+                    ):
+                        provided.setdefault(provides[0].name, []).append(
+                            provides[0].version
+                        )
+                    pending.extend(
+                        parse_relations(package.depends, self.architecture)
+                    )
+                    break
+            else:
+                unresolved.append(format_relation(alternatives))
+        return sorted(
+            selected.values(), key=lambda package: package.package
+        ), unresolved
+
+    def _find(
+        self, relation: relation_type, selected: Dict[str, binary_package_type]
+    ) -> Optional[binary_package_type]:
+        # a package is selected in one version only
+        candidates = [
+            package for package in self.packages.get(relation.name, [])
+            if satisfies(package.version, relation) and (
+                package.package not in selected
+            )
+        ]
+        if not candidates:
+            candidates = sorted(
+                [
+                    package for version, package in self.providers.get(
+                        relation.name, []
+                    ) if package.package not in selected and (
+                        not relation.operator or version and satisfies(
+                            version, relation
+                        )
+                    )
+                ], key=lambda package: package.package
+            )[:1]
+        if not candidates:
+            return None
+        return _get_latest(candidates)
+
+    @staticmethod
+    def _is_selected(
+        relation: relation_type, selected: Dict[str, binary_package_type],
+        provided: Dict[str, List[Optional[str]]]
+    ) -> bool:
+        package = selected.get(relation.name)
+        if package and satisfies(package.version, relation):
+            return True
+        return any(
+            not relation.operator or version and satisfies(version, relation)
+            for version in provided.get(relation.name, [])
+        )
+
+
+def write_manifest(
+    filename: str, source: source_package_type, architecture: str,
+    uri: str, packages: List[binary_package_type], unresolved: List[str]
+) -> None:
+    """
+    Write the prefetch manifest of a source package
+
+    The manifest is a JSON document listing URL, size and sha256
+    checksum of every package of the build dependency closure
+
+    :param str filename: manifest file path
+    :param source_package_type source: source package record
+    :param str architecture: host architecture
+    :param str uri: mirror base URI the packages are found on
+    :param list packages: list of binary_package_type
+    :param list unresolved: relations which could not be satisfied
+
+    :raises CSCMPrefetchError: if the manifest could not be written
+    """
+    manifest = {
+        'source': source.package,
+        'version': source.version,
+        'architecture': architecture,
+        'packages': [
+            {
+                'package': package.package,
+                'version': package.version,
+                'architecture': package.architecture,
+                'url': f'{uri}/{package.filename}',
+                'size': package.size,
+                'sha256': package.sha256
+            } for package in packages
+        ],
+        'unresolved': unresolved
+    }
+    try:
+        with open(filename, 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=4)
+            manifest_file.write(os.linesep)
+    except OSError as issue:
+        raise CSCMPrefetchError(
+            f'Failed to write prefetch manifest {filename}: {issue}'
+        )
+
+
+def warm_packages(
+    uri: str, packages: List[binary_package_type], directory: str,
+    workers: int = 4, rate_limit: Optional[int] = None
+) -> None:
+    """
+    Download the given packages into directory, packages which
+    are already present are not downloaded again
+
+    :param str uri: mirror base URI the packages are found on
+    :param list packages: list of binary_package_type
+    :param str directory: package directory
+    :param int workers: number of concurrent downloads
+    :param int rate_limit: maximum rate in bytes per second or None
+    """
+    os.makedirs(directory, exist_ok=True)
+    jobs = []
+    for package in packages:
+        filename = os.sep.join([directory, os.path.basename(package.filename)])
+        # a file is only renamed into place once it was verified
+        if os.path.exists(filename) and (
+            os.path.getsize(filename) == package.size
+        ):
+            Metrics.inc('corbos_scm_prefetch_packages_total', {'result': 'hit'})
+            continue
+        Metrics.inc('corbos_scm_prefetch_packages_total', {'result': 'miss'})
+        jobs.append(
+            download_job_type(
+                url=f'{uri}/{package.filename}', filename=filename,
+                size=package.size, sha256=package.sha256 or None
+            )
+        )
+    log.info(
+        f'Prefetching {len(jobs)} of {len(packages)} packages into {directory}'
+    )
+    with Downloader(workers, rate_limit=rate_limit) as downloader:
+        downloader.download_all(jobs)
+
+
+def _get_latest(
+    packages: List[binary_package_type]
+) -> binary_package_type:
+    latest = packages[0]
+    for package in packages[1:]:
+        if compare_versions(package.version, latest.version) > 0:
+            latest = package
+    return latest
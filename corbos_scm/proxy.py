@@ -0,0 +1,784 @@
+# Copyright (c) 2021 Marcus Schäfer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""
+Usage:
+    corbos_scm_proxy --cache-dir=<directory>
+        [--listen=<address>]
+        [--allow-hosts=<list>]
+        [--cache-size=<megabytes>]
+        [--metrics=<file>]
+    corbos_scm_proxy -h | --help
+    corbos_scm_proxy --version
+
+Options:
+    --cache-dir=<directory>
+        Directory to store cache data shared between service
+        calls on the same host. The responses of the proxy are
+        stored below it
+
+    --listen=<address>
+        Address and port to accept proxy requests from the
+        service containers on [default: 127.0.0.1:3142]
+
+    --allow-hosts=<list>
+        Comma separated list of the archive hosts requests are
+        passed to, subdomains of a listed host are included
+        [default: deb.debian.org,security.debian.org,archive.ubuntu.com,security.ubuntu.com,ports.ubuntu.com]
+
+    --cache-size=<megabytes>
+        Maximum size of the stored responses. If the store grows
+        beyond this size the least recently used responses are
+        removed [default: 10240]
+
+    --metrics=<file>
+        Prometheus textfile collector file to merge the metrics
+        of each served request into
+"""
+import os
+import json
+import time
+import shutil
+import socket
+import signal
+import hashlib
+import logging
+import threading
+import subprocess
+import socketserver
+from email.utils import (
+    formatdate, parsedate_to_datetime
+)
+from http.client import HTTPException
+from http.server import (
+    HTTPServer, BaseHTTPRequestHandler
+)
+from tempfile import NamedTemporaryFile
+from urllib.error import (
+    HTTPError, URLError
+)
+from urllib.parse import urlsplit
+from urllib.request import (
+    HTTPRedirectHandler, Request, build_opener
+)
+from contextlib import contextmanager
+from typing import (
+    Dict, Iterator, List, Optional, Tuple
+)
+import docopt
+
+from corbos_scm.version import __version__
+from corbos_scm.metrics import Metrics
+from corbos_scm.command import Command
+from corbos_scm.exceptions import (
+    exception_handler,
+    CSCMCommandError,
+    CSCMProxyError
+)
+
+log = logging.getLogger('corbos_scm')
+
+# response headers stored with a cached response and passed on
+STORED_HEADERS = ('Content-Type', 'ETag', 'Last-Modified')
+
+
+@exception_handler
+def main() -> None:
+    args = docopt.docopt(__doc__, version=__version__)
+
+    Metrics.setup(args['--metrics'])
+
+    host, _, port = args['--listen'].rpartition(':')
+    cache = ProxyCache(
+        args['--cache-dir'], int(args['--cache-size']) * 1024 * 1024
+    )
+    server = ProxyServer(
+        (host, int(port)), cache, args['--allow-hosts'].split(',')
+    )
+    signal.signal(
+        signal.SIGTERM,
+        lambda signum, frame: threading.Thread(target=server.shutdown).start()
+    )
+    try:
+        log.info(f'Caching apt traffic on {args["--listen"]}')
+        server.serve_forever()
+    finally:
+        server.server_close()
+        cache.close()
+
+
+def is_archive_path(path: str) -> bool:
+    """
+    Check if the URL path is part of a Debian archive
+
+    :param str path: URL path
+
+    :return: True for index and package pool files
+
+    :rtype: bool
+    """
+    return '/dists/' in path or '/pool/' in path
+
+
+def is_immutable(path: str) -> bool:
+    """
+    Check if the URL path names a file which never changes
+
+    Files below pool/ carry their version in the name and files
+    below by-hash/ their checksum, Release files and the indexes
+    named by their type change with every archive update
+
+    :param str path: URL path
+
+    :return: True if the file does not need revalidation
+
+    :rtype: bool
+    """
+    return '/pool/' in path or '/by-hash/' in path
+
+
+def get_expiry(headers, now: float) -> Optional[float]:
+    """
+    Time until which a response is fresh by its caching headers
+
+    :param headers: response headers
+    :param float now: time the response was received
+
+    :return: timestamp, None if the response must be revalidated
+
+    :rtype: float
+    """
+    directives = [
+        directive.strip().lower()
+        for directive in headers.get('Cache-Control', '').split(',')
+    ]
+    if 'no-cache' in directives or 'must-revalidate' in directives:
+        return None
+    for directive in directives:
+        if directive.startswith('max-age='):
+            try:
+                max_age = int(directive[8:])
+                age = int(headers.get('Age', 0))
+            except ValueError:
+                return None
+            return now + max_age - age
+    if headers.get('Expires'):
+        try:
+            return parsedate_to_datetime(headers['Expires']).timestamp()
+        except (TypeError, ValueError):
+            return None
+    return None
+
+
+def is_cacheable(headers) -> bool:
+    """
+    Check if a 200 response may be stored
+
+    :param headers: response headers
+
+    :return: True if storing is allowed
+
+    :rtype: bool
+    """
+    directives = [
+        directive.strip().lower()
+        for directive in headers.get('Cache-Control', '').split(',')
+    ]
+    return 'no-store' not in directives and 'private' not in directives
+
+
+def is_allowed_host(host: str, allowed_hosts: List[str]) -> bool:
+    """
+    Check if requests to host may be passed on
+
+    :param str host: host name of the request URL
+    :param list allowed_hosts: allowed archive hosts
+
+    :return: True for a listed host or a subdomain of it
+
+    :rtype: bool
+    """
+    host = host.lower().rstrip('.')
+    for allowed in allowed_hosts:
+        allowed = allowed.strip().lower()
+        if allowed and (host == allowed or host.endswith(f'.{allowed}')):
+            return True
+    return False
+
+
+def get_listen_host(uri: str) -> str:
+    """
+    Address on this host the containers reach the proxy URI on
+
+    This is the host of the URI if it is an address of this host,
+    otherwise the gateway of the podman bridge network if it is
+    one, otherwise localhost. The proxy is never bound to all
+    addresses of the host
+
+    :param str uri: proxy URI as used by the containers
+
+    :return: IP address
+
+    :rtype: str
+    """
+    try:
+        address = socket.gethostbyname(urlsplit(uri).hostname or '')
+    except OSError:
+        address = ''
+    if address and _is_local(address):
+        return address
+    try:
+        gateway = Command.run(
+            [
+                'podman', 'network', 'inspect', 'podman', '--format',
+                '{{range .Subnets}}{{.Gateway}}{{end}}'
+            ], raise_on_error=False, timeout=10
+        ).output.strip()
+    except CSCMCommandError:
+        gateway = ''
+    if gateway and _is_local(gateway):
+        return gateway
+    return '127.0.0.1'
+
+
+def start_proxy(
+    uri: str, cache_dir: str, allowed_hosts: Optional[str] = None,
+    timeout: float = 10
+) -> None:
+    """
+    Attach to the caching proxy on the port of the given URI,
+    start it on this host if nothing listens on that port
+
+    The proxy is started as a separate corbos_scm_proxy process
+    which outlives the caller and serves all later calls. If
+    several callers start it at the same time only one of them
+    can bind the port, the others attach to it
+
+    :param str uri: proxy URI as used by the containers
+    :param str cache_dir: base cache directory
+    :param str allowed_hosts:
+        comma separated archive hosts the proxy passes requests
+        to, None for the corbos_scm_proxy default
+    :param float timeout: time in seconds to wait for the proxy
+
+    :raises CSCMProxyError: if the proxy does not accept connections
+    """
+    port = urlsplit(uri).port or 3142
+    host = get_listen_host(uri)
+    if _is_listening(host, port):
+        return
+    log_file = os.sep.join([cache_dir, 'proxy', 'proxy.log'])
+    os.makedirs(os.path.dirname(log_file), exist_ok=True)
+    log.info(f'Starting caching apt proxy on {host}:{port}')
+    command = [
+        'corbos_scm_proxy', '--cache-dir', cache_dir,
+        '--listen', f'{host}:{port}'
+    ]
+    if allowed_hosts:
+        command += ['--allow-hosts', allowed_hosts]
+    try:
+        with open(log_file, 'a') as proxy_log:
+            subprocess.Popen(
+                command, stdin=subprocess.DEVNULL, stdout=proxy_log,
+                stderr=proxy_log, start_new_session=True
+            )
+    except OSError as issue:
+        raise CSCMProxyError(f'Failed to start corbos_scm_proxy: {issue}')
+    deadline = time.monotonic() + timeout
+    while not _is_listening(host, port):
+        if time.monotonic() > deadline:
+            raise CSCMProxyError(
+                f'corbos_scm_proxy not listening on port {port}, '
+                f'see {log_file}'
+            )
+        time.sleep(0.1)
+
+
+class ProxyCache:
+    """
+    Size bounded store of the responses of the caching proxy
+
+    Responses are stored once by the sha256 checksum of their
+    data, e.g the same pool file fetched through two mirror
+    hosts takes the space of one. An index maps the requested
+    URL to the stored data and the caching headers it was sent
+    with. If the store exceeds its quota the least recently
+    used URLs are evicted. The index is kept in memory and
+    written when responses are stored, a store directory is
+    meant to be used by one proxy process
+    """
+    def __init__(self, cache_dir: str, quota: int) -> None:
+        """
+        Setup proxy cache
+
+        :param str cache_dir: base cache directory
+        :param int quota: maximum size of the store in bytes
+        """
+        self.quota = quota
+        self.root = os.sep.join([cache_dir, 'proxy'])
+        self.objects_dir = os.sep.join([self.root, 'objects'])
+        self.index_file = os.sep.join([self.root, 'index.json'])
+        os.makedirs(self.objects_dir, exist_ok=True)
+        self.index = self._read_index()
+        self.index_lock = threading.Lock()
+        self.url_locks: Dict[str, List] = {}
+
+    def get(self, url: str) -> Optional[Dict]:
+        """
+        Index entry of the given URL
+
+        :param str url: requested URL
+
+        :return: entry or None if the URL is not stored
+
+        :rtype: dict
+        """
+        with self.index_lock:
+            entry = self.index.get(url)
+            if not entry:
+                return None
+            if not os.path.exists(self.get_object(entry['sha256'])):
+                log.warning(f'Proxy cache object missing for {url}')
+                del self.index[url]
+                return None
+            entry['used'] = time.time()
+            return dict(entry)
+
+    def is_fresh(self, url: str, entry: Dict) -> bool:
+        """
+        Check if the stored response may be served without
+        asking the upstream server
+
+        :param str url: requested URL
+        :param dict entry: index entry of the URL
+
+        :return: True if no revalidation is required
+
+        :rtype: bool
+        """
+        if is_immutable(urlsplit(url).path):
+            return True
+        return bool(entry['expires']) and time.time() < entry['expires']
+
+    @contextmanager
+    def url_lock(self, url: str) -> Iterator[None]:
+        """
+        Lock to hold while the given URL is fetched upstream,
+        such that concurrent requests for it fetch it once
+
+        :param str url: requested URL
+        """
+        with self.index_lock:
+            lock_users = self.url_locks.setdefault(url, [threading.Lock(), 0])
+            lock_users[1] += 1
+        try:
+            with lock_users[0]:
+                yield
+        finally:
+            with self.index_lock:
+                lock_users[1] -= 1
+                if not lock_users[1]:
+                    del self.url_locks[url]
+
+    def new_file(self):
+        """
+        Temporary file in the store to receive a response into
+
+        :return: NamedTemporaryFile, not deleted on close
+        """
+        return NamedTemporaryFile(
+            dir=self.objects_dir, prefix='.incoming.', delete=False
+        )
+
+    def store(
+        self, url: str, filename: str, sha256: str, size: int, headers
+    ) -> None:
+        """
+        Move the received response into the store
+
+        :param str url: requested URL
+        :param str filename: file containing the response data
+        :param str sha256: hex digest of the data
+        :param int size: size of the data
+        :param headers: response headers
+        """
+        object_file = self.get_object(sha256)
+        os.makedirs(os.path.dirname(object_file), exist_ok=True)
+        os.chmod(filename, 0o444)
+        os.replace(filename, object_file)
+        with self.index_lock:
+            self.index[url] = dict(
+                self._get_entry_headers(headers), sha256=sha256, size=size,
+                used=time.time()
+            )
+            self._evict()
+            self._write_index()
+
+    def refresh(self, url: str, headers) -> Optional[Dict]:
+        """
+        Update the caching headers of a revalidated response
+
+        :param str url: requested URL
+        :param headers: headers of the 304 response
+
+        :return: updated entry or None if the URL was evicted
+            while it was revalidated
+
+        :rtype: dict
+        """
+        with self.index_lock:
+            entry = self.index.get(url)
+            if not entry:
+                return None
+            for name, value in self._get_entry_headers(headers).items():
+                if value or name == 'expires':
+                    entry[name] = value
+            entry['used'] = time.time()
+            self._write_index()
+            return dict(entry)
+
+    def get_object(self, sha256: str) -> str:
+        """
+        Path of the store object for the given checksum
+
+        :param str sha256: hex digest
+
+        :return: file path
+
+        :rtype: str
+        """
+        return os.sep.join([self.objects_dir, sha256[:2], sha256])
+
+    def close(self) -> None:
+        """
+        Write the index including the last access times
+        """
+        with self.index_lock:
+            self._write_index()
+
+    @staticmethod
+    def _get_entry_headers(headers) -> Dict:
+        entry = {
+            name.lower(): headers.get(name) for name in STORED_HEADERS
+        }
+        entry['expires'] = get_expiry(headers, time.time())
+        return entry
+
+    def _evict(self) -> None:
+        sizes = {
+            entry['sha256']: entry['size'] for entry in self.index.values()
+        }
+        total = sum(sizes.values())
+        for url in sorted(self.index, key=lambda url: self.index[url]['used']):
+            if total <= self.quota:
+                break
+            log.info(f'Proxy cache evicting {url}')
+            del self.index[url]
+            referenced = set(entry['sha256'] for entry in self.index.values())
+            for sha256 in list(sizes):
+                if sha256 not in referenced:
+                    total -= sizes.pop(sha256)
+                    object_file = self.get_object(sha256)
+                    if os.path.exists(object_file):
+                        os.unlink(object_file)
+
+    def _read_index(self) -> Dict[str, Dict]:
+        if not os.path.exists(self.index_file):
+            return {}
+        try:
+            with open(self.index_file) as index:
+                return json.load(index)
+        except (OSError, ValueError) as issue:
+            log.warning(f'Ignoring unreadable proxy cache index: {issue}')
+            return {}
+
+    def _write_index(self) -> None:
+        new_index_file = f'{self.index_file}.new'
+        try:
+            with open(new_index_file, 'w') as new_index:
+                json.dump(self.index, new_index)
+            os.replace(new_index_file, self.index_file)
+        except OSError as issue:
+            log.warning(f'Failed to write proxy cache index: {issue}')
+
+
+class ProxyRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serve one proxied GET request, from the cache if possible
+
+    Only http URLs of Debian archive paths on the allowed hosts
+    are served, the proxy is not meant to be used for anything else
+    """
+    protocol_version = 'HTTP/1.1'
+    server: 'ProxyServer'
+
+    def do_GET(self) -> None:
+        url = self.path
+        location = urlsplit(url)
+        if location.scheme != 'http' or not is_archive_path(location.path):
+            self.send_error(403, 'Not a Debian archive URL')
+            return
+        if not is_allowed_host(
+            location.hostname or '', self.server.allowed_hosts
+        ):
+            self.send_error(403, 'Archive host not allowed')
+            return
+        cache = self.server.cache
+        entry = cache.get(url)
+        if entry and cache.is_fresh(url, entry):
+            self._serve(entry, 'hit')
+        else:
+            with cache.url_lock(url):
+                # fetched by a concurrent request meanwhile
+                entry = cache.get(url)
+                if entry and cache.is_fresh(url, entry):
+                    self._serve(entry, 'hit')
+                else:
+                    self._fetch(url, entry)
+        Metrics.flush()
+
+    def log_message(self, format: str, *args) -> None:
+        log.debug(f'{self.address_string()} {format % args}')
+
+    def _fetch(self, url: str, entry: Optional[Dict]) -> None:
+        headers = {'User-Agent': self.headers.get('User-Agent', 'corbos_scm')}
+        if entry:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last-modified']:
+                headers['If-Modified-Since'] = entry['last-modified']
+        try:
+            response = self.server.opener.open(
+                Request(url, headers=headers), timeout=60
+            )
+        except HTTPError as error:
+            if error.code == 304 and entry:
+                entry = self.server.cache.refresh(url, error.headers)
+                if entry:
+                    self._serve(entry, 'revalidated')
+                else:
+                    # evicted meanwhile, nothing left to revalidate
+                    self._fetch(url, None)
+            else:
+                Metrics.inc(
+                    'corbos_scm_proxy_requests_total', {'result': 'error'}
+                )
+                self.send_error(error.code)
+            return
+        except (URLError, OSError) as issue:
+            log.warning(f'Proxy request for {url} failed: {issue}')
+            Metrics.inc('corbos_scm_proxy_requests_total', {'result': 'error'})
+            self.send_error(502, 'Upstream server not reachable')
+            return
+        with response:
+            self._forward(url, response)
+
+    def _forward(self, url: str, response) -> None:
+        # the response is sent to the client while it is written
+        # into the cache, a large pool file does not stall apt
+        cache = self.server.cache
+        length = response.headers.get('Content-Length')
+        self.send_response(200)
+        for name in STORED_HEADERS:
+            if response.headers.get(name):
+                self.send_header(name, response.headers[name])
+        if length:
+            self.send_header('Content-Length', length)
+        else:
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        self.end_headers()
+        digest = hashlib.sha256()
+        size = 0
+        client_gone = False
+        complete = True
+        incoming = cache.new_file()
+        try:
+            with incoming:
+                while True:
+                    try:
+                        chunk = response.read(1 << 16)
+                    except (OSError, HTTPException) as issue:
+                        log.warning(f'Proxy request for {url} failed: {issue}')
+                        self.close_connection = True
+                        complete = False
+                        break
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    incoming.write(chunk)
+                    size += len(chunk)
+                    if not client_gone:
+                        try:
+                            self.wfile.write(chunk)
+                        except OSError:
+                            # the response is still completed for
+                            # the cache
+                            client_gone = True
+                            self.close_connection = True
+            sha256 = digest.hexdigest()
+            Metrics.inc(
+                'corbos_scm_proxy_bytes_total', {'source': 'upstream'}, size
+            )
+            if not complete or (length and int(length) != size):
+                log.warning(f'Not caching {url}: incomplete response')
+                Metrics.inc(
+                    'corbos_scm_proxy_requests_total', {'result': 'error'}
+                )
+                return
+            Metrics.inc('corbos_scm_proxy_requests_total', {'result': 'miss'})
+            if '/by-hash/SHA256/' in url and not url.endswith(sha256):
+                log.warning(f'Not caching {url}: checksum mismatch')
+            elif is_cacheable(response.headers):
+                cache.store(url, incoming.name, sha256, size, response.headers)
+        finally:
+            if os.path.exists(incoming.name):
+                os.unlink(incoming.name)
+
+    def _serve(self, entry: Dict, result: str) -> None:
+        if self._is_not_modified(entry):
+            self.send_response(304)
+            self._send_entry_headers(entry)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        else:
+            offset = self._get_offset(entry)
+            if offset:
+                self.send_response(206)
+                self.send_header(
+                    'Content-Range',
+                    f'bytes {offset}-{entry["size"] - 1}/{entry["size"]}'
+                )
+            else:
+                self.send_response(200)
+            self._send_entry_headers(entry)
+            self.send_header('Content-Length', str(entry['size'] - offset))
+            self.end_headers()
+            object_file = self.server.cache.get_object(entry['sha256'])
+            with open(object_file, 'rb') as data:
+                data.seek(offset)
+                shutil.copyfileobj(data, self.wfile, 1 << 16)
+            Metrics.inc(
+                'corbos_scm_proxy_bytes_total', {'source': 'cache'},
+                entry['size'] - offset
+            )
+        Metrics.inc('corbos_scm_proxy_requests_total', {'result': result})
+
+    def _send_entry_headers(self, entry: Dict) -> None:
+        for name in STORED_HEADERS:
+            if entry[name.lower()]:
+                self.send_header(name, entry[name.lower()])
+        self.send_header('Date', formatdate(usegmt=True))
+
+    def _is_not_modified(self, entry: Dict) -> bool:
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match:
+            return entry['etag'] in [
+                tag.strip() for tag in if_none_match.split(',')
+            ]
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since and entry['last-modified']:
+            try:
+                return parsedate_to_datetime(
+                    entry['last-modified']
+                ) <= parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def _get_offset(self, entry: Dict) -> int:
+        byte_range = self.headers.get('Range', '')
+        if_range = self.headers.get('If-Range')
+        if not byte_range.startswith('bytes=') or not byte_range.endswith('-'):
+            return 0
+        if if_range and if_range not in (
+            entry['etag'], entry['last-modified']
+        ):
+            return 0
+        try:
+            offset = int(byte_range[6:-1])
+        except ValueError:
+            return 0
+        return offset if 0 < offset < entry['size'] else 0
+
+
+class ArchiveRedirectHandler(HTTPRedirectHandler):
+    """
+    Follow upstream redirects only to the allowed archive hosts
+
+    Without it a mirror could redirect the proxy to any host
+    reachable from the build host, e.g. a service on localhost
+    """
+    def __init__(self, allowed_hosts: List[str]) -> None:
+        """
+        Setup redirect handler
+
+        :param list allowed_hosts: archive hosts redirects may point to
+        """
+        self.allowed_hosts = allowed_hosts
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        location = urlsplit(newurl)
+        if location.scheme not in ('http', 'https') or not is_allowed_host(
+            location.hostname or '', self.allowed_hosts
+        ):
+            fp.close()
+            raise URLError(f'redirect to {newurl} not allowed')
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+class ProxyServer(socketserver.ThreadingMixIn, HTTPServer):
+    """
+    Threaded HTTP proxy server serving from a ProxyCache
+    """
+    daemon_threads = True
+
+    def __init__(
+        self, address: Tuple[str, int], cache: ProxyCache,
+        allowed_hosts: List[str]
+    ) -> None:
+        """
+        Setup server listening on address
+
+        :param tuple address: host and port
+        :param ProxyCache cache: response store
+        :param list allowed_hosts: archive hosts requests are passed to
+        """
+        self.cache = cache
+        self.allowed_hosts = allowed_hosts
+        self.opener = build_opener(ArchiveRedirectHandler(allowed_hosts))
+        super().__init__(address, ProxyRequestHandler)
+
+
+def _is_listening(host: str, port: int) -> bool:
+    try:
+        with socket.create_connection((host, port), timeout=1):
+            return True
+    except OSError:
+        return False
+
+
+def _is_local(address: str) -> bool:
+    try:
+        with socket.socket() as probe:
+            probe.bind((address, 0))
+            return True
+    except OSError:
+        return False
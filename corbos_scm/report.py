@@ -0,0 +1,274 @@
+# Copyright (c) 2021 Marcus Schäfer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+import os
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from typing import (
+    NamedTuple, List, Dict, Optional, Iterator
+)
+
+from corbos_scm.version import __version__
+from corbos_scm.metrics import Metrics
+from corbos_scm.exceptions import CSCMReportError
+
+log = logging.getLogger('corbos_scm')
+
+phase_type = NamedTuple(
+    'phase_type', [
+        ('name', str),
+        ('start', float),
+        ('duration', float),
+        ('success', bool)
+    ]
+)
+
+command_record_type = NamedTuple(
+    'command_record_type', [
+        ('command', List[str]),
+        ('start', float),
+        ('duration', float),
+        ('returncode', Optional[int])
+    ]
+)
+
+
+class Report:
+    """
+    Timing report of one service run
+
+    Phases are recorded via the phase context manager, commands
+    are recorded by Command. Both are logged through the
+    corbos_scm logger with the timing data as extra record
+    attributes. Recording into a report only takes place for
+    the report activated via activate
+    """
+    current: Optional['Report'] = None
+
+    def __init__(self, package: str = '') -> None:
+        """
+        Setup report, the run starts now
+
+        :param str package: requested package name
+        """
+        self.package = package
+        self.start = time.time()
+        self.started = time.monotonic()
+        self.error = ''
+        self.outdir_bytes = 0
+        self.phases: List[phase_type] = []
+        self.commands: List[command_record_type] = []
+        self.records_lock = threading.Lock()
+
+    def activate(self) -> None:
+        """
+        Record all following phases and commands in this report
+        """
+        Report.current = self
+
+    def add_phase(self, phase: phase_type) -> None:
+        """
+        Add finished phase
+
+        :param phase_type phase: phase record
+        """
+        with self.records_lock:
+            self.phases.append(phase)
+
+    def add_command(self, command: command_record_type) -> None:
+        """
+        Add finished command
+
+        :param command_record_type command: command record
+        """
+        with self.records_lock:
+            self.commands.append(command)
+
+    def add_published(self, size: int) -> None:
+        """
+        Add bytes published into the output directory
+
+        :param int size: size in bytes
+        """
+        with self.records_lock:
+            self.outdir_bytes += size
+
+    def get_data(self, outdir: Optional[str] = None) -> Dict:
+        """
+        Report data suitable for JSON serialization
+
+        :param str outdir: output directory of the run
+
+        :return: report data
+
+        :rtype: dict
+        """
+        return {
+            'corbos_scm': __version__,
+            'package': self.package,
+            'start': self.start,
+            'duration': time.monotonic() - self.started,
+            'success': not self.error,
+            'error': self.error,
+            'outdir': outdir,
+            'outdir_bytes': self.outdir_bytes,
+            'phases': [phase._asdict() for phase in self.phases],
+            'commands': [command._asdict() for command in self.commands]
+        }
+
+    def write(self, filename: str, outdir: Optional[str] = None) -> None:
+        """
+        Write report to filename
+
+        If filename ends with .jsonl the report is appended as one
+        line, such that the reports of many runs can be collected
+        in one file. Otherwise the file is replaced atomically
+
+        :param str filename: report file path
+        :param str outdir: output directory of the run
+        """
+        data = json.dumps(self.get_data(outdir))
+        try:
+            if filename.endswith('.jsonl'):
+                with open(filename, 'a') as report:
+                    report.write(f'{data}\n')
+            else:
+                new_report_file = f'{filename}.new'
+                with open(new_report_file, 'w') as report:
+                    report.write(data)
+                os.replace(new_report_file, filename)
+        except OSError as issue:
+            raise CSCMReportError(
+                f'Failed to write report {filename}: {issue}'
+            )
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    """
+    Context manager to time a phase of the service run
+
+    :param str name: phase name
+    """
+    start = time.time()
+    started = time.monotonic()
+    success = False
+    try:
+        yield
+        success = True
+    finally:
+        duration = time.monotonic() - started
+        log.info(
+            f'phase={name} duration={duration:.3f} success={success}',
+            extra={'phase': name, 'duration': duration, 'success': success}
+        )
+        Metrics.observe(
+            'corbos_scm_phase_duration_seconds', duration, {'phase': name}
+        )
+        if Report.current:
+            Report.current.add_phase(
+                phase_type(
+                    name=name, start=start, duration=duration,
+                    success=success
+                )
+            )
+
+
+def record_command(
+    command: List, started: float, returncode: Optional[int]
+) -> None:
+    """
+    Record finished command
+
+    :param list command: command and arguments
+    :param float started: time.monotonic() at command start
+    :param int returncode: exit code, None if the command timed out
+    """
+    duration = time.monotonic() - started
+    log.debug(
+        f'command={command[0]} duration={duration:.3f} '
+        f'returncode={returncode}',
+        extra={
+            'command': command, 'duration': duration,
+            'returncode': returncode
+        }
+    )
+    program = os.path.basename(str(command[0]))
+    Metrics.inc(
+        'corbos_scm_commands_total', {
+            'command': program,
+            'result': 'timeout' if returncode is None else (
+                'success' if returncode == 0 else 'failure'
+            )
+        }
+    )
+    Metrics.observe(
+        'corbos_scm_command_duration_seconds', duration,
+        {'command': program}
+    )
+    if Report.current:
+        Report.current.add_command(
+            command_record_type(
+                command=[str(argument) for argument in command],
+                start=time.time() - duration,
+                duration=duration,
+                returncode=returncode
+            )
+        )
+
+
+def record_published(directory: str, names: List[str]) -> None:
+    """
+    Record files published into the output directory
+
+    :param str directory: output directory
+    :param list names: names of the published files
+    """
+    size = 0
+    for name in names:
+        path = os.sep.join([directory, name])
+        if os.path.isdir(path) and not os.path.islink(path):
+            size += get_directory_size(path)
+        elif not os.path.islink(path):
+            size += os.path.getsize(path)
+    if Report.current:
+        Report.current.add_published(size)
+
+
+def get_directory_size(directory: str) -> int:
+    """
+    Sum of the size of all files below directory
+
+    :param str directory: directory path
+
+    :return: size in bytes
+
+    :rtype: int
+    """
+    size = 0
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            path = os.path.join(root, name)
+            if not os.path.islink(path):
+                size += os.path.getsize(path)
+    return size
@@ -0,0 +1,268 @@
+# Copyright (c) 2021 Marcus Schäfer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+import re
+import time
+import random
+import logging
+from typing import (
+    Callable, List, Optional, TypeVar
+)
+
+from corbos_scm.command import Command
+from corbos_scm.metrics import Metrics
+from corbos_scm.exceptions import (
+    CSCMError,
+    CSCMCommandError,
+    CSCMCommandTimeoutError,
+    CSCMDownloadError,
+    CSCMChecksumError,
+    CSCMMirrorError
+)
+
+log = logging.getLogger('corbos_scm')
+
+T = TypeVar('T')
+
+# messages of podman, skopeo and apt hinting at a temporary issue
+TRANSIENT_ERRORS = re.compile(
+    '|'.join(
+        [
+            r'temporary failure',
+            r'could not resolve',
+            r'connection (refused|reset|timed out)',
+            r'network is unreachable',
+            r'no route to host',
+            r'i/o timeout',
+            r'tls handshake timeout',
+            r'unexpected eof',
+            r'too many requests',
+            r'http/\S+ (429|50[0234])\b',
+            r'(http )?status( code)?:? (429|50[0234])\b',
+            r'service unavailable',
+            r'bad gateway',
+            r'gateway time-?out',
+            r'hash sum mismatch',
+            r'checksum mismatch',
+            r'corrupt index',
+            # apt reports missing files as failed fetches too, only
+            # the cause given with them tells if they are temporary
+            r'failed to fetch \S+\s+(429|50[0234])\b',
+            r'(could not|unable to) connect',
+            r'connection failed'
+        ]
+    ), re.IGNORECASE
+)
+
+# lines of apt and podman reporting an issue on stdout, e.g.
+# with a terminal stdout and stderr are merged
+ERROR_LINE = re.compile(r'^(E|W|Err|Error|Warning):', re.IGNORECASE)
+
+# exit codes of commands which can not be found or executed
+FATAL_EXIT_CODES = (126, 127)
+
+
+def is_retryable(issue: CSCMError) -> bool:
+    """
+    Check if the operation which raised issue may succeed
+    when tried again
+
+    Download, checksum and timeout errors are retryable. Command
+    and mirror errors are retryable if their message matches a
+    known temporary network or mirror issue. Everything else,
+    e.g. a package which does not exist, is fatal
+
+    :param CSCMError issue: raised exception
+
+    :return: True if retryable
+
+    :rtype: bool
+    """
+    if isinstance(
+        issue, (CSCMDownloadError, CSCMChecksumError, CSCMCommandTimeoutError)
+    ):
+        return True
+    if isinstance(issue, CSCMCommandError):
+        if issue.returncode in FATAL_EXIT_CODES:
+            return False
+        return bool(TRANSIENT_ERRORS.search(get_diagnostics(issue)))
+    if isinstance(issue, CSCMMirrorError):
+        return bool(TRANSIENT_ERRORS.search(str(issue)))
+    return False
+
+
+def get_diagnostics(issue: CSCMCommandError) -> str:
+    """
+    Error messages of a failed command
+
+    The stdout of a command is mostly progress output, e.g. the
+    sizes of the files apt fetches, only its error lines are
+    taken besides stderr
+
+    :param CSCMCommandError issue: raised exception
+
+    :return: stderr and error lines of stdout, or the exception
+        message if the command output is not known
+
+    :rtype: str
+    """
+    if issue.stderr is None:
+        return str(issue)
+    return '\n'.join(
+        [issue.stderr] + [
+            line for line in (issue.stdout or '').splitlines()
+            if ERROR_LINE.match(line.strip())
+        ]
+    )
+
+
+class RetryPolicy:
+    """
+    Retry of operations failing with a retryable error
+
+    The delay between attempts grows exponentially and is
+    randomized by jitter, such that many services failing at the
+    same time do not hit the registry or mirror in lockstep. The
+    time a phase may spend with retries is limited by its budget
+    and by the deadline set via Command.set_total_timeout
+    """
+    initial_delay = 1.0
+    max_delay = 30.0
+    multiplier = 2.0
+    # fraction of the delay which is randomized
+    jitter = 0.5
+
+    def __init__(self, retries: int = 3, budget: Optional[float] = None):
+        """
+        Setup policy
+
+        :param int retries: maximum number of retries per candidate
+        :param float budget:
+            maximum seconds a phase may take including retries,
+            None for no limit
+        """
+        self.retries = retries
+        self.budget = budget
+
+    def get_delay(self, retry: int) -> float:
+        """
+        Delay before the given retry
+
+        :param int retry: number of the retry, starting with 0
+
+        :return: delay in seconds
+
+        :rtype: float
+        """
+        delay = min(self.max_delay, self.initial_delay * self.multiplier ** retry)
+        return delay * (1 - self.jitter * random.random())
+
+    def call(
+        self, func: Callable[[], T], phase: str,
+        started: Optional[float] = None
+    ) -> T:
+        """
+        Call func, retrying it on retryable errors
+
+        :param Callable func: operation without arguments
+        :param str phase: phase name for logging and metrics
+        :param float started:
+            time.monotonic() at the start of the phase, now if None
+
+        :return: return value of func
+
+        :raises CSCMError: if the error is fatal or no retry is left
+        """
+        started = time.monotonic() if started is None else started
+        retry = 0
+        while True:
+            try:
+                return func()
+            except CSCMError as issue:
+                if not is_retryable(issue) or retry >= self.retries:
+                    raise
+                delay = self.get_delay(retry)
+                if not self._has_time(started, delay):
+                    log.warning(f'No time left to retry {phase}')
+                    raise
+                log.warning(
+                    f'{phase} failed: {type(issue).__name__}: {issue}, '
+                    f'retry in {delay:.1f}s'
+                )
+                Metrics.inc('corbos_scm_retries_total', {'phase': phase})
+                time.sleep(delay)
+                retry += 1
+
+    def failover(
+        self, candidates: List[str], func: Callable[[str], T], phase: str
+    ) -> T:
+        """
+        Call func with the first candidate, e.g. registry or mirror,
+        which succeeds
+
+        Each candidate is retried according to the policy. If a
+        candidate keeps failing with a retryable error the next
+        one is used. All candidates share the phase budget
+
+        :param list candidates: ordered candidates
+        :param Callable func: operation taking the candidate
+        :param str phase: phase name for logging and metrics
+
+        :return: return value of func
+
+        :raises CSCMError:
+            if the error is fatal or all candidates failed
+        """
+        started = time.monotonic()
+        for index, candidate in enumerate(candidates):
+            try:
+                return self.call(lambda: func(candidate), phase, started)
+            except CSCMError as issue:
+                if not is_retryable(issue) or index == len(candidates) - 1:
+                    raise
+                if not self._has_time(started, 0):
+                    raise
+                log.warning(
+                    f'{phase} from {candidate} failed, '
+                    f'failing over to {candidates[index + 1]}'
+                )
+                Metrics.inc('corbos_scm_failovers_total', {'phase': phase})
+        raise CSCMError(f'No candidates for {phase}')
+
+    def _has_time(self, started: float, delay: float) -> bool:
+        now = time.monotonic()
+        if self.budget is not None and now + delay - started >= self.budget:
+            return False
+        if Command.deadline is not None and now + delay >= Command.deadline:
+            return False
+        return True
+
+
+def get_candidates(uris: str) -> List[str]:
+    """
+    Split comma separated list of URIs
+
+    :param str uris: comma separated URIs
+
+    :return: list of URIs in the given order
+
+    :rtype: list
+    """
+    return [uri.strip() for uri in uris.split(',') if uri.strip()]
@@ -0,0 +1,124 @@
+# Copyright (c) 2021 Marcus Schäfer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+import logging
+from concurrent.futures import (
+    ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+)
+from typing import (
+    NamedTuple, Callable, Dict, List, Optional, Any
+)
+
+log = logging.getLogger('corbos_scm')
+
+job_type = NamedTuple(
+    'job_type', [
+        ('package', str),
+        ('outdir', str),
+        ('hosts', List[str]),
+        ('size', Optional[int])
+    ]
+)
+
+
+class Scheduler:
+    """
+    Bounded concurrent execution of package fetch jobs
+
+    At most workers jobs run at the same time and at most
+    host_limit of them on the same host. A job can be served by
+    any of its hosts, it is started on the first one with a free
+    slot. Jobs of known size are started smallest first, such
+    that many packages are done early, jobs of unknown size are
+    started last in the given order
+    """
+    def __init__(
+        self, workers: int = 1, host_limit: Optional[int] = None
+    ) -> None:
+        """
+        Setup scheduler
+
+        :param int workers: maximum number of concurrent jobs
+        :param int host_limit:
+            maximum number of concurrent jobs per host or None
+        """
+        self.workers = max(workers, 1)
+        self.host_limit = max(host_limit, 1) if host_limit else None
+
+    def run(
+        self, jobs: List[job_type], func: Callable[[job_type, str], Any]
+    ) -> List[Any]:
+        """
+        Run all jobs
+
+        :param list jobs: list of job_type
+        :param callable func:
+            called with job and selected host in a worker thread,
+            usually to run a fetch process. func must not raise
+
+        :return: list of func results in the order of jobs
+
+        :rtype: list
+        """
+        pending = sorted(range(len(jobs)), key=lambda index: get_job_order(
+            jobs[index]
+        ))
+        running: Dict[Future, str] = {}
+        futures: Dict[int, Future] = {}
+        host_jobs: Dict[str, int] = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while pending or running:
+                for index in list(pending):
+                    if len(running) >= self.workers:
+                        break
+                    host = self._get_free_host(jobs[index], host_jobs)
+                    if host is None:
+                        continue
+                    pending.remove(index)
+                    host_jobs[host] = host_jobs.get(host, 0) + 1
+                    log.info(f'Starting {jobs[index].package} on {host}')
+                    future = pool.submit(func, jobs[index], host)
+                    futures[index] = future
+                    running[future] = host
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    host_jobs[running.pop(future)] -= 1
+        return [futures[index].result() for index in range(len(jobs))]
+
+    def _get_free_host(
+        self, job: job_type, host_jobs: Dict[str, int]
+    ) -> Optional[str]:
+        for host in job.hosts or ['']:
+            if not self.host_limit or host_jobs.get(host, 0) < self.host_limit:
+                return host
+        return None
+
+
+def get_job_order(job: job_type) -> tuple:
+    """
+    Sort key starting small jobs first and jobs of unknown size last
+
+    :param job_type job: fetch job
+
+    :return: sort key
+
+    :rtype: tuple
+    """
+    return (job.size is None, job.size or 0)
@@ -0,0 +1,597 @@
+# Copyright (c) 2021 Marcus Schäfer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""
+Fetch pipeline of the corbos_scm command line
+"""
+import os
+import logging
+from pathlib import Path
+from typing import (
+    Dict, Optional
+)
+
+from corbos_scm.command import Command
+from corbos_scm.client import (
+    DaemonClient, DAEMON_TIMEOUT
+)
+from corbos_scm.container import (
+    pull, run
+)
+from corbos_scm.apt_cache import AptCache
+from corbos_scm.source_cache import SourceCache
+from corbos_scm.metadata_cache import MetadataCache
+from corbos_scm.state import OutdirState
+from corbos_scm.coalesce import RequestCoalescer
+from corbos_scm.staging import StagingDir
+from corbos_scm.report import (
+    Report, phase, record_published
+)
+from corbos_scm.metrics import Metrics
+from corbos_scm.retry import (
+    RetryPolicy, get_candidates
+)
+from corbos_scm.sources import (
+    parse_sources, select_source
+)
+from corbos_scm.exceptions import (
+    CSCMError, CSCMPrefetchError, CSCMReportError
+)
+from corbos_scm.apt import (
+    get_update_command, get_source_command, get_showsrc_command,
+    check_package, AptProxyConfig
+)
+
+log = logging.getLogger('corbos_scm')
+
+
+def serve(args: Dict) -> None:
+    """
+    Run a fetch request of the corbos_scm command line
+
+    :param dict args: docopt arguments of main()
+    """
+    if args['--timeout']:
+        Command.set_total_timeout(int(args['--timeout']))
+
+    Metrics.setup(args['--metrics'])
+
+    report = Report(args['--package'])
+    report.activate()
+    policy = RetryPolicy(int(args['--retries']), int(args['--retry-budget']))
+    try:
+        fetch(args, policy)
+    except BaseException as issue:
+        report.error = f'{type(issue).__name__}: {issue}'
+        if args['--report']:
+            # the fetch error is the one to report, not this one
+            try:
+                report.write(args['--report'], args['--outdir'])
+            except CSCMReportError as write_issue:
+                log.warning(f'{type(write_issue).__name__}: {write_issue}')
+        raise
+    if args['--report']:
+        report.write(args['--report'], args['--outdir'])
+
+
+def fetch(args: Dict, policy: RetryPolicy) -> None:
+    """
+    Fetch package sources into --outdir
+
+    The sources are fetched into a staging directory and only
+    published into --outdir once they are complete. If the version
+    recorded in the state of --outdir is still the latest one,
+    nothing is fetched and --outdir is left untouched
+
+    :param dict args: docopt arguments of main()
+    :param RetryPolicy policy: retry policy of all phases
+    """
+    if not os.path.exists(args['--outdir']):
+        Path(args['--outdir']).mkdir(parents=True, exist_ok=True)
+    state = OutdirState(args['--outdir'])
+
+    request = None
+    if args['--cache-dir']:
+        # concurrent runs for the same package share one fetch
+        request = RequestCoalescer(
+            args['--cache-dir'], get_request_key(args),
+            exclude=[OutdirState.state_name]
+        )
+    with StagingDir(
+        args['--outdir'], request.partial_dir if request else None
+    ) as staging:
+        if request:
+            with phase('wait'):
+                request.acquire()
+            try:
+                fetched = request.receive(staging.path)
+                if not fetched:
+                    # resume what a failed fetch left behind
+                    staging.resume()
+                    fetched = fetch_sources(args, policy, state, staging.path)
+                    if fetched:
+                        request.publish(staging.path)
+            finally:
+                request.release()
+        else:
+            fetched = fetch_sources(args, policy, state, staging.path)
+
+        if fetched:
+            with phase('publish'):
+                state.begin_publish(staging.get_names())
+                published = staging.publish(state.get_files())
+                record_published(args['--outdir'], published)
+
+    if fetched:
+        state.write(
+            args['--package'], published, args['--package-version']
+        )
+        if args['--mirror'] and (
+            args['--prefetch-manifest'] or args['--prefetch-dir']
+        ):
+            # the sources are in place, the build dependencies are
+            # only a head start for the build
+            try:
+                with phase('prefetch'):
+                    prefetch_build_deps(args, policy, state)
+            except CSCMError as issue:
+                log.warning(
+                    f'Prefetch of build dependencies failed: '
+                    f'{type(issue).__name__}: {issue}'
+                )
+    else:
+        Metrics.inc('corbos_scm_unchanged_total')
+
+
+def fetch_sources(
+    args: Dict, policy: RetryPolicy, state: OutdirState, staging_dir: str
+) -> bool:
+    """
+    Fetch package sources with the selected fetch engine
+
+    :param dict args: docopt arguments of main()
+    :param RetryPolicy policy: retry policy of all phases
+    :param OutdirState state: state of --outdir
+    :param str staging_dir: directory to fetch the sources into
+
+    :return: False if the sources in --outdir are unchanged
+
+    :rtype: bool
+    """
+    if args['--mirror']:
+        return fetch_from_mirror(args, policy, state, staging_dir)
+    return fetch_from_container(args, policy, state, staging_dir)
+
+
+def get_request_key(args: Dict) -> str:
+    """
+    Key identifying equal fetch requests
+
+    :param dict args: docopt arguments of main()
+
+    :return: package origin, name and version
+
+    :rtype: str
+    """
+    if args['--mirror']:
+        origin = ' '.join(
+            [
+                args['--mirror'], args['--snapshot'] or '',
+                args['--distribution'], args['--components']
+            ]
+        )
+    else:
+        origin = f'container:{args["--container"]}'
+    return MetadataCache.get_key(
+        origin, args['--package'], args['--package-version']
+    )
+
+
+def get_bandwidth_limit(args: Dict) -> Optional[int]:
+    """
+    Download rate limit of this run
+
+    :param dict args: docopt arguments of main()
+
+    :return: limit in kB/s or None
+
+    :rtype: int
+    """
+    return int(args['--bandwidth-limit']) if args['--bandwidth-limit'] else None
+
+
+def get_daemon_timeout(args: Dict) -> float:
+    """
+    Time to wait for the answer of the daemon
+
+    With --timeout the daemon gets half of it, such that a
+    direct fetch still fits into the limit if the daemon does
+    not answer
+
+    :param dict args: docopt arguments of main()
+
+    :return: timeout in seconds
+
+    :rtype: float
+    """
+    if args['--timeout']:
+        return int(args['--timeout']) / 2
+    return DAEMON_TIMEOUT
+
+
+def get_apt_proxy(args: Dict) -> Optional[AptProxyConfig]:
+    """
+    apt configuration of the caching proxy for the containers of
+    this run, the proxy is started if --cache-dir is set and it
+    is not running
+
+    :param dict args: docopt arguments of main()
+
+    :return: AptProxyConfig or None if no proxy is used
+
+    :rtype: AptProxyConfig
+    """
+    if not args['--apt-proxy']:
+        return None
+    # only a proxied run needs the proxy and its http stack
+    from corbos_scm.proxy import start_proxy
+
+    if args['--cache-dir']:
+        start_proxy(
+            args['--apt-proxy'], args['--cache-dir'],
+            args['--apt-proxy-hosts']
+        )
+    return AptProxyConfig(args['--apt-proxy'])
+
+
+def fetch_from_container(
+    args: Dict, policy: RetryPolicy, state: OutdirState, staging_dir: str
+) -> bool:
+    """
+    Fetch package sources using the development tools container
+
+    :param dict args: docopt arguments of main()
+    :param RetryPolicy policy: retry policy of all phases
+    :param OutdirState state: state of --outdir
+    :param str staging_dir: directory to fetch the sources into
+
+    :return: False if the sources in --outdir are unchanged
+
+    :rtype: bool
+    """
+    # fail before a container is pulled or the daemon is asked
+    check_package(args['--package'], args['--package-version'])
+    registries = get_candidates(args['--registry'])
+    image = f'{registries[0]}/{args["--container"]}'
+    if not args['--bandwidth-limit']:
+        # the daemon does not limit the bandwidth of a request
+        client = DaemonClient(
+            args['--daemon-socket'], get_daemon_timeout(args)
+        )
+        if state.exists():
+            with phase('resolve'):
+                showsrc = client.resolve(image, args['--package'])
+            if showsrc is not None and state.is_current(
+                select_source(
+                    parse_sources(showsrc), args['--package-version']
+                )
+            ):
+                return False
+        with phase('daemon'):
+            fetched = client.fetch(
+                image, args['--package'], staging_dir,
+                args['--package-version']
+            )
+        if fetched:
+            return True
+
+    with phase('pull'):
+        policy.failover(
+            registries, lambda registry: pull(
+                f'{registry}/{args["--container"]}',
+                args['--cache-dir'], int(args['--image-ttl'])
+            ), 'pull'
+        )
+
+    if args['--cache-dir']:
+        return fetch_cached(args, policy, state, staging_dir)
+
+    apt_proxy = get_apt_proxy(args)
+    proxy_volumes = apt_proxy.get_volumes() if apt_proxy else {}
+    if state.exists():
+        # a fresh container knows no packages, the check
+        # costs an additional apt update
+        lookup = get_update_command() + ['>', '/dev/null', '&&']
+        lookup += get_showsrc_command(args['--package'])
+        with phase('resolve'):
+            source = select_source(
+                parse_sources(
+                    policy.call(
+                        lambda: run(
+                            args['--container'], proxy_volumes, lookup,
+                            tty=False
+                        ), 'resolve'
+                    ).output
+                ), args['--package-version']
+            )
+        if state.is_current(source):
+            return False
+
+    pull_debian_source = ['cd', '/mnt', '&&']
+    pull_debian_source += get_update_command() + ['&&']
+    pull_debian_source += get_source_command(
+        args['--package'], args['--package-version'],
+        get_bandwidth_limit(args)
+    )
+    with phase('fetch'):
+        policy.call(
+            lambda: run(
+                args['--container'], dict(proxy_volumes, **{
+                    staging_dir: '/mnt'
+                }), pull_debian_source
+            ), 'fetch'
+        )
+    return True
+
+
+def fetch_cached(
+    args: Dict, policy: RetryPolicy, state: OutdirState, staging_dir: str
+) -> bool:
+    """
+    Fetch package sources using the apt index cache and the
+    source file store below --cache-dir
+
+    :param dict args: docopt arguments of main()
+    :param RetryPolicy policy: retry policy of all phases
+    :param OutdirState state: state of --outdir
+    :param str staging_dir: directory to fetch the sources into
+
+    :return: False if the sources in --outdir are unchanged
+
+    :rtype: bool
+    """
+    apt_cache = AptCache(
+        args['--cache-dir'], args['--container'], int(args['--apt-ttl'])
+    )
+    source_cache = SourceCache(
+        args['--cache-dir'], int(args['--source-cache-size']) * 1024 * 1024
+    )
+    apt_proxy = get_apt_proxy(args)
+    update_volumes = apt_cache.get_volumes()
+    if apt_proxy:
+        update_volumes.update(apt_proxy.get_volumes())
+    volumes = {staging_dir: '/mnt'}
+    volumes.update(update_volumes)
+    version = args['--package-version']
+
+    def update() -> None:
+        with phase('update'), apt_cache.update_lock():
+            if not apt_cache.is_fresh():
+                policy.call(
+                    lambda: run(
+                        args['--container'], update_volumes,
+                        apt_cache.get_update_command()
+                    ), 'update'
+                )
+
+    metadata_cache = None
+    source = None
+    if version:
+        metadata_cache = MetadataCache(args['--cache-dir'])
+        metadata_key = MetadataCache.get_key(
+            f'container:{args["--container"]}', args['--package'], version
+        )
+        source = metadata_cache.get(metadata_key)
+    if not source:
+        update()
+        with apt_cache.read_lock(), phase('resolve'):
+            source = select_source(
+                parse_sources(
+                    policy.call(
+                        lambda: run(
+                            args['--container'], apt_cache.get_volumes(),
+                            get_showsrc_command(args['--package']), tty=False
+                        ), 'resolve'
+                    ).output
+                ), version
+            )
+        if source and metadata_cache:
+            metadata_cache.put(metadata_key, source)
+    if state.is_current(source):
+        return False
+    if source:
+        with phase('download'):
+            if source_cache.materialize(source, staging_dir):
+                return True
+    update()
+    with apt_cache.read_lock(), phase('download'):
+        policy.call(
+            lambda: run(
+                args['--container'], volumes, ['cd', '/mnt', '&&'] + (
+                    get_source_command(
+                        args['--package'], version, get_bandwidth_limit(args)
+                    )
+                )
+            ), 'download'
+        )
+    if source:
+        with phase('store'):
+            source_cache.store(source, staging_dir)
+    return True
+
+
+def get_mirrors(args: Dict, sources_index=None) -> Dict:
+    """
+    Mirrors of this run in failover order
+
+    :param dict args: docopt arguments of main()
+    :param SourcesIndex sources_index:
+        index to resolve packages from or None
+
+    :return: mirror URI to Mirror mapping
+
+    :rtype: dict
+    """
+    from corbos_scm.mirror import Mirror
+
+    snapshot = args['--snapshot']
+    return {
+        uri: Mirror(
+            uri, args['--distribution'],
+            args['--components'].split(','), args['--keyring'],
+            int(args['--download-workers']), get_bandwidth_limit(args),
+            sources_index
+        ) for uri in [
+            f'{uri.rstrip("/")}/{snapshot}' if snapshot else uri
+            for uri in get_candidates(args['--mirror'])
+        ]
+    }
+
+
+def prefetch_build_deps(
+    args: Dict, policy: RetryPolicy, state: OutdirState
+) -> None:
+    """
+    Resolve the build dependency closure of the fetched package
+    against the mirror, write it as --prefetch-manifest and
+    download it into --prefetch-dir
+
+    :param dict args: docopt arguments of main()
+    :param RetryPolicy policy: retry policy of all phases
+    :param OutdirState state: state of the fetch published to --outdir
+    """
+    from corbos_scm.packages import get_build_depends
+    from corbos_scm.prefetch import (
+        PackagesCache, BuildDepsResolver, write_manifest, warm_packages
+    )
+
+    # only the .dsc of this fetch, outdir may hold others
+    dsc_name = state.read().get('dsc')
+    if not dsc_name:
+        raise CSCMPrefetchError(f'No .dsc file recorded in {state.outdir}')
+    with open(os.sep.join([state.outdir, dsc_name])) as dsc:
+        dsc_data = dsc.read()
+    source = parse_sources(dsc_data)[0]
+    architecture = args['--architecture']
+    packages_cache = None
+    if args['--cache-dir']:
+        packages_cache = PackagesCache(args['--cache-dir'])
+    mirrors = get_mirrors(args)
+    uri, packages = policy.failover(
+        list(mirrors), lambda uri: (
+            uri, mirrors[uri].get_packages(architecture, packages_cache)
+        ), 'prefetch'
+    )
+    selected, unresolved = BuildDepsResolver(packages, architecture).resolve(
+        get_build_depends(dsc_data, architecture)
+    )
+    log.info(
+        f'Build dependency closure of {source.package}: '
+        f'{len(selected)} packages, {len(unresolved)} unresolved'
+    )
+    for relation in unresolved:
+        log.warning(f'Unresolved build dependency: {relation}')
+    if args['--prefetch-manifest']:
+        write_manifest(
+            args['--prefetch-manifest'], source, architecture, uri,
+            selected, unresolved
+        )
+    if args['--prefetch-dir']:
+        bandwidth_limit = get_bandwidth_limit(args)
+        policy.call(
+            lambda: warm_packages(
+                uri, selected, args['--prefetch-dir'],
+                int(args['--download-workers']),
+                bandwidth_limit * 1024 if bandwidth_limit else None
+            ), 'prefetch'
+        )
+
+
+def fetch_from_mirror(
+    args: Dict, policy: RetryPolicy, state: OutdirState, staging_dir: str
+) -> bool:
+    """
+    Fetch package sources directly from the mirrors, using the
+    source file store below --cache-dir if set
+
+    :param dict args: docopt arguments of main()
+    :param RetryPolicy policy: retry policy of all phases
+    :param OutdirState state: state of --outdir
+    :param str staging_dir: directory to fetch the sources into
+
+    :return: False if the sources in --outdir are unchanged
+
+    :rtype: bool
+    """
+    # only the mirror engine needs the http and download stack
+    from corbos_scm.sources_index import SourcesIndex
+
+    version = args['--package-version']
+    snapshot = args['--snapshot']
+    sources_index = None
+    if args['--cache-dir']:
+        sources_index = SourcesIndex(
+            args['--cache-dir'], int(args['--apt-ttl'])
+        )
+    mirrors = get_mirrors(args, sources_index)
+    metadata_cache = None
+    source = None
+    if args['--cache-dir'] and (version or snapshot):
+        metadata_cache = MetadataCache(args['--cache-dir'])
+        metadata_key = MetadataCache.get_key(
+            ' '.join(
+                [','.join(mirrors), args['--distribution'], args['--components']]
+            ), args['--package'], version
+        )
+        source = metadata_cache.get(metadata_key)
+    download_uris = list(mirrors)
+    if not source:
+        with phase('resolve'):
+            resolved_uri, source = policy.failover(
+                list(mirrors), lambda uri: (
+                    uri, mirrors[uri].resolve(args['--package'], version)
+                ), 'resolve'
+            )
+        if metadata_cache:
+            metadata_cache.put(metadata_key, source)
+        # download from the mirror which resolved the package first
+        download_uris = [resolved_uri] + [
+            uri for uri in mirrors if uri != resolved_uri
+        ]
+    if state.is_current(source):
+        return False
+    source_cache = None
+    with phase('download'):
+        if args['--cache-dir']:
+            source_cache = SourceCache(
+                args['--cache-dir'],
+                int(args['--source-cache-size']) * 1024 * 1024
+            )
+            if source_cache.materialize(source, staging_dir):
+                return True
+        policy.failover(
+            download_uris, lambda uri: mirrors[uri].fetch(
+                source, staging_dir
+            ), 'download'
+        )
+    if source_cache:
+        with phase('store'):
+            source_cache.store(source, staging_dir, verified=True)
+    return True
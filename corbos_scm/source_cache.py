@@ -0,0 +1,277 @@
+# Copyright (c) 2021 Marcus Schäfer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+import os
+import json
+import time
+import logging
+from typing import (
+    Dict, List
+)
+
+from corbos_scm.lock import FileLock
+from corbos_scm.metrics import Metrics
+from corbos_scm.sources import (
+    source_file_type, source_package_type
+)
+from corbos_scm.filesystem import (
+    link_or_copy, reflink_or_copy, sha256sum
+)
+from corbos_scm.exceptions import CSCMSourceCacheError
+
+log = logging.getLogger('corbos_scm')
+
+
+class SourceCache:
+    """
+    Content addressed store of source package files
+
+    Files are stored once by their sha256 checksum. An index maps
+    source package name and version to the list of files as given
+    by the Checksums-Sha256 field of the source record. Stored
+    files are reflinked or copied into read only objects, such
+    that the fetched files stay writable. Cache hits hardlink the
+    objects into the output directory, or reflink or copy them
+    if it is on another filesystem. A hardlinked output file
+    shares its data with the object, therefore the size and
+    modification time of every object are recorded when it is
+    stored and checked before it is handed out again. An object
+    changed since is dropped from the store. If the store exceeds
+    its quota the least recently used packages are evicted
+    """
+    def __init__(self, cache_dir: str, quota: int) -> None:
+        """
+        Setup source cache
+
+        :param str cache_dir: base cache directory
+        :param int quota: maximum size of the store in bytes
+        """
+        self.quota = quota
+        self.root = os.sep.join([cache_dir, 'sources'])
+        self.objects_dir = os.sep.join([self.root, 'objects'])
+        self.index_file = os.sep.join([self.root, 'index.json'])
+        self.lock_file = os.sep.join([self.root, 'sources.lock'])
+        os.makedirs(self.objects_dir, exist_ok=True)
+
+    def materialize(self, source: source_package_type, outdir: str) -> bool:
+        """
+        Provide the files of the given source package in outdir
+        if they are in the cache
+
+        :param source_package_type source: source package record
+        :param str outdir: target directory
+
+        :return: True on cache hit, False otherwise
+
+        :rtype: bool
+        """
+        key = self.get_key(source)
+        with FileLock(self.lock_file):
+            index = self._read_index()
+            entry = index.get(key)
+            if not entry or entry['files'] != self._get_files(source):
+                Metrics.inc('corbos_scm_source_cache_total', {'result': 'miss'})
+                return False
+            for source_file in source.files:
+                object_file = self.get_object(source_file.sha256)
+                if not self._is_intact(object_file, source_file, entry):
+                    log.warning(f'Source cache object missing or changed for {key}')
+                    if os.path.exists(object_file):
+                        os.unlink(object_file)
+                    del index[key]
+                    self._write_index(index)
+                    Metrics.inc(
+                        'corbos_scm_source_cache_total', {'result': 'miss'}
+                    )
+                    return False
+            for source_file in source.files:
+                # the objects are unchanged since they were stored
+                # from verified files and are read only
+                link_or_copy(
+                    self.get_object(source_file.sha256),
+                    os.sep.join([outdir, source_file.name])
+                )
+            entry['used'] = time.time()
+            self._write_index(index)
+        log.info(f'Source cache hit for {key}')
+        Metrics.inc('corbos_scm_source_cache_total', {'result': 'hit'})
+        return True
+
+    def store(
+        self, source: source_package_type, outdir: str,
+        verified: bool = False
+    ) -> bool:
+        """
+        Add the files of the given source package from outdir
+        to the cache
+
+        Files are only stored if all of them exist and match
+        their checksum
+
+        :param source_package_type source: source package record
+        :param str outdir: directory containing the source files
+        :param bool verified:
+            the files were verified against the checksums of the
+            source record already, e.g while they were downloaded,
+            and are not read again
+
+        :return: True if stored, False otherwise
+
+        :rtype: bool
+        """
+        key = self.get_key(source)
+        for source_file in source.files:
+            filename = os.sep.join([outdir, source_file.name])
+            if not os.path.exists(filename) or (
+                not verified and sha256sum(filename) != source_file.sha256
+            ):
+                log.warning(f'Not caching {key}: {source_file.name} mismatch')
+                return False
+        with FileLock(self.lock_file):
+            index = self._read_index()
+            mtimes = {}
+            added = []
+            for source_file in source.files:
+                object_file = self.get_object(source_file.sha256)
+                try:
+                    if not os.path.exists(object_file):
+                        self._add_object(
+                            os.sep.join([outdir, source_file.name]),
+                            object_file
+                        )
+                        added.append(object_file)
+                    mtimes[source_file.sha256] = os.stat(
+                        object_file
+                    ).st_mtime_ns
+                except OSError as issue:
+                    # caching is best effort, the fetched files
+                    # are in place already
+                    log.warning(f'Not caching {key}: {issue}')
+                    for object_file in added:
+                        os.unlink(object_file)
+                    return False
+            index[key] = {
+                'files': self._get_files(source),
+                'mtimes': mtimes,
+                'used': time.time()
+            }
+            self._evict(index)
+            self._write_index(index)
+        return True
+
+    def get_object(self, sha256: str) -> str:
+        """
+        Path of the store object for the given checksum
+
+        :param str sha256: hex digest
+
+        :return: file path
+
+        :rtype: str
+        """
+        return os.sep.join([self.objects_dir, sha256[:2], sha256])
+
+    @staticmethod
+    def get_key(source: source_package_type) -> str:
+        """
+        Index key of the given source package
+
+        :param source_package_type source: source package record
+
+        :return: key
+
+        :rtype: str
+        """
+        return f'{source.package}_{source.version}'
+
+    @staticmethod
+    def _add_object(filename: str, object_file: str) -> None:
+        os.makedirs(os.path.dirname(object_file), exist_ok=True)
+        new_object_file = f'{object_file}.new'
+        try:
+            # a hardlink would make the file in outdir read
+            # only and expose the object to changes of it
+            reflink_or_copy(filename, new_object_file)
+            os.chmod(new_object_file, 0o444)
+            os.replace(new_object_file, object_file)
+        except OSError:
+            if os.path.exists(new_object_file):
+                os.unlink(new_object_file)
+            raise
+
+    @staticmethod
+    def _is_intact(
+        object_file: str, source_file: source_file_type, entry: Dict
+    ) -> bool:
+        # the objects were verified when they were stored, reading
+        # them again on every hit would cost the size of the sources
+        try:
+            status = os.stat(object_file)
+        except OSError:
+            return False
+        return status.st_size == source_file.size and \
+            status.st_mtime_ns == entry.get('mtimes', {}).get(source_file.sha256)
+
+    @staticmethod
+    def _get_files(source: source_package_type) -> List[Dict]:
+        return [source_file._asdict() for source_file in source.files]
+
+    def _evict(self, index: Dict[str, Dict]) -> None:
+        sizes = {}
+        for entry in index.values():
+            for source_file in entry['files']:
+                sizes[source_file['sha256']] = source_file['size']
+        total = sum(sizes.values())
+        for key in sorted(index, key=lambda key: index[key]['used']):
+            if total <= self.quota:
+                break
+            log.info(f'Source cache evicting {key}')
+            del index[key]
+            referenced = set(
+                source_file['sha256'] for entry in index.values()
+                for source_file in entry['files']
+            )
+            for sha256 in list(sizes):
+                if sha256 not in referenced:
+                    total -= sizes.pop(sha256)
+                    object_file = self.get_object(sha256)
+                    if os.path.exists(object_file):
+                        os.unlink(object_file)
+
+    def _read_index(self) -> Dict[str, Dict]:
+        if not os.path.exists(self.index_file):
+            return {}
+        try:
+            with open(self.index_file) as index:
+                return json.load(index)
+        except (OSError, ValueError) as issue:
+            log.warning(f'Ignoring unreadable source cache index: {issue}')
+            return {}
+
+    def _write_index(self, index: Dict[str, Dict]) -> None:
+        new_index_file = f'{self.index_file}.new'
+        try:
+            with open(new_index_file, 'w') as new_index:
+                json.dump(index, new_index)
+            os.replace(new_index_file, self.index_file)
+        except OSError as issue:
+            raise CSCMSourceCacheError(
+                f'Failed to write source cache index: {issue}'
+            )
@@ -0,0 +1,280 @@
+# Copyright (c) 2021 Marcus Schäfer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""
+Parser for Debian source package control data as found in
+Sources indexes, apt-cache showsrc output and .dsc files
+"""
+import re
+from functools import cmp_to_key
+from typing import (
+    NamedTuple, List, Dict, Optional, Tuple
+)
+
+from corbos_scm.exceptions import CSCMSourceFormatError
+
+source_file_type = NamedTuple(
+    'source_file_type', [
+        ('name', str),
+        ('size', int),
+        ('sha256', str)
+    ]
+)
+
+source_package_type = NamedTuple(
+    'source_package_type', [
+        ('package', str),
+        ('version', str),
+        ('directory', str),
+        ('files', List[source_file_type]),
+        ('binaries', List[str])
+    ]
+)
+
+
+def parse_paragraphs(data: str) -> List[Dict[str, str]]:
+    """
+    Parse deb822 formatted data into paragraphs
+
+    Continuation lines are joined with a newline to the value of
+    the field they belong to. An OpenPGP clearsign armor as used
+    in signed .dsc files is skipped, as well as any text before
+    and after the signed part
+
+    :param str data: deb822 data
+
+    :return: list of field name to value dicts
+
+    :rtype: list
+    """
+    paragraphs: List[Dict[str, str]] = []
+    paragraph: Dict[str, str] = {}
+    field = ''
+    in_signature = False
+    for line in data.splitlines():
+        if line.startswith('-----BEGIN PGP SIGNED MESSAGE'):
+            # armor header lines (Hash: ...) until the empty line
+            in_signature = True
+            paragraphs = []
+            paragraph = {}
+            field = ''
+            continue
+        if line.startswith('-----BEGIN PGP SIGNATURE'):
+            break
+        if in_signature:
+            in_signature = bool(line.strip())
+            continue
+        if not line.strip():
+            if paragraph:
+                paragraphs.append(paragraph)
+            paragraph = {}
+        elif line[0] in ' \t':
+            if field:
+                paragraph[field] += '\n' + line.strip()
+        elif ':' in line:
+            field, value = line.split(':', 1)
+            paragraph[field] = value.strip()
+    if paragraph:
+        paragraphs.append(paragraph)
+    return paragraphs
+
+
+def parse_sources(data: str) -> List[source_package_type]:
+    """
+    Parse source package records
+
+    The file names are used as path below the output directory
+    and the caches, a name which is not a plain basename is
+    rejected
+
+    :param str data: Sources index, apt-cache showsrc or .dsc data
+
+    :return: list of source_package_type
+
+    :rtype: list
+
+    :raises CSCMSourceFormatError: if a file name is not valid
+    """
+    sources = []
+    for paragraph in parse_paragraphs(data):
+        package = paragraph.get('Package') or paragraph.get('Source')
+        if not package or 'Version' not in paragraph:
+            continue
+        files = []
+        for line in paragraph.get('Checksums-Sha256', '').splitlines():
+            checksum = line.split()
+            if len(checksum) == 3:
+                if '/' in checksum[2] or checksum[2] in ('.', '..'):
+                    raise CSCMSourceFormatError(
+                        f'Invalid file name {checksum[2]!r} in {package}'
+                    )
+                files.append(
+                    source_file_type(
+                        name=checksum[2], size=int(checksum[1]),
+                        sha256=checksum[0]
+                    )
+                )
+        sources.append(
+            source_package_type(
+                package=package,
+                version=paragraph['Version'],
+                directory=paragraph.get('Directory', ''),
+                files=files,
+                binaries=[
+                    binary.strip() for binary in
+                    paragraph.get('Binary', '').replace('\n', ' ').split(',')
+                    if binary.strip()
+                ]
+            )
+        )
+    return sources
+
+
+def get_latest(
+    sources: List[source_package_type]
+) -> Optional[source_package_type]:
+    """
+    Select the source package with the highest version
+
+    :param list sources: list of source_package_type
+
+    :return: source_package_type or None if sources is empty
+
+    :rtype: source_package_type
+    """
+    if not sources:
+        return None
+    version_key = cmp_to_key(compare_versions)
+    return max(sources, key=lambda source: version_key(source.version))
+
+
+def select_source(
+    sources: List[source_package_type], version: Optional[str] = None
+) -> Optional[source_package_type]:
+    """
+    Select the source package record of the given version
+
+    :param list sources: list of source_package_type
+    :param str version: exact version, None for the latest
+
+    :return: source_package_type or None
+
+    :rtype: source_package_type
+    """
+    if not version:
+        return get_latest(sources)
+    for source in sources:
+        if source.version == version:
+            return source
+    return None
+
+
+def find_source(
+    sources: List[source_package_type], package: str,
+    version: Optional[str] = None
+) -> Optional[source_package_type]:
+    """
+    Find the source package of the given name, or the one
+    building a binary package of the given name
+
+    :param list sources: list of source_package_type
+    :param str package: source or binary package name
+    :param str version: exact version, None for the latest
+
+    :return: source_package_type or None
+
+    :rtype: source_package_type
+    """
+    return select_source(
+        [source for source in sources if source.package == package],
+        version
+    ) or select_source(
+        [source for source in sources if package in source.binaries],
+        version
+    )
+
+
+def compare_versions(version_a: str, version_b: str) -> int:
+    """
+    Compare two Debian package versions following the rules
+    of the Debian policy manual
+
+    :param str version_a: version string
+    :param str version_b: version string
+
+    :return: negative, zero or positive like a cmp function
+
+    :rtype: int
+    """
+    epoch_a, upstream_a, revision_a = _split_version(version_a)
+    epoch_b, upstream_b, revision_b = _split_version(version_b)
+    if epoch_a != epoch_b:
+        return epoch_a - epoch_b
+    result = _compare_part(upstream_a, upstream_b)
+    return result or _compare_part(revision_a, revision_b)
+
+
+def _split_version(version: str) -> Tuple[int, str, str]:
+    epoch = 0
+    if ':' in version:
+        epoch_string, version = version.split(':', 1)
+        epoch = int(epoch_string)
+    revision = '0'
+    if '-' in version:
+        version, revision = version.rsplit('-', 1)
+    return epoch, version, revision
+
+
+def _order(char: str) -> int:
+    if char == '~':
+        return -1
+    if char.isalpha():
+        return ord(char)
+    return ord(char) + 256
+
+
+def _compare_part(part_a: str, part_b: str) -> int:
+    tokens_a = re.findall(r'\d+|\D+', part_a)
+    tokens_b = re.findall(r'\d+|\D+', part_b)
+    # the policy algorithm alternates between non digit and digit
+    # parts always starting with a, possibly empty, non digit part
+    if not tokens_a or tokens_a[0].isdigit():
+        tokens_a.insert(0, '')
+    if not tokens_b or tokens_b[0].isdigit():
+        tokens_b.insert(0, '')
+    for index in range(max(len(tokens_a), len(tokens_b))):
+        token_a = tokens_a[index] if index < len(tokens_a) else ''
+        token_b = tokens_b[index] if index < len(tokens_b) else ''
+        if index % 2:
+            result = int(token_a or 0) - int(token_b or 0)
+        else:
+            result = _compare_lexical(token_a, token_b)
+        if result:
+            return result
+    return 0
+
+
+def _compare_lexical(string_a: str, string_b: str) -> int:
+    for index in range(max(len(string_a), len(string_b))):
+        order_a = _order(string_a[index]) if index < len(string_a) else 0
+        order_b = _order(string_b[index]) if index < len(string_b) else 0
+        if order_a != order_b:
+            return order_a - order_b
+    return 0
@@ -0,0 +1,346 @@
+# Copyright (c) 2021 Marcus Schäfer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+import os
+import json
+import time
+import hashlib
+import logging
+import sqlite3
+from typing import (
+    Dict, List, Optional
+)
+
+from corbos_scm.lock import FileLock
+from corbos_scm.metrics import Metrics
+from corbos_scm.sources import (
+    source_package_type, source_file_type, parse_sources, select_source
+)
+from corbos_scm.exceptions import CSCMSourcesIndexError
+
+log = logging.getLogger('corbos_scm')
+
+
+class SourcesIndex:
+    """
+    Indexed local copy of the Sources indexes of package mirrors
+
+    The source packages of every indexed Sources file, called an
+    origin, are stored in a SQLite database below the cache
+    directory which is shared by all service calls on the host.
+    Source and binary package names are looked up from the
+    database without reading any Sources file. An origin is
+    considered fresh for ttl seconds after it was last checked.
+    The Sources file of each origin is kept next to the database
+    as the base for applying the pdiff patches of later updates.
+    Origins not checked for max_age seconds are removed
+    """
+    schema = [
+        'CREATE TABLE IF NOT EXISTS origins ('
+        'origin TEXT PRIMARY KEY, sha256 TEXT, checked REAL)',
+        'CREATE TABLE IF NOT EXISTS sources ('
+        'id INTEGER PRIMARY KEY, origin TEXT, package TEXT, '
+        'digest TEXT, record TEXT)',
+        'CREATE INDEX IF NOT EXISTS sources_origin ON sources (origin)',
+        'CREATE INDEX IF NOT EXISTS sources_package ON sources (package)',
+        'CREATE TABLE IF NOT EXISTS binaries (source_id INTEGER, name TEXT)',
+        'CREATE INDEX IF NOT EXISTS binaries_name ON binaries (name)',
+        'CREATE INDEX IF NOT EXISTS binaries_source ON binaries (source_id)'
+    ]
+
+    def __init__(
+        self, cache_dir: str, ttl: int = 3600, max_age: int = 30 * 86400
+    ) -> None:
+        """
+        Open the index database, created if not present
+
+        :param str cache_dir: base cache directory
+        :param int ttl: time in seconds an origin is considered fresh
+        :param int max_age:
+            time in seconds after which an origin which was not
+            checked is removed
+        """
+        self.ttl = ttl
+        self.max_age = max_age
+        # separate from the source cache kept in cache_dir/sources
+        self.root = os.sep.join([cache_dir, 'sources-index'])
+        self.lists_dir = os.sep.join([self.root, 'lists'])
+        self.database_file = os.sep.join([self.root, 'index.db'])
+        self.lock_file = os.sep.join([self.root, 'index.lock'])
+        os.makedirs(self.lists_dir, exist_ok=True)
+        try:
+            self.database = sqlite3.connect(self.database_file, timeout=60)
+            # readers are not blocked by an update in progress
+            self.database.execute('PRAGMA journal_mode=WAL')
+            with self.database:
+                for statement in self.schema:
+                    self.database.execute(statement)
+        except sqlite3.Error as issue:
+            raise CSCMSourcesIndexError(
+                f'Failed to open {self.database_file}: {issue}'
+            )
+
+    def close(self) -> None:
+        """
+        Close the index database
+        """
+        self.database.close()
+
+    def update_lock(self) -> FileLock:
+        """
+        Lock to hold while checking for and running an update
+
+        :return: exclusive FileLock
+
+        :rtype: FileLock
+        """
+        return FileLock(self.lock_file)
+
+    def get_state(self, origin: str) -> Optional[str]:
+        """
+        Checksum of the indexed Sources file of the given origin
+
+        :param str origin: origin name, e.g mirror, distribution
+            and component
+
+        :return: sha256 or None if the origin is not indexed
+
+        :rtype: str
+        """
+        row = self._query(
+            'SELECT sha256 FROM origins WHERE origin = ?', (origin,)
+        ).fetchone()
+        if not row or not os.path.exists(self.get_sources_file(origin)):
+            return None
+        return row[0]
+
+    def is_fresh(self, origin: str) -> bool:
+        """
+        Check if the origin was indexed or checked within the ttl
+
+        :param str origin: origin name
+
+        :return: True if no update check is required
+
+        :rtype: bool
+        """
+        row = self._query(
+            'SELECT checked FROM origins WHERE origin = ?', (origin,)
+        ).fetchone()
+        return bool(row) and time.time() - row[0] < self.ttl
+
+    def touch(self, origin: str) -> None:
+        """
+        Record that the origin was checked and is unchanged
+
+        :param str origin: origin name
+        """
+        self._execute(
+            [
+                (
+                    'UPDATE origins SET checked = ? WHERE origin = ?',
+                    (time.time(), origin)
+                )
+            ]
+        )
+
+    def get_sources_file(self, origin: str) -> str:
+        """
+        Path of the kept Sources file of the given origin
+
+        :param str origin: origin name
+
+        :return: file path
+
+        :rtype: str
+        """
+        return os.sep.join(
+            [self.lists_dir, hashlib.sha256(origin.encode()).hexdigest()]
+        )
+
+    def read_sources(self, origin: str) -> bytes:
+        """
+        Read the kept Sources file of the given origin
+
+        :param str origin: origin name
+
+        :return: uncompressed Sources data
+
+        :rtype: bytes
+        """
+        with open(self.get_sources_file(origin), 'rb') as sources:
+            return sources.read()
+
+    def update(self, origin: str, data: bytes) -> None:
+        """
+        Index the given Sources data of the origin
+
+        Only source packages which were added, changed or removed
+        since the last update of the origin are written
+
+        :param str origin: origin name
+        :param bytes data: uncompressed Sources data
+        """
+        records = {}
+        for source in parse_sources(data.decode('utf-8', errors='replace')):
+            record = json.dumps(source._asdict())
+            records[hashlib.sha256(record.encode()).hexdigest()] = (
+                source, record
+            )
+        indexed = dict(
+            self._query(
+                'SELECT digest, id FROM sources WHERE origin = ?', (origin,)
+            ).fetchall()
+        )
+        statements = []
+        for digest in set(indexed) - set(records):
+            statements += [
+                ('DELETE FROM sources WHERE id = ?', (indexed[digest],)),
+                (
+                    'DELETE FROM binaries WHERE source_id = ?',
+                    (indexed[digest],)
+                )
+            ]
+        added = set(records) - set(indexed)
+        sources_file = self.get_sources_file(origin)
+        new_sources_file = f'{sources_file}.new'
+        try:
+            with open(new_sources_file, 'wb') as new_sources:
+                new_sources.write(data)
+        except OSError as issue:
+            raise CSCMSourcesIndexError(
+                f'Failed to write {new_sources_file}: {issue}'
+            )
+        try:
+            with self.database:
+                for statement, parameters in statements:
+                    self.database.execute(statement, parameters)
+                for digest in added:
+                    source, record = records[digest]
+                    source_id = self.database.execute(
+                        'INSERT INTO sources (origin, package, digest, record) '
+                        'VALUES (?, ?, ?, ?)',
+                        (origin, source.package, digest, record)
+                    ).lastrowid
+                    self.database.executemany(
+                        'INSERT INTO binaries VALUES (?, ?)',
+                        [(source_id, binary) for binary in source.binaries]
+                    )
+                self.database.execute(
+                    'INSERT OR REPLACE INTO origins VALUES (?, ?, ?)', (
+                        origin, hashlib.sha256(data).hexdigest(), time.time()
+                    )
+                )
+                os.replace(new_sources_file, sources_file)
+        except (sqlite3.Error, OSError) as issue:
+            raise CSCMSourcesIndexError(
+                f'Failed to update index of {origin}: {issue}'
+            )
+        log.info(
+            f'Indexed {origin}: {len(added)} added, '
+            f'{len(statements) // 2} removed'
+        )
+
+    def lookup(
+        self, origins: List[str], package: str, version: Optional[str] = None
+    ) -> Optional[source_package_type]:
+        """
+        Find the source package of the given name, or the one
+        building a binary package of the given name, in the
+        given origins
+
+        :param list origins: origin names
+        :param str package: source or binary package name
+        :param str version: exact version, None for the latest
+
+        :return: source_package_type or None
+
+        :rtype: source_package_type
+        """
+        placeholders = ','.join('?' * len(origins))
+        source = select_source(
+            self._get_sources(
+                'SELECT record FROM sources WHERE package = ? '
+                f'AND origin IN ({placeholders})', [package] + origins
+            ), version
+        ) or select_source(
+            self._get_sources(
+                'SELECT record FROM binaries JOIN sources '
+                'ON sources.id = binaries.source_id WHERE name = ? '
+                f'AND origin IN ({placeholders})', [package] + origins
+            ), version
+        )
+        Metrics.inc(
+            'corbos_scm_sources_index_lookups_total',
+            {'result': 'hit' if source else 'miss'}
+        )
+        return source
+
+    def evict(self) -> None:
+        """
+        Remove origins which were not checked for max_age seconds
+        """
+        for origin, in self._query(
+            'SELECT origin FROM origins WHERE checked < ?',
+            (time.time() - self.max_age,)
+        ).fetchall():
+            log.info(f'Removing unused index of {origin}')
+            self._execute(
+                [
+                    (
+                        'DELETE FROM binaries WHERE source_id IN '
+                        '(SELECT id FROM sources WHERE origin = ?)', (origin,)
+                    ),
+                    ('DELETE FROM sources WHERE origin = ?', (origin,)),
+                    ('DELETE FROM origins WHERE origin = ?', (origin,))
+                ]
+            )
+            if os.path.exists(self.get_sources_file(origin)):
+                os.unlink(self.get_sources_file(origin))
+
+    def _get_sources(
+        self, query: str, parameters: List[str]
+    ) -> List[source_package_type]:
+        sources = []
+        for record, in self._query(query, parameters).fetchall():
+            data: Dict = json.loads(record)
+            data['files'] = [
+                source_file_type(*source_file) for source_file in data['files']
+            ]
+            sources.append(source_package_type(**data))
+        return sources
+
+    def _query(self, query: str, parameters) -> sqlite3.Cursor:
+        try:
+            return self.database.execute(query, parameters)
+        except sqlite3.Error as issue:
+            raise CSCMSourcesIndexError(
+                f'Failed to read {self.database_file}: {issue}'
+            )
+
+    def _execute(self, statements: List) -> None:
+        try:
+            with self.database:
+                for statement, parameters in statements:
+                    self.database.execute(statement, parameters)
+        except sqlite3.Error as issue:
+            raise CSCMSourcesIndexError(
+                f'Failed to write {self.database_file}: {issue}'
+            )
@@ -0,0 +1,161 @@
+# Copyright (c) 2021 Marcus Schäfer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+import os
+import shutil
+import logging
+from tempfile import mkdtemp
+from typing import (
+    List, Optional
+)
+
+log = logging.getLogger('corbos_scm')
+
+
+class StagingDir:
+    """
+    Directory in which the files for outdir are assembled
+
+    The staging directory is created next to outdir on the same
+    filesystem. Nothing shows up in outdir before publish is
+    called, which renames the complete files into outdir one by
+    one. A run dying before the publish leaves outdir untouched,
+    a run dying during the publish leaves a mix of old and new
+    files, which OutdirState records for the next run to repair.
+    Files which
+    were linked into staging from a cache are published without
+    copying their data. The staging directory is removed when
+    the context ends. If a partial directory is given, unfinished
+    downloads (.part files) are moved there instead of being
+    removed, such that a later run can resume them
+    """
+    partial_suffix = '.part'
+
+    def __init__(self, outdir: str, partial_dir: Optional[str] = None) -> None:
+        """
+        Create staging directory for outdir
+
+        :param str outdir: existing output directory
+        :param str partial_dir: directory keeping unfinished downloads
+        """
+        self.outdir = outdir
+        self.partial_dir = partial_dir
+        outdir_path = os.path.abspath(outdir)
+        self.path = mkdtemp(
+            prefix=f'.{os.path.basename(outdir_path)}.staging.',
+            dir=os.path.dirname(outdir_path)
+        )
+        # staging is written by the same parties as outdir,
+        # e.g the daemon or the container
+        os.chmod(self.path, os.stat(outdir).st_mode & 0o7777)
+
+    def __enter__(self) -> 'StagingDir':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.cleanup()
+
+    def publish(self, replace: Optional[List[str]] = None) -> List[str]:
+        """
+        Move all staged files into outdir
+
+        Every single file is renamed into place atomically,
+        existing files of the same name are replaced. The publish
+        as a whole is not atomic, callers record get_names in the
+        outdir state beforehand. Files of a previous
+        publish which are not part of this one are removed after
+        the new files are in place. Left over unfinished downloads
+        are not published
+
+        :param list replace: names published by the previous fetch
+
+        :return: list of published names
+
+        :rtype: list
+        """
+        names = self.get_names()
+        for name in names:
+            target = os.sep.join([self.outdir, name])
+            if os.path.isdir(target) and not os.path.islink(target):
+                shutil.rmtree(target)
+            os.replace(os.sep.join([self.path, name]), target)
+        for name in replace or []:
+            if name in names or os.path.basename(name) != name or (
+                name in ('', '.', '..')
+            ):
+                continue
+            self._remove(os.sep.join([self.outdir, name]))
+        log.debug(f'Published {len(names)} files into {self.outdir}')
+        return names
+
+    def get_names(self) -> List[str]:
+        """
+        Names of the staged files publish would move into outdir
+
+        Left over unfinished downloads are removed
+
+        :return: sorted list of names
+
+        :rtype: list
+        """
+        names = []
+        for name in sorted(os.listdir(self.path)):
+            if name.endswith(self.partial_suffix):
+                # resumed for a file the fetch did not need
+                os.unlink(os.sep.join([self.path, name]))
+            else:
+                names.append(name)
+        return names
+
+    def resume(self) -> None:
+        """
+        Move unfinished downloads of a previous run into staging
+        """
+        if self.partial_dir and os.path.isdir(self.partial_dir):
+            self._move_partial(self.partial_dir, self.path)
+
+    def cleanup(self) -> None:
+        """
+        Remove the staging directory and all unpublished files,
+        unfinished downloads are kept in the partial directory
+        """
+        if self.partial_dir:
+            try:
+                os.makedirs(self.partial_dir, exist_ok=True)
+                self._move_partial(self.path, self.partial_dir)
+            except OSError as issue:
+                log.warning(f'Failed to keep partial downloads: {issue}')
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def _move_partial(self, source_dir: str, target_dir: str) -> None:
+        for name in os.listdir(source_dir):
+            if name.endswith(self.partial_suffix):
+                # the partial directory may be on another filesystem
+                shutil.move(
+                    os.sep.join([source_dir, name]),
+                    os.sep.join([target_dir, name])
+                )
+
+    @staticmethod
+    def _remove(path: str) -> None:
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        elif os.path.lexists(path):
+            os.unlink(path)
@@ -0,0 +1,220 @@
+# Copyright (c) 2021 Marcus Schäfer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+import os
+import json
+import logging
+from typing import (
+    Dict, List, Optional
+)
+
+from corbos_scm.sources import (
+    source_package_type, source_file_type, parse_sources, select_source
+)
+from corbos_scm.filesystem import sha256sum
+from corbos_scm.exceptions import CSCMStateError
+
+log = logging.getLogger('corbos_scm')
+
+
+class OutdirState:
+    """
+    Record of the source package version fetched into outdir
+
+    The state file stores version and .dsc checksum of the
+    fetched source package. If a later run resolves the same
+    version with the same .dsc checksum and the .dsc in outdir
+    is still intact, the fetch can be skipped and outdir is
+    left untouched. Before the first file is renamed into outdir
+    the names about to be published are recorded, such that a
+    publish which died midway is detected and repaired by the
+    next run
+    """
+    state_name = '.corbos_scm.json'
+
+    def __init__(self, outdir: str) -> None:
+        """
+        Setup state of outdir
+
+        :param str outdir: output directory
+        """
+        self.outdir = outdir
+        self.state_file = os.sep.join([outdir, self.state_name])
+
+    def exists(self) -> bool:
+        """
+        Check if a previous fetch was recorded
+
+        :return: True if the state file exists
+
+        :rtype: bool
+        """
+        return os.path.exists(self.state_file)
+
+    def read(self) -> Dict:
+        """
+        Read recorded state
+
+        :return: state data, empty if nothing valid was recorded
+
+        :rtype: dict
+        """
+        try:
+            with open(self.state_file) as state:
+                data = json.load(state)
+        except (OSError, ValueError):
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    def is_current(self, source: Optional[source_package_type]) -> bool:
+        """
+        Check if outdir contains the given source package version
+
+        :param source_package_type source: resolved source package
+
+        :return: True if the fetch can be skipped
+
+        :rtype: bool
+        """
+        dsc = get_dsc_file(source) if source else None
+        if not source or not dsc:
+            return False
+        state = self.read()
+        if 'publishing' in state:
+            log.warning(
+                f'Previous publish into {self.outdir} is incomplete, '
+                'fetching again'
+            )
+            return False
+        if state.get('version') != source.version or state.get(
+            'dsc_sha256'
+        ) != dsc.sha256:
+            return False
+        dsc_file = os.sep.join([self.outdir, dsc.name])
+        if not os.path.exists(dsc_file) or sha256sum(dsc_file) != dsc.sha256:
+            log.warning(f'{dsc.name} in {self.outdir} changed, fetching again')
+            return False
+        log.info(
+            f'{source.package} {source.version} is unchanged, nothing to fetch'
+        )
+        return True
+
+    def get_files(self) -> List[str]:
+        """
+        Names of the files published by the recorded fetch
+
+        Names of an incomplete publish are included, such that
+        the next publish removes whatever it does not replace
+
+        :return: list of file names, empty if nothing was recorded
+
+        :rtype: list
+        """
+        state = self.read()
+        names: List[str] = []
+        for key in ('files', 'publishing'):
+            files = state.get(key)
+            if isinstance(files, list):
+                names += [
+                    name for name in files
+                    if isinstance(name, str) and name not in names
+                ]
+        return names
+
+    def begin_publish(self, names: List[str]) -> None:
+        """
+        Record the names about to be published into outdir
+
+        The record is kept until write is called after the
+        publish completed
+
+        :param list names: names of the files to publish
+        """
+        state = self.read()
+        state['publishing'] = names
+        self._write_state(state)
+
+    def write(
+        self, package: str, files: List[str], version: Optional[str] = None
+    ) -> None:
+        """
+        Record the source package published into outdir
+
+        Only the .dsc files among the published files are taken
+        into account, such that sources of previous fetches can
+        not be recorded by mistake. The version is taken from the
+        .dsc file, such that the state is correct no matter how
+        it was fetched
+
+        :param str package: requested package name
+        :param list files: names published into outdir by this fetch
+        :param str version: requested version, None for the latest
+        """
+        sources = []
+        dsc_files = {}
+        for name in files:
+            if name.endswith('.dsc'):
+                dsc_file = os.sep.join([self.outdir, name])
+                with open(dsc_file, errors='replace') as dsc:
+                    for dsc_source in parse_sources(dsc.read()):
+                        sources.append(dsc_source)
+                        dsc_files[dsc_source.version] = (name, dsc_file)
+        source = select_source(sources, version)
+        if not source:
+            log.warning(f'No .dsc file in {self.outdir}, state not recorded')
+            return
+        name, dsc_file = dsc_files[source.version]
+        self._write_state(
+            {
+                'package': package,
+                'source': source.package,
+                'version': source.version,
+                'dsc': name,
+                'dsc_sha256': sha256sum(dsc_file),
+                'files': files
+            }
+        )
+
+    def _write_state(self, data: Dict) -> None:
+        new_state_file = f'{self.state_file}.new'
+        try:
+            with open(new_state_file, 'w') as state:
+                json.dump(data, state)
+            os.replace(new_state_file, self.state_file)
+        except OSError as issue:
+            raise CSCMStateError(
+                f'Failed to write state {self.state_file}: {issue}'
+            )
+
+
+def get_dsc_file(source: source_package_type) -> Optional[source_file_type]:
+    """
+    Find the .dsc file of a source package
+
+    :param source_package_type source: source package record
+
+    :return: source_file_type or None
+
+    :rtype: source_file_type
+    """
+    for source_file in source.files:
+        if source_file.name.endswith('.dsc'):
+            return source_file
+    return None
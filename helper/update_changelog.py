@@ -1,134 +1,283 @@
 #!/usr/bin/python3
 """
 usage: update_changelog (--since=<reference_file>|--file=<reference_file>)
-            [--utc]
+            [--utc] [--cache=<cache_file>]
 
 arguments:
     --since=<reference_file>
         changes since the latest entry in the reference file
+    --file=<reference_file>
+        changes listed in the reference file
     --utc
         print date/time in UTC
+    --cache=<cache_file>
+        sqlite database of already rendered changelog entries by
+        commit hash, later runs only render new commits
 """
 import docopt
 import os
+import sqlite3
 import subprocess
 import sys
+import time
+from datetime import (
+    datetime, timedelta, timezone
+)
+from functools import lru_cache
 from dateutil import parser
 from dateutil import tz
 
-# Commandline arguments
-arguments = docopt.docopt(__doc__)
+# changelog header line
+log_start = '-' * 67 + os.linesep
 
-# Latest date of the given reference file
-date_reference = None
+# date format for rpm changelog
+date_format = '%a %b %d %T %Z %Y'
 
-# List of skipped commits older than date_reference
-skip_list = []
+# first byte of the message lines of a git log
+message_start = (b' ', b'\n', b'\r', b'\t')
 
-# hash of git history log entries
-log_data = {}
+# month names of the git default date format
+months = {
+    name: number for number, name in enumerate(
+        [
+            'Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+            'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'
+        ], 1
+    )
+}
 
-# raw list of log lines from git history or reference file
-log_lines = []
 
-# Author and Date
-log_author = None
-log_date = None
+@lru_cache(maxsize=None)
+def get_timezone(offset):
+    """
+    Fixed timezone for a git offset like +0100
+    """
+    minutes = int(offset[1:3]) * 60 + int(offset[3:5])
+    return timezone(timedelta(minutes=-minutes if offset[0] == '-' else minutes))
 
-# changelog header line
-log_start = '-' * 67 + os.linesep
 
-# date format for rpm changelog
-date_format = '%a %b %d %T %Z %Y'
+def parse_date(value):
+    """
+    Parse a date of the git default format, e.g
+    Sat Dec 18 16:10:08 2021 +0100, without the cost of
+    dateutil. Dates in any other format are passed to dateutil
+    """
+    try:
+        _, month, day, clock, year, offset = value.split()
+        hour, minute, second = clock.split(':')
+        return datetime(
+            int(year), months[month], int(day),
+            int(hour), int(minute), int(second),
+            tzinfo=get_timezone(offset)
+        )
+    except (ValueError, KeyError):
+        return parser.parse(value)
 
-# commit message
-commit_message = []
 
-# Open reference log file
-reference_file = arguments['--since'] or arguments['--file']
+def render_entry(author, author_date, message, zone):
+    """
+    Changelog entry of one commit
+    """
+    # the message starts after an empty line, the commits of a
+    # git log are separated by one, except for the last commit
+    message = [
+        line.decode(encoding='utf-8').strip() for line in message[1:]
+    ]
+    if not message[-1]:
+        message.pop()
+    message_header = message.pop(0)
+    message_body = []
+    for message_line in message + ['']:
+        if not message_line:
+            message_body.append(os.linesep)
+        else:
+            message_body.append(
+                '  {0}{1}'.format(message_line, os.linesep)
+            )
+    return ''.join(
+        [
+            log_start,
+            '{0} - {1}{2}{2}'.format(
+                author_date.astimezone(zone).strftime(date_format),
+                author, os.linesep
+            ),
+            '- {0}{1}'.format(
+                message_header, os.linesep
+            )
+        ] + message_body
+    )
 
-if arguments['--since']:
-    # Read latest date from reference file
-    with open(reference_file, 'r') as gitlog:
-        # read commit and author
-        gitlog.readline()
-        gitlog.readline()
-        # read date
-        latest_date = gitlog.readline().replace('AuthorDate:', '').strip()
-        date_reference = parser.parse(latest_date)
 
-    # Read git history since latest entry from reference file
-    process = subprocess.Popen(
-        [
-            'git', 'log', '--no-merges', '--format=fuller',
-            '--since="{0}"'.format(latest_date)
-        ], stdout=subprocess.PIPE
+def open_cache(filename):
+    """
+    Open the database of rendered changelog entries
+    """
+    cache = sqlite3.connect(filename)
+    cache.execute(
+        'CREATE TABLE IF NOT EXISTS entries ('
+        'key TEXT PRIMARY KEY, timestamp REAL, date TEXT, entry TEXT)'
     )
-    for line in iter(process.stdout.readline, b''):
-        log_lines.append(line)
-else:
-    with open(reference_file, 'rb') as gitlog:
-        log_lines = gitlog.readlines()
-
-# Iterate over log data and convert to changelog format
-for line_data in log_lines:
-    line = line_data.decode(encoding='utf-8')
-    if line.startswith('commit'):
-        if commit_message:
-            commit_message.pop(0)
-            message_header = commit_message.pop(0).lstrip()
-            message_body = []
-            for line in commit_message:
-                message_line = line.lstrip()
-                if not message_line:
-                    message_body.append(os.linesep)
-                else:
-                    message_body.append(
-                        '  {0}{1}'.format(message_line, os.linesep)
+    return cache
+
+
+class ChangelogWriter:
+    """
+    Write the commits of a git log in fuller format on stdout in
+    changelog format, latest author date first. The commits are
+    parsed and rendered as the log is read, only a bounded window
+    of commits is kept in memory. The entries can not be written
+    as they are rendered: git log orders by commit date or
+    topology, and a rebased or cherry-picked commit keeps an older
+    author date, so any later commit of the log may still belong
+    first. Rendered entries are therefore ordered in a temporary
+    database on disk. With a cache the commits of one window are
+    looked up at once and commits rendered by an earlier run are
+    not rendered again. Commits not newer than date_reference,
+    including the reference commit itself, are reported as
+    skipped on stderr
+    """
+    # commits read before they are looked up and rendered
+    window = 256
+
+    def __init__(self, zone, cache=None, date_reference=None):
+        self.zone = zone
+        self.cache = cache
+        # an empty name is a temporary database on disk
+        self.entries = sqlite3.connect('')
+        self.entries.execute(
+            'CREATE TABLE entries (timestamp REAL, date TEXT, entry TEXT)'
+        )
+        self.date_reference = date_reference
+        self.reference_time = None
+        if date_reference:
+            self.reference_time = date_reference.timestamp()
+        self.zone_name = 'UTC' if zone == tz.UTC else 'local {0}'.format(
+            ','.join(time.tzname)
+        )
+        self.skipped = False
+
+    def write(self, lines):
+        commits = []
+        message = []
+        for line_data in lines:
+            if line_data[:1] in message_start:
+                # indented or empty message line
+                message.append(line_data)
+            elif line_data.startswith(b'commit'):
+                if len(commits) == self.window:
+                    self.write_commits(commits)
+                    commits = []
+                message = []
+                commits.append(
+                    [line_data.split()[1].decode(), None, None, message]
+                )
+            elif line_data.startswith(b'Author:'):
+                commits[-1][1] = line_data[7:].decode(encoding='utf-8').strip()
+            elif line_data.startswith(b'AuthorDate:'):
+                commits[-1][2] = line_data[11:].decode(encoding='utf-8').strip()
+            elif not line_data.startswith((b'Commit:', b'CommitDate:')):
+                message.append(line_data)
+        self.write_commits(commits)
+        self.write_entries()
+
+    def write_commits(self, commits):
+        cached = {}
+        if self.cache and commits:
+            keys = [self.get_key(commit[0]) for commit in commits]
+            cached = {
+                key: (timestamp, date, entry)
+                for key, timestamp, date, entry in self.cache.execute(
+                    'SELECT key, timestamp, date, entry FROM entries '
+                    'WHERE key IN ({0})'.format(','.join('?' * len(keys))),
+                    keys
+                )
+            }
+        for commit, author, date, message in commits:
+            self.write_commit(
+                commit, author, date, message,
+                cached.get(self.get_key(commit))
+            )
+
+    def get_key(self, commit):
+        return '{0} {1}'.format(commit, self.zone_name)
+
+    def write_commit(self, commit, author, date, message, cached):
+        if cached:
+            timestamp, date, entry = cached
+        else:
+            author_date = parse_date(date)
+            timestamp = author_date.timestamp()
+            entry = render_entry(author, author_date, message, self.zone)
+            if self.cache:
+                self.cache.execute(
+                    'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+                    (self.get_key(commit), timestamp, date, entry)
+                )
+        self.entries.execute(
+            'INSERT INTO entries VALUES (?, ?, ?)', (timestamp, date, entry)
+        )
+
+    def write_entries(self):
+        # commits of equal author date keep the order of the log
+        for timestamp, date, entry in self.entries.execute(
+            'SELECT timestamp, date, entry FROM entries '
+            'ORDER BY timestamp DESC, rowid'
+        ):
+            if self.reference_time is None or self.reference_time < timestamp:
+                sys.stdout.write(entry)
+            else:
+                if not self.skipped:
+                    sys.stderr.write(
+                        'Reference Date: {0}{1}'.format(
+                            self.date_reference, os.linesep
+                        )
                     )
-            log_data[log_date] = ''.join(
-                [
-                    log_start,
-                    '{0} - {1}{2}{2}'.format(
-                        log_date.astimezone(
-                            tz.UTC if arguments['--utc'] else tz.tzlocal()
-                        ).strftime(date_format), log_author, os.linesep
-                    ),
-                    '- {0}{1}'.format(
-                        message_header, os.linesep
+                    self.skipped = True
+                sys.stderr.write(
+                    '  + Skipped: {0}: past reference{1}'.format(
+                        parse_date(date), os.linesep
                     )
-                ] + message_body
+                )
+        self.entries.close()
+
+
+def main():
+    arguments = docopt.docopt(__doc__)
+    zone = tz.UTC if arguments['--utc'] else tz.tzlocal()
+    cache = None
+    if arguments['--cache']:
+        cache = open_cache(arguments['--cache'])
+    try:
+        if arguments['--since']:
+            # Read latest date from reference file
+            with open(arguments['--since'], 'r') as gitlog:
+                # read commit and author
+                gitlog.readline()
+                gitlog.readline()
+                # read date
+                latest_date = gitlog.readline().replace(
+                    'AuthorDate:', ''
+                ).strip()
+
+            # Read git history since latest entry from reference file
+            process = subprocess.Popen(
+                [
+                    'git', 'log', '--no-merges', '--format=fuller',
+                    '--since="{0}"'.format(latest_date)
+                ], stdout=subprocess.PIPE
             )
-            commit_message = []
-    elif line.startswith('Author:'):
-        log_author = line.replace('Author:', '').strip()
-    elif line.startswith('AuthorDate:'):
-        log_date = parser.parse(line.replace('AuthorDate:', '').strip())
-    elif line.startswith('Commit:'):
-        pass
-    elif line.startswith('CommitDate:'):
-        pass
-    else:
-        commit_message.append(line.strip())
-
-# print in changelog format on stdout
-for author_date in reversed(sorted(log_data.keys())):
-    if date_reference:
-        if date_reference < author_date:
-            sys.stdout.write(log_data[author_date])
+            ChangelogWriter(
+                zone, cache, parse_date(latest_date)
+            ).write(process.stdout)
+            process.wait()
         else:
-            skip_list.append(author_date)
-    else:
-        sys.stdout.write(log_data[author_date])
-
-# print inconsistencies if any on stderr
-if skip_list:
-    sys.stderr.write(
-        'Reference Date: {0}{1}'.format(date_reference, os.linesep)
-    )
-    for date in skip_list:
-        sys.stderr.write(
-            '  + Skipped: {0}: past reference{1}'.format(
-                date, os.linesep
-            )
-        )
+            with open(arguments['--file'], 'rb') as gitlog:
+                ChangelogWriter(zone, cache).write(gitlog)
+    finally:
+        if cache:
+            cache.commit()
+            cache.close()
+
+
+if __name__ == '__main__':
+    main()
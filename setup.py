@@ -30,7 +30,10 @@ config = {
     'packages': ['corbos_scm'],
     'entry_points': {
         'console_scripts': [
-            'corbos_scm=corbos_scm.corbos_scm:main'
+            'corbos_scm=corbos_scm.corbos_scm:main',
+            'corbos_scm_batch=corbos_scm.batch:main',
+            'corbos_scm_daemon=corbos_scm.daemon:main',
+            'corbos_scm_proxy=corbos_scm.proxy:main'
         ]
     },
     'include_package_data': True,
@@ -0,0 +1,158 @@
+#!/usr/bin/python3
+"""
+usage: changelog_benchmark [--commits=<number>] [--rounds=<number>]
+           [--script=<file>]
+
+Benchmark of helper/update_changelog.py over a synthetic git
+history. The history is created with git fast-import, the --file
+scenario reads the same history from a git log in fuller format.
+The peak RSS of the --since scenarios includes git log.
+
+options:
+    --commits=<number>
+        Number of commits of the synthetic history [default: 100000]
+
+    --rounds=<number>
+        Measured runs per scenario [default: 3]
+
+    --script=<file>
+        Changelog script to measure, e.g another version of
+        helper/update_changelog.py to compare with
+"""
+import os
+import sys
+import json
+import shutil
+import statistics
+import subprocess
+import tempfile
+from typing import (
+    Dict, List
+)
+import docopt
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(os.path.dirname(BENCHMARK_DIR))
+
+# seconds since the epoch of the first synthetic commit
+START_TIME = 1609459200
+
+
+def create_history(repository: str, commits: int) -> None:
+    """
+    Create a git repository with the given number of empty
+    commits, every commit has a subject and a body of a few lines
+    """
+    subprocess.run(
+        ['git', 'init', '--quiet', repository], check=True
+    )
+    stream = []
+    for index in range(commits):
+        offset = '+0100' if index % 2 else '-0500'
+        timestamp = START_TIME + index * 60
+        message = f'Change number {index}\n\n' + ''.join(
+            f'Line {line} describing change {index} in more detail\n'
+            for line in range(index % 8)
+        )
+        data = message.encode()
+        stream.append(
+            f'commit refs/heads/master\n'
+            f'mark :{index + 1}\n'
+            f'author Developer {index % 50} <dev{index % 50}@example.com> '
+            f'{timestamp} {offset}\n'
+            f'committer Developer <dev@example.com> {timestamp} {offset}\n'
+            f'data {len(data)}\n{message}\n'
+        )
+        if index:
+            stream.append(f'from :{index}\n')
+        stream.append('\n')
+    subprocess.run(
+        ['git', 'fast-import', '--quiet'], cwd=repository, check=True,
+        input=''.join(stream).encode()
+    )
+    subprocess.run(
+        ['git', 'checkout', '--quiet', 'master'], cwd=repository, check=True
+    )
+
+
+def run(command: List[str], repository: str, output: str) -> Dict:
+    """
+    Run command in repository and return its wall time and peak RSS
+    """
+    with tempfile.NamedTemporaryFile() as result_file:
+        with open(output, 'wb') as stdout:
+            subprocess.run(
+                [
+                    sys.executable, f'{BENCHMARK_DIR}/rusage.py',
+                    result_file.name
+                ] + command, cwd=repository, check=True, stdout=stdout,
+                stderr=subprocess.DEVNULL
+            )
+        return json.load(result_file)
+
+
+def main() -> int:
+    arguments = docopt.docopt(__doc__)
+    commits = int(arguments['--commits'])
+    rounds = int(arguments['--rounds'])
+    script = arguments['--script'] or f'{ROOT_DIR}/helper/update_changelog.py'
+    root = tempfile.mkdtemp(prefix='corbos_scm_changelog.')
+    try:
+        repository = os.sep.join([root, 'repository'])
+        gitlog = os.sep.join([root, 'git.log'])
+        reference = os.sep.join([root, 'reference.log'])
+        output = os.sep.join([root, 'changelog'])
+        cache = os.sep.join([root, 'cache.db'])
+        sys.stderr.write(f'Creating history of {commits} commits\n')
+        create_history(repository, commits)
+        with open(gitlog, 'wb') as log:
+            subprocess.run(
+                ['git', 'log', '--no-merges', '--format=fuller'],
+                cwd=repository, check=True, stdout=log
+            )
+        with open(reference, 'wb') as log:
+            subprocess.run(
+                [
+                    'git', 'log', '--no-merges', '--format=fuller',
+                    '--max-parents=0'
+                ], cwd=repository, check=True, stdout=log
+            )
+        command = [sys.executable, script, '--utc']
+        scenarios = {
+            'file': (command + ['--file', gitlog], None),
+            'since': (command + ['--since', reference], None),
+            'since-cache-cold': (
+                command + ['--since', reference, '--cache', cache], 'cold'
+            ),
+            'since-cache-warm': (
+                command + ['--since', reference, '--cache', cache], 'warm'
+            )
+        }
+        print('SCENARIO          MEDIAN_S  COMMITS/S  RSS_MB')
+        for name, (scenario_command, cache_state) in scenarios.items():
+            sys.stderr.write(f'Running {name}\n')
+            runs = []
+            try:
+                if cache_state == 'warm':
+                    run(scenario_command, repository, output)
+                for count in range(rounds):
+                    if cache_state == 'cold' and os.path.exists(cache):
+                        os.unlink(cache)
+                    runs.append(run(scenario_command, repository, output))
+            except subprocess.CalledProcessError:
+                # e.g an older script without --cache
+                print(f'{name:<16}  failed')
+                continue
+            median = statistics.median(result['duration'] for result in runs)
+            peak_rss = max(result['peak_rss'] for result in runs) / 1024 ** 2
+            print(
+                f'{name:<16}  {median:<8.3f}  {commits / median:<9.0f}  '
+                f'{peak_rss:.1f}'
+            )
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
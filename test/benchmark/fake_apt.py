@@ -0,0 +1,102 @@
+#!/usr/bin/python3
+"""
+Stand-in for apt and apt-cache inside of the fake container
+
+Serves the apt commands used by corbos_scm from a mirror given
+by the environment, without root privileges or a sources.list.
+The first argument names the tool:
+
+* apt update
+* apt [-o option]... source --download-only <package>[=<version>]
+* apt-cache showsrc <package>
+
+FAKE_APT_MIRROR and FAKE_APT_DIST select the mirror, the index
+is stored in FAKE_APT_LISTS
+"""
+import os
+import sys
+import lzma
+import shutil
+from urllib.request import urlopen
+
+
+def read_paragraphs(data):
+    paragraphs = []
+    for block in data.split('\n\n'):
+        paragraph = {}
+        key = None
+        for line in block.splitlines():
+            if line.startswith(' ') and key:
+                paragraph[key] += '\n' + line.strip()
+            elif ':' in line:
+                key, value = line.split(':', 1)
+                paragraph[key] = value.strip()
+        if paragraph:
+            paragraphs.append((block, paragraph))
+    return paragraphs
+
+
+def find_sources(package):
+    index = os.path.join(os.environ['FAKE_APT_LISTS'], 'Sources')
+    if not os.path.exists(index):
+        return []
+    with open(index) as sources:
+        paragraphs = read_paragraphs(sources.read())
+    name, _, version = package.partition('=')
+    found = []
+    for block, paragraph in paragraphs:
+        binaries = [
+            binary.strip() for binary in paragraph.get('Binary', '').split(',')
+        ]
+        if paragraph.get('Package') != name and name not in binaries:
+            continue
+        if version and paragraph.get('Version') != version:
+            continue
+        found.append((block, paragraph))
+    return found
+
+
+def update():
+    mirror = os.environ['FAKE_APT_MIRROR']
+    dist = os.environ['FAKE_APT_DIST']
+    with urlopen(f'{mirror}/dists/{dist}/main/source/Sources.xz') as index:
+        data = lzma.decompress(index.read())
+    with open(os.path.join(os.environ['FAKE_APT_LISTS'], 'Sources'), 'wb') as f:
+        f.write(data)
+    return 0
+
+
+def source(package):
+    found = find_sources(package)
+    if not found:
+        sys.stderr.write(f'E: Unable to find a source package for {package}\n')
+        return 100
+    paragraph = found[-1][1]
+    mirror = os.environ['FAKE_APT_MIRROR']
+    for line in paragraph['Checksums-Sha256'].splitlines():
+        checksum = line.split()
+        if len(checksum) != 3:
+            continue
+        url = f'{mirror}/{paragraph["Directory"]}/{checksum[2]}'
+        with urlopen(url) as response, open(checksum[2], 'wb') as target:
+            shutil.copyfileobj(response, target, 1 << 20)
+    return 0
+
+
+def main(tool, args):
+    if tool == 'apt-cache':
+        for block, paragraph in find_sources(args[-1]):
+            print(block + '\n')
+        return 0
+    while args and args[0] == '-o':
+        args = args[2:]
+    if args[:1] == ['update']:
+        return update()
+    if args[:2] == ['source', '--download-only']:
+        return source(args[2])
+    sys.stderr.write(f'E: unsupported apt call {args}\n')
+    return 100
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1], sys.argv[2:]))
@@ -0,0 +1,114 @@
+#!/usr/bin/python3
+"""
+Stand-in for podman running the container commands on the host
+
+Container paths of the --volume options are rewritten to their
+host paths before the command is run with bash. The apt tools of
+the fake container are taken from FAKE_CONTAINER_BIN. Detached
+containers only record their volumes below FAKE_PODMAN_STATE,
+later exec calls run with them. FAKE_PODMAN_START_DELAY seconds
+are spent for every container start to model the startup cost
+of a real container
+"""
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import subprocess
+import uuid
+
+LISTS_PATH = '/var/lib/apt/lists'
+
+
+def state_file(container_id):
+    return os.path.join(os.environ['FAKE_PODMAN_STATE'], f'{container_id}.json')
+
+
+def parse_run(args):
+    volumes = {}
+    detach = False
+    while args and args[0].startswith('-'):
+        option = args.pop(0)
+        if option == '--volume':
+            host_path, container_path = args.pop(0).rsplit(':', 1)
+            volumes[container_path] = os.path.realpath(host_path)
+        elif option == '--detach':
+            detach = True
+    # image name, followed by the command
+    return volumes, detach, args[1:]
+
+
+def map_paths(argument, volumes):
+    for container_path in sorted(volumes, key=len, reverse=True):
+        argument = re.sub(
+            r'(?<![\w./-]){0}(?=/|\s|$)'.format(re.escape(container_path)),
+            volumes[container_path].replace('\\', '\\\\'), argument
+        )
+    return argument
+
+
+def execute(command, volumes):
+    lists_dir = None
+    if LISTS_PATH not in volumes:
+        # a fresh container knows no packages
+        lists_dir = tempfile.mkdtemp(dir=os.environ['FAKE_PODMAN_STATE'])
+        volumes = dict(volumes, **{LISTS_PATH: lists_dir})
+    environment = dict(
+        os.environ, FAKE_APT_LISTS=volumes[LISTS_PATH], PATH=os.pathsep.join(
+            [os.environ['FAKE_CONTAINER_BIN'], os.environ['PATH']]
+        )
+    )
+    try:
+        return subprocess.call(
+            [map_paths(argument, volumes) for argument in command],
+            env=environment
+        )
+    finally:
+        if lists_dir:
+            shutil.rmtree(lists_dir, ignore_errors=True)
+
+
+def main(args):
+    action = args.pop(0)
+    if action == 'pull':
+        return 0
+    if action == 'image':
+        if args[0] == 'inspect':
+            print('sha256:' + hashlib.sha256(args[-1].encode()).hexdigest())
+        return 0
+    if action == 'run':
+        time.sleep(float(os.environ.get('FAKE_PODMAN_START_DELAY', 0)))
+        volumes, detach, command = parse_run(args)
+        if not detach:
+            return execute(command, volumes)
+        container_id = uuid.uuid4().hex
+        if LISTS_PATH not in volumes:
+            volumes[LISTS_PATH] = tempfile.mkdtemp(
+                dir=os.environ['FAKE_PODMAN_STATE']
+            )
+        with open(state_file(container_id), 'w') as state:
+            json.dump(volumes, state)
+        print(container_id)
+        return 0
+    if action == 'exec':
+        with open(state_file(args[0])) as state:
+            volumes = json.load(state)
+        return execute(args[1:], volumes)
+    if action == 'rm':
+        if os.path.exists(state_file(args[-1])):
+            with open(state_file(args[-1])) as state:
+                lists_dir = json.load(state)[LISTS_PATH]
+            if lists_dir.startswith(os.environ['FAKE_PODMAN_STATE']):
+                shutil.rmtree(lists_dir, ignore_errors=True)
+            os.unlink(state_file(args[-1]))
+        return 0
+    sys.stderr.write(f'Error: unsupported podman call {action}\n')
+    return 125
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
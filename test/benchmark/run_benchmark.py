@@ -0,0 +1,387 @@
+#!/usr/bin/python3
+"""
+usage: run_benchmark [--rounds=<number>] [--scenario=<name>...]
+           [--save=<file>] [--baseline=<file>] [--tolerance=<percent>]
+           [--container-delay=<seconds>]
+       run_benchmark --list
+
+Offline end to end benchmark of corbos_scm and corbos_scm_batch.
+Every scenario runs main() in a new process against a local HTTP
+mirror with synthetic source packages. Container scenarios use a
+fake podman on PATH which runs the container commands on the host
+with a fake apt fetching from the same mirror.
+
+options:
+    --rounds=<number>
+        Measured runs per scenario [default: 5]
+
+    --scenario=<name>
+        Run only the given scenario, can be specified multiple times
+
+    --save=<file>
+        Write the results as JSON, e.g. to store a new baseline
+
+    --baseline=<file>
+        Compare the results with a previously saved run, e.g. the
+        test/benchmark/baseline.json of the reference machine.
+        Fails if the median latency or the peak RSS of a scenario
+        grew by more than --tolerance
+
+    --tolerance=<percent>
+        Allowed growth compared to the baseline [default: 25]
+
+    --container-delay=<seconds>
+        Time the fake podman spends for each container start, to
+        model the startup cost of a real container [default: 0.1]
+
+    --list
+        List the scenarios
+"""
+import os
+import sys
+import json
+import shutil
+import platform
+import statistics
+import subprocess
+import tempfile
+import threading
+from typing import (
+    NamedTuple, Callable, Dict, List, Optional
+)
+import docopt
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(os.path.dirname(BENCHMARK_DIR))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+from corbos_scm.report import get_directory_size  # noqa: E402
+from unit.conftest import (  # noqa: E402
+    create_mirror, MirrorServer
+)
+
+DISTRIBUTION = 'bench'
+
+# synthetic source packages, name to size of the orig tarball
+PACKAGES = {
+    'small': 16 * 1024,
+    'medium': 1024 * 1024,
+    'large': 32 * 1024 * 1024
+}
+BATCH_PACKAGES = {
+    f'batch{index:02d}': (16 * 1024 if index % 2 else 512 * 1024)
+    for index in range(20)
+}
+
+scenario_type = NamedTuple(
+    'scenario_type', [
+        ('name', str),
+        ('command', Callable[[str, str], List[str]]),
+        ('packages', int),
+        ('warm', bool)
+    ]
+)
+
+run_type = NamedTuple(
+    'run_type', [
+        ('duration', float),
+        ('peak_rss', int),
+        ('size', int)
+    ]
+)
+
+
+class BenchmarkEnvironment:
+    """
+    Local mirror, fake container tools and corbos_scm entry points
+    of the source tree, all below one temporary directory
+    """
+    def __init__(self, container_delay: float) -> None:
+        self.root = tempfile.mkdtemp(prefix='corbos_scm_benchmark.')
+        self.bin_dir = os.sep.join([self.root, 'bin'])
+        self.container_bin_dir = os.sep.join([self.root, 'container_bin'])
+        self.package_list = os.sep.join([self.root, 'packages.txt'])
+        for directory in (self.bin_dir, self.container_bin_dir):
+            os.makedirs(directory)
+        os.makedirs(os.sep.join([self.root, 'podman']))
+        create_mirror(
+            os.sep.join([self.root, 'mirror']), {
+                name: {
+                    'version': '1.0-1',
+                    'files': {
+                        f'{name}_1.0.orig.tar.gz': os.urandom(size),
+                        f'{name}_1.0-1.debian.tar.xz': os.urandom(4096)
+                    }
+                } for name, size in dict(PACKAGES, **BATCH_PACKAGES).items()
+            }, distribution=DISTRIBUTION
+        )
+        with open(self.package_list, 'w') as package_list:
+            package_list.write('\n'.join(BATCH_PACKAGES) + '\n')
+        self.server = MirrorServer(os.sep.join([self.root, 'mirror']))
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, daemon=True
+        )
+        self.thread.start()
+        self._write_shim(
+            self.bin_dir, 'podman',
+            f'exec {sys.executable} {BENCHMARK_DIR}/fake_podman.py "$@"'
+        )
+        for tool in ('apt', 'apt-cache'):
+            self._write_shim(
+                self.container_bin_dir, tool,
+                f'exec {sys.executable} {BENCHMARK_DIR}/fake_apt.py '
+                f'{tool} "$@"'
+            )
+        for tool, module in [
+            ('corbos_scm', 'corbos_scm.corbos_scm'),
+            ('corbos_scm_batch', 'corbos_scm.batch')
+        ]:
+            self._write_shim(
+                self.bin_dir, tool,
+                f'exec {sys.executable} -c "import sys; '
+                f'from {module} import main; sys.argv[0] = \'{tool}\'; '
+                f'main()" "$@"'
+            )
+        self.env = dict(
+            os.environ,
+            PATH=os.pathsep.join([self.bin_dir, os.environ['PATH']]),
+            PYTHONPATH=ROOT_DIR,
+            FAKE_CONTAINER_BIN=self.container_bin_dir,
+            FAKE_PODMAN_STATE=os.sep.join([self.root, 'podman']),
+            FAKE_PODMAN_START_DELAY=format(container_delay),
+            FAKE_APT_MIRROR=self.server.uri,
+            FAKE_APT_DIST=DISTRIBUTION
+        )
+
+    def __enter__(self) -> 'BenchmarkEnvironment':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    @staticmethod
+    def _write_shim(directory: str, name: str, command: str) -> None:
+        shim = os.sep.join([directory, name])
+        with open(shim, 'w') as script:
+            script.write(f'#!/bin/sh\n{command}\n')
+        os.chmod(shim, 0o755)
+
+    def get_scenarios(self) -> List[scenario_type]:
+        mirror = [
+            '--mirror', self.server.uri, '--distribution', DISTRIBUTION
+        ]
+        container = [
+            '--registry', 'registry.bench', '--container', 'ubdevtools',
+            '--daemon-socket', os.sep.join([self.root, 'no_daemon.sock'])
+        ]
+        scenarios = [
+            scenario_type(
+                f'mirror-single-{name}', lambda outdir, cache_dir, name=name: [
+                    'corbos_scm', '--package', name, '--outdir', outdir
+                ] + mirror, 1, False
+            ) for name in PACKAGES
+        ]
+        scenarios += [
+            scenario_type(
+                'mirror-single-large-cached', lambda outdir, cache_dir: [
+                    'corbos_scm', '--package', 'large', '--outdir', outdir,
+                    '--cache-dir', cache_dir
+                ] + mirror, 1, True
+            ),
+            scenario_type(
+                'container-single-small', lambda outdir, cache_dir: [
+                    'corbos_scm', '--package', 'small', '--outdir', outdir
+                ] + container, 1, False
+            ),
+            scenario_type(
+                'container-single-medium-cached', lambda outdir, cache_dir: [
+                    'corbos_scm', '--package', 'medium', '--outdir', outdir,
+                    '--cache-dir', cache_dir
+                ] + container, 1, True
+            ),
+            scenario_type(
+                'batch-container-session', lambda outdir, cache_dir: [
+                    'corbos_scm_batch', '--outdir', outdir,
+                    '--package-list', self.package_list,
+                    '--registry', 'registry.bench', '--container', 'ubdevtools'
+                ], len(BATCH_PACKAGES), False
+            ),
+            scenario_type(
+                'batch-mirror-workers', lambda outdir, cache_dir: [
+                    'corbos_scm_batch', '--outdir', outdir,
+                    '--package-list', self.package_list, '--workers', '4'
+                ] + mirror, len(BATCH_PACKAGES), False
+            )
+        ]
+        return scenarios
+
+    def run(self, command: List[str], outdir: str) -> run_type:
+        """
+        Run command and measure wall time and peak RSS
+
+        The peak RSS is the largest one of the started process
+        and all processes it waited for
+        """
+        with tempfile.TemporaryFile() as stderr, \
+                tempfile.NamedTemporaryFile() as result_file:
+            process = subprocess.run(
+                [
+                    sys.executable, f'{BENCHMARK_DIR}/rusage.py',
+                    result_file.name
+                ] + command,
+                env=self.env, stdout=subprocess.DEVNULL, stderr=stderr
+            )
+            if process.returncode != 0:
+                stderr.seek(0)
+                raise RuntimeError(
+                    f'{" ".join(command)} failed: '
+                    f'{stderr.read().decode(errors="replace")[-2000:]}'
+                )
+            result = json.load(result_file)
+        return run_type(
+            duration=result['duration'],
+            peak_rss=result['peak_rss'],
+            size=get_directory_size(outdir)
+        )
+
+    def measure(self, scenario: scenario_type, rounds: int) -> Dict:
+        work_dir = tempfile.mkdtemp(dir=self.root)
+        cache_dir = os.sep.join([work_dir, 'cache'])
+        try:
+            if scenario.warm:
+                outdir = os.sep.join([work_dir, 'warmup'])
+                self.run(scenario.command(outdir, cache_dir), outdir)
+            runs = []
+            for count in range(rounds):
+                outdir = os.sep.join([work_dir, f'out{count}'])
+                runs.append(
+                    self.run(scenario.command(outdir, cache_dir), outdir)
+                )
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        durations = [run.duration for run in runs]
+        median = statistics.median(durations)
+        return {
+            'rounds': rounds,
+            'latency': {
+                'min': round(min(durations), 4),
+                'median': round(median, 4),
+                'max': round(max(durations), 4)
+            },
+            'throughput_mb_s': round(runs[0].size / median / 1024 ** 2, 2),
+            'packages_per_s': round(scenario.packages / median, 2),
+            'peak_rss_mb': round(max(run.peak_rss for run in runs) / 1024 ** 2, 1)
+        }
+
+
+def compare(
+    results: Dict, baseline: Dict, tolerance: float
+) -> Dict[str, Optional[str]]:
+    """
+    Compare results with the baseline
+
+    :return: scenario name to change text, None if not in baseline
+    """
+    changes: Dict[str, Optional[str]] = {}
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            changes[name] = None
+            continue
+        latency = result['latency']['median'] / base['latency']['median'] - 1
+        rss = result['peak_rss_mb'] / base['peak_rss_mb'] - 1
+        status = 'ok'
+        if latency > tolerance or rss > tolerance:
+            status = 'REGRESSION'
+        changes[name] = f'{latency:+.1%} time {rss:+.1%} rss {status}'
+    return changes
+
+
+def print_results(results: Dict, changes: Dict[str, Optional[str]]) -> None:
+    rows = [
+        [
+            'SCENARIO', 'MEDIAN_S', 'MIN_S', 'MAX_S', 'MB/S', 'PKG/S',
+            'RSS_MB', 'BASELINE'
+        ]
+    ]
+    for name, result in results.items():
+        rows.append(
+            [
+                name,
+                f'{result["latency"]["median"]:.3f}',
+                f'{result["latency"]["min"]:.3f}',
+                f'{result["latency"]["max"]:.3f}',
+                f'{result["throughput_mb_s"]:.2f}',
+                f'{result["packages_per_s"]:.2f}',
+                f'{result["peak_rss_mb"]:.1f}',
+                changes.get(name) or '-'
+            ]
+        )
+    widths = [max(len(row[column]) for row in rows) for column in range(7)]
+    for row in rows:
+        cells = [row[column].ljust(widths[column]) for column in range(7)]
+        print('  '.join(cells + [row[7]]))
+
+
+def main() -> int:
+    arguments = docopt.docopt(__doc__)
+    with BenchmarkEnvironment(float(arguments['--container-delay'])) as env:
+        scenarios = env.get_scenarios()
+        if arguments['--list']:
+            for scenario in scenarios:
+                print(scenario.name)
+            return 0
+        if arguments['--scenario']:
+            unknown = set(arguments['--scenario']) - {
+                scenario.name for scenario in scenarios
+            }
+            if unknown:
+                sys.stderr.write(f'Unknown scenario: {sorted(unknown)}\n')
+                return 2
+            scenarios = [
+                scenario for scenario in scenarios
+                if scenario.name in arguments['--scenario']
+            ]
+        results = {}
+        for scenario in scenarios:
+            sys.stderr.write(f'Running {scenario.name}\n')
+            results[scenario.name] = env.measure(
+                scenario, int(arguments['--rounds'])
+            )
+    changes: Dict[str, Optional[str]] = {}
+    if arguments['--baseline']:
+        with open(arguments['--baseline']) as baseline_file:
+            baseline = json.load(baseline_file)
+        if (baseline['python'], baseline['machine']) != (
+            platform.python_version(), platform.machine()
+        ):
+            sys.stderr.write(
+                f'Baseline was saved with Python {baseline["python"]} '
+                f'on {baseline["machine"]}, results may not compare\n'
+            )
+        changes = compare(
+            results, baseline['scenarios'],
+            float(arguments['--tolerance']) / 100
+        )
+    print_results(results, changes)
+    if arguments['--save']:
+        with open(arguments['--save'], 'w') as save:
+            json.dump(
+                {
+                    'python': platform.python_version(),
+                    'machine': platform.machine(),
+                    'scenarios': results
+                }, save, indent=2
+            )
+    regressions = [
+        name for name, change in changes.items()
+        if change and change.endswith('REGRESSION')
+    ]
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
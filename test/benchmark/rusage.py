@@ -0,0 +1,30 @@
+#!/usr/bin/python3
+"""
+usage: rusage.py <result_file> <command>...
+
+Run command and write its wall time, exit code and peak RSS as
+JSON to result_file. The peak RSS of a process starts with the
+one of the process it was forked from, measuring from this small
+process keeps the memory of the benchmark runner out of it
+"""
+import os
+import sys
+import json
+import time
+import subprocess
+
+if __name__ == '__main__':
+    started = time.monotonic()
+    process = subprocess.Popen(sys.argv[2:])
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.WEXITSTATUS(status)
+    with open(sys.argv[1], 'w') as result:
+        json.dump(
+            {
+                'duration': time.monotonic() - started,
+                'returncode': process.returncode,
+                # ru_maxrss is in kB on Linux
+                'peak_rss': usage.ru_maxrss * 1024
+            }, result
+        )
+    sys.exit(process.returncode)
@@ -0,0 +1,94 @@
+#!/usr/bin/python3
+"""
+usage: startup_benchmark [--rounds=<number>] [--budget=<microseconds>]
+
+Benchmark of the startup of the corbos_scm command line. Every OBS
+service call is a new process, the modules imported before the
+arguments are parsed are paid by each invocation. The cumulative
+import time of the command line module is taken from
+python -X importtime, the wall time and peak RSS of a
+corbos_scm --version call from a new process.
+
+options:
+    --rounds=<number>
+        Measured runs per scenario [default: 10]
+
+    --budget=<microseconds>
+        Fail if the median import time of the command line module
+        exceeds the given time, e.g. 100000 on the reference machine
+"""
+import os
+import sys
+import json
+import statistics
+import subprocess
+import tempfile
+from typing import Dict
+import docopt
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(os.path.dirname(BENCHMARK_DIR))
+
+MODULE = 'corbos_scm.corbos_scm'
+
+
+def get_import_time(module: str) -> int:
+    """
+    Cumulative import time of module in a new process in
+    microseconds
+    """
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True,
+        universal_newlines=True, env=dict(os.environ, PYTHONPATH=ROOT_DIR)
+    )
+    for line in process.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            self_us, cumulative_us, name = line[12:].split('|')
+            if name.strip() == module:
+                return int(cumulative_us)
+    raise RuntimeError(f'No import time reported for {module}')
+
+
+def run_version() -> Dict:
+    """
+    Run corbos_scm --version and return its wall time and peak RSS
+    """
+    with tempfile.NamedTemporaryFile() as result_file:
+        subprocess.run(
+            [
+                sys.executable, f'{BENCHMARK_DIR}/rusage.py',
+                result_file.name, sys.executable, '-c',
+                f'import sys; from {MODULE} import main; '
+                'sys.argv = ["corbos_scm", "--version"]; main()'
+            ], check=True, stdout=subprocess.DEVNULL,
+            env=dict(os.environ, PYTHONPATH=ROOT_DIR)
+        )
+        return json.load(result_file)
+
+
+def main() -> int:
+    arguments = docopt.docopt(__doc__)
+    rounds = int(arguments['--rounds'])
+    # the first run warms the bytecode and filesystem caches
+    get_import_time(MODULE)
+    import_us = statistics.median(
+        get_import_time(MODULE) for count in range(rounds)
+    )
+    runs = [run_version() for count in range(rounds)]
+    median = statistics.median(result['duration'] for result in runs)
+    peak_rss = max(result['peak_rss'] for result in runs) / 1024 ** 2
+    print('SCENARIO   MEDIAN_MS  RSS_MB')
+    print(f'{"import":<9}  {import_us / 1000:.1f}')
+    print(f'{"version":<9}  {median * 1000:<9.1f}  {peak_rss:.1f}')
+    if arguments['--budget'] and import_us > int(arguments['--budget']):
+        sys.stderr.write(
+            f'Import of {MODULE} took {import_us:.0f}us, '
+            f'budget is {arguments["--budget"]}us\n'
+        )
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,54 @@
+from mock import patch
+import os
+import hashlib
+
+from corbos_scm.apt_cache import AptCache
+
+IMAGE_DIR = hashlib.sha256(b'image').hexdigest()
+
+
+class TestAptCache:
+    def test_get_volumes(self, tmpdir):
+        apt_cache = AptCache(tmpdir.strpath, 'image')
+        assert apt_cache.get_volumes() == {
+            tmpdir.join('apt', IMAGE_DIR, 'lists').strpath: '/var/lib/apt/lists',
+            tmpdir.join('apt', IMAGE_DIR, 'cache').strpath: '/var/cache/apt'
+        }
+        assert os.path.isdir(tmpdir.join('apt', IMAGE_DIR, 'lists').strpath)
+
+    def test_get_update_command(self, tmpdir):
+        assert AptCache(tmpdir.strpath, 'image').get_update_command() == [
+            'apt', 'update', '&&',
+            'touch', '/var/lib/apt/lists/corbos_scm.stamp'
+        ]
+
+    @patch('time.time')
+    def test_is_fresh(self, mock_time, tmpdir):
+        apt_cache = AptCache(tmpdir.strpath, 'image', ttl=100)
+        assert apt_cache.is_fresh() is False
+        stamp = tmpdir.join('apt', IMAGE_DIR, 'lists', 'corbos_scm.stamp')
+        stamp.write('')
+        os.utime(stamp.strpath, (1000, 1000))
+        mock_time.return_value = 1050
+        assert apt_cache.is_fresh() is True
+        mock_time.return_value = 1100
+        assert apt_cache.is_fresh() is False
+
+    def test_locks(self, tmpdir):
+        apt_cache = AptCache(tmpdir.strpath, 'image')
+        assert apt_cache.update_lock().exclusive is True
+        assert apt_cache.read_lock().exclusive is False
+        with apt_cache.read_lock():
+            assert os.path.exists(tmpdir.join('apt', IMAGE_DIR, 'apt.lock').strpath)
+
+    def test_images_do_not_share_lists(self, tmpdir):
+        debian = AptCache(tmpdir.strpath, 'debian:latest')
+        ubuntu = AptCache(tmpdir.strpath, 'ubuntu:latest')
+        assert debian.lists_dir != ubuntu.lists_dir
+        assert debian.lock_file != ubuntu.lock_file
+        with open(
+            os.sep.join([debian.lists_dir, 'corbos_scm.stamp']), 'w'
+        ):
+            pass
+        assert debian.is_fresh() is True
+        assert ubuntu.is_fresh() is False
@@ -0,0 +1,106 @@
+import os
+import subprocess
+from pytest import raises
+
+from corbos_scm.apt import (
+    get_update_command, get_source_command, get_showsrc_command,
+    check_package, AptProxyConfig
+)
+from corbos_scm.exceptions import CSCMPackageNameError
+
+# Stand-in for apt which behaves like apt source: it always
+# downloads the source files and unpacks them into a directory
+# unless --download-only is given
+FAKE_APT = '''#!/bin/bash
+[ "$1" = "update" ] && exit 0
+printf 'Source: curl\\nVersion: 1.0-1\\n' > curl_1.0-1.dsc
+touch curl_1.0.orig.tar.gz curl_1.0-1.debian.tar.xz
+for arg in "$@";do
+    [ "$arg" = "--download-only" ] && exit 0
+done
+mkdir -p curl-1.0/debian
+'''
+
+
+class TestApt:
+    def test_get_update_command(self):
+        assert get_update_command() == ['apt', 'update']
+
+    def test_get_source_command(self):
+        assert get_source_command('curl') == [
+            'apt', 'source', '--download-only', 'curl'
+        ]
+        assert get_source_command('curl', '7.74.0-1.3') == [
+            'apt', 'source', '--download-only', 'curl=7.74.0-1.3'
+        ]
+        assert get_source_command('curl', bandwidth_limit=512) == [
+            'apt', '-o', 'Acquire::http::Dl-Limit=512',
+            '-o', 'Acquire::https::Dl-Limit=512',
+            'source', '--download-only', 'curl'
+        ]
+
+    def test_get_source_command_quoted(self, tmpdir):
+        command = get_source_command('curl', '1:7.74.0~rc1-1')
+        assert command[-1] == "'curl=1:7.74.0~rc1-1'"
+        # the shell passes the argument on unchanged
+        assert subprocess.check_output(
+            ['bash', '-c', ' '.join(['echo'] + command[-1:])],
+            cwd=tmpdir.strpath, env={'HOME': tmpdir.strpath}
+        ) == b'curl=1:7.74.0~rc1-1\n'
+
+    def test_check_package(self):
+        check_package('libc++-dev', '2:1.0+dfsg~beta.1-1ubuntu1')
+        check_package('curl', None)
+        for package, version in (
+            ('curl;touch /x', None),
+            ('$(touch /x)', None),
+            ('-curl', None),
+            ('Curl', None),
+            ('c', None),
+            ('curl\n', None),
+            ('curl', '1.0 && touch /x'),
+            ('curl', '1.0`touch /x`'),
+            ('curl', '-1.0'),
+            ('curl', '1.0\n')
+        ):
+            with raises(CSCMPackageNameError):
+                check_package(package, version)
+        with raises(CSCMPackageNameError):
+            get_source_command('curl', '1.0;reboot')
+        with raises(CSCMPackageNameError):
+            get_showsrc_command('curl|reboot')
+
+    def test_get_source_command_never_creates_directories(self, tmpdir):
+        bindir = tmpdir.mkdir('bin')
+        outdir = tmpdir.mkdir('out')
+        fake_apt = bindir.join('apt')
+        fake_apt.write(FAKE_APT)
+        fake_apt.chmod(0o755)
+        subprocess.check_call(
+            ['bash', '-c', ' '.join(get_source_command('curl'))],
+            cwd=outdir.strpath, env={
+                'PATH': os.pathsep.join([bindir.strpath, os.environ['PATH']])
+            }
+        )
+        assert sorted(os.listdir(outdir.strpath)) == [
+            'curl_1.0-1.debian.tar.xz', 'curl_1.0-1.dsc',
+            'curl_1.0.orig.tar.gz'
+        ]
+        assert not [
+            entry for entry in os.scandir(outdir.strpath) if entry.is_dir()
+        ]
+
+    def test_get_showsrc_command(self):
+        assert get_showsrc_command('curl') == [
+            'apt-cache', 'showsrc', 'curl'
+        ]
+
+    def test_apt_proxy_config(self):
+        apt_proxy = AptProxyConfig('http://host.containers.internal:3142')
+        volumes = apt_proxy.get_volumes()
+        assert list(volumes.values()) == [
+            '/etc/apt/apt.conf.d/99corbos_scm_proxy'
+        ]
+        with open(list(volumes)[0]) as config:
+            assert config.read() == \
+                'Acquire::http::Proxy "http://host.containers.internal:3142";\n'
@@ -0,0 +1,453 @@
+from mock import (
+    patch, call, Mock, MagicMock
+)
+from pytest import (
+    fixture, raises
+)
+import os
+import sys
+import json
+import logging
+
+from corbos_scm.command import command_type
+from corbos_scm.exceptions import (
+    CSCMBatchError,
+    CSCMCommandTimeoutError
+)
+from corbos_scm.batch import (
+    main, read_package_list, fetch, fetch_packages, fetch_result_type,
+    get_sizes, format_size, write_summary, get_fetch_command, fetch_job
+)
+from corbos_scm.scheduler import job_type
+from .conftest import create_mirror
+
+
+def fake_fetch(command, raise_on_error=True):
+    package = command[command.index('--package') + 1]
+    outdir = command[command.index('--outdir') + 1]
+    if package == 'missing':
+        return command_type(
+            output='', error='CSCMMirrorError: missing not found\n',
+            returncode=1
+        )
+    if package == 'slow':
+        raise CSCMCommandTimeoutError('timed out')
+    os.makedirs(outdir, exist_ok=True)
+    with open(os.path.join(outdir, f'{package}.dsc'), 'w') as dsc:
+        dsc.write('dsc')
+    return command_type(output='', error='', returncode=0)
+
+
+def fake_staging(outdir):
+    staging = MagicMock()
+    staging.path = f'{outdir}.staging'
+    staging.__enter__.return_value = staging
+    return staging
+
+
+class TestBatch:
+    @fixture(autouse=True)
+    def inject_fixtures(self, capsys, caplog):
+        self._capsys = capsys
+        self._caplog = caplog
+
+    def setup_method(self):
+        sys.argv = [
+            sys.argv[0],
+            '--registry', 'registry.example.com',
+            '--container', 'ubdevtools:latest',
+            '--outdir', 'obs_out'
+        ]
+
+    @patch('corbos_scm.batch.fetch')
+    @patch('corbos_scm.batch.pull')
+    def test_main_packages(self, mock_pull, mock_fetch):
+        sys.argv += ['--package', 'curl', '--package', 'vim']
+        mock_fetch.return_value = [
+            fetch_result_type('curl', 'obs_out/curl', True, '', 1.25, 2048),
+            fetch_result_type('vim', 'obs_out/vim', True, '', 0.5, None)
+        ]
+        main()
+        mock_pull.assert_called_once_with(
+            'registry.example.com/ubdevtools:latest', None, 3600
+        )
+        mock_fetch.assert_called_once_with(
+            'ubdevtools:latest',
+            {'curl': 'obs_out/curl', 'vim': 'obs_out/vim'}, None, None, None
+        )
+        lines = self._capsys.readouterr().out.splitlines()
+        assert lines[0].split() == [
+            'PACKAGE', 'STATUS', 'SECONDS', 'SIZE', 'RESULT'
+        ]
+        assert lines[1].split() == ['curl', 'OK', '1.2', '2.0K', 'obs_out/curl']
+        assert lines[2].split() == ['vim', 'OK', '0.5', '-', 'obs_out/vim']
+        assert lines[3].startswith('2 of 2 packages fetched in ')
+
+    @patch('sys.exit')
+    @patch('corbos_scm.batch.fetch')
+    @patch('corbos_scm.batch.pull')
+    def test_main_package_list_failed(
+        self, mock_pull, mock_fetch, mock_sys_exit, tmpdir
+    ):
+        package_list = tmpdir.join('packages')
+        package_list.write('curl\n')
+        sys.argv += ['--package-list', package_list.strpath]
+        mock_fetch.return_value = [
+            fetch_result_type('curl', 'obs_out/curl', False, 'not found', 1, None)
+        ]
+        main()
+        mock_sys_exit.assert_called_once_with(1)
+        assert self._capsys.readouterr().out.splitlines()[1].split() == [
+            'curl', 'FAILED', '1.0', '-', 'not', 'found'
+        ]
+
+    def test_read_package_list(self, tmpdir):
+        package_list = tmpdir.join('packages')
+        package_list.write(
+            '# comment\n\ncurl\nvim editors/vim\nbash /abs/bash\n'
+        )
+        assert read_package_list(package_list.strpath, 'out') == {
+            'curl': 'out/curl',
+            'vim': 'out/editors/vim',
+            'bash': '/abs/bash'
+        }
+
+    @patch('corbos_scm.batch.time.monotonic')
+    @patch('corbos_scm.batch.Path')
+    @patch('corbos_scm.batch.ContainerSession')
+    @patch('corbos_scm.batch.OutdirState')
+    @patch('corbos_scm.batch.StagingDir')
+    def test_fetch(
+        self, mock_StagingDir, mock_OutdirState, mock_ContainerSession,
+        mock_Path, mock_monotonic
+    ):
+        staging = {}
+        mock_StagingDir.side_effect = lambda outdir: staging.setdefault(
+            outdir, fake_staging(outdir)
+        )
+        mock_monotonic.return_value = 0
+        session = mock_ContainerSession.return_value.__enter__.return_value
+        session.execute.side_effect = [
+            command_type(output='', error='', returncode=0),
+            command_type(output='', error='', returncode=0),
+            command_type(
+                output='', error='W: x\nE: Unable to find a source package\n',
+                returncode=100
+            ),
+            command_type(output='', error='', returncode=1)
+        ]
+        results = fetch(
+            'ubdevtools:latest', {
+                'curl': 'out/curl', 'nope': 'out/nope', 'void': 'out/void'
+            }
+        )
+        mock_ContainerSession.assert_called_once_with(
+            'ubdevtools:latest', {
+                'out/curl.staging': '/mnt/0',
+                'out/nope.staging': '/mnt/1',
+                'out/void.staging': '/mnt/2'
+            }
+        )
+        assert session.execute.call_args_list[0] == call(['apt', 'update'])
+        assert session.execute.call_args_list[1][0][0][0:4] == [
+            'cd', '/mnt/0', '&&', 'apt'
+        ]
+        assert results == [
+            fetch_result_type('curl', 'out/curl', True, '', 0, 0),
+            fetch_result_type(
+                'nope', 'out/nope', False,
+                'E: Unable to find a source package', 0, None
+            ),
+            fetch_result_type('void', 'out/void', False, 'exit code 1', 0, None)
+        ]
+        # only the successful fetch is published, all are cleaned up
+        assert [
+            staging[outdir].publish.called for outdir in sorted(staging)
+        ] == [True, False, False]
+        for outdir in staging:
+            assert staging[outdir].__exit__.called
+        # the previous batch run is replaced and recorded
+        mock_OutdirState.assert_called_once_with('out/curl')
+        state = mock_OutdirState.return_value
+        staging['out/curl'].publish.assert_called_once_with(
+            state.get_files.return_value
+        )
+        state.write.assert_called_once_with(
+            'curl', staging['out/curl'].publish.return_value
+        )
+
+    @patch('corbos_scm.batch.OutdirState')
+    def test_fetch_packages_invalid_name(self, mock_OutdirState):
+        session = Mock()
+        session.execute.return_value = command_type(
+            output='', error='', returncode=0
+        )
+        staging = {
+            outdir: fake_staging(outdir) for outdir in ('out/a', 'out/b')
+        }
+        results = fetch_packages(
+            session, {'curl;reboot': 'out/a', 'curl': 'out/b'}, staging,
+            {'out/a.staging': '/mnt/0', 'out/b.staging': '/mnt/1'}
+        )
+        assert [(result.package, result.success) for result in results] == [
+            ('curl;reboot', False), ('curl', True)
+        ]
+        assert results[0].message == "Invalid package name: 'curl;reboot'"
+        session.execute.assert_called_once_with(
+            ['cd', '/mnt/1', '&&', 'apt', 'source', '--download-only', 'curl'],
+            raise_on_error=False
+        )
+        assert not staging['out/a'].publish.called
+
+    @patch('corbos_scm.batch.get_apt_proxy')
+    @patch('corbos_scm.batch.AptCache')
+    @patch('corbos_scm.batch.fetch')
+    @patch('corbos_scm.batch.pull')
+    def test_main_with_cache(
+        self, mock_pull, mock_fetch, mock_AptCache, mock_get_apt_proxy
+    ):
+        sys.argv += [
+            '--package', 'curl', '--cache-dir', 'cache',
+            '--apt-proxy', 'http://proxy:3142'
+        ]
+        mock_fetch.return_value = []
+        main()
+        mock_AptCache.assert_called_once_with(
+            'cache', 'ubdevtools:latest', 3600
+        )
+        assert mock_get_apt_proxy.call_args[0][0]['--apt-proxy'] == \
+            'http://proxy:3142'
+        mock_fetch.assert_called_once_with(
+            'ubdevtools:latest', {'curl': 'obs_out/curl'},
+            mock_AptCache.return_value, None, mock_get_apt_proxy.return_value
+        )
+
+    @patch('corbos_scm.batch.OutdirState')
+    @patch('corbos_scm.batch.time.monotonic')
+    @patch('corbos_scm.batch.Path')
+    @patch('corbos_scm.batch.ContainerSession')
+    @patch('corbos_scm.batch.StagingDir')
+    def test_fetch_with_apt_cache(
+        self, mock_StagingDir, mock_ContainerSession, mock_Path, mock_monotonic,
+        mock_OutdirState
+    ):
+        mock_StagingDir.side_effect = fake_staging
+        mock_monotonic.return_value = 0
+        apt_cache = MagicMock()
+        apt_cache.get_volumes.return_value = {'lists': '/var/lib/apt/lists'}
+        apt_cache.get_update_command.return_value = ['apt', 'update', '&&', 'touch']
+        apt_cache.is_fresh.return_value = False
+        session = mock_ContainerSession.return_value.__enter__.return_value
+        session.execute.return_value = command_type(
+            output='', error='', returncode=0
+        )
+        apt_proxy = MagicMock()
+        apt_proxy.get_volumes.return_value = {
+            'proxy.conf': '/etc/apt/apt.conf.d/99corbos_scm_proxy'
+        }
+        results = fetch(
+            'ubdevtools:latest', {'curl': 'out/curl'}, apt_cache,
+            apt_proxy=apt_proxy
+        )
+        mock_ContainerSession.assert_called_once_with(
+            'ubdevtools:latest', {
+                'out/curl.staging': '/mnt/0', 'lists': '/var/lib/apt/lists',
+                'proxy.conf': '/etc/apt/apt.conf.d/99corbos_scm_proxy'
+            }
+        )
+        assert session.execute.call_args_list[0] == call(
+            ['apt', 'update', '&&', 'touch']
+        )
+        assert results == [
+            fetch_result_type('curl', 'out/curl', True, '', 0, 0)
+        ]
+        apt_cache.read_lock.return_value.__enter__.assert_called_once_with()
+
+        session.execute.reset_mock()
+        apt_cache.is_fresh.return_value = True
+        fetch('ubdevtools:latest', {'curl': 'out/curl'}, apt_cache)
+        assert session.execute.call_count == 1
+
+    @patch('corbos_scm.batch.Command')
+    @patch('corbos_scm.batch.fetch')
+    @patch('corbos_scm.batch.pull')
+    def test_main_total_timeout(self, mock_pull, mock_fetch, mock_Command):
+        sys.argv += ['--package', 'curl', '--timeout', '600']
+        mock_fetch.return_value = []
+        main()
+        mock_Command.set_total_timeout.assert_called_once_with(600)
+
+    @patch('corbos_scm.batch.fetch')
+    @patch('corbos_scm.batch.pull')
+    def test_main_raises_batch_error(self, mock_pull, mock_fetch):
+        sys.argv += ['--package', 'curl']
+        mock_fetch.return_value = [
+            fetch_result_type('curl', 'obs_out/curl', False, 'not found', 1, None)
+        ]
+        with raises(SystemExit):
+            main()
+        with raises(CSCMBatchError):
+            main.__wrapped__()
+
+    @patch('sys.exit')
+    @patch('corbos_scm.mirror.Command')
+    @patch('corbos_scm.batch.Command')
+    def test_main_scheduled_mirror(
+        self, mock_Command, mock_mirror_Command, mock_sys_exit, tmpdir
+    ):
+        def gpgv(command, raise_on_error):
+            # a good signature, gpgv writes the signed data
+            with open(command[-1]) as in_release:
+                return command_type(
+                    output=in_release.read(), error='', returncode=0
+                )
+
+        mock_mirror_Command.run.side_effect = gpgv
+        mirror = 'file://' + create_mirror(
+            tmpdir.join('mirror').strpath, {
+                'big': {'version': '1.0', 'files': {'big.tar': b'b' * 4096}},
+                'small': {'version': '1.0', 'files': {'small.tar': b's'}}
+            }
+        )
+        mock_Command.run.side_effect = fake_fetch
+        outdir = tmpdir.join('out')
+        summary = tmpdir.join('summary.json')
+        cache = tmpdir.join('cache')
+        sys.argv = [
+            sys.argv[0], '--mirror', mirror, '--distribution', 'hirsute',
+            '--outdir', outdir.strpath, '--keyring', 'keyring.gpg',
+            '--package', 'missing', '--package', 'big',
+            '--package', 'small', '--summary', summary.strpath,
+            '--cache-dir', cache.strpath, '--bandwidth-limit', '100'
+        ]
+
+        main()
+
+        mock_sys_exit.assert_called_once_with(1)
+        commands = [
+            run_call[0][0] for run_call in mock_Command.run.call_args_list
+        ]
+        # small packages first, unknown sizes last
+        assert [command[4] for command in commands] == [
+            'small', 'big', 'missing'
+        ]
+        assert commands[0] == [
+            sys.executable, '-m', 'corbos_scm.corbos_scm', '--package', 'small',
+            '--outdir', outdir.join('small').strpath,
+            '--mirror', mirror, '--distribution', 'hirsute',
+            '--components', 'main', '--apt-ttl', '3600',
+            '--keyring', 'keyring.gpg',
+            '--cache-dir', cache.strpath, '--bandwidth-limit', '100'
+        ]
+        # the package sizes were looked up from the shared index
+        assert cache.join('sources-index', 'index.db').check()
+        data = json.loads(summary.read())
+        assert [
+            (package['package'], package['success'], package['size'])
+            for package in data['packages']
+        ] == [('missing', False, None), ('big', True, 3), ('small', True, 3)]
+        assert data['packages'][0]['message'] == \
+            'CSCMMirrorError: missing not found'
+        assert '2 of 3 packages fetched' in self._capsys.readouterr().out
+
+    @patch('corbos_scm.batch.Command')
+    def test_main_scheduled_empty_package_list(self, mock_Command, tmpdir):
+        package_list = tmpdir.join('packages')
+        package_list.write('# nothing to fetch\n')
+        sys.argv[sys.argv.index('obs_out')] = tmpdir.strpath
+        sys.argv += [
+            '--package-list', package_list.strpath, '--workers', '2',
+            '--bandwidth-limit', '100'
+        ]
+
+        main.__wrapped__()
+
+        assert not mock_Command.run.called
+        assert '0 of 0 packages fetched' in self._capsys.readouterr().out
+
+    @patch('corbos_scm.batch.Command')
+    def test_main_scheduled_container(self, mock_Command, tmpdir):
+        mock_Command.run.side_effect = fake_fetch
+        sys.argv[sys.argv.index('obs_out')] = tmpdir.strpath
+        sys.argv[sys.argv.index('registry.example.com')] = 'one,two'
+        sys.argv += [
+            '--package', 'curl', '--package', 'vim', '--package', 'slow',
+            '--workers', '2', '--host-limit', '1',
+            '--bandwidth-limit', '1000', '--apt-proxy', 'http://proxy:3142',
+            '--apt-proxy-hosts', 'mirror.example.com'
+        ]
+
+        with raises(CSCMBatchError):
+            main.__wrapped__()
+
+        commands = [
+            run_call[0][0] for run_call in mock_Command.run.call_args_list
+        ]
+        registries = [
+            command[command.index('--registry') + 1] for command in commands
+        ]
+        assert sorted(registries[:2]) == ['one,two', 'two,one']
+        assert commands[0][9:19] == [
+            '--container', 'ubdevtools:latest', '--image-ttl', '3600',
+            '--apt-ttl', '3600', '--apt-proxy', 'http://proxy:3142',
+            '--apt-proxy-hosts', 'mirror.example.com'
+        ]
+        assert all(
+            command[-2:] == ['--bandwidth-limit', '500']
+            for command in commands
+        )
+        lines = self._capsys.readouterr().out.splitlines()
+        assert lines[3].split()[:2] == ['slow', 'FAILED']
+        assert lines[3].endswith('CSCMCommandTimeoutError: timed out')
+
+    def test_fetch_job_without_script_on_path(self, local_mirror, tmpdir):
+        # the corbos_scm script is installed as OBS service only
+        args = {
+            '--mirror': local_mirror, '--distribution': 'hirsute',
+            '--components': 'main', '--apt-ttl': '3600', '--keyring': None,
+            '--cache-dir': None, '--metrics': None
+        }
+        job = job_type(
+            package='curl', outdir=tmpdir.join('curl').strpath,
+            hosts=[local_mirror], size=None
+        )
+        environment = {
+            'PATH': tmpdir.mkdir('bin').strpath,
+            'PYTHONPATH': os.path.dirname(
+                os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+            )
+        }
+        with patch.dict(os.environ, environment):
+            result = fetch_job(
+                get_fetch_command(args, job, local_mirror), job
+            )
+        assert result.message == ''
+        assert result.success
+        assert tmpdir.join('curl', 'curl_7.74.0-1.3.dsc').check()
+
+    def test_get_sizes(self, tmpdir):
+        outdir = tmpdir.mkdir('out')
+        outdir.join('curl.dsc').write('dsc')
+        args = {
+            '--mirror': f'file://{tmpdir.strpath}/nope',
+            '--distribution': 'hirsute', '--components': 'main',
+            '--keyring': None, '--cache-dir': None, '--apt-ttl': '3600'
+        }
+        with self._caplog.at_level(logging.WARNING):
+            assert get_sizes(
+                args, {'curl': outdir.strpath, 'vim': 'out/vim'}
+            ) == {'curl': 3}
+        assert 'Package sizes unknown' in self._caplog.text
+        args['--cache-dir'] = tmpdir.join('cache').strpath
+        assert get_sizes(args, {'vim': 'out/vim'}) == {}
+
+    def test_format_size(self):
+        assert format_size(None) == '-'
+        assert format_size(512) == '512B'
+        assert format_size(1536) == '1.5K'
+        assert format_size(3 * 1024 ** 2) == '3.0M'
+        assert format_size(5 * 1024 ** 4) == '5120.0G'
+
+    def test_write_summary_failed(self, tmpdir):
+        with raises(CSCMBatchError):
+            write_summary(tmpdir.join('nope', 'summary').strpath, [], 1)
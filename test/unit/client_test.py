@@ -0,0 +1,120 @@
+import json
+import logging
+import socket
+import threading
+from types import SimpleNamespace
+from mock import patch
+from pytest import (
+    fixture, raises
+)
+
+from corbos_scm.client import DaemonClient
+from corbos_scm.exceptions import CSCMDaemonError
+
+
+class TestDaemonClient:
+    @fixture
+    def daemon(self, tmpdir):
+        """
+        Minimal daemon answering each request with the
+        response stored in daemon.response
+        """
+        daemon = SimpleNamespace(
+            socket_path=tmpdir.join('daemon.sock').strpath,
+            response=b'', requests=[]
+        )
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(daemon.socket_path)
+        server.listen(1)
+
+        def serve():
+            connection, _ = server.accept()
+            with connection, connection.makefile('rb') as request:
+                daemon.requests.append(json.loads(request.readline()))
+                connection.sendall(daemon.response)
+
+        daemon.serve = threading.Thread(target=serve)
+        yield daemon
+        server.close()
+
+    def test_fetch(self, daemon):
+        daemon.response = b'{"success": true, "message": ""}\n'
+        daemon.serve.start()
+        client = DaemonClient(daemon.socket_path, timeout=5)
+        assert client.fetch('registry/ubdevtools', 'curl', 'obs_out')
+        daemon.serve.join()
+        request = daemon.requests[0]
+        assert request['image'] == 'registry/ubdevtools'
+        assert request['package'] == 'curl'
+        assert request['outdir'].endswith('/obs_out')
+
+    def test_fetch_failed(self, daemon):
+        daemon.response = b'{"success": false, "message": "not found"}\n'
+        daemon.serve.start()
+        with raises(CSCMDaemonError, match='not found'):
+            DaemonClient(daemon.socket_path).fetch('image', 'curl', 'out')
+
+    def test_fetch_unsupported(self, daemon):
+        daemon.response = b'{"success": false, "unsupported": true}\n'
+        daemon.serve.start()
+        assert not DaemonClient(daemon.socket_path).fetch(
+            'image', 'curl', 'out'
+        )
+
+    def test_fetch_broken_response(self, daemon):
+        daemon.response = b''
+        daemon.serve.start()
+        assert not DaemonClient(daemon.socket_path).fetch(
+            'image', 'curl', 'out'
+        )
+
+    def test_fetch_no_daemon(self, tmpdir):
+        client = DaemonClient(tmpdir.join('daemon.sock').strpath)
+        assert not client.is_available()
+        assert not client.fetch('image', 'curl', 'out')
+        assert client.resolve('image', 'curl') is None
+
+    def test_resolve(self, daemon):
+        daemon.response = b'{"success": true, "output": "Package: curl"}\n'
+        daemon.serve.start()
+        client = DaemonClient(daemon.socket_path, timeout=5)
+        assert client.resolve('registry/ubdevtools', 'curl') == 'Package: curl'
+        daemon.serve.join()
+        assert daemon.requests == [
+            {
+                'image': 'registry/ubdevtools', 'package': 'curl',
+                'resolve': True
+            }
+        ]
+
+    def test_resolve_unsupported(self, daemon):
+        daemon.response = b'{"success": false, "unsupported": true}\n'
+        daemon.serve.start()
+        assert DaemonClient(daemon.socket_path).resolve(
+            'image', 'curl'
+        ) is None
+
+    def test_resolve_failed(self, daemon):
+        daemon.response = b'{"success": false, "message": "no sources"}\n'
+        daemon.serve.start()
+        with raises(CSCMDaemonError, match='resolve curl: no sources'):
+            DaemonClient(daemon.socket_path).resolve('image', 'curl')
+
+    def test_fetch_timeout(self, tmpdir, caplog):
+        socket_path = tmpdir.join('daemon.sock').strpath
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+            # accepted by the kernel, never answered
+            server.bind(socket_path)
+            server.listen(1)
+            with caplog.at_level(logging.WARNING):
+                assert not DaemonClient(socket_path, timeout=0.1).fetch(
+                    'image', 'curl', 'out'
+                )
+        assert 'did not answer within 0.1s' in caplog.text
+
+    @patch('os.path.exists')
+    def test_fetch_refused(self, mock_os_path_exists, tmpdir):
+        mock_os_path_exists.return_value = True
+        assert not DaemonClient(tmpdir.join('daemon.sock').strpath).fetch(
+            'image', 'curl', 'out'
+        )
@@ -0,0 +1,238 @@
+import os
+import json
+import time
+import fcntl
+import socket
+import logging
+import multiprocessing
+from mock import patch
+from pytest import (
+    fixture, raises
+)
+
+from corbos_scm.command import Command
+from corbos_scm.coalesce import RequestCoalescer
+from corbos_scm.exceptions import CSCMLockError
+
+
+def fetch_once(cache_dir, outdir, fetched):
+    with RequestCoalescer(cache_dir, 'mirror curl=latest') as request:
+        if not request.receive(outdir):
+            time.sleep(0.5)
+            with open(os.sep.join([outdir, 'curl.dsc']), 'w') as dsc:
+                dsc.write('dsc')
+            with fetched.get_lock():
+                fetched.value += 1
+            request.publish(outdir)
+
+
+class TestRequestCoalescer:
+    @fixture(autouse=True)
+    def inject_fixtures(self, caplog):
+        self._caplog = caplog
+
+    def setup_method(self):
+        self.holder = {
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+            'started': time.time()
+        }
+
+    def hold(self, request, holder):
+        lock = open(request.lock_file, 'w')
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        if holder is not None:
+            json.dump(holder, lock)
+            lock.flush()
+        return lock
+
+    def wait(self, request):
+        waiter = open(request.waiters_file, 'a')
+        fcntl.flock(waiter.fileno(), fcntl.LOCK_SH)
+        return waiter
+
+    def test_acquire_release(self, tmpdir):
+        with RequestCoalescer(tmpdir.strpath, 'mirror curl=1.0') as request:
+            assert request.lock_file.startswith(
+                tmpdir.join('requests', 'mirror_curl_1.0-').strpath
+            )
+            with open(request.lock_file) as lock:
+                assert json.load(lock)['pid'] == os.getpid()
+        assert request.lock is None
+        assert os.path.getsize(request.lock_file) == 0
+        request.release()
+
+    def test_key_sanitized(self, tmpdir):
+        first = RequestCoalescer(tmpdir.strpath, 'http://a/b c=1')
+        second = RequestCoalescer(tmpdir.strpath, 'http://a/b_c=1')
+        assert '/' not in os.path.basename(first.lock_file)
+        assert first.lock_file != second.lock_file
+
+    def test_publish_receive(self, tmpdir):
+        outdir = tmpdir.mkdir('out')
+        outdir.join('curl.dsc').write('dsc')
+        outdir.join('.corbos_scm.json').write('{}')
+        outdir.mkdir('subdir')
+        request = RequestCoalescer(
+            tmpdir.strpath, 'curl', exclude=['.corbos_scm.json']
+        )
+        waiter = self.wait(request)
+        assert request.has_waiters()
+        request.publish(outdir.strpath)
+        # publishing again replaces the previous result
+        request.publish(outdir.strpath)
+        waiter.close()
+        assert sorted(os.listdir(request.result_dir)) == [
+            '.complete', 'curl.dsc'
+        ]
+
+        waiting = tmpdir.mkdir('waiting')
+        request.started -= 10
+        assert request.receive(waiting.strpath)
+        assert waiting.listdir() == [waiting.join('curl.dsc')]
+
+    def test_publish_without_waiters(self, tmpdir):
+        outdir = tmpdir.mkdir('out')
+        outdir.join('curl.dsc').write('dsc')
+        request = RequestCoalescer(tmpdir.strpath, 'curl')
+        with self.wait(request):
+            request.publish(outdir.strpath)
+        assert not request.has_waiters()
+        # an earlier result nobody waits for is removed
+        request.publish(outdir.strpath)
+        assert not os.path.exists(request.result_dir)
+
+    @patch('time.sleep')
+    def test_last_waiter_removes_result(self, mock_sleep, tmpdir):
+        outdir = tmpdir.mkdir('out')
+        outdir.join('curl.dsc').write('dsc')
+        first = RequestCoalescer(tmpdir.strpath, 'curl')
+        second = RequestCoalescer(tmpdir.strpath, 'curl')
+        lock = self.hold(first, self.holder)
+        other_waiter = self.wait(first)
+
+        def publish(interval):
+            first.publish(outdir.strpath)
+            lock.close()
+        mock_sleep.side_effect = publish
+        second.acquire()
+        assert second.waiter is None
+        assert second.receive(tmpdir.mkdir('second').strpath)
+        second.release()
+        # another request still waits for the result
+        assert os.path.exists(first.result_dir)
+
+        other_waiter.close()
+        first.waited = True
+        first.acquire()
+        assert first.receive(tmpdir.mkdir('first').strpath)
+        first.release()
+        assert not os.path.exists(first.result_dir)
+
+    def test_receive_outdated(self, tmpdir):
+        request = RequestCoalescer(tmpdir.strpath, 'curl')
+        assert not request.receive(tmpdir.strpath)
+        tmpdir.mkdir('out').join('curl.dsc').write('dsc')
+        with self.wait(request):
+            request.publish(tmpdir.join('out').strpath)
+        later = RequestCoalescer(tmpdir.strpath, 'curl')
+        later.started += 10
+        assert not later.receive(tmpdir.mkdir('later').strpath)
+        assert tmpdir.join('later').listdir() == []
+
+    @patch('corbos_scm.coalesce.Metrics')
+    def test_break_dead_holder(self, mock_Metrics, tmpdir):
+        request = RequestCoalescer(tmpdir.strpath, 'curl')
+        self.holder['pid'] = 4711
+        lock = self.hold(request, self.holder)
+        try:
+            with patch('os.kill', side_effect=ProcessLookupError):
+                with self._caplog.at_level(logging.WARNING):
+                    request.acquire()
+            assert 'Breaking stale request lock' in self._caplog.text
+            mock_Metrics.inc.assert_called_once_with(
+                'corbos_scm_stale_locks_total'
+            )
+        finally:
+            request.release()
+            lock.close()
+
+    @patch('time.sleep')
+    def test_wait_for_holder(self, mock_sleep, tmpdir):
+        request = RequestCoalescer(tmpdir.strpath, 'curl')
+        lock = self.hold(request, self.holder)
+        mock_sleep.side_effect = lambda interval: lock.close()
+        with self._caplog.at_level(logging.INFO):
+            request.acquire()
+        assert 'Waiting for concurrent fetch of curl' in self._caplog.text
+        mock_sleep.assert_called_once_with(0.5)
+        request.release()
+
+    def test_wait_timeout(self, tmpdir):
+        request = RequestCoalescer(tmpdir.strpath, 'curl')
+        # holder did not record itself yet
+        lock = self.hold(request, None)
+        Command.set_total_timeout(0)
+        try:
+            with raises(CSCMLockError):
+                request.acquire()
+        finally:
+            Command.set_total_timeout(None)
+            lock.close()
+
+    def test_is_stale(self, tmpdir):
+        request = RequestCoalescer(tmpdir.strpath, 'curl')
+        assert not request._is_stale({})
+        assert not request._is_stale(self.holder)
+        assert not request._is_stale(dict(self.holder, host='other'))
+        assert not request._is_stale(dict(self.holder, pid=None))
+        # a long running fetch keeps its lock
+        assert not request._is_stale(
+            dict(self.holder, started=self.holder['started'] - 86400)
+        )
+        with patch('os.kill', side_effect=PermissionError):
+            assert not request._is_stale(self.holder)
+
+    def test_lock_broken_meanwhile(self, tmpdir):
+        request = RequestCoalescer(tmpdir.strpath, 'curl')
+        with patch.object(
+            RequestCoalescer, '_is_current', side_effect=[False, True]
+        ):
+            request.acquire()
+        request.release()
+        with open(request.lock_file) as lock:
+            os.unlink(request.lock_file)
+            assert not request._is_current(lock)
+            open(request.lock_file, 'w').close()
+            assert not request._is_current(lock)
+
+    def test_unlink_lock(self, tmpdir):
+        request = RequestCoalescer(tmpdir.strpath, 'curl')
+        open(request.lock_file, 'w').close()
+        inode = os.stat(request.lock_file).st_ino
+        # a new lock file created meanwhile is kept
+        request._unlink_lock(inode + 1)
+        assert os.path.exists(request.lock_file)
+        request._unlink_lock(inode)
+        assert not os.path.exists(request.lock_file)
+        request._unlink_lock(inode)
+
+    def test_concurrent_requests(self, tmpdir):
+        fetched = multiprocessing.Value('i', 0)
+        outdirs = [tmpdir.mkdir(f'out{count}') for count in range(3)]
+        processes = [
+            multiprocessing.Process(
+                target=fetch_once,
+                args=(tmpdir.strpath, outdir.strpath, fetched)
+            ) for outdir in outdirs
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        assert fetched.value == 1
+        for outdir in outdirs:
+            assert outdir.join('curl.dsc').read() == 'dsc'
+        assert tmpdir.join('requests').listdir(
+            lambda path: path.ext == '.result'
+        ) == []
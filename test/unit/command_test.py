@@ -1,10 +1,20 @@
 from pytest import raises
 from mock import (
-    patch, Mock
+    patch, call, Mock
 )
+import os
+import time
+import asyncio
+import signal
+import subprocess
 
-from corbos_scm.exceptions import CSCMCommandError
-from corbos_scm.command import Command
+from corbos_scm.exceptions import (
+    CSCMCommandError,
+    CSCMCommandTimeoutError
+)
+from corbos_scm.command import (
+    Command, OutputBuffer, command_type, CHUNK_SIZE
+)
 
 
 class TestCommand:
@@ -14,22 +24,196 @@ class TestCommand:
         with raises(CSCMCommandError):
             Command.run(['ls', '-l'])
 
-    @patch('subprocess.Popen')
-    def test_command_run_exit_code_1(self, mock_subprocess_Popen):
-        process = Mock()
-        process.communicate.return_value = ('stdout', 'stderr')
-        process.returncode = 1
-        mock_subprocess_Popen.return_value = process
-        with raises(CSCMCommandError):
-            Command.run(['ls', '-l'])
+    def test_command_run_exit_code_1(self):
+        with raises(CSCMCommandError) as issue:
+            Command.run(['sh', '-c', 'echo stdout; echo stderr >&2; exit 1'])
+        assert issue.value.returncode == 1
+        assert "stderr: 'stderr\\n', stdout: 'stdout\\n'" in str(issue.value)
+
+    def test_command_run_exit_code_0(self):
+        result = Command.run(['sh', '-c', 'printf stdout; printf stderr >&2'])
+        assert result.returncode == 0
+        assert result.output == 'stdout'
+        assert result.error == 'stderr'
+        assert result == command_type(
+            output='stdout', error='stderr', returncode=0
+        )
+        assert result != ('stdout', 'stderr', 0)
+        assert repr(result) == \
+            "command_type(output='stdout', error='stderr', returncode=0)"
+
+    def test_command_run_output_beyond_limit(self):
+        with patch.object(Command, 'output_limit', 1024):
+            with raises(CSCMCommandError) as issue:
+                Command.run(
+                    ['sh', '-c', 'seq 100000; echo failed >&2; exit 1']
+                )
+            assert "stderr: 'failed\\n', stdout: '[...]" in str(issue.value)
+            assert len(str(issue.value)) < 1500
+            result = Command.run(['seq', '100000'])
+        expected = ''.join(f'{number}\n' for number in range(1, 100001))
+        assert result.output == expected
+        assert result.error == ''
 
     @patch('subprocess.Popen')
-    def test_command_run_exit_code_0(self, mock_subprocess_Popen):
+    def test_command_run_timeout(self, mock_subprocess_Popen):
         process = Mock()
-        process.communicate.return_value = ('stdout', 'stderr')
-        process.returncode = 0
+        process.pid = 4711
+        process.wait.side_effect = [subprocess.TimeoutExpired('ls', 1), 0]
+        stdout, stdout_writer = os.pipe()
+        stderr, stderr_writer = os.pipe()
+        process.stdout.fileno.return_value = stdout
+        process.stderr.fileno.return_value = stderr
         mock_subprocess_Popen.return_value = process
-        ls_cmd = Command.run(['ls', '-l'])
-        assert ls_cmd.returncode == 0
-        assert ls_cmd.output == 'stdout'
-        assert ls_cmd.error == 'stderr'
+        with patch('os.killpg') as mock_killpg:
+            with patch.object(Command, '_get_timeout', return_value=0):
+                with raises(CSCMCommandTimeoutError):
+                    Command.run(['ls', '-l'], timeout=1)
+            assert mock_killpg.call_args_list == [
+                call(4711, signal.SIGTERM), call(4711, signal.SIGKILL)
+            ]
+        for fd in [stdout, stdout_writer, stderr, stderr_writer]:
+            os.close(fd)
+
+    def test_command_run_timeout_real(self):
+        start = time.monotonic()
+        with raises(CSCMCommandTimeoutError):
+            Command.run(['sh', '-c', 'sleep 10 & sleep 10'], timeout=0.2)
+        assert time.monotonic() - start < 5
+
+    def test_command_run_timeout_closed_output(self):
+        start = time.monotonic()
+        with raises(CSCMCommandTimeoutError):
+            Command.run(['sh', '-c', 'exec >&- 2>&-; sleep 8'], timeout=0.5)
+        assert time.monotonic() - start < 5
+
+    def test_command_run_interrupted(self, tmpdir):
+        pid_file = tmpdir.join('pid')
+        command = [
+            'sh', '-c', f'echo $$ > {pid_file}; echo started; exec sleep 60'
+        ]
+        read = os.read
+
+        def failing_read(fd, size):
+            # the exec status of Popen is read in smaller chunks
+            if size == CHUNK_SIZE:
+                raise OSError('read failed')
+            return read(fd, size)
+
+        for issue, target, side_effect in [
+            (OSError, 'os.read', failing_read),
+            (
+                KeyboardInterrupt, 'corbos_scm.command.OutputBuffer.write',
+                KeyboardInterrupt
+            )
+        ]:
+            start = time.monotonic()
+            with patch(target, side_effect=side_effect):
+                with raises(issue):
+                    Command.run(command)
+            assert time.monotonic() - start < 5
+            # the child was terminated and reaped
+            with raises(ProcessLookupError):
+                os.kill(int(pid_file.read()), 0)
+
+    def test_command_run_async(self):
+        loop = asyncio.new_event_loop()
+        try:
+            result = loop.run_until_complete(
+                Command.run_async(['sh', '-c', 'printf stdout'])
+            )
+            assert result == command_type(
+                output='stdout', error='', returncode=0
+            )
+            with raises(CSCMCommandError) as issue:
+                loop.run_until_complete(
+                    Command.run_async(['sh', '-c', 'echo failed >&2; exit 2'])
+                )
+            assert issue.value.returncode == 2
+            assert issue.value.stderr == 'failed\n'
+            assert loop.run_until_complete(
+                Command.run_async(['false'], raise_on_error=False)
+            ).returncode == 1
+            with raises(CSCMCommandTimeoutError):
+                loop.run_until_complete(
+                    Command.run_async(['sleep', '10'], timeout=0.2)
+                )
+        finally:
+            loop.close()
+
+    def test_command_run_async_cancelled(self, tmpdir):
+        pid_file = tmpdir.join('pid')
+
+        async def cancel():
+            task = asyncio.ensure_future(
+                Command.run_async(
+                    ['sh', '-c', f'echo $$ > {pid_file}.new; '
+                     f'mv {pid_file}.new {pid_file}; exec sleep 60']
+                )
+            )
+            while not pid_file.check():
+                await asyncio.sleep(0.01)
+            task.cancel()
+            with raises(asyncio.CancelledError):
+                await task
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(cancel())
+        finally:
+            loop.close()
+        pid = int(pid_file.read())
+        deadline = time.monotonic() + 5
+        with raises(ProcessLookupError):
+            while time.monotonic() < deadline:
+                os.kill(pid, 0)
+                time.sleep(0.01)
+
+    def test_command_stream(self):
+        lines = Command.stream(
+            ['sh', '-c', 'echo one; echo error >&2; printf "two\\nthree"']
+        )
+        assert list(lines) == ['one', 'two', 'three']
+        with patch.object(Command, 'output_limit', 1024):
+            lines = Command.stream(['seq', '100000'])
+            assert sum(1 for line in lines) == 100000
+        with raises(CSCMCommandError) as issue:
+            list(Command.stream(['sh', '-c', 'echo out; echo bad >&2; exit 3']))
+        assert issue.value.returncode == 3
+        assert issue.value.stderr == 'bad\n'
+        with raises(CSCMCommandTimeoutError):
+            list(Command.stream(['sleep', '10'], timeout=0.2))
+
+    def test_command_stream_stopped(self, tmpdir):
+        pid_file = tmpdir.join('pid')
+        lines = Command.stream(
+            ['sh', '-c', f'echo $$ > {pid_file}; echo started; exec sleep 60']
+        )
+        start = time.monotonic()
+        assert next(lines) == 'started'
+        lines.close()
+        assert time.monotonic() - start < 5
+        with raises(ProcessLookupError):
+            os.kill(int(pid_file.read()), 0)
+
+    def test_output_buffer_close(self):
+        buffer = OutputBuffer(4)
+        buffer.write(b'spilled data')
+        buffer.close()
+        assert buffer.spill.closed
+        OutputBuffer(4).close()
+
+    def test_total_timeout(self):
+        Command.set_total_timeout(100)
+        try:
+            assert 99 < Command._get_timeout(None) <= 100
+            assert Command._get_timeout(5) == 5
+            Command.set_total_timeout(-1)
+            assert Command._get_timeout(5) == 0
+        finally:
+            Command.set_total_timeout(None)
+        assert Command._get_timeout(None) is None
+
+    def test_signal_process_gone(self):
+        with patch('os.killpg', side_effect=ProcessLookupError):
+            Command._signal(4711, signal.SIGTERM)
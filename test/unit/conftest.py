@@ -0,0 +1,244 @@
+import os
+import gzip
+import lzma
+import hashlib
+import posixpath
+import threading
+import socketserver
+from urllib.parse import unquote
+from http.server import (
+    SimpleHTTPRequestHandler, HTTPServer
+)
+from pytest import fixture
+
+
+def create_mirror(
+    root, packages, distribution='hirsute', component='main',
+    binary_packages=None
+):
+    """
+    Create a synthetic Debian mirror below root
+
+    packages maps source package names to a dict with the keys
+    version, binaries and files, the latter mapping file names
+    to their content. A .dsc file is added for each package.
+    binary_packages maps architectures to a list of dicts with
+    the keys package, version and optionally depends and
+    provides, a .deb file is added for each of them
+    """
+    sources = []
+    for package, setup in packages.items():
+        directory = f'pool/{component}/{package[0]}/{package}'
+        os.makedirs(os.path.join(root, directory), exist_ok=True)
+        files = dict(setup['files'])
+        checksums = ''.join(
+            f' {hashlib.sha256(data).hexdigest()} {len(data)} {name}\n'
+            for name, data in files.items()
+        )
+        binaries = ', '.join(setup.get('binaries', [package]))
+        dsc_name = f'{package}_{setup["version"]}.dsc'
+        files[dsc_name] = (
+            f'Format: 3.0 (quilt)\nSource: {package}\n'
+            f'Binary: {binaries}\nVersion: {setup["version"]}\n'
+            f'Build-Depends: {setup.get("build_depends", "debhelper")}\n'
+            f'Checksums-Sha256:\n{checksums}'
+        ).encode()
+        for name, data in files.items():
+            with open(os.path.join(root, directory, name), 'wb') as pool_file:
+                pool_file.write(data)
+        sources.append(
+            f'Package: {package}\nBinary: {binaries}\n'
+            f'Version: {setup["version"]}\nDirectory: {directory}\n'
+            'Checksums-Sha256:\n' + ''.join(
+                f' {hashlib.sha256(data).hexdigest()} {len(data)} {name}\n'
+                for name, data in files.items()
+            )
+        )
+    indexes = {'source/Sources': '\n'.join(sources).encode()}
+    for architecture, binaries in (binary_packages or {}).items():
+        records = []
+        for binary in binaries:
+            filename = (
+                f'pool/{component}/{binary["package"][0]}/'
+                f'{binary["package"]}_{binary["version"]}_{architecture}.deb'
+            )
+            data = f'{binary["package"]} {binary["version"]}'.encode()
+            os.makedirs(
+                os.path.dirname(os.path.join(root, filename)), exist_ok=True
+            )
+            with open(os.path.join(root, filename), 'wb') as deb:
+                deb.write(data)
+            records.append(
+                f'Package: {binary["package"]}\n'
+                f'Version: {binary["version"]}\n'
+                f'Architecture: {architecture}\n'
+                f'Depends: {binary.get("depends", "")}\n'
+                f'Provides: {binary.get("provides", "")}\n'
+                f'Filename: {filename}\nSize: {len(data)}\n'
+                f'SHA256: {hashlib.sha256(data).hexdigest()}\n'
+            )
+        indexes[f'binary-{architecture}/Packages'] = '\n'.join(
+            records
+        ).encode()
+    dists = os.path.join(root, 'dists', distribution)
+    release = ''
+    for path, index in indexes.items():
+        os.makedirs(
+            os.path.join(dists, component, os.path.dirname(path)),
+            exist_ok=True
+        )
+        for name, data in [
+            (path, index),
+            (f'{path}.gz', gzip.compress(index)),
+            (f'{path}.xz', lzma.compress(index))
+        ]:
+            with open(os.path.join(dists, component, name), 'wb') as f:
+                f.write(data)
+            release += ' {0} {1} {2}/{3}\n'.format(
+                hashlib.sha256(data).hexdigest(), len(data), component, name
+            )
+    with open(os.path.join(dists, 'InRelease'), 'w') as in_release:
+        in_release.write(
+            f'Suite: {distribution}\nComponents: {component}\n'
+            f'SHA256:\n{release}'
+        )
+    return root
+
+
+@fixture
+def local_mirror(tmpdir):
+    """
+    file:// URI of a synthetic mirror providing the curl sources
+    """
+    root = create_mirror(
+        tmpdir.join('mirror').strpath, {
+            'curl': {
+                'version': '7.74.0-1.3',
+                'binaries': ['curl', 'libcurl4'],
+                'files': {
+                    'curl_7.74.0.orig.tar.gz': b'orig' * 1024,
+                    'curl_7.74.0-1.3.debian.tar.xz': b'debian'
+                }
+            }
+        }
+    )
+    return f'file://{root}'
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """
+    Static file handler with keep-alive and Range request support
+
+    Paths listed in server.interrupt are answered with only half
+    of their data once before the connection is dropped. Range
+    requests are ignored if server.ranges is False. Extra response
+    headers per path are taken from server.headers, a request
+    matching the ETag given there is answered with 304. Paths
+    listed in server.unsized are sent without Content-Length
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def translate_path(self, path):
+        path = posixpath.normpath(unquote(path.split('?', 1)[0]))
+        parts = [
+            part for part in path.split('/')
+            if part and part not in (os.curdir, os.pardir)
+        ]
+        return os.path.join(self.server.directory, *parts)
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get('Range')))
+        if self.path.startswith('/redirect/'):
+            self.send_response(302)
+            self.send_header('Location', self.path[len('/redirect'):])
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        filename = self.translate_path(self.path)
+        if not os.path.isfile(filename):
+            self.send_error(404)
+            return
+        with open(filename, 'rb') as data_file:
+            data = data_file.read()
+        headers = self.server.headers.get(self.path, {})
+        etag = headers.get('ETag')
+        if etag and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.path in self.server.unsized:
+            self.send_response(200)
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.wfile.write(data)
+            self.close_connection = True
+            return
+        offset = 0
+        byte_range = self.headers.get('Range')
+        if byte_range and self.server.ranges:
+            offset = int(byte_range.split('=')[1].rstrip('-'))
+            if offset >= len(data):
+                self.send_response(416)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header(
+                'Content-Range', f'bytes {offset}-{len(data) - 1}/{len(data)}'
+            )
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data) - offset))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.path in self.server.interrupt:
+            self.server.interrupt.remove(self.path)
+            self.wfile.write(data[offset:offset + (len(data) - offset) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(data[offset:])
+
+
+class MirrorServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.requests = []
+        self.interrupt = []
+        self.headers = {}
+        self.unsized = []
+        self.ranges = True
+        self.connections = 0
+        super().__init__(('127.0.0.1', 0), RangeRequestHandler)
+
+    def verify_request(self, request, client_address):
+        self.connections += 1
+        return True
+
+    @property
+    def uri(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+
+@fixture
+def http_server(tmpdir):
+    """
+    Local HTTP server serving the files below tmpdir/www
+    """
+    server = MirrorServer(tmpdir.mkdir('www').strpath)
+    thread = threading.Thread(
+        target=server.serve_forever, kwargs={'poll_interval': 0.05},
+        daemon=True
+    )
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
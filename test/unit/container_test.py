@@ -0,0 +1,108 @@
+from mock import (
+    patch, call, Mock
+)
+
+from corbos_scm.command import command_type
+from corbos_scm.container import (
+    pull, run, SafeVolumes, ContainerSession
+)
+
+
+class TestContainer:
+    @patch('corbos_scm.container.Command')
+    def test_pull(self, mock_Command):
+        pull('registry.example.com/ubdevtools:latest')
+        mock_Command.run.assert_called_once_with(
+            ['podman', 'pull', 'registry.example.com/ubdevtools:latest']
+        )
+
+    @patch('corbos_scm.container.ImageCache')
+    def test_pull_cached(self, mock_ImageCache):
+        pull('registry.example.com/ubdevtools:latest', 'cache', 42)
+        mock_ImageCache.assert_called_once_with('cache', 42)
+        mock_ImageCache.return_value.pull.assert_called_once_with(
+            'registry.example.com/ubdevtools:latest'
+        )
+
+    @patch('corbos_scm.container.Command')
+    @patch('corbos_scm.container.SafeVolumes')
+    def test_run(self, mock_SafeVolumes, mock_Command):
+        mock_SafeVolumes.return_value.get_options.return_value = [
+            '--volume', 'tmpdir/volume:/mnt'
+        ]
+        run('ubdevtools:latest', {'out': '/mnt'}, ['ls', '&&', 'true'])
+        mock_SafeVolumes.return_value.add.assert_called_once_with(
+            'out', '/mnt'
+        )
+        mock_Command.run.assert_called_once_with(
+            [
+                'podman', 'run', '--volume', 'tmpdir/volume:/mnt',
+                '-ti', '--rm', 'ubdevtools:latest', 'bash', '-c',
+                'ls && true'
+            ]
+        )
+        mock_Command.run.reset_mock()
+        run('ubdevtools:latest', {}, ['ls'], tty=False)
+        mock_Command.run.assert_called_once_with(
+            [
+                'podman', 'run', '--volume', 'tmpdir/volume:/mnt',
+                '--rm', 'ubdevtools:latest', 'bash', '-c', 'ls'
+            ]
+        )
+
+    @patch('os.symlink')
+    @patch('corbos_scm.container.TemporaryDirectory')
+    def test_safe_volumes(self, mock_TemporaryDirectory, mock_os_symlink):
+        tmpdir = Mock()
+        tmpdir.name = 'tmpdir'
+        mock_TemporaryDirectory.return_value = tmpdir
+        safe_volumes = SafeVolumes()
+        safe_volumes.add('home:user/out', '/mnt/0')
+        safe_volumes.add('home:user/other', '/mnt/1')
+        assert mock_os_symlink.call_args_list == [
+            call('home:user/out', 'tmpdir/volume'),
+            call('home:user/other', 'tmpdir/volume1')
+        ]
+        assert safe_volumes.get_options() == [
+            '--volume', 'tmpdir/volume:/mnt/0',
+            '--volume', 'tmpdir/volume1:/mnt/1'
+        ]
+
+    @patch('corbos_scm.container.Command')
+    @patch('corbos_scm.container.SafeVolumes')
+    def test_container_session(self, mock_SafeVolumes, mock_Command):
+        mock_SafeVolumes.return_value.get_options.return_value = [
+            '--volume', 'tmpdir/volume:/mnt/0'
+        ]
+        mock_Command.run.return_value = command_type(
+            output='0815\n', error='', returncode=0
+        )
+        with ContainerSession('ubdevtools:latest', {'out': '/mnt/0'}) as session:
+            session.execute(['apt', 'update'])
+            session.execute(['false'], raise_on_error=False)
+        mock_SafeVolumes.return_value.add.assert_called_once_with(
+            'out', '/mnt/0'
+        )
+        assert mock_Command.run.call_args_list == [
+            call(
+                [
+                    'podman', 'run', '--detach', '--rm',
+                    '--volume', 'tmpdir/volume:/mnt/0',
+                    'ubdevtools:latest', 'sleep', 'infinity'
+                ]
+            ),
+            call(
+                ['podman', 'exec', '0815', 'bash', '-c', 'apt update'],
+                raise_on_error=True
+            ),
+            call(
+                ['podman', 'exec', '0815', 'bash', '-c', 'false'],
+                raise_on_error=False
+            ),
+            call(
+                ['podman', 'rm', '--force', '0815'], raise_on_error=False
+            )
+        ]
+        assert session.container_id == ''
+        session.__exit__(None, None, None)
+        assert mock_Command.run.call_count == 4
@@ -1,10 +1,35 @@
 from mock import (
     patch, call, Mock
 )
-from pytest import fixture
+from pytest import (
+    fixture, raises
+)
+import os
 import sys
+import json
+import logging
+import subprocess
 
+from corbos_scm.command import command_type
+from corbos_scm.client import DAEMON_TIMEOUT
+from corbos_scm.exceptions import (
+    CSCMCommandError,
+    CSCMPrefetchError
+)
 from corbos_scm.corbos_scm import main
+from corbos_scm.service import prefetch_build_deps
+from corbos_scm.state import OutdirState
+from corbos_scm.metrics import Metrics
+from .conftest import create_mirror
+from .apt_test import FAKE_APT
+
+BENCHMARK_DIR = os.path.join(os.path.dirname(__file__), '..', 'benchmark')
+
+SHOWSRC = '''Package: curl
+Version: 7.74.0-1.3
+Checksums-Sha256:
+ cccc 101 curl_7.74.0-1.3.dsc
+'''
 
 
 class TestCorbosSCM:
@@ -12,7 +37,12 @@ class TestCorbosSCM:
     def inject_fixtures(self, caplog):
         self._caplog = caplog
 
-    def setup(self):
+    def setup_staging(self, mock_StagingDir):
+        staging = mock_StagingDir.return_value.__enter__.return_value
+        staging.path = 'staging'
+        return staging
+
+    def setup_method(self):
         sys.argv = [
             sys.argv[0],
             '--registry',
@@ -28,13 +58,18 @@ class TestCorbosSCM:
     @patch('sys.exit')
     @patch('os.symlink')
     @patch('os.path.exists')
-    @patch('corbos_scm.corbos_scm.Path')
-    @patch('corbos_scm.corbos_scm.Command')
-    @patch('corbos_scm.corbos_scm.TemporaryDirectory')
+    @patch('corbos_scm.service.Path')
+    @patch('corbos_scm.service.OutdirState')
+    @patch('corbos_scm.container.Command')
+    @patch('corbos_scm.container.TemporaryDirectory')
+    @patch('corbos_scm.service.StagingDir')
     def test_pull_and_run(
-        self, mock_TemporaryDirectory, mock_Command, mock_Path,
-        mock_os_path_exists, mock_os_symlink, mock_sys_exit
+        self, mock_StagingDir, mock_TemporaryDirectory, mock_Command,
+        mock_OutdirState, mock_Path, mock_os_path_exists, mock_os_symlink,
+        mock_sys_exit
     ):
+        staging = self.setup_staging(mock_StagingDir)
+        mock_OutdirState.return_value.exists.return_value = False
         tmpdir = Mock()
         tmpdir.name = 'tmpdir'
         mock_os_path_exists.return_value = False
@@ -46,8 +81,9 @@ class TestCorbosSCM:
         mock_Path.return_value.mkdir.assert_called_once_with(
             parents=True, exist_ok=True
         )
+        mock_StagingDir.assert_called_once_with('obs_out', None)
         mock_os_symlink.assert_called_once_with(
-            'obs_out', 'tmpdir/volume'
+            'staging', 'tmpdir/volume'
         )
         assert mock_Command.run.call_args_list == [
             call(
@@ -61,8 +97,841 @@ class TestCorbosSCM:
                     'podman', 'run', '--volume', 'tmpdir/volume:/mnt',
                     '-ti', '--rm', 'ubdevtools:latest',
                     'bash', '-c',
-                    'cd /mnt && apt update && apt source curl && '
-                    'find -maxdepth 1 -type d -not -path . | xargs rm -rf'
+                    'cd /mnt && apt update && '
+                    'apt source --download-only curl'
+                ]
+            )
+        ]
+        staging.publish.assert_called_once_with(
+            mock_OutdirState.return_value.get_files.return_value
+        )
+        mock_OutdirState.return_value.write.assert_called_once_with(
+            'curl', staging.publish.return_value, None
+        )
+
+    @patch('corbos_scm.service.run')
+    @patch('corbos_scm.service.pull')
+    @patch('corbos_scm.service.DaemonClient')
+    @patch('corbos_scm.service.OutdirState')
+    def test_pull_and_run_bandwidth_limit(
+        self, mock_OutdirState, mock_DaemonClient, mock_pull, mock_run,
+        tmpdir
+    ):
+        mock_OutdirState.return_value.exists.return_value = False
+        sys.argv[sys.argv.index('obs_out')] = tmpdir.strpath
+        sys.argv += ['--bandwidth-limit', '512']
+
+        main()
+
+        assert not mock_DaemonClient.called
+        assert mock_run.call_args[0][2][-5:] == [
+            '-o', 'Acquire::https::Dl-Limit=512',
+            'source', '--download-only', 'curl'
+        ]
+
+    @patch('corbos_scm.proxy.start_proxy')
+    @patch('corbos_scm.service.run')
+    @patch('corbos_scm.service.pull')
+    @patch('corbos_scm.service.DaemonClient')
+    @patch('corbos_scm.service.OutdirState')
+    def test_pull_and_run_apt_proxy(
+        self, mock_OutdirState, mock_DaemonClient, mock_pull, mock_run,
+        mock_start_proxy, tmpdir
+    ):
+        mock_DaemonClient.return_value.fetch.return_value = False
+        mock_DaemonClient.return_value.resolve.return_value = None
+        mock_OutdirState.return_value.exists.return_value = True
+        mock_OutdirState.return_value.is_current.return_value = False
+        configs = []
+
+        def run(container, volumes, command, tty=True):
+            for host_path, container_path in volumes.items():
+                if container_path.startswith('/etc/apt/apt.conf.d/'):
+                    with open(host_path) as config:
+                        configs.append(config.read())
+            return command_type(output=SHOWSRC, error='', returncode=0)
+
+        mock_run.side_effect = run
+        sys.argv[sys.argv.index('obs_out')] = tmpdir.strpath
+        sys.argv += ['--apt-proxy', 'http://host.containers.internal:3142']
+
+        main()
+
+        # attached only, no cache directory to start the proxy with
+        assert not mock_start_proxy.called
+        assert configs == [
+            'Acquire::http::Proxy "http://host.containers.internal:3142";\n'
+        ] * 2
+        assert '/mnt' in mock_run.call_args[0][1].values()
+
+    @patch('corbos_scm.proxy.start_proxy')
+    @patch('corbos_scm.service.SourceCache')
+    @patch('corbos_scm.service.AptCache')
+    @patch('corbos_scm.service.run')
+    @patch('corbos_scm.service.pull')
+    @patch('corbos_scm.service.DaemonClient')
+    @patch('corbos_scm.service.OutdirState')
+    def test_pull_and_run_cached_apt_proxy(
+        self, mock_OutdirState, mock_DaemonClient, mock_pull, mock_run,
+        mock_AptCache, mock_SourceCache, mock_start_proxy, tmpdir
+    ):
+        mock_DaemonClient.return_value.fetch.return_value = False
+        mock_DaemonClient.return_value.resolve.return_value = None
+        mock_OutdirState.return_value.is_current.return_value = False
+        apt_cache = mock_AptCache.return_value
+        apt_cache.get_volumes.return_value = {'lists': '/var/lib/apt/lists'}
+        apt_cache.get_update_command.return_value = ['apt', 'update']
+        apt_cache.is_fresh.return_value = False
+        mock_SourceCache.return_value.materialize.return_value = False
+        mock_run.return_value = command_type(
+            output=SHOWSRC, error='', returncode=0
+        )
+        sys.argv[sys.argv.index('obs_out')] = tmpdir.join('out').strpath
+        sys.argv += [
+            '--cache-dir', tmpdir.strpath,
+            '--apt-proxy', 'http://host.containers.internal:3142',
+            '--apt-proxy-hosts', 'mirror.example.com'
+        ]
+
+        main()
+
+        mock_start_proxy.assert_called_once_with(
+            'http://host.containers.internal:3142', tmpdir.strpath,
+            'mirror.example.com'
+        )
+        volumes = [
+            set(run_call[0][1].values())
+            for run_call in mock_run.call_args_list
+        ]
+        update_volumes = volumes[0]
+        download_volumes = volumes[-1]
+        assert update_volumes == {
+            '/var/lib/apt/lists', '/etc/apt/apt.conf.d/99corbos_scm_proxy'
+        }
+        assert download_volumes == update_volumes | {'/mnt'}
+
+    @patch('sys.exit')
+    @patch('os.path.exists')
+    @patch('corbos_scm.service.run')
+    @patch('corbos_scm.service.pull')
+    @patch('corbos_scm.service.DaemonClient')
+    @patch('corbos_scm.service.OutdirState')
+    @patch('corbos_scm.service.StagingDir')
+    def test_fetch_through_daemon(
+        self, mock_StagingDir, mock_OutdirState, mock_DaemonClient,
+        mock_pull, mock_run, mock_os_path_exists, mock_sys_exit
+    ):
+        staging = self.setup_staging(mock_StagingDir)
+        sys.argv += ['--daemon-socket', '/run/test.sock', '--timeout', '600']
+        mock_os_path_exists.return_value = True
+        mock_OutdirState.return_value.exists.return_value = False
+        mock_DaemonClient.return_value.fetch.return_value = True
+
+        main()
+
+        # half of --timeout, the other half is left for a direct fetch
+        mock_DaemonClient.assert_called_once_with('/run/test.sock', 300)
+        assert not mock_DaemonClient.return_value.resolve.called
+        mock_DaemonClient.return_value.fetch.assert_called_once_with(
+            'registry.example.com/ubdevtools:latest', 'curl', 'staging', None
+        )
+        assert not mock_pull.called
+        assert not mock_run.called
+        staging.publish.assert_called_once_with(
+            mock_OutdirState.return_value.get_files.return_value
+        )
+        mock_OutdirState.return_value.write.assert_called_once_with(
+            'curl', staging.publish.return_value, None
+        )
+
+    @patch('sys.exit')
+    @patch('os.path.exists')
+    @patch('corbos_scm.service.run')
+    @patch('corbos_scm.service.pull')
+    @patch('corbos_scm.service.DaemonClient')
+    @patch('corbos_scm.service.OutdirState')
+    @patch('corbos_scm.service.StagingDir')
+    def test_daemon_sources_current(
+        self, mock_StagingDir, mock_OutdirState, mock_DaemonClient,
+        mock_pull, mock_run, mock_os_path_exists, mock_sys_exit
+    ):
+        staging = self.setup_staging(mock_StagingDir)
+        sys.argv += ['--daemon-socket', '/run/test.sock']
+        mock_os_path_exists.return_value = True
+        mock_OutdirState.return_value.exists.return_value = True
+        mock_OutdirState.return_value.is_current.return_value = True
+        mock_DaemonClient.return_value.resolve.return_value = SHOWSRC
+
+        main()
+
+        mock_DaemonClient.assert_called_once_with(
+            '/run/test.sock', DAEMON_TIMEOUT
+        )
+        mock_DaemonClient.return_value.resolve.assert_called_once_with(
+            'registry.example.com/ubdevtools:latest', 'curl'
+        )
+        assert mock_OutdirState.return_value.is_current.call_args[0][
+            0
+        ].version == '7.74.0-1.3'
+        assert not mock_DaemonClient.return_value.fetch.called
+        assert not mock_pull.called
+        assert not mock_run.called
+        assert not staging.publish.called
+        assert not mock_OutdirState.return_value.write.called
+
+    @patch('sys.exit')
+    @patch('os.path.exists')
+    @patch('corbos_scm.service.SourceCache')
+    @patch('corbos_scm.service.AptCache')
+    @patch('corbos_scm.service.run')
+    @patch('corbos_scm.service.pull')
+    @patch('corbos_scm.service.DaemonClient')
+    @patch('corbos_scm.service.RequestCoalescer')
+    @patch('corbos_scm.service.OutdirState')
+    @patch('corbos_scm.service.StagingDir')
+    def test_pull_and_run_cached(
+        self, mock_StagingDir, mock_OutdirState, mock_RequestCoalescer,
+        mock_DaemonClient, mock_pull, mock_run, mock_AptCache,
+        mock_SourceCache, mock_os_path_exists, mock_sys_exit
+    ):
+        self.setup_staging(mock_StagingDir)
+        mock_RequestCoalescer.return_value.receive.return_value = False
+        mock_OutdirState.return_value.is_current.return_value = False
+        sys.argv += [
+            '--cache-dir', '/var/cache/corbos_scm', '--apt-ttl', '600'
+        ]
+        mock_DaemonClient.return_value.fetch.return_value = False
+        mock_DaemonClient.return_value.resolve.return_value = None
+        mock_os_path_exists.return_value = True
+        apt_cache = mock_AptCache.return_value
+        apt_cache.get_volumes.return_value = {
+            'lists': '/var/lib/apt/lists'
+        }
+        apt_cache.get_update_command.return_value = ['apt', 'update']
+        # stale, then fresh after the update
+        apt_cache.is_fresh.side_effect = [False, True]
+        source_cache = mock_SourceCache.return_value
+        source_cache.materialize.return_value = False
+        mock_run.return_value = command_type(
+            output=SHOWSRC, error='', returncode=0
+        )
+
+        main()
+
+        mock_pull.assert_called_once_with(
+            'registry.example.com/ubdevtools:latest',
+            '/var/cache/corbos_scm', 3600
+        )
+        mock_AptCache.assert_called_once_with(
+            '/var/cache/corbos_scm', 'ubdevtools:latest', 600
+        )
+        mock_SourceCache.assert_called_once_with(
+            '/var/cache/corbos_scm', 10240 * 1024 * 1024
+        )
+        assert mock_run.call_args_list == [
+            call(
+                'ubdevtools:latest', {'lists': '/var/lib/apt/lists'},
+                ['apt', 'update']
+            ),
+            call(
+                'ubdevtools:latest', {'lists': '/var/lib/apt/lists'},
+                ['apt-cache', 'showsrc', 'curl'], tty=False
+            ),
+            call(
+                'ubdevtools:latest', {
+                    'staging': '/mnt', 'lists': '/var/lib/apt/lists'
+                }, [
+                    'cd', '/mnt', '&&',
+                    'apt', 'source', '--download-only', 'curl'
+                ]
+            )
+        ]
+        # index checked before resolve and before download
+        assert apt_cache.update_lock.return_value.__enter__.call_count == 2
+        assert apt_cache.read_lock.return_value.__enter__.call_count == 2
+        source = source_cache.materialize.call_args[0][0]
+        assert source.version == '7.74.0-1.3'
+        source_cache.store.assert_called_once_with(source, 'staging')
+
+        # index is fresh and sources are cached
+        mock_run.reset_mock()
+        source_cache.store.reset_mock()
+        apt_cache.is_fresh.side_effect = None
+        apt_cache.is_fresh.return_value = True
+        source_cache.materialize.return_value = True
+
+        main()
+
+        assert mock_run.call_count == 1
+        assert not source_cache.store.called
+
+        # package unknown to apt-cache showsrc
+        mock_run.reset_mock()
+        mock_run.return_value = command_type(
+            output='', error='', returncode=0
+        )
+
+        main()
+
+        assert mock_run.call_count == 2
+        assert not source_cache.store.called
+
+    @patch('corbos_scm.service.fetch_sources')
+    @patch('corbos_scm.service.RequestCoalescer')
+    @patch('corbos_scm.service.OutdirState')
+    def test_fetch_coalesced(
+        self, mock_OutdirState, mock_RequestCoalescer, mock_fetch_sources,
+        tmpdir
+    ):
+        sys.argv[sys.argv.index('obs_out')] = tmpdir.strpath
+        sys.argv += ['--cache-dir', tmpdir.strpath]
+        mock_OutdirState.state_name = '.corbos_scm.json'
+        request = mock_RequestCoalescer.return_value
+        request.receive.return_value = True
+        request.partial_dir = tmpdir.join('partial').strpath
+
+        main()
+
+        mock_RequestCoalescer.assert_called_once_with(
+            tmpdir.strpath, 'container:ubdevtools:latest curl=latest',
+            exclude=['.corbos_scm.json']
+        )
+        request.acquire.assert_called_once_with()
+        request.release.assert_called_once_with()
+        assert not mock_fetch_sources.called
+        mock_OutdirState.return_value.write.assert_called_once_with(
+            'curl', [], None
+        )
+
+        # nobody fetched concurrently, fetch and share the result
+        # resuming the download a failed fetch left behind
+        request.reset_mock()
+        request.receive.return_value = False
+        tmpdir.join('partial', 'curl.tar.xz.part').write('cu', ensure=True)
+
+        def fetch_resumed(args, policy, state, staging_dir):
+            assert os.listdir(staging_dir) == ['curl.tar.xz.part']
+            os.rename(
+                os.sep.join([staging_dir, 'curl.tar.xz.part']),
+                os.sep.join([staging_dir, 'curl.tar.xz'])
+            )
+            return True
+
+        mock_fetch_sources.side_effect = fetch_resumed
+
+        main()
+
+        assert mock_fetch_sources.called
+        assert not tmpdir.join('partial').listdir()
+        staging_dir = request.publish.call_args[0][0]
+        assert os.path.dirname(staging_dir) == tmpdir.dirname
+        assert os.path.basename(staging_dir).startswith(
+            f'.{tmpdir.basename}.staging.'
+        )
+        assert not os.path.exists(staging_dir)
+        request.release.assert_called_once_with()
+
+    @patch('corbos_scm.service.fetch_sources')
+    @patch('corbos_scm.service.OutdirState')
+    def test_fetch_publishes_complete_result(
+        self, mock_OutdirState, mock_fetch_sources, tmpdir
+    ):
+        outdir = tmpdir.mkdir('out')
+        sys.argv[sys.argv.index('obs_out')] = outdir.strpath
+
+        def fetch_partial(args, policy, state, staging_dir):
+            with open(os.sep.join([staging_dir, 'curl.dsc']), 'w') as dsc:
+                dsc.write('dsc')
+            assert not outdir.listdir()
+            raise CSCMCommandError('connection lost')
+
+        mock_fetch_sources.side_effect = fetch_partial
+        with raises(SystemExit):
+            main()
+        # neither partial files nor the staging directory are left
+        assert not outdir.listdir()
+        assert tmpdir.listdir() == [outdir]
+
+        def fetch_complete(args, policy, state, staging_dir):
+            with open(os.sep.join([staging_dir, 'curl.dsc']), 'w') as dsc:
+                dsc.write('dsc')
+            return True
+
+        mock_fetch_sources.side_effect = fetch_complete
+        main()
+        assert outdir.join('curl.dsc').read() == 'dsc'
+        assert tmpdir.listdir() == [outdir]
+
+    @patch('corbos_scm.service.pull')
+    def test_fetch_from_mirror(self, mock_pull, local_mirror, tmpdir):
+        outdir = tmpdir.mkdir('out')
+        sys.argv = [
+            sys.argv[0], '--package', 'curl', '--mirror', local_mirror,
+            '--distribution', 'hirsute', '--outdir', outdir.strpath,
+            '--cache-dir', tmpdir.join('cache').strpath
+        ]
+
+        main()
+
+        assert not mock_pull.called
+        assert len(outdir.listdir()) == 3 + 1
+        assert json.loads(outdir.join('.corbos_scm.json').read())[
+            'version'
+        ] == '7.74.0-1.3'
+
+        # unchanged version, outdir is left alone
+        with patch('corbos_scm.service.SourceCache') as mock_SourceCache:
+            main()
+            assert not mock_SourceCache.called
+
+        # second fetch is served from the source cache
+        outdir.join('.corbos_scm.json').remove()
+        with patch('corbos_scm.mirror.Downloader') as mock_Downloader:
+            main()
+            assert not mock_Downloader.called
+
+        outdir.join('.corbos_scm.json').remove()
+        sys.argv = sys.argv[:-2]
+        with patch('corbos_scm.service.SourceCache') as mock_SourceCache:
+            main()
+            assert not mock_SourceCache.called
+
+    def test_fetch_from_mirror_prefetch(self, tmpdir):
+        root = create_mirror(
+            tmpdir.join('mirror').strpath, {
+                'curl': {
+                    'version': '7.74.0-1.3',
+                    'build_depends': 'debhelper-compat (= 13), '
+                    'libssl-dev [!hurd-any], libnghttp2-dev <!stage1>',
+                    'files': {'curl_7.74.0.orig.tar.gz': b'orig'}
+                }
+            }, binary_packages={
+                'amd64': [
+                    {
+                        'package': 'debhelper', 'version': '13.3',
+                        'depends': 'perl', 'provides': 'debhelper-compat (= 13)'
+                    },
+                    {'package': 'perl', 'version': '5.32'},
+                    {'package': 'libssl-dev', 'version': '1.1.1'}
                 ]
+            }
+        )
+        outdir = tmpdir.mkdir('out')
+        # not part of the fetch, e.g. left by someone else
+        for version in ('7.74.0-1.1', '7.74.0-1.2', '7.74.0-1.4'):
+            outdir.join(f'curl_{version}.dsc').write(
+                f'Source: curl\nVersion: {version}\n'
+                'Build-Depends: libnghttp2-dev\n'
             )
+        manifest = tmpdir.join('prefetch.json')
+        debs = tmpdir.join('debs')
+        sys.argv = [
+            sys.argv[0], '--package', 'curl', '--mirror', f'file://{root}',
+            '--distribution', 'hirsute', '--outdir', outdir.strpath,
+            '--cache-dir', tmpdir.join('cache').strpath,
+            '--prefetch-manifest', manifest.strpath,
+            '--prefetch-dir', debs.strpath
+        ]
+
+        main()
+
+        result = json.loads(manifest.read())
+        assert result['source'] == 'curl'
+        assert result['version'] == '7.74.0-1.3'
+        assert result['architecture'] == 'amd64'
+        assert [
+            package['package'] for package in result['packages']
+        ] == ['debhelper', 'libssl-dev', 'perl']
+        assert result['packages'][0]['url'] == \
+            f'file://{root}/pool/main/d/debhelper_13.3_amd64.deb'
+        assert result['unresolved'] == ['libnghttp2-dev']
+        assert sorted(os.listdir(debs.strpath)) == [
+            'debhelper_13.3_amd64.deb', 'libssl-dev_1.1.1_amd64.deb',
+            'perl_5.32_amd64.deb'
+        ]
+        assert tmpdir.join('cache', 'packages').listdir()
+
+        # unchanged sources, no new manifest
+        manifest.remove()
+        main()
+        assert not manifest.exists()
+
+    def test_fetch_from_mirror_prefetch_failed(self, tmpdir):
+        root = create_mirror(
+            tmpdir.join('mirror').strpath, {
+                'curl': {
+                    'version': '7.74.0-1.3',
+                    'files': {'curl_7.74.0.orig.tar.gz': b'orig'}
+                }
+            }
+        )
+        outdir = tmpdir.mkdir('out')
+        sys.argv = [
+            sys.argv[0], '--package', 'curl', '--mirror', f'file://{root}',
+            '--distribution', 'hirsute', '--outdir', outdir.strpath,
+            '--prefetch-manifest', tmpdir.join('prefetch.json').strpath,
+            '--retries', '0'
+        ]
+
+        with self._caplog.at_level(logging.WARNING):
+            main()
+
+        # no Packages index, the sources are published nevertheless
+        assert 'Prefetch of build dependencies failed' in self._caplog.text
+        assert outdir.join('curl_7.74.0-1.3.dsc').exists()
+        assert outdir.join('.corbos_scm.json').exists()
+        assert not tmpdir.join('prefetch.json').exists()
+
+    def test_prefetch_without_dsc(self, tmpdir):
+        tmpdir.join('curl_7.74.0-1.3.dsc').write('Source: curl')
+        with raises(CSCMPrefetchError, match='No .dsc file recorded'):
+            prefetch_build_deps({}, Mock(), OutdirState(tmpdir.strpath))
+
+    @patch('corbos_scm.service.Command')
+    @patch('corbos_scm.service.run')
+    @patch('corbos_scm.service.pull')
+    def test_total_timeout(self, mock_pull, mock_run, mock_Command, tmpdir):
+        sys.argv += ['--timeout', '600']
+        sys.argv[sys.argv.index('obs_out')] = tmpdir.strpath
+        main()
+        mock_Command.set_total_timeout.assert_called_once_with(600)
+
+    @patch('sys.exit')
+    @patch('corbos_scm.service.pull')
+    def test_report(self, mock_pull, mock_sys_exit, local_mirror, tmpdir):
+        outdir = tmpdir.mkdir('out')
+        report_file = tmpdir.join('report.jsonl')
+        sys.argv = [
+            sys.argv[0], '--package', 'curl', '--mirror', local_mirror,
+            '--distribution', 'hirsute', '--outdir', outdir.strpath,
+            '--report', report_file.strpath
+        ]
+        main()
+        # unchanged sources, nothing is written
+        main()
+        sys.argv[sys.argv.index('curl')] = 'foo'
+        main()
+        mock_sys_exit.assert_called_once_with(1)
+
+        success, unchanged, failure = [
+            json.loads(line) for line in report_file.readlines()
+        ]
+        assert success['success']
+        assert success['package'] == 'curl'
+        assert success['outdir_bytes'] > 0
+        assert unchanged['success']
+        assert unchanged['outdir_bytes'] == 0
+        assert [
+            phase['name'] for phase in success['phases']
+        ] == ['resolve', 'download', 'publish']
+        assert not failure['success']
+        assert failure['error'].startswith('CSCMMirrorError')
+        assert failure['phases'][0]['success'] is False
+
+    @patch('sys.exit')
+    @patch('corbos_scm.service.pull')
+    def test_report_write_failed(
+        self, mock_pull, mock_sys_exit, local_mirror, tmpdir
+    ):
+        sys.argv = [
+            sys.argv[0], '--package', 'foo', '--mirror', local_mirror,
+            '--distribution', 'hirsute', '--outdir', tmpdir.strpath,
+            '--report', tmpdir.join('missing', 'report.json').strpath
+        ]
+        with self._caplog.at_level(logging.WARNING):
+            main()
+        mock_sys_exit.assert_called_once_with(1)
+        records = [
+            (record.levelname, record.getMessage())
+            for record in self._caplog.records
+        ]
+        assert records[-2][0] == 'WARNING'
+        assert records[-2][1].startswith('CSCMReportError')
+        assert records[-1][0] == 'ERROR'
+        assert records[-1][1].startswith('CSCMMirrorError')
+
+        # without a fetch error the report error is the error
+        mock_sys_exit.reset_mock()
+        sys.argv[sys.argv.index('foo')] = 'curl'
+        with self._caplog.at_level(logging.WARNING):
+            main()
+        mock_sys_exit.assert_called_once_with(1)
+        assert self._caplog.records[-1].getMessage().startswith(
+            'CSCMReportError'
+        )
+
+    @patch('corbos_scm.service.pull')
+    def test_metrics(self, mock_pull, local_mirror, tmpdir):
+        textfile = tmpdir.join('corbos_scm.prom')
+        sys.argv = [
+            sys.argv[0], '--package', 'curl', '--mirror', local_mirror,
+            '--distribution', 'hirsute', '--outdir', tmpdir.strpath,
+            '--metrics', textfile.strpath
         ]
+        main()
+        Metrics.setup(None)
+        content = textfile.read()
+        assert 'corbos_scm_runs_total{result="success"} 1\n' in content
+        assert 'corbos_scm_downloaded_bytes_total' in content
+        assert 'corbos_scm_phase_duration_seconds_count' \
+            '{phase="download"} 1\n' in content
+
+    @patch('time.sleep')
+    @patch('corbos_scm.service.pull')
+    def test_mirror_failover(
+        self, mock_pull, mock_sleep, local_mirror, tmpdir
+    ):
+        outdir = tmpdir.mkdir('out')
+        sys.argv = [
+            sys.argv[0], '--package', 'curl',
+            '--mirror', f'http://127.0.0.1:9/debian,{local_mirror}',
+            '--distribution', 'hirsute', '--outdir', outdir.strpath,
+            '--retries', '1'
+        ]
+        main()
+        assert len(outdir.listdir()) == 3 + 1
+        assert mock_sleep.call_count == 1
+
+    def test_pull_and_run_never_creates_directories(self, tmpdir):
+        # the real command line through podman and apt stand-ins,
+        # which unpack the sources unless told otherwise
+        bindir = tmpdir.mkdir('bin')
+        container_bindir = tmpdir.mkdir('container_bin')
+        podman = bindir.join('podman')
+        podman.write(
+            f'#!/bin/bash\nexec {sys.executable} '
+            f'{BENCHMARK_DIR}/fake_podman.py "$@"\n'
+        )
+        podman.chmod(0o755)
+        fake_apt = container_bindir.join('apt')
+        fake_apt.write(FAKE_APT)
+        fake_apt.chmod(0o755)
+        outdir = tmpdir.join('out')
+        sys.argv[sys.argv.index('obs_out')] = outdir.strpath
+        sys.argv += ['--daemon-socket', tmpdir.join('missing').strpath]
+        with patch.dict(
+            os.environ, {
+                'PATH': os.pathsep.join([bindir.strpath, os.environ['PATH']]),
+                'FAKE_CONTAINER_BIN': container_bindir.strpath,
+                'FAKE_PODMAN_STATE': tmpdir.mkdir('podman').strpath
+            }
+        ):
+            main()
+        assert sorted(os.listdir(outdir.strpath)) == [
+            '.corbos_scm.json', 'curl_1.0-1.debian.tar.xz', 'curl_1.0-1.dsc',
+            'curl_1.0.orig.tar.gz'
+        ]
+        assert not [
+            entry for entry in os.scandir(outdir.strpath) if entry.is_dir()
+        ]
+
+    @patch('sys.exit')
+    @patch('corbos_scm.service.DaemonClient')
+    @patch('corbos_scm.service.pull')
+    def test_invalid_package(
+        self, mock_pull, mock_DaemonClient, mock_sys_exit, tmpdir
+    ):
+        sys.argv[sys.argv.index('obs_out')] = tmpdir.strpath
+        sys.argv[sys.argv.index('curl')] = 'curl;reboot'
+        with self._caplog.at_level(logging.ERROR):
+            main()
+        mock_sys_exit.assert_called_once_with(1)
+        assert 'CSCMPackageNameError' in self._caplog.text
+        assert not mock_DaemonClient.called
+        assert not mock_pull.called
+
+    @patch('time.sleep')
+    @patch('corbos_scm.service.run')
+    @patch('corbos_scm.service.pull')
+    def test_registry_failover(self, mock_pull, mock_run, mock_sleep, tmpdir):
+        sys.argv[sys.argv.index('registry.example.com')] = 'a.example.com,b'
+        sys.argv[sys.argv.index('obs_out')] = tmpdir.strpath
+        sys.argv += ['--retries', '0', '--daemon-socket', 'missing']
+        mock_pull.side_effect = [
+            CSCMCommandError('Error: 503 Service Unavailable', 125), None
+        ]
+        main()
+        assert mock_pull.call_args_list == [
+            call('a.example.com/ubdevtools:latest', None, 3600),
+            call('b/ubdevtools:latest', None, 3600)
+        ]
+        assert not mock_sleep.called
+
+    @patch('corbos_scm.service.OutdirState')
+    @patch('corbos_scm.service.run')
+    @patch('corbos_scm.service.pull')
+    def test_pull_and_run_unchanged(
+        self, mock_pull, mock_run, mock_OutdirState, tmpdir
+    ):
+        sys.argv[sys.argv.index('obs_out')] = tmpdir.strpath
+        sys.argv += ['--daemon-socket', 'missing']
+        state = mock_OutdirState.return_value
+        state.exists.return_value = True
+        state.is_current.return_value = True
+        mock_run.return_value = command_type(
+            output=SHOWSRC, error='', returncode=0
+        )
+
+        main()
+
+        mock_run.assert_called_once_with(
+            'ubdevtools:latest', {}, [
+                'apt', 'update', '>', '/dev/null', '&&',
+                'apt-cache', 'showsrc', 'curl'
+            ], tty=False
+        )
+        assert state.is_current.call_args[0][0].version == '7.74.0-1.3'
+        assert not state.write.called
+
+        # new version, lookup and fetch
+        mock_run.reset_mock()
+        state.is_current.return_value = False
+        main()
+        assert mock_run.call_count == 2
+        state.write.assert_called_once_with('curl', [], None)
+
+    @patch('corbos_scm.service.OutdirState')
+    @patch('corbos_scm.service.SourceCache')
+    @patch('corbos_scm.service.AptCache')
+    @patch('corbos_scm.service.run')
+    @patch('corbos_scm.service.pull')
+    def test_pull_and_run_cached_unchanged(
+        self, mock_pull, mock_run, mock_AptCache, mock_SourceCache,
+        mock_OutdirState, tmpdir
+    ):
+        sys.argv[sys.argv.index('obs_out')] = tmpdir.strpath
+        sys.argv += [
+            '--cache-dir', tmpdir.strpath, '--daemon-socket', 'missing'
+        ]
+        mock_OutdirState.return_value.is_current.return_value = True
+        mock_run.return_value = command_type(
+            output=SHOWSRC, error='', returncode=0
+        )
+        main()
+        # index is fresh, only the version lookup runs
+        assert mock_run.call_count == 1
+        assert not mock_SourceCache.return_value.materialize.called
+        assert not mock_OutdirState.return_value.write.called
+
+    @patch('corbos_scm.service.pull')
+    def test_fetch_snapshot_version(self, mock_pull, tmpdir):
+        create_mirror(
+            tmpdir.join('snapshot', '20210801T000000Z').strpath, {
+                'curl': {
+                    'version': '7.74.0-1.2',
+                    'files': {'curl_7.74.0.orig.tar.gz': b'orig'}
+                }
+            }
+        )
+        outdir = tmpdir.join('out')
+        sys.argv = [
+            sys.argv[0], '--package', 'curl',
+            '--mirror', f'file://{tmpdir.strpath}/snapshot/',
+            '--snapshot', '20210801T000000Z',
+            '--package-version', '7.74.0-1.2',
+            '--distribution', 'hirsute', '--outdir', outdir.strpath,
+            '--cache-dir', tmpdir.join('cache').strpath
+        ]
+        main()
+        assert outdir.join('curl_7.74.0-1.2.dsc').exists()
+
+        # resolved from the metadata cache, served from the source cache
+        outdir.remove()
+        with patch('corbos_scm.mirror.Mirror.get_sources') as get_sources:
+            main()
+            assert not get_sources.called
+        assert outdir.join('curl_7.74.0-1.2.dsc').exists()
+
+    @patch('corbos_scm.service.OutdirState')
+    @patch('corbos_scm.service.run')
+    @patch('corbos_scm.service.pull')
+    def test_pull_and_run_cached_version(
+        self, mock_pull, mock_run, mock_OutdirState, tmpdir
+    ):
+        sys.argv[sys.argv.index('obs_out')] = tmpdir.join('out').strpath
+        sys.argv += [
+            '--cache-dir', tmpdir.strpath, '--daemon-socket', 'missing',
+            '--package-version', '7.74.0-1.3'
+        ]
+        mock_OutdirState.return_value.is_current.return_value = False
+        mock_run.return_value = command_type(
+            output=SHOWSRC, error='', returncode=0
+        )
+        main()
+        assert mock_run.call_args_list[-1][0][2] == [
+            'cd', '/mnt', '&&',
+            'apt', 'source', '--download-only', 'curl=7.74.0-1.3'
+        ]
+
+        # resolved from the metadata cache, no index update or lookup
+        mock_run.reset_mock()
+        mock_OutdirState.return_value.is_current.return_value = True
+        main()
+        assert not mock_run.called
+
+
+class TestStartup:
+    """
+    Every OBS service call is a new process, the modules imported
+    before the arguments are parsed are paid by each invocation.
+    The import time itself is measured by
+    test/benchmark/startup_benchmark.py
+    """
+    fetch_modules = [
+        'corbos_scm.service',
+        'corbos_scm.command',
+        'corbos_scm.container',
+        'corbos_scm.mirror',
+        'corbos_scm.download',
+        'asyncio',
+        'http.client',
+        'tempfile'
+    ]
+
+    def get_imports(self, code):
+        environment = dict(
+            os.environ, PYTHONPATH=os.path.dirname(
+                os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+            )
+        )
+        # the loaded modules are printed on exit, main() may exit
+        # through SystemExit
+        process = subprocess.run(
+            [
+                sys.executable, '-c',
+                'import sys, json, atexit; atexit.register(lambda: '
+                'print(json.dumps(sorted(sys.modules)))); ' + code
+            ],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            universal_newlines=True, env=environment
+        )
+        return set(json.loads(process.stdout.splitlines()[-1]))
+
+    def run_main(self, *arguments):
+        return self.get_imports(
+            'import sys; from corbos_scm.corbos_scm import main; '
+            f'sys.argv = {["corbos_scm"] + list(arguments)!r}; main()'
+        )
+
+    def test_import(self):
+        imports = self.get_imports('import corbos_scm.corbos_scm')
+        assert 'corbos_scm.corbos_scm' in imports
+        assert not set(self.fetch_modules).intersection(imports)
+
+    def test_help_and_version(self):
+        for argument in ['--help', '--version']:
+            imports = self.run_main(argument)
+            assert 'docopt' in imports
+            assert not set(self.fetch_modules).intersection(imports)
+
+    def test_usage_error(self):
+        imports = self.run_main('--package', 'curl')
+        assert not set(self.fetch_modules).intersection(imports)
+
+    def test_container_without_mirror_engine(self):
+        imports = self.get_imports('import corbos_scm.service')
+        assert 'corbos_scm.command' in imports
+        assert not {
+            'corbos_scm.mirror', 'corbos_scm.download',
+            'corbos_scm.proxy', 'asyncio', 'http.client'
+        }.intersection(imports)
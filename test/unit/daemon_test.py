@@ -0,0 +1,266 @@
+import os
+import sys
+import signal
+import threading
+from mock import (
+    patch, call, Mock, MagicMock
+)
+from pytest import (
+    fixture, raises
+)
+
+from corbos_scm.command import command_type
+from corbos_scm.client import DaemonClient
+from corbos_scm.batch import fetch_result_type
+from corbos_scm.exceptions import (
+    CSCMDaemonError, CSCMPackageNameError
+)
+from corbos_scm.daemon import (
+    main, ContainerPool, DaemonServer
+)
+
+OK = command_type(output='', error='', returncode=0)
+
+
+class TestContainerPool:
+    def setup_method(self):
+        self.sessions = []
+
+    def new_session(self, container, volumes):
+        session = Mock()
+        session.container_id = f'id{len(self.sessions)}'
+        session.execute.return_value = OK
+        self.sessions.append(session)
+        return session
+
+    @fixture
+    def pool(self, tmpdir):
+        with patch('corbos_scm.daemon.ContainerSession') as session:
+            session.side_effect = self.new_session
+            pool = ContainerPool(
+                'ubdevtools:latest', 2, tmpdir.join('work').strpath
+            )
+            pool.start()
+            yield pool
+
+    def test_start_stop(self, pool):
+        assert len(self.sessions) == 2
+        for session in self.sessions:
+            session.start.assert_called_once_with()
+        pool.stop()
+        for session in self.sessions:
+            session.stop.assert_called_once_with()
+
+    def test_fetch(self, pool, tmpdir):
+        outdir = tmpdir.join('obs_out').strpath
+
+        def apt_source(command, raise_on_error=True):
+            if command[0] == 'cd':
+                fetch_dir = os.path.join(
+                    pool.work_dir, os.path.basename(command[1])
+                )
+                with open(os.path.join(fetch_dir, 'curl.dsc'), 'w') as dsc:
+                    dsc.write('dsc')
+            return OK
+
+        session = self.sessions[0]
+        session.execute.side_effect = apt_source
+        result = pool.fetch('curl', outdir)
+        assert result == fetch_result_type(
+            'curl', outdir, True, '', result.duration, 3
+        )
+        assert session.execute.call_args_list[0] == call(['apt', 'update'])
+        command = session.execute.call_args_list[1][0][0]
+        assert command[1].startswith('/work/')
+        assert command[2:] == [
+            '&&', 'apt', 'source', '--download-only', 'curl'
+        ]
+        assert os.listdir(outdir) == ['curl.dsc']
+        assert os.listdir(pool.work_dir) == []
+
+        # the index of the first session is fresh now
+        pool.fetch('curl', outdir)
+        pool.fetch('curl', outdir)
+        assert session.execute.call_count == 3
+
+    def test_fetch_failed(self, pool):
+        self.sessions[0].execute.side_effect = [
+            OK, command_type(output='', error='E: not found\n', returncode=100)
+        ]
+        result = pool.fetch('foo', 'out')
+        assert result == fetch_result_type(
+            'foo', 'out', False, 'E: not found', result.duration, None
+        )
+        self.sessions[1].execute.return_value = command_type(
+            output='', error='', returncode=1
+        )
+        assert pool.fetch('foo', 'out').message == 'exit code 1'
+
+    def test_fetch_invalid_package(self, pool):
+        with raises(CSCMPackageNameError):
+            pool.fetch('curl;touch /x', 'out')
+        with raises(CSCMPackageNameError):
+            pool.fetch('curl', 'out', '1.0 && touch /x')
+        with raises(CSCMPackageNameError):
+            pool.resolve('$(touch /x)')
+        for session in self.sessions:
+            assert not session.execute.called
+        assert pool.sessions.qsize() == 2
+
+    def test_fetch_container_gone(self, pool, tmpdir):
+        gone = self.sessions[0]
+        gone.execute.return_value = command_type(
+            output='', error='no such container', returncode=125
+        )
+        assert pool.fetch('curl', tmpdir.strpath).success
+        gone.stop.assert_called_once_with()
+        assert self.sessions[2].start.called
+        assert pool.sessions.qsize() == 2
+
+    def test_resolve(self, pool):
+        session = self.sessions[0]
+        session.execute.side_effect = [
+            OK, command_type(output='Package: curl\n', error='', returncode=0)
+        ]
+        assert pool.resolve('curl').output == 'Package: curl\n'
+        assert session.execute.call_args_list == [
+            call(['apt', 'update']),
+            call(['apt-cache', 'showsrc', 'curl'], raise_on_error=False)
+        ]
+        assert pool.sessions.qsize() == 2
+
+    def test_fetch_apt_cache(self, tmpdir):
+        apt_cache = MagicMock()
+        apt_cache.get_volumes.return_value = {'lists': '/var/lib/apt/lists'}
+        apt_cache.get_update_command.return_value = ['update']
+        apt_cache.is_fresh.return_value = False
+        apt_proxy = MagicMock()
+        apt_proxy.get_volumes.return_value = {
+            'proxy.conf': '/etc/apt/apt.conf.d/99corbos_scm_proxy'
+        }
+        with patch('corbos_scm.daemon.ContainerSession') as session:
+            session.side_effect = self.new_session
+            pool = ContainerPool(
+                'ubdevtools:latest', 1, tmpdir.strpath, apt_cache,
+                apt_proxy=apt_proxy
+            )
+            pool.start()
+            session.assert_called_once_with(
+                'ubdevtools:latest', {
+                    tmpdir.strpath: '/work', 'lists': '/var/lib/apt/lists',
+                    'proxy.conf': '/etc/apt/apt.conf.d/99corbos_scm_proxy'
+                }
+            )
+        assert pool.fetch('curl', tmpdir.strpath).success
+        assert self.sessions[0].execute.call_args_list[0] == call(['update'])
+        apt_cache.update_lock.return_value.__enter__.assert_called_once_with()
+        apt_cache.read_lock.return_value.__enter__.assert_called_once_with()
+        assert pool.resolve('curl').returncode == 0
+        assert apt_cache.read_lock.return_value.__enter__.call_count == 2
+
+
+class TestDaemonServer:
+    @fixture
+    def server(self, tmpdir):
+        socket_path = tmpdir.join('run', 'daemon.sock').strpath
+        os.makedirs(os.path.dirname(socket_path))
+        # left behind by a previous daemon
+        open(socket_path, 'w').close()
+        server = DaemonServer(socket_path, 'registry/ubdevtools', Mock())
+        serve = threading.Thread(
+            target=server.serve_forever, kwargs={'poll_interval': 0.05}
+        )
+        serve.start()
+        yield server
+        server.shutdown()
+        serve.join()
+        server.close()
+        assert not os.path.exists(socket_path)
+
+    def test_fetch(self, server):
+        server.pool.fetch.return_value = fetch_result_type(
+            'curl', '/out', True, '', 0.5, 3
+        )
+        client = DaemonClient(server.socket_path, timeout=5)
+        assert client.fetch('registry/ubdevtools', 'curl', '/out')
+        server.pool.fetch.assert_called_once_with('curl', '/out', None)
+
+    def test_fetch_failed(self, server):
+        server.pool.fetch.side_effect = Exception('podman broken')
+        client = DaemonClient(server.socket_path, timeout=5)
+        with raises(CSCMDaemonError, match='podman broken'):
+            client.fetch('registry/ubdevtools', 'curl', '/out')
+
+    def test_resolve(self, server):
+        server.pool.resolve.return_value = command_type(
+            output='Package: curl\n', error='', returncode=0
+        )
+        client = DaemonClient(server.socket_path, timeout=5)
+        assert client.resolve(
+            'registry/ubdevtools', 'curl'
+        ) == 'Package: curl\n'
+        server.pool.resolve.assert_called_once_with('curl')
+        assert not server.pool.fetch.called
+
+    def test_resolve_failed(self, server):
+        server.pool.resolve.return_value = command_type(
+            output='', error='E: no apt sources\n', returncode=100
+        )
+        client = DaemonClient(server.socket_path, timeout=5)
+        with raises(CSCMDaemonError, match='E: no apt sources'):
+            client.resolve('registry/ubdevtools', 'curl')
+
+    def test_fetch_other_image(self, server):
+        client = DaemonClient(server.socket_path, timeout=5)
+        assert not client.fetch('registry/other', 'curl', '/out')
+        assert not server.pool.fetch.called
+
+
+class TestDaemon:
+    def setup_method(self):
+        sys.argv = [
+            sys.argv[0],
+            '--registry', 'registry.example.com',
+            '--container', 'ubdevtools:latest',
+            '--socket', '/run/test.sock',
+            '--cache-dir', '/var/cache/corbos_scm'
+        ]
+
+    @patch('signal.signal')
+    @patch('corbos_scm.daemon.DaemonServer')
+    @patch('corbos_scm.daemon.ContainerPool')
+    @patch('corbos_scm.daemon.AptCache')
+    @patch('corbos_scm.daemon.pull')
+    def test_main(
+        self, mock_pull, mock_AptCache, mock_ContainerPool,
+        mock_DaemonServer, mock_signal
+    ):
+        server = mock_DaemonServer.return_value
+        pool = mock_ContainerPool.return_value
+        main()
+        mock_pull.assert_called_once_with(
+            'registry.example.com/ubdevtools:latest',
+            '/var/cache/corbos_scm', 3600
+        )
+        mock_AptCache.assert_called_once_with(
+            '/var/cache/corbos_scm', 'ubdevtools:latest', 3600
+        )
+        mock_ContainerPool.assert_called_once_with(
+            'ubdevtools:latest', 2, '/var/tmp/corbos_scm',
+            mock_AptCache.return_value, 3600, None
+        )
+        mock_DaemonServer.assert_called_once_with(
+            '/run/test.sock', 'registry.example.com/ubdevtools:latest', pool
+        )
+        pool.start.assert_called_once_with()
+        server.serve_forever.assert_called_once_with()
+        server.close.assert_called_once_with()
+        pool.stop.assert_called_once_with()
+
+        # SIGTERM shuts the server down
+        signum, handler = mock_signal.call_args[0]
+        assert signum == signal.SIGTERM
+        with patch('threading.Thread') as mock_Thread:
+            handler(signum, None)
+            mock_Thread.assert_called_once_with(target=server.shutdown)
+            mock_Thread.return_value.start.assert_called_once_with()
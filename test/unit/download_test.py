@@ -0,0 +1,244 @@
+from mock import patch
+from pytest import raises
+
+import socket
+import hashlib
+
+from corbos_scm.exceptions import (
+    CSCMDownloadError,
+    CSCMChecksumError
+)
+from corbos_scm.download import (
+    fetch_url, download, Downloader, download_job_type, StreamVerifier,
+    Throttle
+)
+
+
+class TestDownload:
+    def test_fetch_url(self, tmpdir):
+        data = tmpdir.join('data')
+        data.write('data')
+        assert fetch_url(f'file://{data.strpath}') == b'data'
+        with raises(CSCMDownloadError):
+            fetch_url(f'file://{tmpdir.strpath}/missing')
+
+    def test_download(self, tmpdir):
+        data = tmpdir.join('data')
+        data.write('data')
+        target = tmpdir.join('target')
+        download(f'file://{data.strpath}', target.strpath)
+        assert target.read() == 'data'
+        with raises(CSCMDownloadError):
+            download(f'file://{tmpdir.strpath}/missing', target.strpath)
+
+    def test_stalling_server(self, tmpdir):
+        # accepts connections but never answers
+        with socket.socket() as server:
+            server.bind(('127.0.0.1', 0))
+            server.listen(2)
+            url = 'http://127.0.0.1:{0}/data'.format(server.getsockname()[1])
+            with raises(CSCMDownloadError, match='timed out'):
+                fetch_url(url, timeout=0.2)
+            with raises(CSCMDownloadError, match='timed out'):
+                download(url, tmpdir.join('target').strpath, timeout=0.2)
+
+
+class TestStreamVerifier:
+    def test_verify(self, tmpdir):
+        verifier = StreamVerifier('data', 4, hashlib.sha256(b'data').hexdigest())
+        verifier.update(b'da')
+        verifier.update(b'ta')
+        verifier.verify()
+        tmpdir.join('part').write('da')
+        verifier.update_from_file(tmpdir.join('part').strpath)
+        assert verifier.received == 2
+
+    def test_verify_too_much_data(self):
+        verifier = StreamVerifier('data', 4)
+        with raises(CSCMChecksumError):
+            verifier.update(b'datadata')
+
+    def test_verify_size(self):
+        verifier = StreamVerifier('data', 4)
+        verifier.update(b'da')
+        with raises(CSCMChecksumError):
+            verifier.verify()
+
+    def test_verify_checksum(self):
+        verifier = StreamVerifier('data', sha256='0000')
+        verifier.update(b'data')
+        with raises(CSCMChecksumError):
+            verifier.verify()
+
+
+class TestThrottle:
+    @patch('time.sleep')
+    @patch('time.monotonic')
+    def test_consume(self, mock_monotonic, mock_sleep):
+        mock_monotonic.side_effect = [0, 0, 0, 10]
+        throttle = Throttle(100)
+        throttle.consume(100)
+        mock_sleep.assert_called_once_with(1)
+        throttle.consume(50)
+        mock_sleep.assert_called_with(1.5)
+        # idle time is not saved up for later transfers
+        mock_sleep.reset_mock()
+        throttle.consume(50)
+        mock_sleep.assert_called_once_with(0.5)
+
+
+class TestDownloader:
+    def setup_method(self):
+        self.data = bytes(range(256)) * 4096
+        self.sha256 = hashlib.sha256(self.data).hexdigest()
+
+    def _publish(self, http_server, tmpdir, count=1):
+        for index in range(count):
+            tmpdir.join('www', f'file{index}').write_binary(self.data)
+
+    def test_download_all_parallel_keep_alive(self, http_server, tmpdir):
+        self._publish(http_server, tmpdir, count=8)
+        outdir = tmpdir.mkdir('out')
+        with Downloader(workers=2) as downloader:
+            downloader.download_all(
+                [
+                    download_job_type(
+                        url=f'{http_server.uri}/file{index}',
+                        filename=outdir.join(f'file{index}').strpath,
+                        size=len(self.data),
+                        sha256=hashlib.sha256(self.data).hexdigest()
+                    ) for index in range(8)
+                ]
+            )
+        for index in range(8):
+            assert outdir.join(f'file{index}').read_binary() == self.data
+        assert not outdir.listdir(lambda path: path.ext == '.part')
+        assert len(http_server.requests) == 8
+        # connections are reused, one per worker at most
+        assert http_server.connections <= 2
+
+    @patch('corbos_scm.download.time.sleep')
+    def test_download_rate_limit(self, mock_sleep, http_server, tmpdir):
+        self._publish(http_server, tmpdir)
+        target = tmpdir.join('file0')
+        Downloader(rate_limit=len(self.data) // 2).download(
+            f'{http_server.uri}/file0', target.strpath,
+            len(self.data), self.sha256
+        )
+        assert target.read_binary() == self.data
+        assert 1.5 < mock_sleep.call_args[0][0] <= 2
+
+    def test_download_resume(self, http_server, tmpdir):
+        self._publish(http_server, tmpdir)
+        http_server.interrupt.append('/file0')
+        target = tmpdir.join('file0')
+        Downloader(workers=1).download(
+            f'{http_server.uri}/file0', target.strpath,
+            len(self.data), self.sha256
+        )
+        assert target.read_binary() == self.data
+        assert http_server.requests == [
+            ('/file0', None), ('/file0', f'bytes={len(self.data) // 2}-')
+        ]
+
+    def test_download_resume_partial_file(self, http_server, tmpdir):
+        self._publish(http_server, tmpdir)
+        tmpdir.join('file0.part').write_binary(self.data[:1000])
+        target = tmpdir.join('file0')
+        Downloader().download(
+            f'{http_server.uri}/file0', target.strpath,
+            len(self.data), self.sha256
+        )
+        assert target.read_binary() == self.data
+        assert http_server.requests == [('/file0', 'bytes=1000-')]
+
+    def test_download_partial_file_complete(self, http_server, tmpdir):
+        self._publish(http_server, tmpdir)
+        tmpdir.join('file0.part').write_binary(self.data)
+        target = tmpdir.join('file0')
+        Downloader().download(f'{http_server.uri}/file0', target.strpath)
+        assert target.read_binary() == self.data
+
+    def test_download_range_ignored(self, http_server, tmpdir):
+        self._publish(http_server, tmpdir)
+        tmpdir.join('file0.part').write_binary(b'x' * 1000)
+        target = tmpdir.join('file0')
+        http_server.ranges = False
+        Downloader().download(
+            f'{http_server.uri}/file0', target.strpath,
+            len(self.data), self.sha256
+        )
+        assert target.read_binary() == self.data
+
+    def test_download_checksum_mismatch(self, http_server, tmpdir):
+        self._publish(http_server, tmpdir)
+        with raises(CSCMChecksumError):
+            Downloader().download(
+                f'{http_server.uri}/file0', tmpdir.join('file0').strpath,
+                len(self.data), '0000'
+            )
+        assert not tmpdir.join('file0.part').exists()
+        assert not tmpdir.join('file0').exists()
+
+    def test_download_aborts_early_on_size(self, http_server, tmpdir):
+        self._publish(http_server, tmpdir)
+        with raises(CSCMChecksumError):
+            Downloader().download(
+                f'{http_server.uri}/file0', tmpdir.join('file0').strpath,
+                10, self.sha256
+            )
+        assert not tmpdir.join('file0.part').exists()
+
+    def test_download_redirect(self, http_server, tmpdir):
+        self._publish(http_server, tmpdir)
+        target = tmpdir.join('file0')
+        Downloader().download(
+            f'{http_server.uri}/redirect/file0', target.strpath
+        )
+        assert target.read_binary() == self.data
+
+    def test_download_too_many_redirects(self, http_server, tmpdir):
+        downloader = Downloader()
+        downloader.max_redirects = 0
+        with raises(CSCMDownloadError):
+            downloader.download(
+                f'{http_server.uri}/redirect/file0', tmpdir.join('x').strpath
+            )
+
+    def test_download_not_found(self, http_server, tmpdir):
+        with raises(CSCMDownloadError):
+            Downloader().download(
+                f'{http_server.uri}/missing', tmpdir.join('x').strpath
+            )
+        # no retries for a clear server answer
+        assert len(http_server.requests) == 1
+
+    def test_download_retries_exhausted(self, http_server, tmpdir):
+        self._publish(http_server, tmpdir)
+        http_server.interrupt += ['/file0'] * 2
+        with raises(CSCMDownloadError):
+            Downloader(retries=1).download(
+                f'{http_server.uri}/file0', tmpdir.join('file0').strpath
+            )
+        assert tmpdir.join('file0.part').size() == \
+            len(self.data) // 2 + len(self.data) // 4
+
+    def test_download_file_url(self, tmpdir):
+        tmpdir.join('data').write('data')
+        Downloader().download(
+            f'file://{tmpdir.strpath}/data', tmpdir.join('target').strpath,
+            4, hashlib.sha256(b'data').hexdigest()
+        )
+        assert tmpdir.join('target').read() == 'data'
+        with raises(CSCMChecksumError):
+            Downloader().download(
+                f'file://{tmpdir.strpath}/data',
+                tmpdir.join('target').strpath, 4, '0000'
+            )
+        assert not tmpdir.join('target').exists()
+
+    @patch('http.client.HTTPSConnection')
+    def test_https_connection(self, mock_HTTPSConnection):
+        downloader = Downloader()
+        assert downloader._acquire(('https', 'example.com')) == \
+            mock_HTTPSConnection.return_value
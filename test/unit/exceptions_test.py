@@ -56,3 +56,15 @@ class TestExceptions:
             with self._caplog.at_level(logging.ERROR):
                 wrapper()
                 assert format('Unexpected error:') in self._caplog.text
+
+    @patch('corbos_scm.exceptions.Metrics')
+    @patch('sys.exit')
+    def test_exception_handler_metrics(self, mock_sys_exit, mock_Metrics):
+        issue = CSCMError('issue')
+        exception_handler(Mock(side_effect=issue))()
+        assert mock_Metrics.record_run.call_args[0][1] is issue
+        mock_Metrics.flush.assert_called_once_with()
+        mock_Metrics.reset_mock()
+        assert exception_handler(Mock(return_value=42))() == 42
+        assert mock_Metrics.record_run.call_args[0][1] is None
+        mock_Metrics.flush.assert_called_once_with()
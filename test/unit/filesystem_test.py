@@ -0,0 +1,64 @@
+from mock import patch
+import os
+
+from corbos_scm.filesystem import (
+    link_or_copy, reflink, reflink_or_copy, sha256sum
+)
+
+
+class TestFilesystem:
+    def test_link_or_copy_link(self, tmpdir):
+        source = tmpdir.join('source')
+        source.write('data')
+        target = tmpdir.join('target')
+        target.write('old')
+        assert link_or_copy(source.strpath, target.strpath) == 'link'
+        assert os.stat(target.strpath).st_ino == \
+            os.stat(source.strpath).st_ino
+
+    @patch('corbos_scm.filesystem.reflink')
+    @patch('os.link')
+    def test_link_or_copy_reflink(self, mock_link, mock_reflink, tmpdir):
+        mock_link.side_effect = OSError('EXDEV')
+        assert link_or_copy('source', tmpdir.join('target').strpath) == \
+            'reflink'
+        mock_reflink.assert_called_once_with(
+            'source', tmpdir.join('target').strpath
+        )
+
+    @patch('fcntl.ioctl')
+    @patch('os.link')
+    def test_link_or_copy_copy(self, mock_link, mock_ioctl, tmpdir):
+        mock_link.side_effect = OSError('EXDEV')
+        mock_ioctl.side_effect = OSError('EOPNOTSUPP')
+        source = tmpdir.join('source')
+        source.write('data')
+        target = tmpdir.join('target')
+        assert link_or_copy(source.strpath, target.strpath) == 'copy'
+        assert target.read() == 'data'
+
+    @patch('fcntl.ioctl')
+    def test_reflink_or_copy(self, mock_ioctl, tmpdir):
+        source = tmpdir.join('source')
+        source.write('data')
+        target = tmpdir.join('target')
+        target.write('old')
+        assert reflink_or_copy(source.strpath, target.strpath) == 'reflink'
+        mock_ioctl.side_effect = OSError('EOPNOTSUPP')
+        assert reflink_or_copy(source.strpath, target.strpath) == 'copy'
+        assert target.read() == 'data'
+        assert os.stat(target.strpath).st_ino != \
+            os.stat(source.strpath).st_ino
+
+    @patch('fcntl.ioctl')
+    def test_reflink(self, mock_ioctl, tmpdir):
+        source = tmpdir.join('source')
+        source.write('data')
+        reflink(source.strpath, tmpdir.join('target').strpath)
+        assert mock_ioctl.called
+
+    def test_sha256sum(self, tmpdir):
+        data = tmpdir.join('data')
+        data.write('data')
+        assert sha256sum(data.strpath) == \
+            '3a6eb0790f39ac87c94f3856b2dd2c5d110e6811602261a9a923d3bb23adc8b7'
@@ -0,0 +1,122 @@
+from mock import (
+    patch, Mock
+)
+from pytest import raises
+import json
+
+from corbos_scm.command import command_type
+from corbos_scm.exceptions import (
+    CSCMCommandError,
+    CSCMImageCacheError
+)
+from corbos_scm.image_cache import ImageCache
+
+IMAGE = 'registry.example.com/ubdevtools:latest'
+
+
+def result(output='', returncode=0):
+    return command_type(output=output, error='', returncode=returncode)
+
+
+class TestImageCache:
+    def setup_method(self):
+        self.commands = []
+
+    def _run(self, responses):
+        def run(command, raise_on_error=True, timeout=None):
+            self.commands.append(command)
+            if command[0:2] == ['podman', 'image']:
+                return responses[command[2]]
+            return responses[command[0]]
+        return run
+
+    def _write(self, tmpdir, state):
+        tmpdir.join('images.json').write(json.dumps(state))
+
+    def _read(self, tmpdir):
+        return json.loads(tmpdir.join('images.json').read())
+
+    @patch('corbos_scm.image_cache.Command')
+    def test_pull_no_entry(self, mock_Command, tmpdir):
+        mock_Command.run.side_effect = self._run(
+            {'skopeo': result('sha256:abc\n'), 'podman': result()}
+        )
+        assert ImageCache(tmpdir.strpath).pull(IMAGE) is True
+        assert ['podman', 'pull', IMAGE] in self.commands
+        assert self._read(tmpdir)[IMAGE]['digest'] == 'sha256:abc'
+
+    @patch('time.time')
+    @patch('corbos_scm.image_cache.Command')
+    def test_pull_skipped_within_ttl(self, mock_Command, mock_time, tmpdir):
+        mock_time.return_value = 1100
+        self._write(tmpdir, {IMAGE: {'digest': 'sha256:abc', 'checked': 1000}})
+        mock_Command.run.side_effect = self._run({'exists': result()})
+        assert ImageCache(tmpdir.strpath, ttl=3600).pull(IMAGE) is False
+        assert self.commands == [['podman', 'image', 'exists', IMAGE]]
+
+    @patch('time.time')
+    @patch('corbos_scm.image_cache.Command')
+    def test_pull_skipped_digest_unchanged(
+        self, mock_Command, mock_time, tmpdir
+    ):
+        mock_time.return_value = 5000
+        self._write(tmpdir, {IMAGE: {'digest': 'sha256:abc', 'checked': 1000}})
+        mock_Command.run.side_effect = self._run(
+            {'exists': result(), 'skopeo': result('sha256:abc\n')}
+        )
+        assert ImageCache(tmpdir.strpath, ttl=3600).pull(IMAGE) is False
+        assert self._read(tmpdir)[IMAGE]['checked'] == 5000
+
+    @patch('time.time')
+    @patch('corbos_scm.image_cache.Command')
+    def test_pull_digest_changed(self, mock_Command, mock_time, tmpdir):
+        mock_time.return_value = 5000
+        self._write(tmpdir, {IMAGE: {'digest': 'sha256:abc', 'checked': 1000}})
+        mock_Command.run.side_effect = self._run(
+            {
+                'exists': result(), 'skopeo': result('sha256:new\n'),
+                'podman': result()
+            }
+        )
+        assert ImageCache(tmpdir.strpath, ttl=3600).pull(IMAGE) is True
+        assert self.commands.count(
+            ['skopeo', 'inspect', '--no-tags', '--format', '{{.Digest}}', f'docker://{IMAGE}']
+        ) == 1
+        assert self._read(tmpdir)[IMAGE]['digest'] == 'sha256:new'
+
+    @patch('corbos_scm.image_cache.Command')
+    def test_pull_image_removed_locally(self, mock_Command, tmpdir):
+        self._write(tmpdir, {IMAGE: {'digest': 'sha256:abc', 'checked': 1000}})
+        mock_Command.run.side_effect = self._run(
+            {
+                'exists': result(returncode=1),
+                'skopeo': result(returncode=1),
+                'inspect': result('sha256:local\n'),
+                'podman': result()
+            }
+        )
+        assert ImageCache(tmpdir.strpath).pull(IMAGE) is True
+        assert self._read(tmpdir)[IMAGE]['digest'] == 'sha256:local'
+
+    @patch('corbos_scm.image_cache.Command')
+    def test_get_remote_digest_no_skopeo(self, mock_Command):
+        mock_Command.run.side_effect = CSCMCommandError('not found')
+        assert ImageCache('cache').get_remote_digest(IMAGE) is None
+
+    @patch('corbos_scm.image_cache.Command')
+    def test_pull_unreadable_state(self, mock_Command, tmpdir):
+        tmpdir.join('images.json').write('{garbage')
+        mock_Command.run.side_effect = self._run(
+            {'skopeo': result('sha256:abc\n'), 'podman': result()}
+        )
+        assert ImageCache(tmpdir.strpath).pull(IMAGE) is True
+
+    @patch('corbos_scm.image_cache.Command')
+    def test_pull_write_state_fails(self, mock_Command, tmpdir):
+        mock_Command.run.side_effect = self._run(
+            {'skopeo': result('sha256:abc\n'), 'podman': result()}
+        )
+        image_cache = ImageCache(tmpdir.strpath)
+        with patch('os.replace', Mock(side_effect=OSError('ro'))):
+            with raises(CSCMImageCacheError):
+                image_cache.pull(IMAGE)
@@ -0,0 +1,53 @@
+from pytest import raises
+from mock import patch
+import fcntl
+
+from corbos_scm.exceptions import CSCMLockError
+from corbos_scm.lock import FileLock
+
+
+class TestFileLock:
+    def test_lock_exclusive(self, tmpdir):
+        lock_file = tmpdir.join('sub', 'lock').strpath
+        with patch('fcntl.flock') as mock_flock:
+            with FileLock(lock_file) as lock:
+                assert lock.lock_file
+                fileno = lock.lock_file.fileno()
+                mock_flock.assert_called_once_with(fileno, fcntl.LOCK_EX)
+            assert lock.lock_file is None
+            assert mock_flock.call_args_list[-1][0][1] == fcntl.LOCK_UN
+
+    def test_lock_shared(self, tmpdir):
+        lock_file = tmpdir.join('lock').strpath
+        with patch('fcntl.flock') as mock_flock:
+            with FileLock(lock_file, exclusive=False) as lock:
+                mock_flock.assert_called_once_with(
+                    lock.lock_file.fileno(), fcntl.LOCK_SH
+                )
+
+    def test_lock_real(self, tmpdir):
+        lock_file = tmpdir.join('lock').strpath
+        with FileLock(lock_file):
+            pass
+        with FileLock(lock_file, exclusive=False):
+            with FileLock(lock_file, exclusive=False):
+                pass
+
+    @patch('fcntl.flock')
+    def test_lock_raises(self, mock_flock, tmpdir):
+        mock_flock.side_effect = [OSError('busy'), None]
+        lock = FileLock(tmpdir.join('lock').strpath)
+        with raises(CSCMLockError):
+            lock.acquire()
+        assert lock.lock_file is None
+
+    def test_lock_dir_fails(self, tmpdir):
+        # e.g. a read only cache directory
+        tmpdir.join('file').write('')
+        lock = FileLock(tmpdir.join('file', 'sub', 'lock').strpath)
+        with raises(CSCMLockError):
+            lock.acquire()
+        assert lock.lock_file is None
+
+    def test_release_not_locked(self):
+        FileLock('lock').release()
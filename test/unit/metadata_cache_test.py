@@ -0,0 +1,52 @@
+import logging
+from mock import patch
+from pytest import (
+    fixture, raises
+)
+
+from corbos_scm.sources import (
+    source_package_type, source_file_type
+)
+from corbos_scm.metadata_cache import MetadataCache
+from corbos_scm.exceptions import CSCMMetadataCacheError
+
+
+class TestMetadataCache:
+    @fixture(autouse=True)
+    def inject_fixtures(self, caplog):
+        self._caplog = caplog
+
+    def setup_method(self):
+        self.source = source_package_type(
+            package='curl', version='7.74.0-1.3',
+            directory='pool/main/c/curl', files=[
+                source_file_type('curl_7.74.0-1.3.dsc', 101, 'cccc')
+            ], binaries=['curl', 'libcurl4']
+        )
+
+    def test_put_get(self, tmpdir):
+        cache = MetadataCache(tmpdir.strpath)
+        key = MetadataCache.get_key('container:ubdevtools', 'curl', '7.74.0')
+        assert key == 'container:ubdevtools curl=7.74.0'
+        assert cache.get(key) is None
+        cache.put(key, self.source)
+        assert MetadataCache(tmpdir.strpath).get(key) == self.source
+        assert tmpdir.join('metadata', 'resolved.json').exists()
+
+    def test_get_key_latest(self):
+        assert MetadataCache.get_key('mirror', 'curl') == 'mirror curl=latest'
+
+    def test_unreadable(self, tmpdir):
+        cache = MetadataCache(tmpdir.strpath)
+        tmpdir.join('metadata', 'resolved.json').write('{')
+        with self._caplog.at_level(logging.WARNING):
+            assert cache.get('key') is None
+        assert 'Ignoring unreadable metadata cache' in self._caplog.text
+        cache.put('key', self.source)
+        assert cache.get('key') == self.source
+
+    def test_write_failed(self, tmpdir):
+        cache = MetadataCache(tmpdir.strpath)
+        with patch('os.replace', side_effect=OSError('read-only')):
+            with raises(CSCMMetadataCacheError):
+                cache.put('key', self.source)
@@ -0,0 +1,148 @@
+import logging
+import multiprocessing
+from mock import patch
+from pytest import fixture
+
+from corbos_scm.metrics import (
+    Metrics, read_textfile, format_textfile
+)
+
+
+def count_runs(filename, runs):
+    Metrics.setup(filename)
+    for _ in range(runs):
+        Metrics.inc('corbos_scm_runs_total', {'result': 'success'})
+        Metrics.flush()
+
+
+class TestMetrics:
+    @fixture(autouse=True)
+    def inject_fixtures(self, caplog):
+        self._caplog = caplog
+
+    def setup_method(self):
+        Metrics.setup(None)
+        Metrics.flush()
+
+    def teardown_method(self):
+        Metrics.setup(None)
+
+    def test_flush(self, tmpdir):
+        textfile = tmpdir.join('corbos_scm.prom')
+        Metrics.setup(textfile.strpath)
+        Metrics.inc('corbos_scm_image_pulls_total', {'result': 'skipped'})
+        Metrics.observe('corbos_scm_phase_duration_seconds', 3, {
+            'phase': 'pull'
+        })
+        Metrics.flush()
+        Metrics.inc('corbos_scm_image_pulls_total', {'result': 'skipped'})
+        Metrics.inc('corbos_scm_downloaded_bytes_total', value=1024)
+        Metrics.observe('corbos_scm_phase_duration_seconds', 0.05, {
+            'phase': 'pull'
+        })
+        Metrics.flush()
+        content = textfile.read()
+        assert '# TYPE corbos_scm_image_pulls_total counter\n' \
+            'corbos_scm_image_pulls_total{result="skipped"} 2\n' in content
+        assert 'corbos_scm_downloaded_bytes_total 1024\n' in content
+        assert '# TYPE corbos_scm_phase_duration_seconds histogram\n' \
+            'corbos_scm_phase_duration_seconds_bucket' \
+            '{le="0.1",phase="pull"} 1\n' in content
+        assert 'corbos_scm_phase_duration_seconds_bucket' \
+            '{le="5",phase="pull"} 2\n' in content
+        assert 'corbos_scm_phase_duration_seconds_bucket' \
+            '{le="+Inf",phase="pull"} 2\n' in content
+        assert 'corbos_scm_phase_duration_seconds_sum' \
+            '{phase="pull"} 3.05\n' in content
+        assert 'corbos_scm_phase_duration_seconds_count' \
+            '{phase="pull"} 2\n' in content
+        assert not tmpdir.join('corbos_scm.prom.new').exists()
+
+        # nothing collected, the file is left alone
+        textfile.write('')
+        Metrics.flush()
+        assert textfile.read() == ''
+
+    def test_flush_without_file(self):
+        Metrics.inc('corbos_scm_runs_total')
+        Metrics.flush()
+        assert Metrics.samples == {}
+
+    def test_flush_failed(self, tmpdir):
+        Metrics.setup(tmpdir.join('missing', 'corbos_scm.prom').strpath)
+        Metrics.inc('corbos_scm_runs_total')
+        with self._caplog.at_level(logging.WARNING):
+            Metrics.flush()
+        assert 'Failed to write metrics' in self._caplog.text
+
+    def test_flush_concurrent(self, tmpdir):
+        textfile = tmpdir.join('corbos_scm.prom').strpath
+        context = multiprocessing.get_context('fork')
+        processes = [
+            context.Process(target=count_runs, args=(textfile, 20))
+            for _ in range(4)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        samples, types = read_textfile(textfile)
+        assert samples['corbos_scm_runs_total{result="success"}'] == 80
+        assert types['corbos_scm_runs_total'] == 'counter'
+
+    def test_record_run(self):
+        with patch.object(Metrics, 'observe') as mock_observe:
+            Metrics.record_run(2, ValueError('issue'))
+            mock_observe.assert_called_once_with(
+                'corbos_scm_run_duration_seconds', 2
+            )
+        assert Metrics.samples == {
+            'corbos_scm_runs_total{result="failure"}': 1,
+            'corbos_scm_failures_total{error="ValueError"}': 1
+        }
+        Metrics.flush()
+        Metrics.record_run(2, None)
+        assert 'corbos_scm_runs_total{result="success"}' in Metrics.samples
+
+    def test_read_textfile(self, tmpdir):
+        textfile = tmpdir.join('corbos_scm.prom')
+        assert read_textfile(textfile.strpath) == ({}, {})
+        textfile.write(
+            '# HELP other_total some other tool\n'
+            '# TYPE other_total counter\n'
+            'other_total{path="a\\"b"} 3\n'
+            'broken_total NaNa\n'
+            '# TYPE broken_total\n'
+            '# TYPE broken_total counter extra\n'
+            '\n'
+        )
+        with self._caplog.at_level(logging.WARNING):
+            assert read_textfile(textfile.strpath) == (
+                {'other_total{path="a\\"b"}': 3},
+                {'other_total': 'counter'}
+            )
+        assert 'Ignoring invalid metrics sample' in self._caplog.text
+        assert 'Ignoring invalid metrics type: # TYPE broken_total' in \
+            self._caplog.text
+
+    def test_format_textfile(self):
+        assert format_textfile(
+            {
+                'untyped': 1.5,
+                'duration_seconds_count': 1,
+                'duration_seconds_bucket{le="10"}': 1,
+                'duration_seconds_bucket{le="+Inf"}': 1,
+                'duration_seconds_bucket{le="5"}': 0
+            }, {'duration_seconds': 'histogram'}
+        ) == (
+            '# TYPE duration_seconds histogram\n'
+            'duration_seconds_bucket{le="5"} 0\n'
+            'duration_seconds_bucket{le="10"} 1\n'
+            'duration_seconds_bucket{le="+Inf"} 1\n'
+            'duration_seconds_count 1\n'
+            'untyped 1.5\n'
+        )
+
+    def test_label_escaping(self):
+        Metrics.inc('paths_total', {'path': 'a"b\\c'})
+        assert list(Metrics.samples) == ['paths_total{path="a\\"b\\\\c"}']
@@ -0,0 +1,391 @@
+from mock import (
+    patch, call
+)
+from pytest import (
+    fixture, raises
+)
+import os
+import gzip
+import lzma
+import hashlib
+import logging
+
+from corbos_scm.command import command_type
+from corbos_scm.exceptions import (
+    CSCMMirrorError,
+    CSCMDownloadError,
+    CSCMChecksumError
+)
+from corbos_scm.mirror import Mirror
+from corbos_scm.retry import is_retryable
+from corbos_scm.prefetch import PackagesCache
+from corbos_scm.sources_index import SourcesIndex
+
+WGET = b'''Package: wget
+Binary: wget
+Version: 1.21-1
+Directory: pool/main/w/wget
+Checksums-Sha256:
+ ffff 103 wget_1.21-1.dsc
+'''
+
+
+def publish_index(root, data, files=None, by_hash=False):
+    """
+    Replace the Sources index of the main component of the mirror
+    below root. files maps further paths below the distribution
+    directory to their data, all files are listed in InRelease
+    """
+    dists = os.path.join(root, 'dists', 'hirsute')
+    files = dict(files or {})
+    files.update(
+        {
+            'main/source/Sources': data,
+            'main/source/Sources.gz': gzip.compress(data),
+            'main/source/Sources.xz': lzma.compress(data)
+        }
+    )
+    release = 'Acquire-By-Hash: yes\n' if by_hash else ''
+    release += 'SHA256:\n'
+    for path, file_data in files.items():
+        os.makedirs(os.path.dirname(os.path.join(dists, path)), exist_ok=True)
+        with open(os.path.join(dists, path), 'wb') as dist_file:
+            dist_file.write(file_data)
+        release += ' {0} {1} {2}\n'.format(
+            hashlib.sha256(file_data).hexdigest(), len(file_data), path
+        )
+    with open(os.path.join(dists, 'InRelease'), 'w') as in_release:
+        in_release.write(release)
+
+
+def get_pdiff(old, new, script, download_size=None):
+    """
+    Sources.diff files of one patch turning old into new
+    """
+    name = '2021-12-01-0800.00'
+    patch_data = gzip.compress(script)
+    index = (
+        f'SHA256-Current: {hashlib.sha256(new).hexdigest()} {len(new)}\n'
+        f'SHA256-History:\n'
+        f' {hashlib.sha256(old).hexdigest()} {len(old)} {name}\n'
+        f'SHA256-Patches:\n'
+        f' {hashlib.sha256(script).hexdigest()} {len(script)} {name}\n'
+        f'SHA256-Download:\n'
+        f' {hashlib.sha256(patch_data).hexdigest()} '
+        f'{download_size or len(patch_data)} {name}.gz\n'
+    )
+    return {
+        'main/source/Sources.diff/Index': index.encode(),
+        f'main/source/Sources.diff/{name}.gz': patch_data
+    }
+
+
+class TestMirror:
+    @fixture(autouse=True)
+    def inject_fixtures(self, caplog):
+        self._caplog = caplog
+
+    def test_resolve_and_fetch(self, local_mirror, tmpdir):
+        mirror = Mirror(local_mirror, 'hirsute', ['main'])
+        source = mirror.resolve('curl')
+        assert source.version == '7.74.0-1.3'
+        outdir = tmpdir.mkdir('out')
+        mirror.fetch(source, outdir.strpath)
+        assert sorted(os.listdir(outdir.strpath)) == [
+            'curl_7.74.0-1.3.debian.tar.xz', 'curl_7.74.0-1.3.dsc',
+            'curl_7.74.0.orig.tar.gz'
+        ]
+        assert outdir.join('curl_7.74.0-1.3.debian.tar.xz').read() == 'debian'
+
+    @patch('corbos_scm.mirror.Downloader')
+    def test_fetch_bandwidth_limit(self, mock_Downloader, local_mirror):
+        mirror = Mirror(local_mirror, 'hirsute', ['main'], bandwidth_limit=64)
+        mirror.fetch(mirror.resolve('curl'), 'out')
+        mock_Downloader.assert_called_once_with(4, rate_limit=65536)
+
+    def test_resolve_binary_name(self, local_mirror):
+        mirror = Mirror(local_mirror, 'hirsute', ['main'])
+        assert mirror.resolve('libcurl4').package == 'curl'
+
+    def test_resolve_not_found(self, local_mirror):
+        mirror = Mirror(local_mirror, 'hirsute', ['main'])
+        with raises(CSCMMirrorError):
+            mirror.resolve('vim')
+
+    def test_resolve_version(self, local_mirror):
+        mirror = Mirror(local_mirror, 'hirsute', ['main'])
+        assert mirror.resolve('curl', '7.74.0-1.3').version == '7.74.0-1.3'
+        with raises(CSCMMirrorError, match='curl=7.74.0-1.2 not found'):
+            mirror.resolve('curl', '7.74.0-1.2')
+
+    def test_no_index_for_component(self, local_mirror):
+        mirror = Mirror(local_mirror, 'hirsute', ['universe'])
+        with raises(CSCMMirrorError):
+            mirror.get_sources()
+
+    def test_index_checksum_mismatch(self, local_mirror):
+        index = local_mirror[7:] + '/dists/hirsute/main/source/Sources.xz'
+        with open(index, 'ab') as data:
+            data.write(b'garbage')
+        with raises(CSCMMirrorError):
+            Mirror(local_mirror, 'hirsute', ['main']).get_sources()
+
+    def test_index_corrupt(self, local_mirror):
+        mirror = Mirror(local_mirror, 'hirsute', ['main'])
+        data = b'Package: curl\n'
+        for index_name, corrupt in [
+            ('Sources.xz', b'garbage'),
+            ('Sources.xz', lzma.compress(data)[:-8]),
+            ('Sources.gz', gzip.compress(data)[:-8])
+        ]:
+            mirror.index_names = [index_name]
+            with patch.object(Mirror, '_fetch_verified', return_value=corrupt):
+                with raises(CSCMMirrorError) as issue:
+                    mirror.get_sources()
+            assert str(issue.value).startswith(
+                f'Corrupt index main/source/{index_name}:'
+            )
+            assert is_retryable(issue.value)
+
+    def test_plain_index(self, local_mirror):
+        mirror = Mirror(local_mirror, 'hirsute', ['main'])
+        mirror.index_names = ['Sources.gz']
+        assert mirror.resolve('curl').package == 'curl'
+        mirror.index_names = ['Sources']
+        assert mirror.resolve('curl').package == 'curl'
+
+    def test_fetch_size_mismatch(self, local_mirror, tmpdir):
+        mirror = Mirror(local_mirror, 'hirsute', ['main'])
+        source = mirror.resolve('curl')
+        source.files[0] = source.files[0]._replace(size=1)
+        with raises(CSCMChecksumError):
+            mirror.fetch(source, tmpdir.strpath)
+
+    def test_fetch_checksum_mismatch(self, local_mirror, tmpdir):
+        mirror = Mirror(local_mirror, 'hirsute', ['main'])
+        source = mirror.resolve('curl')
+        source.files[0] = source.files[0]._replace(sha256='0000')
+        with raises(CSCMChecksumError):
+            mirror.fetch(source, tmpdir.strpath)
+        assert not tmpdir.join(source.files[0].name).exists()
+
+    def test_fetch_missing_file(self, local_mirror, tmpdir):
+        mirror = Mirror(local_mirror, 'hirsute', ['main'])
+        source = mirror.resolve('curl')
+        source.files[0] = source.files[0]._replace(name='missing')
+        with raises(CSCMDownloadError):
+            mirror.fetch(source, tmpdir.strpath)
+
+    @patch('corbos_scm.mirror.Command')
+    def test_signature(self, mock_Command, local_mirror):
+        # only the verified data as written by gpgv is read
+        mock_Command.run.return_value = command_type(
+            output='SHA256:\n aaaa 1 main/source/Sources\n', error='',
+            returncode=0
+        )
+        mirror = Mirror(local_mirror, 'hirsute', ['main'], 'keyring.gpg')
+        assert mirror.get_release() == {
+            'main/source/Sources': (1, 'aaaa')
+        }
+        command = mock_Command.run.call_args[0][0]
+        assert command[0:5] == [
+            'gpgv', '--keyring', 'keyring.gpg', '--output', '-'
+        ]
+        mock_Command.run.return_value = command_type(
+            output='', error='BAD signature', returncode=1
+        )
+        with raises(CSCMMirrorError):
+            mirror.get_release()
+
+    @patch('corbos_scm.mirror.fetch_url')
+    def test_update_index_without_index(self, mock_fetch_url, local_mirror):
+        Mirror(local_mirror, 'hirsute', ['main']).update_index()
+        assert not mock_fetch_url.called
+
+    @patch('corbos_scm.mirror.Metrics')
+    def test_resolve_indexed(self, mock_Metrics, local_mirror, tmpdir):
+        sources_index = SourcesIndex(tmpdir.join('cache').strpath)
+        mirror = Mirror(
+            local_mirror, 'hirsute', ['main'], sources_index=sources_index
+        )
+        assert mirror.resolve('libcurl4').version == '7.74.0-1.3'
+        os.unlink(local_mirror[7:] + '/dists/hirsute/InRelease')
+        # a fresh index is used without reading the mirror
+        assert mirror.resolve('curl').version == '7.74.0-1.3'
+        with raises(CSCMMirrorError, match='vim not found'):
+            mirror.resolve('vim')
+        assert mock_Metrics.inc.call_args_list[:2] == [
+            call('corbos_scm_sources_index_total', {'result': 'full'}),
+            call('corbos_scm_sources_index_total', {'result': 'fresh'})
+        ]
+
+    @patch('corbos_scm.mirror.Metrics')
+    def test_resolve_indexed_update(self, mock_Metrics, local_mirror, tmpdir):
+        root = local_mirror[7:]
+        sources_index = SourcesIndex(tmpdir.join('cache').strpath, ttl=0)
+        mirror = Mirror(
+            local_mirror, 'hirsute', ['main'], sources_index=sources_index
+        )
+        mirror.update_index()
+        old = sources_index.read_sources(mirror.get_origin('main'))
+        mirror.update_index()
+        new = old + b'\n' + WGET
+        publish_index(root, new)
+        assert mirror.resolve('wget').version == '1.21-1'
+        # without a plain Sources in InRelease the state is only
+        # known after the download
+        publish_index(root, new)
+        os.unlink(root + '/dists/hirsute/main/source/Sources')
+        with open(root + '/dists/hirsute/InRelease') as in_release:
+            release = in_release.read()
+        with open(root + '/dists/hirsute/InRelease', 'w') as in_release:
+            in_release.write(
+                ''.join(
+                    line + '\n' for line in release.splitlines()
+                    if not line.endswith('/Sources')
+                )
+            )
+        mirror.update_index()
+        assert [
+            index_call[0][1]['result'] for index_call in
+            mock_Metrics.inc.call_args_list
+        ] == ['full', 'unchanged', 'full', 'unchanged']
+
+    @patch('corbos_scm.mirror.Metrics')
+    def test_resolve_pdiff(self, mock_Metrics, local_mirror, tmpdir):
+        root = local_mirror[7:]
+        sources_index = SourcesIndex(tmpdir.join('cache').strpath, ttl=0)
+        mirror = Mirror(
+            local_mirror, 'hirsute', ['main'], sources_index=sources_index
+        )
+        mirror.update_index()
+        origin = mirror.get_origin('main')
+        old = sources_index.read_sources(origin)
+        new = old + b'\n' + WGET
+        lines = len(old.splitlines())
+        script = f'{lines}a\n'.encode() + b'\n' + WGET + b'.\n'
+        publish_index(root, new, get_pdiff(old, new, script))
+        assert mirror.resolve('wget').version == '1.21-1'
+        assert sources_index.read_sources(origin) == new
+        assert mock_Metrics.inc.call_args == call(
+            'corbos_scm_sources_index_total', {'result': 'pdiff'}
+        )
+
+    @patch('corbos_scm.mirror.Metrics')
+    def test_resolve_pdiff_fallback(
+        self, mock_Metrics, local_mirror, tmpdir
+    ):
+        root = local_mirror[7:]
+        sources_index = SourcesIndex(tmpdir.join('cache').strpath, ttl=0)
+        mirror = Mirror(
+            local_mirror, 'hirsute', ['main'], sources_index=sources_index
+        )
+        mirror.update_index()
+        origin = mirror.get_origin('main')
+        old = sources_index.read_sources(origin)
+        new = old + b'\n' + WGET
+        # patches larger than the index are not used
+        publish_index(
+            root, new, get_pdiff(old, new, b'1d\n', download_size=1 << 20)
+        )
+        mirror.update_index()
+        assert sources_index.read_sources(origin) == new
+        # a patch giving a different result is not used
+        newer = new.replace(b'1.21-1', b'1.21-2')
+        publish_index(root, newer, get_pdiff(new, newer, b'1d\n'))
+        with self._caplog.at_level(logging.WARNING):
+            mirror.update_index()
+        assert 'Falling back to full index download' in self._caplog.text
+        assert sources_index.read_sources(origin) == newer
+        # an unknown state has no patches
+        publish_index(root, new, get_pdiff(old, new, b'1d\n'))
+        mirror.update_index()
+        assert sources_index.read_sources(origin) == new
+        assert [
+            index_call[0][1]['result'] for index_call in
+            mock_Metrics.inc.call_args_list
+        ] == ['full', 'full', 'full', 'full']
+
+    def test_pdiff_patch_mismatch(self, local_mirror, tmpdir):
+        root = local_mirror[7:]
+        sources_index = SourcesIndex(tmpdir.join('cache').strpath, ttl=0)
+        mirror = Mirror(
+            local_mirror, 'hirsute', ['main'], sources_index=sources_index
+        )
+        mirror.update_index()
+        origin = mirror.get_origin('main')
+        old = sources_index.read_sources(origin)
+        new = old + b'\n' + WGET
+        files = get_pdiff(old, new, b'1d\n')
+        files['main/source/Sources.diff/Index'] = files[
+            'main/source/Sources.diff/Index'
+        ].replace(b' 3 2021', b' 4 2021')
+        publish_index(root, new, files)
+        with self._caplog.at_level(logging.WARNING):
+            mirror.update_index()
+        assert 'Checksum mismatch for 2021-12-01-0800.00' in self._caplog.text
+        assert sources_index.read_sources(origin) == new
+
+    def test_by_hash(self, local_mirror):
+        root = local_mirror[7:]
+        dists = root + '/dists/hirsute/main/source'
+        with open(dists + '/Sources', 'rb') as sources:
+            data = sources.read()
+        publish_index(root, data, by_hash=True)
+        mirror = Mirror(local_mirror, 'hirsute', ['main'])
+        # no by-hash files, the named index is used
+        assert mirror.resolve('curl').package == 'curl'
+        assert mirror.by_hash
+        os.makedirs(dists + '/by-hash/SHA256')
+        compressed = lzma.compress(data)
+        sha256 = hashlib.sha256(compressed).hexdigest()
+        with open(dists + '/Sources.xz', 'rb') as sources:
+            published = sources.read()
+        with open(dists + f'/by-hash/SHA256/{sha256}', 'wb') as by_hash:
+            by_hash.write(published)
+        with open(dists + '/Sources.xz', 'wb') as sources:
+            sources.write(b'garbage')
+        assert mirror.resolve('curl').package == 'curl'
+        os.unlink(dists + f'/by-hash/SHA256/{sha256}')
+        with raises(CSCMMirrorError, match='Checksum mismatch'):
+            mirror.resolve('curl')
+        os.unlink(dists + '/Sources.xz')
+        with raises(CSCMDownloadError):
+            mirror.resolve('curl')
+
+    def test_get_packages(self, local_mirror, tmpdir):
+        root = local_mirror[7:]
+        with open(root + '/dists/hirsute/main/source/Sources', 'rb') as sources:
+            data = sources.read()
+        libc6 = b'Package: libc6\nVersion: 2.33\nFilename: pool/l/libc6.deb\n'
+        perl = b'Package: perl-modules\nVersion: 5.32\nFilename: pool/p/pm.deb\n'
+        publish_index(
+            root, data, {
+                'main/binary-amd64/Packages.xz': lzma.compress(libc6),
+                'main/binary-amd64/Packages': libc6,
+                'main/binary-all/Packages.gz': gzip.compress(perl)
+            }
+        )
+        mirror = Mirror(local_mirror, 'hirsute', ['main'])
+        assert [
+            package.package for package in mirror.get_packages('amd64')
+        ] == ['libc6', 'perl-modules']
+        with raises(CSCMMirrorError, match='No index for main/binary-arm64'):
+            mirror.get_packages('arm64')
+
+        # the parsed index is reused while its checksum is unchanged
+        packages_cache = PackagesCache(tmpdir.strpath)
+        mirror.get_packages('amd64', packages_cache)
+        assert os.path.exists(
+            packages_cache.get_index_file(hashlib.sha256(libc6).hexdigest())
+        )
+        with patch.object(Mirror, '_get_index_data') as mock_get_index_data:
+            mock_get_index_data.return_value = perl
+            assert [
+                package.package
+                for package in mirror.get_packages('amd64', packages_cache)
+            ] == ['libc6', 'perl-modules']
+            mock_get_index_data.assert_called_once_with(
+                mirror.get_release(), 'main/binary-all',
+                mirror.packages_index_names
+            )
@@ -0,0 +1,133 @@
+from corbos_scm.packages import (
+    parse_packages, parse_relations, get_build_depends, satisfies,
+    format_relation, relation_type, binary_package_type
+)
+
+PACKAGES = '''Package: libc6
+Version: 2.33-0ubuntu5
+Architecture: amd64
+Filename: pool/main/g/glibc/libc6_2.33-0ubuntu5_amd64.deb
+Size: 2500
+SHA256: aaaa
+
+Package: debhelper
+Version: 13.3.4ubuntu1
+Architecture: all
+Pre-Depends: dpkg (>= 1.16)
+Depends: perl:any,
+ libdebhelper-perl (= 13.3.4ubuntu1)
+Provides: debhelper-compat (= 13)
+Filename: pool/main/d/debhelper/debhelper_13.3.4ubuntu1_all.deb
+Size: 1000
+SHA256: bbbb
+
+Package: broken
+Version: 1.0
+'''
+
+DSC = '''-----BEGIN PGP SIGNED MESSAGE-----
+Hash: SHA512
+
+Format: 3.0 (quilt)
+Source: curl
+Version: 7.74.0-1.3
+Build-Depends: debhelper-compat (= 13), libssl-dev <!pkg.curl.openssl>,
+ libidn2-dev [linux-any]
+Build-Depends-Indep: python3:native <!nodoc>
+'''
+
+
+class TestPackages:
+    def test_parse_packages(self):
+        assert parse_packages(PACKAGES) == [
+            binary_package_type(
+                package='libc6', version='2.33-0ubuntu5',
+                architecture='amd64',
+                filename='pool/main/g/glibc/libc6_2.33-0ubuntu5_amd64.deb',
+                size=2500, sha256='aaaa', depends='', provides=''
+            ),
+            binary_package_type(
+                package='debhelper', version='13.3.4ubuntu1',
+                architecture='all',
+                filename='pool/main/d/debhelper/'
+                'debhelper_13.3.4ubuntu1_all.deb',
+                size=1000, sha256='bbbb',
+                depends='dpkg (>= 1.16), perl:any,\n'
+                'libdebhelper-perl (= 13.3.4ubuntu1)',
+                provides='debhelper-compat (= 13)'
+            )
+        ]
+
+    def test_parse_relations(self):
+        assert parse_relations(
+            'libc6 (>= 2.33), perl:any | perl-base (>>5.30), (broken', 'amd64'
+        ) == [
+            [relation_type('libc6', '>=', '2.33')],
+            [
+                relation_type('perl', None, None),
+                relation_type('perl-base', '>>', '5.30')
+            ]
+        ]
+
+    def test_parse_relations_architectures(self):
+        value = 'a [amd64], b [!amd64], c [linux-any], d [any-arm64], ' \
+            'e [i386 armhf] | f, g [!hurd-any !kfreebsd-any]'
+        assert [
+            relation[0].name for relation in parse_relations(value, 'amd64')
+        ] == ['a', 'c', 'f', 'g']
+        assert [
+            relation[0].name for relation in parse_relations(value, 'arm64')
+        ] == ['b', 'c', 'd', 'f', 'g']
+        assert [
+            relation[0].name
+            for relation in parse_relations(value, 'hurd-i386')
+        ] == ['b', 'f']
+
+    def test_parse_relations_profiles(self):
+        value = 'a <!nocheck>, b <nocheck>, c <stage1 cross> <nodoc>, ' \
+            'd <!stage1 !cross>'
+        assert [
+            relation[0].name for relation in parse_relations(value, 'amd64')
+        ] == ['a', 'd']
+        assert [
+            relation[0].name for relation in parse_relations(
+                value, 'amd64', ['nocheck', 'stage1']
+            )
+        ] == ['b']
+        assert [
+            relation[0].name for relation in parse_relations(
+                value, 'amd64', ['stage1', 'cross']
+            )
+        ] == ['a', 'c']
+
+    def test_get_build_depends(self):
+        assert get_build_depends(DSC, 'amd64') == [
+            [relation_type('debhelper-compat', '=', '13')],
+            [relation_type('libssl-dev', None, None)],
+            [relation_type('libidn2-dev', None, None)],
+            [relation_type('python3', None, None)]
+        ]
+        assert get_build_depends(DSC, 'amd64', ['nodoc']) == [
+            [relation_type('debhelper-compat', '=', '13')],
+            [relation_type('libssl-dev', None, None)],
+            [relation_type('libidn2-dev', None, None)]
+        ]
+        assert get_build_depends('', 'amd64') == []
+
+    def test_satisfies(self):
+        assert satisfies('1.0', relation_type('a', None, None))
+        assert satisfies('1.0', relation_type('a', '>=', '1.0'))
+        assert not satisfies('1.0', relation_type('a', '>>', '1.0'))
+        assert satisfies('1.0', relation_type('a', '<<', '1.0+b1'))
+        assert satisfies('1.0', relation_type('a', '<=', '1.0'))
+        assert satisfies('1:0.1', relation_type('a', '=', '1:0.1'))
+        assert satisfies('1.0', relation_type('a', '>', '1.0'))
+        assert not satisfies('1.1', relation_type('a', '<', '1.0'))
+
+    def test_format_relation(self):
+        assert format_relation(
+            [
+                relation_type('libssl-dev', '>=', '1.1'),
+                relation_type('libgnutls28-dev', None, None)
+            ]
+        ) == 'libssl-dev (>= 1.1) | libgnutls28-dev'
@@ -0,0 +1,90 @@
+from pytest import raises
+
+from corbos_scm.pdiff import (
+    get_patches, apply_ed_script, pdiff_patch_type
+)
+from corbos_scm.exceptions import CSCMPdiffError
+
+INDEX = '''SHA256-Current: cccc 300
+SHA256-History:
+ aaaa 100 2021-12-01-0800.00
+ bbbb 200 2021-12-01-1400.00
+SHA256-Patches:
+ 1111 10 2021-12-01-0800.00
+ 2222 20 2021-12-01-1400.00
+SHA256-Download:
+ 3333 30 2021-12-01-0800.00.gz
+ 4444 40 2021-12-01-1400.00.gz
+'''
+
+MERGED = '''SHA256-Current: cccc 300
+SHA256-History:
+ aaaa 100 T-2021-12-01-0800.00-F-2021-12-01-0800.00
+ bbbb 200 T-2021-12-01-1400.00-F-2021-12-01-1400.00
+SHA256-Patches:
+ 1111 10 T-2021-12-01-0800.00-F-2021-12-01-0800.00
+ 2222 20 T-2021-12-01-1400.00-F-2021-12-01-1400.00
+SHA256-Download:
+ 3333 30 T-2021-12-01-0800.00-F-2021-12-01-0800.00.gz
+ 4444 40 T-2021-12-01-1400.00-F-2021-12-01-1400.00.gz
+X-Patch-Precedence: merged
+'''
+
+
+class TestPdiff:
+    def test_get_patches(self):
+        assert get_patches(INDEX, 'aaaa') == [
+            pdiff_patch_type(
+                name='2021-12-01-0800.00', size=10, sha256='1111',
+                download_size=30, download_sha256='3333'
+            ),
+            pdiff_patch_type(
+                name='2021-12-01-1400.00', size=20, sha256='2222',
+                download_size=40, download_sha256='4444'
+            )
+        ]
+        assert [patch.name for patch in get_patches(INDEX, 'bbbb')] == [
+            '2021-12-01-1400.00'
+        ]
+
+    def test_get_patches_merged(self):
+        assert [patch.name for patch in get_patches(MERGED, 'aaaa')] == [
+            'T-2021-12-01-0800.00-F-2021-12-01-0800.00'
+        ]
+
+    def test_get_patches_unknown_state(self):
+        assert get_patches(INDEX, 'cccc') is None
+        assert get_patches('', 'aaaa') is None
+
+    def test_get_patches_missing_patch(self):
+        index = INDEX.replace(' 4444 40 2021-12-01-1400.00.gz\n', '')
+        assert get_patches(index, 'aaaa') is None
+        assert get_patches(index, 'bbbb') is None
+
+    def test_apply_ed_script(self):
+        data = b'one\ntwo\nthree\nfour\nfive\n'
+        script = b'5a\nsix\n.\n3,4c\nTHREE\n.\n1d\n'
+        assert apply_ed_script(data, script) == \
+            b'two\nTHREE\nfive\nsix\n'
+
+    def test_apply_ed_script_dot_line(self):
+        # diff --ed writes a line consisting of a dot as two dots
+        # and substitutes them after the text
+        data = b'one\ntwo\n'
+        script = b'1a\n..\n.\ns/.//\na\nafter\n.\n'
+        assert apply_ed_script(data, script) == b'one\n.\nafter\ntwo\n'
+
+    def test_apply_ed_script_errors(self):
+        data = b'one\ntwo\n'
+        with raises(CSCMPdiffError, match='Unsupported'):
+            apply_ed_script(data, b'1i\nzero\n.\n')
+        with raises(CSCMPdiffError, match='out of order'):
+            apply_ed_script(data, b'1d\n2d\n')
+        with raises(CSCMPdiffError, match='out of order'):
+            apply_ed_script(data, b'5d\n')
+        with raises(CSCMPdiffError, match='Unterminated'):
+            apply_ed_script(data, b'1a\nzero\n')
+        with raises(CSCMPdiffError, match='Substitution'):
+            apply_ed_script(data, b's/.//\n')
+        with raises(CSCMPdiffError, match='Append'):
+            apply_ed_script(data, b'a\nzero\n.\n')
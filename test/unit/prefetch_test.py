@@ -0,0 +1,242 @@
+from mock import patch
+from pytest import (
+    fixture, raises
+)
+import os
+import json
+import time
+import hashlib
+import logging
+
+from corbos_scm.packages import (
+    binary_package_type, parse_relations
+)
+from corbos_scm.sources import source_package_type
+from corbos_scm.exceptions import (
+    CSCMPrefetchError,
+    CSCMChecksumError
+)
+from corbos_scm.prefetch import (
+    PackagesCache, BuildDepsResolver, write_manifest, warm_packages
+)
+
+
+def binary(package, version='1.0', depends='', provides='', data=None):
+    data = data or f'{package} {version}'.encode()
+    return binary_package_type(
+        package=package, version=version, architecture='amd64',
+        filename=f'pool/main/{package[0]}/{package}_{version}_amd64.deb',
+        size=len(data), sha256=hashlib.sha256(data).hexdigest(),
+        depends=depends, provides=provides
+    )
+
+
+PACKAGES = [
+    binary('libc6', '2.33'),
+    binary('libc6', '2.34'),
+    binary('libssl3', depends='libc6 (>= 2.34)'),
+    binary('libssl-dev', depends='libssl3 (= 1.0)'),
+    binary(
+        'debhelper', depends='perl, dh-autoreconf',
+        provides='debhelper-compat (= 12), debhelper-compat (= 13)'
+    ),
+    binary('perl', depends='perl-base'),
+    binary('perl-base', depends='libc6'),
+    binary('dh-autoreconf', depends='autoconf | autoconf2.69'),
+    binary('autoconf2.69'),
+    binary('mawk', provides='awk'),
+    binary('gawk', provides='awk'),
+    binary('libgnutls-dev', version='3.0', provides='libssl-dev (= 0.9)')
+]
+
+
+class TestPackagesCache:
+    @fixture(autouse=True)
+    def inject_fixtures(self, caplog):
+        self._caplog = caplog
+
+    def setup_method(self):
+        self.packages = [binary('libc6'), binary('perl')]
+
+    def test_put_and_get(self, tmpdir):
+        cache = PackagesCache(tmpdir.strpath)
+        assert cache.get('aaaa') is None
+        cache.put('aaaa', self.packages)
+        assert cache.get('aaaa') == self.packages
+        assert tmpdir.join('packages').listdir() == [
+            tmpdir.join('packages', 'aaaa.json')
+        ]
+
+    def test_unused_index_removed(self, tmpdir):
+        cache = PackagesCache(tmpdir.strpath, max_age=60)
+        cache.put('aaaa', self.packages)
+        old = time.time() - 120
+        os.utime(cache.get_index_file('aaaa'), (old, old))
+        cache.put('bbbb', self.packages)
+        assert cache.get('aaaa') is None
+        assert cache.get('bbbb') == self.packages
+
+    def test_unreadable_index(self, tmpdir):
+        cache = PackagesCache(tmpdir.strpath)
+        with open(cache.get_index_file('aaaa'), 'w') as index:
+            index.write('[[1]]')
+        with self._caplog.at_level(logging.WARNING):
+            assert cache.get('aaaa') is None
+        assert 'Ignoring unreadable packages cache' in self._caplog.text
+
+    @patch('corbos_scm.prefetch.os.replace')
+    def test_write_failure(self, mock_replace, tmpdir):
+        mock_replace.side_effect = OSError('disk full')
+        cache = PackagesCache(tmpdir.strpath)
+        with self._caplog.at_level(logging.WARNING):
+            cache.put('aaaa', self.packages)
+        assert 'Failed to write packages cache' in self._caplog.text
+        assert cache.get('aaaa') is None
+        assert tmpdir.join('packages').listdir() == []
+
+    def test_expire_concurrent(self, tmpdir):
+        cache = PackagesCache(tmpdir.strpath, max_age=60)
+        old = time.time() - 120
+        for name in ['gone.json', '.incoming.other', 'aaaa.json']:
+            tmpdir.join('packages', name).write('[]')
+            os.utime(tmpdir.join('packages', name).strpath, (old, old))
+        getmtime = os.path.getmtime
+
+        def removed_meanwhile(filename):
+            if filename.endswith('gone.json'):
+                raise FileNotFoundError(filename)
+            return getmtime(filename)
+
+        with patch(
+            'corbos_scm.prefetch.os.path.getmtime',
+            side_effect=removed_meanwhile
+        ):
+            cache.put('bbbb', self.packages)
+        # the file written by a concurrent call is left alone
+        assert sorted(
+            path.basename for path in tmpdir.join('packages').listdir()
+        ) == ['.incoming.other', 'bbbb.json', 'gone.json']
+
+
+class TestBuildDepsResolver:
+    def setup_method(self):
+        self.resolver = BuildDepsResolver(PACKAGES, 'amd64')
+
+    def resolve(self, value):
+        selected, unresolved = self.resolver.resolve(
+            parse_relations(value, 'amd64')
+        )
+        return [
+            f'{package.package}={package.version}' for package in selected
+        ], unresolved
+
+    def test_closure(self):
+        assert self.resolve('debhelper-compat (= 13), libssl-dev') == ([
+            'autoconf2.69=1.0', 'debhelper=1.0', 'dh-autoreconf=1.0',
+            'libc6=2.34', 'libssl-dev=1.0', 'libssl3=1.0', 'perl=1.0',
+            'perl-base=1.0'
+        ], [])
+
+    def test_selected_package_satisfies_relation(self):
+        assert self.resolve('libc6 (>= 2.0), libc6, perl-base') == (
+            ['libc6=2.34', 'perl-base=1.0'], []
+        )
+
+    def test_virtual_package(self):
+        # one provider is selected, by name if there are several
+        assert self.resolve('awk, mawk | gawk') == (['gawk=1.0'], [])
+        assert self.resolve('mawk, awk') == (['mawk=1.0'], [])
+
+    def test_versioned_provides(self):
+        assert self.resolve('debhelper-compat (= 12)')[0][1] == 'debhelper=1.0'
+        assert self.resolve('debhelper-compat (>= 14)') == (
+            [], ['debhelper-compat (>= 14)']
+        )
+        assert self.resolve('awk (>= 1)') == ([], ['awk (>= 1)'])
+        assert self.resolve('libssl-dev (<< 1.0)') == (
+            ['libgnutls-dev=3.0'], []
+        )
+
+    def test_unresolved(self):
+        assert self.resolve('missing | libc6 (>= 3), libc6 (<< 2.34)') == (
+            ['libc6=2.33'], ['missing | libc6 (>= 3)']
+        )
+        # libc6 is selected in one version only
+        assert self.resolve('libc6, libc6 (<< 2.34)') == (
+            ['libc6=2.34'], ['libc6 (<< 2.34)']
+        )
+
+
+class TestManifest:
+    def setup_method(self):
+        self.source = source_package_type(
+            package='curl', version='7.74.0-1.3',
+            directory='pool/main/c/curl', files=[], binaries=['curl']
+        )
+
+    def test_write_manifest(self, tmpdir):
+        manifest = tmpdir.join('prefetch.json')
+        write_manifest(
+            manifest.strpath, self.source, 'amd64', 'http://mirror',
+            [PACKAGES[0]], ['missing']
+        )
+        assert json.loads(manifest.read()) == {
+            'source': 'curl',
+            'version': '7.74.0-1.3',
+            'architecture': 'amd64',
+            'packages': [
+                {
+                    'package': 'libc6',
+                    'version': '2.33',
+                    'architecture': 'amd64',
+                    'url': 'http://mirror/pool/main/l/libc6_2.33_amd64.deb',
+                    'size': PACKAGES[0].size,
+                    'sha256': PACKAGES[0].sha256
+                }
+            ],
+            'unresolved': ['missing']
+        }
+
+    def test_write_manifest_failure(self, tmpdir):
+        with raises(CSCMPrefetchError):
+            write_manifest(
+                tmpdir.join('missing', 'prefetch.json').strpath,
+                self.source, 'amd64', 'http://mirror', [], []
+            )
+
+
+class TestWarmPackages:
+    def setup_method(self):
+        self.packages = [binary('libc6'), binary('perl')]
+
+    def publish(self, root, packages):
+        for package in packages:
+            filename = os.path.join(root, package.filename)
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with open(filename, 'wb') as deb:
+                deb.write(f'{package.package} {package.version}'.encode())
+
+    def test_warm_packages(self, tmpdir):
+        mirror = tmpdir.mkdir('mirror').strpath
+        self.publish(mirror, self.packages)
+        target = tmpdir.join('debs')
+        warm_packages(f'file://{mirror}', self.packages, target.strpath)
+        assert sorted(target.listdir()) == [
+            target.join('libc6_1.0_amd64.deb'),
+            target.join('perl_1.0_amd64.deb')
+        ]
+
+        # present packages are not downloaded again
+        with patch('corbos_scm.prefetch.Downloader') as mock_Downloader:
+            warm_packages(f'file://{mirror}', self.packages, target.strpath)
+        downloader = mock_Downloader.return_value.__enter__.return_value
+        downloader.download_all.assert_called_once_with([])
+
+    def test_warm_packages_checksum_mismatch(self, tmpdir):
+        mirror = tmpdir.mkdir('mirror').strpath
+        self.publish(mirror, [binary('libc6')])
+        with raises(CSCMChecksumError):
+            warm_packages(
+                f'file://{mirror}', [binary('libc6', data=b'other data')],
+                tmpdir.join('debs').strpath
+            )
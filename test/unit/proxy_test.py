@@ -0,0 +1,492 @@
+import os
+import sys
+import time
+import hashlib
+import logging
+import threading
+from http.client import (
+    HTTPConnection, IncompleteRead
+)
+from urllib.error import (
+    HTTPError, URLError
+)
+from urllib.request import (
+    Request, ProxyHandler, build_opener
+)
+from mock import (
+    patch, MagicMock
+)
+from pytest import (
+    fixture, raises
+)
+
+from corbos_scm.proxy import (
+    main, ProxyCache, ProxyServer, ProxyRequestHandler, ArchiveRedirectHandler,
+    get_expiry, is_cacheable, is_archive_path, is_immutable, is_allowed_host,
+    get_listen_host, start_proxy
+)
+from corbos_scm.command import command_type
+from corbos_scm.exceptions import (
+    CSCMCommandError,
+    CSCMProxyError
+)
+
+POOL = '/ubuntu/pool/main/c/curl/curl_7.74.0.orig.tar.gz'
+RELEASE = '/ubuntu/dists/hirsute/InRelease'
+
+
+class TestProxy:
+    @fixture(autouse=True)
+    def inject_fixtures(self, caplog):
+        self._caplog = caplog
+
+    @fixture
+    def proxy(self, tmpdir):
+        """
+        Caching proxy in front of the local stand-in mirror
+        """
+        cache = ProxyCache(tmpdir.join('cache').strpath, 1024 * 1024)
+        server = ProxyServer(('127.0.0.1', 0), cache, ['127.0.0.1'])
+        thread = threading.Thread(
+            target=server.serve_forever, kwargs={'poll_interval': 0.05},
+            daemon=True
+        )
+        thread.start()
+        yield server
+        server.shutdown()
+        server.server_close()
+
+    def publish(self, http_server, path, data):
+        filename = os.path.join(http_server.directory, path.lstrip('/'))
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, 'wb') as published:
+            published.write(data)
+
+    def get(self, proxy, url, headers=None):
+        opener = build_opener(
+            ProxyHandler(
+                {'http': f'http://127.0.0.1:{proxy.server_address[1]}'}
+            )
+        )
+        with opener.open(Request(url, headers=headers or {})) as response:
+            result = response.status, response.headers, response.read()
+        # the response is stored after it was sent to the client
+        while proxy.cache.url_locks:
+            time.sleep(0.01)
+        return result
+
+    def get_upstream_requests(self, http_server, path):
+        return [request for request in http_server.requests if request[0] == path]
+
+    def test_pool_file_cached(self, proxy, http_server):
+        data = b'orig' * 50000
+        self.publish(http_server, POOL, data)
+        for _ in range(3):
+            status, headers, body = self.get(proxy, http_server.uri + POOL)
+            assert status == 200
+            assert body == data
+        assert len(self.get_upstream_requests(http_server, POOL)) == 1
+        assert os.path.exists(
+            proxy.cache.get_object(hashlib.sha256(data).hexdigest())
+        )
+
+    def test_same_content_stored_once(self, proxy, http_server):
+        data = b'orig'
+        for path in [POOL, '/debian' + POOL[7:]]:
+            self.publish(http_server, path, data)
+            assert self.get(proxy, http_server.uri + path)[2] == data
+        assert len(proxy.cache.index) == 2
+        assert len(os.listdir(proxy.cache.objects_dir)) == 1
+
+    def test_release_revalidated(self, proxy, http_server):
+        self.publish(http_server, RELEASE, b'release 1')
+        http_server.headers[RELEASE] = {
+            'ETag': '"1"', 'Last-Modified': 'Sat, 18 Dec 2021 16:10:08 GMT'
+        }
+        assert self.get(proxy, http_server.uri + RELEASE)[2] == b'release 1'
+        status, headers, body = self.get(proxy, http_server.uri + RELEASE)
+        assert body == b'release 1'
+        assert headers['ETag'] == '"1"'
+        assert len(self.get_upstream_requests(http_server, RELEASE)) == 2
+        # the archive was updated
+        self.publish(http_server, RELEASE, b'release 2')
+        http_server.headers[RELEASE] = {'ETag': '"2"'}
+        assert self.get(proxy, http_server.uri + RELEASE)[2] == b'release 2'
+        assert proxy.cache.get(http_server.uri + RELEASE)['etag'] == '"2"'
+
+    def test_release_evicted_while_revalidated(self, proxy, http_server):
+        self.publish(http_server, RELEASE, b'release')
+        http_server.headers[RELEASE] = {'ETag': '"1"'}
+        assert self.get(proxy, http_server.uri + RELEASE)[2] == b'release'
+        refresh = proxy.cache.refresh
+
+        def evicting_refresh(url, headers):
+            del proxy.cache.index[url]
+            return refresh(url, headers)
+
+        with patch.object(proxy.cache, 'refresh', side_effect=evicting_refresh):
+            assert self.get(proxy, http_server.uri + RELEASE)[2] == b'release'
+        # the revalidation is followed by a full fetch
+        assert [
+            request[0] for request in http_server.requests
+        ] == [RELEASE] * 3
+        assert proxy.cache.get(http_server.uri + RELEASE)['etag'] == '"1"'
+        assert proxy.cache.refresh('http://mirror' + RELEASE, {}) is None
+
+    def test_release_fresh_by_max_age(self, proxy, http_server):
+        self.publish(http_server, RELEASE, b'release')
+        http_server.headers[RELEASE] = {
+            'ETag': '"1"', 'Cache-Control': 'max-age=60'
+        }
+        for _ in range(2):
+            assert self.get(proxy, http_server.uri + RELEASE)[2] == b'release'
+        assert len(self.get_upstream_requests(http_server, RELEASE)) == 1
+        # a revalidation updates the freshness of the response
+        proxy.cache.index[http_server.uri + RELEASE]['expires'] = 0
+        http_server.headers[RELEASE] = {'ETag': '"1"'}
+        assert self.get(proxy, http_server.uri + RELEASE)[2] == b'release'
+        assert proxy.cache.get(http_server.uri + RELEASE)['expires'] is None
+
+    def test_not_cacheable(self, proxy, http_server):
+        self.publish(http_server, RELEASE, b'release')
+        http_server.headers[RELEASE] = {'Cache-Control': 'no-store'}
+        for _ in range(2):
+            assert self.get(proxy, http_server.uri + RELEASE)[2] == b'release'
+        assert len(self.get_upstream_requests(http_server, RELEASE)) == 2
+        assert not proxy.cache.index
+
+    def test_unsized_response(self, proxy, http_server):
+        self.publish(http_server, POOL, b'orig')
+        http_server.unsized.append(POOL)
+        for _ in range(2):
+            assert self.get(proxy, http_server.uri + POOL)[2] == b'orig'
+        assert len(self.get_upstream_requests(http_server, POOL)) == 1
+
+    def test_client_conditional_and_range(self, proxy, http_server):
+        self.publish(http_server, POOL, b'0123456789')
+        http_server.headers[POOL] = {
+            'ETag': '"1"', 'Last-Modified': 'Sat, 18 Dec 2021 16:10:08 GMT'
+        }
+        url = http_server.uri + POOL
+        self.get(proxy, url)
+        status, headers, body = self.get(proxy, url, {'Range': 'bytes=4-'})
+        assert status == 206
+        assert headers['Content-Range'] == 'bytes 4-9/10'
+        assert body == b'456789'
+        # the partial file of the client is outdated
+        status, headers, body = self.get(
+            proxy, url, {'Range': 'bytes=4-', 'If-Range': '"0"'}
+        )
+        assert status == 200
+        assert body == b'0123456789'
+        assert self.get(
+            proxy, url, {'Range': 'bytes=4-', 'If-Range': '"1"'}
+        )[0] == 206
+        for byte_range in ['bytes=0-4', 'bytes=x-', 'bytes=10-']:
+            assert self.get(proxy, url, {'Range': byte_range})[0] == 200
+        for headers in [
+            {'If-None-Match': '"0", "1"'},
+            {'If-Modified-Since': 'Sat, 18 Dec 2021 16:10:08 GMT'}
+        ]:
+            with raises(HTTPError) as not_modified:
+                self.get(proxy, url, headers)
+            assert not_modified.value.code == 304
+        assert self.get(proxy, url, {'If-None-Match': '"0"'})[0] == 200
+        assert self.get(
+            proxy, url, {'If-Modified-Since': 'Fri, 17 Dec 2021 16:10:08 GMT'}
+        )[0] == 200
+        assert self.get(proxy, url, {'If-Modified-Since': 'invalid'})[0] == 200
+        assert len(self.get_upstream_requests(http_server, POOL)) == 1
+
+    def test_forbidden(self, proxy, http_server):
+        with raises(HTTPError) as forbidden:
+            self.get(proxy, http_server.uri + '/index.html')
+        assert forbidden.value.code == 403
+        connection = HTTPConnection('127.0.0.1', proxy.server_address[1])
+        connection.request('GET', POOL)
+        assert connection.getresponse().status == 403
+        connection.close()
+
+    def test_host_not_allowed(self, proxy, http_server):
+        url = http_server.uri.replace('127.0.0.1', 'localhost') + POOL
+        with raises(HTTPError) as forbidden:
+            self.get(proxy, url)
+        assert forbidden.value.code == 403
+        assert http_server.requests == []
+
+    def test_redirect(self, proxy, http_server):
+        data = b'orig'
+        self.publish(http_server, POOL, data)
+        assert self.get(proxy, http_server.uri + '/redirect' + POOL)[2] == data
+        assert self.get_upstream_requests(http_server, POOL)
+
+    def test_redirect_host_not_allowed(self):
+        handler = ArchiveRedirectHandler(['deb.debian.org'])
+        request = Request('http://deb.debian.org/debian' + POOL)
+        redirected = handler.redirect_request(
+            request, MagicMock(), 302, 'Found', {},
+            'https://cdn.deb.debian.org/debian' + POOL
+        )
+        assert redirected.full_url == 'https://cdn.deb.debian.org/debian' + POOL
+        for target in [
+            'http://127.0.0.1:8080/debian' + POOL,
+            'ftp://deb.debian.org/debian' + POOL
+        ]:
+            fp = MagicMock()
+            with raises(URLError):
+                handler.redirect_request(
+                    request, fp, 302, 'Found', {}, target
+                )
+            fp.close.assert_called_once_with()
+
+    def test_is_allowed_host(self):
+        allowed = ['deb.debian.org', ' archive.ubuntu.com', '']
+        assert is_allowed_host('deb.debian.org', allowed)
+        assert is_allowed_host('DE.archive.ubuntu.com.', allowed)
+        assert not is_allowed_host('evil-deb.debian.org.example', allowed)
+        assert not is_allowed_host('notarchive.ubuntu.com', allowed)
+        assert not is_allowed_host('', allowed)
+
+    @patch('corbos_scm.proxy.Command')
+    def test_get_listen_host(self, mock_Command):
+        mock_Command.run.return_value = command_type(
+            output='10.88.0.1\n', error='', returncode=0
+        )
+        assert get_listen_host('http://127.0.0.1:3142') == '127.0.0.1'
+        assert not mock_Command.run.called
+        with patch('corbos_scm.proxy._is_local') as mock_is_local:
+            mock_is_local.side_effect = lambda address: address == '10.88.0.1'
+            assert get_listen_host('http://unknown.invalid') == '10.88.0.1'
+            # the gateway is not an address of this host, e.g. rootless
+            mock_is_local.side_effect = None
+            mock_is_local.return_value = False
+            assert get_listen_host('http://unknown.invalid') == '127.0.0.1'
+        mock_Command.run.side_effect = CSCMCommandError('no podman')
+        assert get_listen_host('http://unknown.invalid') == '127.0.0.1'
+
+    def test_upstream_errors(self, proxy, http_server):
+        with raises(HTTPError) as not_found:
+            self.get(proxy, http_server.uri + POOL)
+        assert not_found.value.code == 404
+        with raises(HTTPError) as bad_gateway:
+            self.get(proxy, 'http://127.0.0.1:1' + POOL)
+        assert bad_gateway.value.code == 502
+
+    def test_interrupted_upstream(self, proxy, http_server):
+        self.publish(http_server, POOL, b'orig' * 1000)
+        http_server.ranges = False
+        http_server.interrupt.append(POOL)
+        with self._caplog.at_level(logging.WARNING):
+            with raises(IncompleteRead):
+                self.get(proxy, http_server.uri + POOL)
+            assert 'incomplete response' in self._caplog.text
+        assert not proxy.cache.index
+        assert self.get(proxy, http_server.uri + POOL)[2] == b'orig' * 1000
+        assert len(proxy.cache.index) == 1
+        # no incoming file is left behind
+        assert [
+            name for name in os.listdir(proxy.cache.objects_dir)
+            if name.startswith('.incoming')
+        ] == []
+
+    def test_by_hash_mismatch(self, proxy, http_server):
+        path = '/ubuntu/dists/hirsute/main/source/by-hash/SHA256/0000'
+        self.publish(http_server, path, b'sources')
+        with self._caplog.at_level(logging.WARNING):
+            assert self.get(proxy, http_server.uri + path)[2] == b'sources'
+        assert 'checksum mismatch' in self._caplog.text
+        assert not proxy.cache.index
+
+    def test_concurrent_requests_fetch_once(self, proxy, http_server):
+        data = b'orig' * 100000
+        self.publish(http_server, POOL, data)
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(
+                    self.get(proxy, http_server.uri + POOL)[2]
+                )
+            ) for _ in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert results == [data] * 4
+        assert len(self.get_upstream_requests(http_server, POOL)) == 1
+        assert not proxy.cache.url_locks
+
+    def test_forward_issues(self, tmpdir):
+        handler = ProxyRequestHandler.__new__(ProxyRequestHandler)
+        handler.server = MagicMock()
+        handler.server.cache = ProxyCache(tmpdir.strpath, 1024)
+        handler.send_response = MagicMock()
+        handler.send_header = MagicMock()
+        handler.end_headers = MagicMock()
+        handler.wfile = MagicMock()
+        response = MagicMock()
+        response.headers = {'Content-Length': '8'}
+        # the client is gone, the response is still cached
+        handler.wfile.write.side_effect = OSError('broken pipe')
+        response.read.side_effect = [b'data', b'data', b'']
+        handler._forward('http://mirror' + POOL, response)
+        assert handler.wfile.write.call_count == 1
+        assert handler.close_connection
+        assert handler.server.cache.get('http://mirror' + POOL)['size'] == 8
+        # the upstream server is gone
+        response.read.side_effect = [b'data', IncompleteRead(b'')]
+        with self._caplog.at_level(logging.WARNING):
+            handler._forward('http://mirror' + RELEASE, response)
+        assert 'incomplete response' in self._caplog.text
+        assert handler.server.cache.get('http://mirror' + RELEASE) is None
+        assert os.listdir(handler.server.cache.objects_dir) == [
+            hashlib.sha256(b'datadata').hexdigest()[:2]
+        ]
+
+    def test_eviction(self, tmpdir):
+        cache = ProxyCache(tmpdir.strpath, 150)
+        for url, data in [('a', b'a' * 100), ('b', b'b' * 100)]:
+            incoming = cache.new_file()
+            with incoming:
+                incoming.write(data)
+            cache.store(
+                url, incoming.name, hashlib.sha256(data).hexdigest(),
+                len(data), {}
+            )
+            time.sleep(0.01)
+        assert list(cache.index) == ['b']
+        assert not os.path.exists(
+            cache.get_object(hashlib.sha256(b'a' * 100).hexdigest())
+        )
+        # the index outlives the proxy process
+        cache.close()
+        assert list(ProxyCache(tmpdir.strpath, 150).index) == ['b']
+
+    def test_index_issues(self, tmpdir):
+        cache = ProxyCache(tmpdir.strpath, 150)
+        cache.index['a'] = {'sha256': '0000', 'size': 1, 'used': 0}
+        with self._caplog.at_level(logging.WARNING):
+            assert cache.get('a') is None
+        assert 'object missing' in self._caplog.text
+        with open(cache.index_file, 'w') as index:
+            index.write('{')
+        with self._caplog.at_level(logging.WARNING):
+            assert ProxyCache(tmpdir.strpath, 150).index == {}
+        assert 'unreadable proxy cache index' in self._caplog.text
+        os.mkdir(cache.index_file + '.new')
+        with self._caplog.at_level(logging.WARNING):
+            cache.close()
+        assert 'Failed to write proxy cache index' in self._caplog.text
+        with open(cache.index_file) as index:
+            assert index.read() == '{'
+
+    @patch('corbos_scm.proxy.time.time')
+    def test_get_expiry(self, mock_time):
+        assert get_expiry({'Cache-Control': 'public, max-age=60'}, 100) == 160
+        assert get_expiry(
+            {'Cache-Control': 'max-age=60', 'Age': '10'}, 100
+        ) == 150
+        assert get_expiry({'Cache-Control': 'max-age=x'}, 100) is None
+        assert get_expiry(
+            {'Cache-Control': 'max-age=60, must-revalidate'}, 100
+        ) is None
+        assert get_expiry(
+            {'Expires': 'Thu, 01 Jan 1970 00:01:00 GMT'}, 100
+        ) == 60
+        assert get_expiry({'Expires': '0'}, 100) is None
+        assert get_expiry({}, 100) is None
+
+    def test_is_cacheable(self):
+        assert is_cacheable({})
+        assert is_cacheable({'Cache-Control': 'max-age=60'})
+        assert not is_cacheable({'Cache-Control': 'no-store'})
+        assert not is_cacheable({'Cache-Control': 'private, max-age=60'})
+
+    def test_paths(self):
+        assert is_archive_path(RELEASE)
+        assert is_archive_path(POOL)
+        assert not is_archive_path('/index.html')
+        assert is_immutable(POOL)
+        assert is_immutable('/dists/hirsute/main/source/by-hash/SHA256/00')
+        assert not is_immutable(RELEASE)
+
+    @patch('corbos_scm.proxy.time.sleep')
+    @patch('corbos_scm.proxy.subprocess.Popen')
+    @patch('corbos_scm.proxy._is_listening')
+    @patch('corbos_scm.proxy.get_listen_host')
+    def test_start_proxy(
+        self, mock_get_listen_host, mock_is_listening, mock_Popen,
+        mock_sleep, tmpdir
+    ):
+        mock_get_listen_host.return_value = '10.88.0.1'
+        mock_is_listening.return_value = True
+        start_proxy('http://host.containers.internal:8000', tmpdir.strpath)
+        assert not mock_Popen.called
+        mock_is_listening.assert_called_once_with('10.88.0.1', 8000)
+        mock_get_listen_host.assert_called_once_with(
+            'http://host.containers.internal:8000'
+        )
+
+        mock_is_listening.side_effect = [False, False, True]
+        start_proxy('http://host.containers.internal', tmpdir.strpath)
+        assert mock_Popen.call_args[0][0] == [
+            'corbos_scm_proxy', '--cache-dir', tmpdir.strpath,
+            '--listen', '10.88.0.1:3142'
+        ]
+        assert mock_Popen.call_args[1]['start_new_session']
+        assert tmpdir.join('proxy', 'proxy.log').exists()
+
+        mock_is_listening.side_effect = [False, True]
+        start_proxy(
+            'http://host.containers.internal', tmpdir.strpath,
+            'mirror.example.com'
+        )
+        assert mock_Popen.call_args[0][0][-2:] == [
+            '--allow-hosts', 'mirror.example.com'
+        ]
+
+        mock_is_listening.side_effect = None
+        mock_is_listening.return_value = False
+        with raises(CSCMProxyError, match='not listening on port 3142'):
+            start_proxy('http://proxy', tmpdir.strpath, timeout=0)
+        mock_Popen.side_effect = OSError('not found')
+        with raises(CSCMProxyError, match='Failed to start'):
+            start_proxy('http://proxy', tmpdir.strpath)
+
+    def test_is_listening(self, proxy):
+        from corbos_scm.proxy import _is_listening
+        assert _is_listening('127.0.0.1', proxy.server_address[1])
+        assert not _is_listening('127.0.0.1', 1)
+
+    def test_is_local(self):
+        from corbos_scm.proxy import _is_local
+        assert _is_local('127.0.0.1')
+        # TEST-NET-1, never assigned to a host
+        assert not _is_local('192.0.2.1')
+
+    @patch('signal.signal')
+    @patch('corbos_scm.proxy.ProxyServer')
+    @patch('corbos_scm.proxy.ProxyCache')
+    def test_main(self, mock_ProxyCache, mock_ProxyServer, mock_signal):
+        sys.argv = [
+            sys.argv[0], '--cache-dir', '/var/cache/corbos_scm',
+            '--cache-size', '100'
+        ]
+        server = mock_ProxyServer.return_value
+        main()
+        mock_ProxyCache.assert_called_once_with(
+            '/var/cache/corbos_scm', 100 * 1024 * 1024
+        )
+        mock_ProxyServer.assert_called_once_with(
+            ('127.0.0.1', 3142), mock_ProxyCache.return_value, [
+                'deb.debian.org', 'security.debian.org', 'archive.ubuntu.com',
+                'security.ubuntu.com', 'ports.ubuntu.com'
+            ]
+        )
+        server.serve_forever.assert_called_once_with()
+        server.server_close.assert_called_once_with()
+        mock_ProxyCache.return_value.close.assert_called_once_with()
+        handler = mock_signal.call_args[0][1]
+        with patch('threading.Thread') as mock_Thread:
+            handler(15, None)
+            mock_Thread.assert_called_once_with(target=server.shutdown)
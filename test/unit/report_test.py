@@ -0,0 +1,103 @@
+import json
+import logging
+from mock import patch
+from pytest import (
+    fixture, raises
+)
+
+from corbos_scm.version import __version__
+from corbos_scm.exceptions import CSCMReportError
+from corbos_scm.report import (
+    Report, phase, record_command, record_published, get_directory_size
+)
+
+
+class TestReport:
+    @fixture(autouse=True)
+    def inject_fixtures(self, caplog):
+        self._caplog = caplog
+
+    def setup_method(self):
+        self.report = Report('curl')
+        self.report.activate()
+
+    def teardown_method(self):
+        Report.current = None
+
+    def test_phase(self):
+        with self._caplog.at_level(logging.INFO):
+            with phase('pull'):
+                pass
+        assert self.report.phases[0].name == 'pull'
+        assert self.report.phases[0].success
+        record = self._caplog.records[0]
+        assert record.phase == 'pull'
+        assert record.success
+        assert 'phase=pull duration=' in record.getMessage()
+
+    def test_phase_failed(self):
+        with raises(ValueError):
+            with phase('download'):
+                raise ValueError
+        assert not self.report.phases[0].success
+
+    def test_phase_no_report(self):
+        Report.current = None
+        with phase('pull'):
+            pass
+        assert self.report.phases == []
+
+    def test_record_command(self):
+        with patch('time.monotonic', return_value=12):
+            record_command(['podman', 'pull', 1], 10, 0)
+        command = self.report.commands[0]
+        assert command.command == ['podman', 'pull', '1']
+        assert command.duration == 2
+        assert command.returncode == 0
+        Report.current = None
+        record_command(['podman'], 10, None)
+        assert len(self.report.commands) == 1
+
+    def test_write(self, tmpdir):
+        outdir = tmpdir.mkdir('obs_out')
+        outdir.join('curl.dsc').write('dsc')
+        outdir.mkdir('debian').join('control').write('control')
+        outdir.join('link').mksymlinkto(outdir.join('curl.dsc'))
+        outdir.join('curl.orig.tar.gz').write('unchanged')
+        record_published(outdir.strpath, ['curl.dsc', 'debian', 'link'])
+        with phase('pull'):
+            record_command(['podman', 'pull'], 0, 0)
+        report_file = tmpdir.join('report.json')
+        self.report.write(report_file.strpath, outdir.strpath)
+        data = json.loads(report_file.read())
+        assert data['corbos_scm'] == __version__
+        assert data['package'] == 'curl'
+        assert data['success']
+        assert data['outdir_bytes'] == 10
+        assert data['phases'][0]['name'] == 'pull'
+        assert data['commands'][0]['command'] == ['podman', 'pull']
+        assert not tmpdir.join('report.json.new').exists()
+
+    def test_write_lines(self, tmpdir):
+        report_file = tmpdir.join('report.jsonl')
+        self.report.write(report_file.strpath)
+        self.report.error = 'CSCMError: failed'
+        self.report.write(report_file.strpath)
+        runs = [json.loads(line) for line in report_file.readlines()]
+        assert [run['success'] for run in runs] == [True, False]
+        assert runs[1]['error'] == 'CSCMError: failed'
+        assert runs[1]['outdir_bytes'] == 0
+
+    def test_write_failed(self, tmpdir):
+        with raises(CSCMReportError):
+            self.report.write(tmpdir.join('missing', 'report.json').strpath)
+
+    def test_record_published_no_report(self, tmpdir):
+        Report.current = None
+        tmpdir.join('curl.dsc').write('dsc')
+        record_published(tmpdir.strpath, ['curl.dsc'])
+        assert self.report.outdir_bytes == 0
+
+    def test_get_directory_size(self, tmpdir):
+        tmpdir.join('a').write('12345')
+        assert get_directory_size(tmpdir.strpath) == 5
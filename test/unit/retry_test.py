@@ -0,0 +1,171 @@
+from mock import (
+    patch, Mock
+)
+from pytest import raises
+
+from corbos_scm.command import Command
+from corbos_scm.retry import (
+    RetryPolicy, is_retryable, get_candidates
+)
+from corbos_scm.exceptions import (
+    CSCMError,
+    CSCMCommandError,
+    CSCMCommandTimeoutError,
+    CSCMDownloadError,
+    CSCMMirrorError
+)
+
+TRANSIENT = CSCMCommandError(
+    "stderr: 'Error: Get https://registry/v2/: dial tcp: i/o timeout'", 125
+)
+FATAL = CSCMCommandError(
+    "stderr: 'E: Unable to find a source package for foo'", 100
+)
+
+
+class TestRetry:
+    def setup_method(self):
+        self.policy = RetryPolicy(retries=2, budget=100)
+
+    def teardown_method(self):
+        Command.deadline = None
+
+    def test_is_retryable(self):
+        assert is_retryable(TRANSIENT)
+        assert is_retryable(CSCMDownloadError('HTTP 404'))
+        assert is_retryable(CSCMCommandTimeoutError('timed out'))
+        assert is_retryable(
+            CSCMCommandError('W: Failed to fetch http://mirror 503', 100)
+        )
+        assert is_retryable(CSCMMirrorError('Checksum mismatch for Sources'))
+        assert not is_retryable(FATAL)
+        assert not is_retryable(CSCMCommandError('connection refused', 127))
+        assert not is_retryable(CSCMMirrorError('Package foo not found'))
+        assert not is_retryable(CSCMError('issue'))
+
+    def test_is_retryable_command_output(self):
+        assert not is_retryable(
+            CSCMCommandError(
+                'command failed', 100,
+                'E: Unable to find a source package for nosuchpkg',
+                'Get:1 http://mirror stable/main Sources [1,502 kB]'
+            )
+        )
+        assert is_retryable(
+            CSCMCommandError(
+                'command failed', 100, '',
+                'Get:1 http://mirror stable/main Sources [1,502 kB]\n'
+                'E: Failed to fetch http://mirror/Sources  503  Unavailable'
+            )
+        )
+        assert is_retryable(
+            CSCMCommandError(
+                'command failed', 125,
+                'Error: received unexpected HTTP status: 502 Bad Gateway'
+            )
+        )
+        assert is_retryable(
+            CSCMCommandError(
+                'command failed', 100,
+                'E: Failed to fetch http://mirror/Sources  Could not connect '
+                'to mirror:80 (10.0.0.1). - connect (111: Connection refused)'
+            )
+        )
+        # a file missing on the mirror does not appear by retrying
+        assert not is_retryable(
+            CSCMCommandError(
+                'command failed', 100,
+                'E: Failed to fetch http://mirror/pool/main/c/curl/curl.dsc  '
+                '404  Not Found [IP: 10.0.0.1 80]\n'
+                'E: Some index files failed to download. They have been '
+                'ignored, or old ones used instead.'
+            )
+        )
+
+    @patch('random.random')
+    def test_get_delay(self, mock_random):
+        mock_random.return_value = 0
+        assert self.policy.get_delay(0) == 1
+        assert self.policy.get_delay(2) == 4
+        assert self.policy.get_delay(10) == 30
+        mock_random.return_value = 1
+        assert self.policy.get_delay(2) == 2
+
+    @patch('time.sleep')
+    def test_call(self, mock_sleep):
+        func = Mock(side_effect=[TRANSIENT, TRANSIENT, 42])
+        assert self.policy.call(func, 'pull') == 42
+        assert func.call_count == 3
+        assert mock_sleep.call_count == 2
+
+    @patch('time.sleep')
+    def test_call_exhausted(self, mock_sleep):
+        func = Mock(side_effect=TRANSIENT)
+        with raises(CSCMCommandError):
+            self.policy.call(func, 'pull')
+        assert func.call_count == 3
+
+    @patch('time.sleep')
+    def test_call_fatal(self, mock_sleep):
+        func = Mock(side_effect=FATAL)
+        with raises(CSCMCommandError):
+            self.policy.call(func, 'download')
+        assert func.call_count == 1
+        assert not mock_sleep.called
+
+    @patch('time.monotonic')
+    @patch('time.sleep')
+    def test_call_budget(self, mock_sleep, mock_monotonic):
+        mock_monotonic.return_value = 1000
+        func = Mock(side_effect=TRANSIENT)
+        with raises(CSCMCommandError):
+            self.policy.call(func, 'pull', started=1000 - 99.5)
+        assert func.call_count == 1
+
+    @patch('time.monotonic')
+    @patch('time.sleep')
+    def test_call_deadline(self, mock_sleep, mock_monotonic):
+        mock_monotonic.return_value = 1000
+        Command.deadline = 1000.5
+        func = Mock(side_effect=TRANSIENT)
+        with raises(CSCMCommandError):
+            RetryPolicy().call(func, 'pull')
+        assert func.call_count == 1
+
+    @patch('time.sleep')
+    def test_failover(self, mock_sleep):
+        func = Mock(side_effect=[TRANSIENT, TRANSIENT, TRANSIENT, 42])
+        assert self.policy.failover(['a', 'b'], func, 'pull') == 42
+        assert [call[0][0] for call in func.call_args_list] == [
+            'a', 'a', 'a', 'b'
+        ]
+
+    @patch('time.sleep')
+    def test_failover_all_failed(self, mock_sleep):
+        func = Mock(side_effect=TRANSIENT)
+        with raises(CSCMCommandError):
+            self.policy.failover(['a', 'b'], func, 'pull')
+        assert func.call_count == 6
+
+    def test_failover_fatal(self):
+        func = Mock(side_effect=FATAL)
+        with raises(CSCMCommandError):
+            self.policy.failover(['a', 'b'], func, 'pull')
+        assert func.call_count == 1
+
+    @patch('time.monotonic')
+    def test_failover_budget(self, mock_monotonic):
+        mock_monotonic.side_effect = [0, 200]
+        func = Mock(side_effect=TRANSIENT)
+        with raises(CSCMCommandError):
+            RetryPolicy(retries=0, budget=100).failover(
+                ['a', 'b'], func, 'pull'
+            )
+        assert func.call_count == 1
+
+    def test_failover_no_candidates(self):
+        with raises(CSCMError):
+            self.policy.failover([], Mock(), 'pull')
+
+    def test_get_candidates(self):
+        assert get_candidates('a, b,,c') == ['a', 'b', 'c']
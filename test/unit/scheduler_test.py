@@ -0,0 +1,62 @@
+import time
+import threading
+
+from corbos_scm.scheduler import (
+    Scheduler, job_type, get_job_order
+)
+
+
+class TestScheduler:
+    def setup_method(self):
+        self.lock = threading.Lock()
+        self.running = {}
+        self.peak = {}
+        self.started = []
+
+    def track(self, job, host):
+        with self.lock:
+            self.started.append(job.package)
+            for key in (host, 'all'):
+                self.running[key] = self.running.get(key, 0) + 1
+                self.peak[key] = max(self.peak.get(key, 0), self.running[key])
+        time.sleep(0.05)
+        with self.lock:
+            for key in (host, 'all'):
+                self.running[key] -= 1
+        return (job.package, host)
+
+    def test_run_in_job_order(self):
+        jobs = [
+            job_type('big', 'out/big', ['mirror'], 1000),
+            job_type('unknown', 'out/unknown', ['mirror'], None),
+            job_type('small', 'out/small', ['mirror'], 10)
+        ]
+        assert Scheduler().run(jobs, self.track) == [
+            ('big', 'mirror'), ('unknown', 'mirror'), ('small', 'mirror')
+        ]
+        assert self.started == ['small', 'big', 'unknown']
+        assert self.peak['all'] == 1
+
+    def test_run_limits(self):
+        jobs = [
+            job_type(f'package{index}', 'out', ['one', 'two'], index)
+            for index in range(8)
+        ]
+        results = Scheduler(workers=3, host_limit=1).run(jobs, self.track)
+        assert {host for package, host in results} == {'one', 'two'}
+        # only two hosts with one slot each
+        assert self.peak['all'] == 2
+        assert self.peak['one'] == 1
+        assert self.peak['two'] == 1
+
+    def test_run_workers(self):
+        jobs = [
+            job_type(f'package{index}', 'out', [], None) for index in range(6)
+        ]
+        results = Scheduler(workers=3).run(jobs, self.track)
+        assert results == [(f'package{index}', '') for index in range(6)]
+        assert 1 < self.peak['all'] <= 3
+
+    def test_get_job_order(self):
+        assert get_job_order(job_type('a', 'out', [], None)) == (True, 0)
+        assert get_job_order(job_type('a', 'out', [], 5)) == (False, 5)
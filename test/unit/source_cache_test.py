@@ -0,0 +1,182 @@
+from mock import patch
+from pytest import raises
+import os
+import json
+import logging
+import hashlib
+
+from corbos_scm.exceptions import CSCMSourceCacheError
+from corbos_scm.sources import (
+    source_file_type, source_package_type
+)
+from corbos_scm.source_cache import SourceCache
+
+
+def make_source(outdir, package, version, files):
+    source_files = []
+    for name, data in files.items():
+        outdir.join(name).write(data)
+        source_files.append(
+            source_file_type(
+                name=name, size=len(data),
+                sha256=hashlib.sha256(data.encode()).hexdigest()
+            )
+        )
+    return source_package_type(
+        package=package, version=version, directory='', files=source_files,
+        binaries=[]
+    )
+
+
+class TestSourceCache:
+    def test_store_and_materialize(self, tmpdir):
+        outdir = tmpdir.mkdir('out')
+        source = make_source(
+            outdir, 'curl', '1.0-1', {
+                'curl_1.0-1.dsc': 'dsc', 'curl_1.0.orig.tar.gz': 'orig'
+            }
+        )
+        source_cache = SourceCache(tmpdir.join('cache').strpath, 1024)
+        assert source_cache.materialize(source, outdir.strpath) is False
+        assert source_cache.store(source, outdir.strpath) is True
+        object_file = source_cache.get_object(source.files[0].sha256)
+        assert os.path.exists(object_file)
+
+        other = tmpdir.mkdir('other')
+        assert source_cache.materialize(source, other.strpath) is True
+        assert other.join('curl_1.0.orig.tar.gz').read() == 'orig'
+
+        # the fetched files stay writable and apart from the objects
+        dsc = outdir.join('curl_1.0-1.dsc')
+        assert os.access(dsc.strpath, os.W_OK)
+        assert os.stat(dsc.strpath).st_ino != os.stat(object_file).st_ino
+        assert os.stat(object_file).st_mode & 0o777 == 0o444
+
+        # cache hits share the read only objects
+        dsc = other.join('curl_1.0-1.dsc')
+        assert os.stat(dsc.strpath).st_ino == os.stat(object_file).st_ino
+
+        # stored again, objects are not replaced
+        assert source_cache.store(source, outdir.strpath) is True
+
+        # a hit does not read the objects again
+        with patch('corbos_scm.source_cache.sha256sum') as mock_sha256sum:
+            assert source_cache.materialize(
+                source, tmpdir.mkdir('third').strpath
+            ) is True
+        assert not mock_sha256sum.called
+
+    def test_materialize_checksum_differs(self, tmpdir):
+        outdir = tmpdir.mkdir('out')
+        source = make_source(outdir, 'curl', '1.0-1', {'curl.dsc': 'dsc'})
+        source_cache = SourceCache(tmpdir.join('cache').strpath, 1024)
+        source_cache.store(source, outdir.strpath)
+        changed = source._replace(
+            files=[source.files[0]._replace(sha256='0000')]
+        )
+        assert source_cache.materialize(changed, outdir.strpath) is False
+
+    def test_materialize_object_missing(self, tmpdir):
+        outdir = tmpdir.mkdir('out')
+        source = make_source(outdir, 'curl', '1.0-1', {'curl.dsc': 'dsc'})
+        source_cache = SourceCache(tmpdir.join('cache').strpath, 1024)
+        source_cache.store(source, outdir.strpath)
+        os.unlink(source_cache.get_object(source.files[0].sha256))
+        assert source_cache.materialize(source, outdir.strpath) is False
+        assert json.loads(
+            tmpdir.join('cache', 'sources', 'index.json').read()
+        ) == {}
+
+    def test_materialize_object_changed(self, tmpdir):
+        outdir = tmpdir.mkdir('out')
+        source = make_source(outdir, 'curl', '1.0-1', {'curl.dsc': 'dsc'})
+        source_cache = SourceCache(tmpdir.join('cache').strpath, 1024)
+        source_cache.store(source, outdir.strpath)
+        other = tmpdir.mkdir('other')
+        assert source_cache.materialize(source, other.strpath) is True
+        # an in place change of the output file reaches the object
+        other.join('curl.dsc').chmod(0o644)
+        other.join('curl.dsc').write('cat')
+        object_file = source_cache.get_object(source.files[0].sha256)
+        status = os.stat(object_file)
+        os.utime(object_file, ns=(status.st_atime_ns, status.st_mtime_ns + 1))
+        assert source_cache.materialize(source, other.strpath) is False
+        assert not os.path.exists(object_file)
+        assert json.loads(
+            tmpdir.join('cache', 'sources', 'index.json').read()
+        ) == {}
+
+    def test_materialize_entry_without_mtimes(self, tmpdir):
+        outdir = tmpdir.mkdir('out')
+        source = make_source(outdir, 'curl', '1.0-1', {'curl.dsc': 'dsc'})
+        source_cache = SourceCache(tmpdir.join('cache').strpath, 1024)
+        source_cache.store(source, outdir.strpath)
+        index = source_cache._read_index()
+        del index['curl_1.0-1']['mtimes']
+        source_cache._write_index(index)
+        assert source_cache.materialize(source, outdir.strpath) is False
+
+    def test_store_fails(self, tmpdir, caplog):
+        outdir = tmpdir.mkdir('out')
+        source = make_source(
+            outdir, 'curl', '1.0-1', {'curl.dsc': 'dsc', 'curl.orig': 'orig'}
+        )
+        source_cache = SourceCache(tmpdir.join('cache').strpath, 1024)
+        with patch('os.chmod', side_effect=[None, OSError('no space')]):
+            with caplog.at_level(logging.WARNING):
+                assert source_cache.store(source, outdir.strpath) is False
+        assert 'Not caching curl_1.0-1: no space' in caplog.text
+        # no object or partial object is left behind
+        assert [
+            files for root, dirs, files in os.walk(source_cache.objects_dir)
+            if files
+        ] == []
+        assert outdir.join('curl.orig').read() == 'orig'
+        assert source_cache.materialize(source, outdir.strpath) is False
+
+    def test_store_mismatch(self, tmpdir):
+        outdir = tmpdir.mkdir('out')
+        source = make_source(outdir, 'curl', '1.0-1', {'curl.dsc': 'dsc'})
+        outdir.join('curl.dsc').write('modified')
+        source_cache = SourceCache(tmpdir.join('cache').strpath, 1024)
+        assert source_cache.store(source, outdir.strpath) is False
+        outdir.join('curl.dsc').remove()
+        assert source_cache.store(source, outdir.strpath) is False
+
+    @patch('time.time')
+    def test_evict_least_recently_used(self, mock_time, tmpdir):
+        source_cache = SourceCache(tmpdir.join('cache').strpath, 9)
+        first_dir = tmpdir.mkdir('first')
+        second_dir = tmpdir.mkdir('second')
+        shared = 'shared'
+        first = make_source(
+            first_dir, 'a', '1', {'a.orig': shared, 'a_1.dsc': 'a1'}
+        )
+        second = make_source(
+            second_dir, 'a', '2', {'a.orig': shared, 'a_2.dsc': 'a2'}
+        )
+        mock_time.return_value = 1
+        source_cache.store(first, first_dir.strpath)
+        mock_time.return_value = 2
+        source_cache.store(second, second_dir.strpath)
+        # shared object stays, the a_1.dsc object is evicted
+        assert os.path.exists(source_cache.get_object(first.files[0].sha256))
+        assert not os.path.exists(
+            source_cache.get_object(first.files[1].sha256)
+        )
+        assert source_cache.materialize(first, first_dir.strpath) is False
+        assert source_cache.materialize(second, second_dir.strpath) is True
+
+    def test_read_index_unreadable(self, tmpdir):
+        source_cache = SourceCache(tmpdir.strpath, 1024)
+        tmpdir.join('sources', 'index.json').write('{')
+        source = source_package_type('curl', '1', '', [], [])
+        assert source_cache.materialize(source, tmpdir.strpath) is False
+
+    def test_write_index_fails(self, tmpdir):
+        outdir = tmpdir.mkdir('out')
+        source = make_source(outdir, 'curl', '1.0-1', {'curl.dsc': 'dsc'})
+        source_cache = SourceCache(tmpdir.join('cache').strpath, 1024)
+        with patch('json.dump', side_effect=OSError('full')):
+            with raises(CSCMSourceCacheError):
+                source_cache.store(source, outdir.strpath)
@@ -0,0 +1,150 @@
+import os
+import sqlite3
+import hashlib
+from mock import patch
+from pytest import raises
+
+from corbos_scm.sources import source_file_type
+from corbos_scm.sources_index import SourcesIndex
+from corbos_scm.source_cache import SourceCache
+from corbos_scm.exceptions import CSCMSourcesIndexError
+
+SOURCES = b'''Package: curl
+Binary: curl, libcurl4
+Version: 7.74.0-1.2
+Directory: pool/main/c/curl
+Checksums-Sha256:
+ aaaa 100 curl_7.74.0-1.2.dsc
+
+Package: curl
+Binary: curl, libcurl4
+Version: 7.74.0-1.3
+Directory: pool/main/c/curl
+Checksums-Sha256:
+ cccc 101 curl_7.74.0-1.3.dsc
+ dddd 4043409 curl_7.74.0.orig.tar.gz
+
+Package: vim
+Binary: vim, xxd
+Version: 2:8.2.2434-3
+Directory: pool/main/v/vim
+Checksums-Sha256:
+ eeee 102 vim_8.2.2434-3.dsc
+'''
+
+ORIGIN = 'http://mirror hirsute main'
+
+
+class TestSourcesIndex:
+    def setup_method(self):
+        self.sha256 = hashlib.sha256(SOURCES).hexdigest()
+
+    def test_update_lookup(self, tmpdir):
+        index = SourcesIndex(tmpdir.strpath)
+        assert index.get_state(ORIGIN) is None
+        assert not index.is_fresh(ORIGIN)
+        index.update(ORIGIN, SOURCES)
+        assert index.get_state(ORIGIN) == self.sha256
+        assert index.is_fresh(ORIGIN)
+        assert index.read_sources(ORIGIN) == SOURCES
+        index.close()
+
+        index = SourcesIndex(tmpdir.strpath)
+        source = index.lookup([ORIGIN], 'curl')
+        assert source.version == '7.74.0-1.3'
+        assert source.files == [
+            source_file_type('curl_7.74.0-1.3.dsc', 101, 'cccc'),
+            source_file_type('curl_7.74.0.orig.tar.gz', 4043409, 'dddd')
+        ]
+        assert index.lookup([ORIGIN], 'libcurl4', '7.74.0-1.2').files == [
+            source_file_type('curl_7.74.0-1.2.dsc', 100, 'aaaa')
+        ]
+        assert index.lookup([ORIGIN], 'xxd').package == 'vim'
+        assert index.lookup([ORIGIN], 'emacs') is None
+        assert index.lookup(['other'], 'curl') is None
+
+    def test_update_incremental(self, tmpdir):
+        index = SourcesIndex(tmpdir.strpath)
+        index.update(ORIGIN, SOURCES)
+        ids = dict(
+            index.database.execute('SELECT digest, id FROM sources')
+        )
+        index.update(ORIGIN, SOURCES.replace(b'xxd', b'vim-tiny'))
+        updated = dict(
+            index.database.execute('SELECT digest, id FROM sources')
+        )
+        # only the changed vim record was replaced
+        assert len(set(ids) & set(updated)) == 2
+        assert len(updated) == 3
+        assert index.lookup([ORIGIN], 'xxd') is None
+        assert index.lookup([ORIGIN], 'vim-tiny').package == 'vim'
+        assert index.database.execute(
+            'SELECT count(*) FROM binaries'
+        ).fetchone()[0] == 6
+
+    def test_state_without_sources_file(self, tmpdir):
+        index = SourcesIndex(tmpdir.strpath)
+        index.update(ORIGIN, SOURCES)
+        os.unlink(index.get_sources_file(ORIGIN))
+        assert index.get_state(ORIGIN) is None
+
+    @patch('corbos_scm.sources_index.time')
+    def test_touch_and_evict(self, mock_time, tmpdir):
+        mock_time.time.return_value = 1000
+        index = SourcesIndex(tmpdir.strpath, ttl=10, max_age=100)
+        index.update(ORIGIN, SOURCES)
+        index.update('old', SOURCES)
+        mock_time.time.return_value = 1050
+        assert not index.is_fresh(ORIGIN)
+        index.touch(ORIGIN)
+        assert index.is_fresh(ORIGIN)
+        mock_time.time.return_value = 1101
+        index.evict()
+        assert index.get_state('old') is None
+        assert not os.path.exists(index.get_sources_file('old'))
+        assert index.lookup(['old'], 'curl') is None
+        assert index.lookup([ORIGIN], 'curl').version == '7.74.0-1.3'
+        assert index.database.execute(
+            'SELECT count(*) FROM binaries'
+        ).fetchone()[0] == 6
+
+    def test_update_lock(self, tmpdir):
+        index = SourcesIndex(tmpdir.strpath)
+        with index.update_lock():
+            assert os.path.exists(index.lock_file)
+
+    def test_separate_from_source_cache(self, tmpdir):
+        index = SourcesIndex(tmpdir.strpath)
+        index.close()
+        source_cache_root = SourceCache(tmpdir.strpath, 1024).root
+        assert os.path.commonpath(
+            [index.root, source_cache_root]
+        ) == tmpdir.strpath
+
+    def test_open_error(self, tmpdir):
+        tmpdir.mkdir('sources-index').mkdir('index.db')
+        with raises(CSCMSourcesIndexError, match='Failed to open'):
+            SourcesIndex(tmpdir.strpath)
+
+    def test_write_error(self, tmpdir):
+        index = SourcesIndex(tmpdir.strpath)
+        os.mkdir(index.get_sources_file(ORIGIN) + '.new')
+        with raises(CSCMSourcesIndexError, match='Failed to write'):
+            index.update(ORIGIN, SOURCES)
+
+    def test_database_errors(self, tmpdir):
+        index = SourcesIndex(tmpdir.strpath)
+        index.update(ORIGIN, SOURCES)
+        index.database.execute('DROP TABLE binaries')
+        with raises(CSCMSourcesIndexError, match='Failed to read'):
+            index.lookup([ORIGIN], 'xxd')
+        with raises(CSCMSourcesIndexError, match='Failed to update'):
+            index.update(ORIGIN, SOURCES.replace(b'xxd', b'vim-tiny'))
+        # the kept Sources file still matches the indexed state
+        assert index.read_sources(ORIGIN) == SOURCES
+        index.database.execute('DROP TABLE origins')
+        with raises(CSCMSourcesIndexError, match='Failed to write'):
+            index.touch(ORIGIN)
+        index.close()
+        with raises(sqlite3.ProgrammingError):
+            index.database.execute('SELECT 1')
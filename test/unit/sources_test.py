@@ -0,0 +1,113 @@
+from pytest import raises
+import os
+
+from corbos_scm.exceptions import CSCMSourceFormatError
+from corbos_scm.sources import (
+    parse_paragraphs, parse_sources, get_latest, select_source,
+    find_source, compare_versions, source_file_type, source_package_type
+)
+
+DATA = os.path.join(os.path.dirname(__file__), '..', 'data')
+
+SHOWSRC = '''Package: curl
+Binary: curl, libcurl4
+Version: 7.74.0-1.2
+Directory: pool/main/c/curl
+Checksums-Sha256:
+ aaaa 100 curl_7.74.0-1.2.dsc
+ bbbb 4043409 curl_7.74.0.orig.tar.gz
+
+Package: curl
+Version: 7.74.0-1.3
+Directory: pool/main/c/curl
+Checksums-Sha256:
+ cccc 101 curl_7.74.0-1.3.dsc
+ broken line
+
+Package: broken
+'''
+
+
+class TestSources:
+    def test_parse_paragraphs(self):
+        assert parse_paragraphs('A: 1\n B\n\n\nC: 2\n') == [
+            {'A': '1\nB'}, {'C': '2'}
+        ]
+        assert parse_paragraphs(' orphan\nA: 1') == [{'A': '1'}]
+        # text outside of the signed part is ignored
+        assert parse_paragraphs(
+            'SHA256:\n fake\n\n'
+            '-----BEGIN PGP SIGNED MESSAGE-----\nHash: SHA512\n\n'
+            'SHA256:\n real\n'
+            '-----BEGIN PGP SIGNATURE-----\nsig\n'
+            '-----END PGP SIGNATURE-----\nSHA256:\n fake\n'
+        ) == [{'SHA256': '\nreal'}]
+
+    def test_parse_sources(self):
+        sources = parse_sources(SHOWSRC)
+        assert sources == [
+            source_package_type(
+                package='curl', version='7.74.0-1.2',
+                directory='pool/main/c/curl', files=[
+                    source_file_type('curl_7.74.0-1.2.dsc', 100, 'aaaa'),
+                    source_file_type('curl_7.74.0.orig.tar.gz', 4043409, 'bbbb')
+                ], binaries=['curl', 'libcurl4']
+            ),
+            source_package_type(
+                package='curl', version='7.74.0-1.3',
+                directory='pool/main/c/curl', files=[
+                    source_file_type('curl_7.74.0-1.3.dsc', 101, 'cccc')
+                ], binaries=[]
+            )
+        ]
+
+    def test_parse_sources_invalid_file_name(self):
+        for name in ['../ESCAPED', '/etc/passwd', 'dir/file', '..', '.']:
+            with raises(CSCMSourceFormatError):
+                parse_sources(
+                    'Package: curl\nVersion: 1.0\n'
+                    f'Checksums-Sha256:\n aaaa 1 {name}\n'
+                )
+
+    def test_parse_sources_signed_dsc(self):
+        with open(os.path.join(DATA, 'curl.dsc')) as dsc:
+            sources = parse_sources(dsc.read())
+        assert len(sources) == 1
+        assert sources[0].package == 'curl'
+        assert sources[0].version == '7.74.0-1.3'
+        assert sources[0].binaries == [
+            'curl', 'libcurl4', 'libcurl4-openssl-dev'
+        ]
+        assert [source_file.name for source_file in sources[0].files] == [
+            'curl_7.74.0.orig.tar.gz', 'curl_7.74.0-1.3.debian.tar.xz'
+        ]
+
+    def test_get_latest(self):
+        assert get_latest([]) is None
+        assert get_latest(parse_sources(SHOWSRC)).version == '7.74.0-1.3'
+
+    def test_select_source(self):
+        sources = parse_sources(SHOWSRC)
+        assert select_source(sources).version == '7.74.0-1.3'
+        assert select_source(sources, '7.74.0-1.2').version == '7.74.0-1.2'
+        assert select_source(sources, '7.74.0-1.1') is None
+
+    def test_find_source(self):
+        sources = parse_sources(SHOWSRC)
+        assert find_source(sources, 'curl').version == '7.74.0-1.3'
+        assert find_source(
+            sources, 'libcurl4'
+        ).version == '7.74.0-1.2'
+        assert find_source(sources, 'libcurl4', '7.74.0-1.3') is None
+        assert find_source(sources, 'vim') is None
+
+    def test_compare_versions(self):
+        assert compare_versions('1.0', '1.0') == 0
+        assert compare_versions('1.0-1', '1.0-2') < 0
+        assert compare_versions('1:0.9', '2.0') > 0
+        assert compare_versions('1.0~rc1', '1.0') < 0
+        assert compare_versions('1.0a', '1.0') > 0
+        assert compare_versions('1.10', '1.9') > 0
+        assert compare_versions('1.0+b1', '1.0.1') < 0
+        assert compare_versions('2.30-1ubuntu1', '2.30-1') > 0
+        assert compare_versions('a', '1') > 0
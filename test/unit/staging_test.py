@@ -0,0 +1,96 @@
+import os
+import logging
+from mock import patch
+
+from corbos_scm.staging import StagingDir
+
+
+class TestStagingDir:
+    def test_publish(self, tmpdir):
+        outdir = tmpdir.mkdir('obs:out')
+        outdir.join('curl.dsc').write('old')
+        outdir.join('keep').write('keep')
+        outdir.mkdir('debian').join('old').write('old')
+        with StagingDir(outdir.strpath) as staging:
+            assert os.path.dirname(staging.path) == tmpdir.strpath
+            assert os.stat(staging.path).st_mode == os.stat(outdir).st_mode
+            with open(os.sep.join([staging.path, 'curl.dsc']), 'w') as dsc:
+                dsc.write('new')
+            os.makedirs(os.sep.join([staging.path, 'debian']))
+            inode = os.stat(os.sep.join([staging.path, 'curl.dsc'])).st_ino
+            assert outdir.join('curl.dsc').read() == 'old'
+            assert staging.publish() == ['curl.dsc', 'debian']
+        assert outdir.join('curl.dsc').read() == 'new'
+        # renamed, not copied
+        assert outdir.join('curl.dsc').stat().ino == inode
+        assert outdir.join('keep').read() == 'keep'
+        assert not outdir.join('debian').listdir()
+        assert sorted(tmpdir.listdir()) == [outdir]
+
+    def test_publish_replaces_previous(self, tmpdir):
+        outdir = tmpdir.mkdir('out')
+        outdir.join('curl_1.0.dsc').write('old')
+        outdir.join('curl_1.0.tar.xz').write('old')
+        outdir.join('curl_1.0.orig.tar.gz').write('orig')
+        outdir.mkdir('debian')
+        outdir.join('_service').write('keep')
+        tmpdir.join('outside').write('keep')
+        with StagingDir(outdir.strpath) as staging:
+            for name in ('curl_2.0.dsc', 'curl_1.0.orig.tar.gz'):
+                with open(os.sep.join([staging.path, name]), 'w') as new:
+                    new.write('new')
+            assert staging.publish(
+                [
+                    'curl_1.0.dsc', 'curl_1.0.tar.xz',
+                    'curl_1.0.orig.tar.gz', 'debian', 'gone',
+                    '../outside', '..', ''
+                ]
+            ) == ['curl_1.0.orig.tar.gz', 'curl_2.0.dsc']
+        assert sorted(name.basename for name in outdir.listdir()) == [
+            '_service', 'curl_1.0.orig.tar.gz', 'curl_2.0.dsc'
+        ]
+        assert outdir.join('curl_1.0.orig.tar.gz').read() == 'new'
+        assert tmpdir.join('outside').read() == 'keep'
+
+    def test_cleanup_unpublished(self, tmpdir):
+        outdir = tmpdir.mkdir('out')
+        with StagingDir(outdir.strpath) as staging:
+            with open(os.sep.join([staging.path, 'partial']), 'w') as partial:
+                partial.write('partial')
+        assert not outdir.listdir()
+        assert tmpdir.listdir() == [outdir]
+
+    def test_partial_kept_and_resumed(self, tmpdir):
+        outdir = tmpdir.mkdir('out')
+        partial_dir = tmpdir.join('cache', 'partial').strpath
+        with StagingDir(outdir.strpath, partial_dir) as staging:
+            # nothing to resume yet
+            staging.resume()
+            for name in ('curl.tar.xz.part', 'curl.dsc'):
+                with open(os.sep.join([staging.path, name]), 'w') as data:
+                    data.write('cu')
+        assert os.listdir(partial_dir) == ['curl.tar.xz.part']
+        assert not outdir.listdir()
+
+        with StagingDir(outdir.strpath, partial_dir) as staging:
+            staging.resume()
+            assert os.listdir(staging.path) == ['curl.tar.xz.part']
+            assert not os.listdir(partial_dir)
+            with open(os.sep.join([staging.path, 'curl.dsc']), 'w') as dsc:
+                dsc.write('dsc')
+            # the resumed file was not needed, it is not published
+            assert staging.get_names() == ['curl.dsc']
+            assert staging.publish() == ['curl.dsc']
+        assert not os.listdir(partial_dir)
+        assert os.listdir(outdir.strpath) == ['curl.dsc']
+
+    def test_partial_not_kept(self, tmpdir, caplog):
+        outdir = tmpdir.mkdir('out')
+        with patch('os.makedirs', side_effect=OSError('read-only')):
+            with caplog.at_level(logging.WARNING):
+                with StagingDir(
+                    outdir.strpath, tmpdir.join('partial').strpath
+                ) as staging:
+                    path = staging.path
+        assert 'Failed to keep partial downloads' in caplog.text
+        assert not os.path.exists(path)
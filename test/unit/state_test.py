@@ -0,0 +1,163 @@
+import json
+import hashlib
+import logging
+from mock import patch
+from pytest import (
+    fixture, raises
+)
+
+from corbos_scm.sources import (
+    source_package_type, source_file_type
+)
+from corbos_scm.state import (
+    OutdirState, get_dsc_file
+)
+from corbos_scm.exceptions import CSCMStateError
+
+DSC = b'''Format: 3.0 (quilt)
+Source: curl
+Version: 7.74.0-1.3
+Checksums-Sha256:
+ aaaa 10 curl_7.74.0.orig.tar.gz
+'''
+
+
+class TestOutdirState:
+    @fixture(autouse=True)
+    def inject_fixtures(self, caplog):
+        self._caplog = caplog
+
+    def setup_method(self):
+        self.source = source_package_type(
+            package='curl', version='7.74.0-1.3', directory='', files=[
+                source_file_type(
+                    'curl_7.74.0.orig.tar.gz', 10, 'aaaa'
+                ),
+                source_file_type(
+                    'curl_7.74.0-1.3.dsc', len(DSC),
+                    hashlib.sha256(DSC).hexdigest()
+                )
+            ], binaries=['curl']
+        )
+
+    def test_write_and_is_current(self, tmpdir):
+        tmpdir.join('curl_7.74.0-1.3.dsc').write_binary(DSC)
+        tmpdir.join('curl_7.74.0-1.2.dsc').write_binary(
+            DSC.replace(b'1.3', b'1.2')
+        )
+        state = OutdirState(tmpdir.strpath)
+        assert not state.exists()
+        assert state.get_files() == []
+        assert not state.is_current(self.source)
+        state.write(
+            'libcurl4', ['curl_7.74.0-1.3.dsc', 'curl_7.74.0.orig.tar.gz']
+        )
+        assert state.exists()
+        assert json.loads(tmpdir.join('.corbos_scm.json').read()) == {
+            'package': 'libcurl4',
+            'source': 'curl',
+            'version': '7.74.0-1.3',
+            'dsc': 'curl_7.74.0-1.3.dsc',
+            'dsc_sha256': hashlib.sha256(DSC).hexdigest(),
+            'files': ['curl_7.74.0-1.3.dsc', 'curl_7.74.0.orig.tar.gz']
+        }
+        assert state.get_files() == [
+            'curl_7.74.0-1.3.dsc', 'curl_7.74.0.orig.tar.gz'
+        ]
+        with self._caplog.at_level(logging.INFO):
+            assert state.is_current(self.source)
+        assert 'curl 7.74.0-1.3 is unchanged' in self._caplog.text
+
+        # new upload
+        assert not state.is_current(
+            self.source._replace(version='7.74.0-1.4')
+        )
+
+        # modified .dsc in outdir
+        tmpdir.join('curl_7.74.0-1.3.dsc').write('modified')
+        assert not state.is_current(self.source)
+        tmpdir.join('curl_7.74.0-1.3.dsc').remove()
+        assert not state.is_current(self.source)
+
+    def test_is_current_no_source(self, tmpdir):
+        state = OutdirState(tmpdir.strpath)
+        assert not state.is_current(None)
+        assert not state.is_current(self.source._replace(files=[]))
+
+    def test_read_invalid(self, tmpdir):
+        state = OutdirState(tmpdir.strpath)
+        assert state.read() == {}
+        tmpdir.join('.corbos_scm.json').write('[]')
+        assert state.read() == {}
+        tmpdir.join('.corbos_scm.json').write('{')
+        assert state.read() == {}
+
+    def test_write_published_only(self, tmpdir):
+        # a newer .dsc of another fetch is not recorded
+        tmpdir.join('curl_7.74.0-1.3.dsc').write_binary(DSC)
+        tmpdir.join('curl_7.74.0-1.4.dsc').write_binary(
+            DSC.replace(b'1.3', b'1.4')
+        )
+        state = OutdirState(tmpdir.strpath)
+        state.write('curl', ['curl_7.74.0-1.3.dsc'])
+        assert state.read()['version'] == '7.74.0-1.3'
+
+        # the requested version among the published ones
+        state.write(
+            'curl', ['curl_7.74.0-1.3.dsc', 'curl_7.74.0-1.4.dsc'],
+            '7.74.0-1.3'
+        )
+        assert state.read()['dsc'] == 'curl_7.74.0-1.3.dsc'
+
+    def test_get_files_invalid(self, tmpdir):
+        state = OutdirState(tmpdir.strpath)
+        tmpdir.join('.corbos_scm.json').write('{"files": "curl.dsc"}')
+        assert state.get_files() == []
+        tmpdir.join('.corbos_scm.json').write('{"files": ["curl.dsc", 1]}')
+        assert state.get_files() == ['curl.dsc']
+
+    def test_publish_interrupted(self, tmpdir):
+        tmpdir.join('curl_7.74.0-1.3.dsc').write_binary(DSC)
+        state = OutdirState(tmpdir.strpath)
+        state.write(
+            'curl', ['curl_7.74.0-1.3.dsc', 'curl_7.74.0.orig.tar.gz']
+        )
+        state.begin_publish(['curl_7.74.0-1.4.dsc', 'curl_7.74.0.orig.tar.gz'])
+        # the previous record is kept until the publish completed
+        assert state.read()['version'] == '7.74.0-1.3'
+        assert state.get_files() == [
+            'curl_7.74.0-1.3.dsc', 'curl_7.74.0.orig.tar.gz',
+            'curl_7.74.0-1.4.dsc'
+        ]
+        with self._caplog.at_level(logging.WARNING):
+            assert not state.is_current(self.source)
+        assert 'is incomplete, fetching again' in self._caplog.text
+
+        state.write('curl', ['curl_7.74.0-1.3.dsc'])
+        assert 'publishing' not in state.read()
+        assert state.get_files() == ['curl_7.74.0-1.3.dsc']
+        assert state.is_current(self.source)
+
+    def test_write_no_dsc(self, tmpdir):
+        tmpdir.join('curl_7.74.0-1.3.dsc').write_binary(DSC)
+        state = OutdirState(tmpdir.strpath)
+        with self._caplog.at_level(logging.WARNING):
+            state.write('curl', ['curl_7.74.0.orig.tar.gz'])
+        assert not state.exists()
+        assert 'state not recorded' in self._caplog.text
+
+    def test_write_failed(self, tmpdir):
+        tmpdir.join('curl_7.74.0-1.3.dsc').write_binary(DSC)
+        with patch('os.replace', side_effect=OSError('read-only')):
+            with raises(CSCMStateError):
+                OutdirState(tmpdir.strpath).write(
+                    'curl', ['curl_7.74.0-1.3.dsc']
+                )
+
+    def test_begin_publish_failed(self, tmpdir):
+        with patch('os.replace', side_effect=OSError('read-only')):
+            with raises(CSCMStateError):
+                OutdirState(tmpdir.strpath).begin_publish(['curl.dsc'])
+
+    def test_get_dsc_file(self):
+        assert get_dsc_file(self.source).name == 'curl_7.74.0-1.3.dsc'
@@ -0,0 +1,65 @@
+from dateutil import tz
+import os
+import importlib.util
+
+spec = importlib.util.spec_from_file_location(
+    'update_changelog', os.path.join(
+        os.path.dirname(__file__), '..', '..', 'helper', 'update_changelog.py'
+    )
+)
+update_changelog = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(update_changelog)
+
+
+def git_log(*commits):
+    lines = []
+    for commit, date, subject in commits:
+        lines += [
+            f'commit {commit}\n',
+            'Author:     Marcus <ms@example.com>\n',
+            f'AuthorDate: {date}\n',
+            'Commit:     Marcus <ms@example.com>\n',
+            f'CommitDate: {date}\n',
+            '\n',
+            f'    {subject}\n',
+            '\n'
+        ]
+    return [line.encode() for line in lines[:-1]]
+
+
+class TestChangelogWriter:
+    def test_latest_author_date_first(self, capsys):
+        # a rebased commit keeps its older author date
+        log = git_log(
+            ('c3', 'Sat Dec 18 12:00:00 2021 +0100', 'Third'),
+            ('c1', 'Sat Dec 18 10:00:00 2021 +0100', 'Rebased'),
+            ('c2', 'Sat Dec 18 11:00:00 2021 +0100', 'Second'),
+            ('c4', 'Sat Dec 18 11:00:00 2021 +0100', 'Same date')
+        )
+        update_changelog.ChangelogWriter(tz.UTC).write(log)
+        subjects = [
+            line for line in capsys.readouterr().out.splitlines()
+            if line.startswith('- ')
+        ]
+        assert subjects == [
+            '- Third', '- Second', '- Same date', '- Rebased'
+        ]
+
+    def test_skipped_past_reference(self, capsys):
+        log = git_log(
+            ('c1', 'Sat Dec 18 10:00:00 2021 +0100', 'Old'),
+            ('c3', 'Sat Dec 18 12:00:00 2021 +0100', 'New'),
+            ('c2', 'Sat Dec 18 11:00:00 2021 +0100', 'Reference')
+        )
+        update_changelog.ChangelogWriter(
+            tz.UTC, date_reference=update_changelog.parse_date(
+                'Sat Dec 18 11:00:00 2021 +0100'
+            )
+        ).write(log)
+        output = capsys.readouterr()
+        assert '- New' in output.out
+        assert '- Reference' not in output.out
+        assert '- Old' not in output.out
+        assert '+ Skipped: 2021-12-18 11:00:00+01:00' in output.err
+        assert '+ Skipped: 2021-12-18 10:00:00+01:00' in output.err
+        assert output.err.count('Skipped') == 2